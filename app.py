@@ -5,20 +5,47 @@ import os
 import io
 import base64
 import csv
-from flask import Flask, request, render_template, send_file, redirect, url_for, flash, session, jsonify
+import json
+import shutil
+import hashlib
+import mmap
+import itertools
+import heapq
+import click
+from flask import Flask, request, render_template, send_file, redirect, url_for, flash, session, jsonify, g, has_request_context, Response, stream_with_context
 import matplotlib.pyplot as plt
+import matplotlib.colors as mcolors
 import contextily as cx
-from shapely.geometry import Point, Polygon, MultiPoint
+import shapely
+from shapely.geometry import Point, Polygon, MultiPoint, mapping, shape
 from pyproj import Transformer, CRS
 import numpy as np
 import datetime
 import calendar
 import locale
-from functools import wraps # Importar wraps para el decorador
+import sys
+import threading
+import time
+import warnings
+import tracemalloc
+import math
+import select
+import socket
+import ssl
+import re
+import unicodedata
+from collections import OrderedDict, namedtuple, Counter
+from functools import wraps, cached_property # Importar wraps para el decorador
 
 # IMPORTACIONES CLAVE PARA POSTGRESQL
 import psycopg2
+import psycopg2.pool
+import psycopg2.errors
+import psycopg2.extensions
+import psycopg2.extras
 from urllib.parse import urlparse
+from markupsafe import Markup, escape
+from itsdangerous import URLSafeSerializer, BadSignature
 
 # Importar para manejar documentos Word
 from docx import Document
@@ -32,29 +59,1394 @@ from werkzeug.security import generate_password_hash, check_password_hash
 
 # 2. --- CONFIGURACIÓN DE LA BASE DE DATOS Y FUNCIONES DE CONEXIÓN/INICIALIZACIÓN ---
 DATABASE_URL = os.environ.get('DATABASE_URL')
+# Réplica opcional para reportes, exportaciones y tablero. Sus lecturas se aceptan mientras el retraso de
+# replicación no supere REPLICA_MAX_RETRASO_SEGUNDOS (verificado cada REPLICA_INTERVALO_VERIFICACION s).
+DATABASE_REPLICA_URL = os.environ.get('DATABASE_REPLICA_URL')
+REPLICA_MAX_RETRASO_SEGUNDOS = float(os.environ.get('REPLICA_MAX_RETRASO_SEGUNDOS', '30'))
+REPLICA_INTERVALO_VERIFICACION = float(os.environ.get('REPLICA_INTERVALO_VERIFICACION', '5'))
+# 'require' para Supabase/Neon; 'disable' o 'prefer' para probar con instancias locales
+DB_SSLMODE = os.environ.get('DB_SSLMODE', 'require')
+# ThreadedConnectionPool cierra las conexiones devueltas cuando ya hay DB_POOL_MIN libres, y con ellas
+# sus sentencias preparadas: solo las DB_POOL_MIN conexiones que permanecen abiertas las conservan.
+# Por eso el mínimo debe cubrir la concurrencia esperada por proceso (hilos de gunicorn + hilos de fondo).
+DB_POOL_MAX = int(os.environ.get('DB_POOL_MAX', '20'))
+DB_POOL_MIN = min(int(os.environ.get('DB_POOL_MIN', '4')), DB_POOL_MAX)
+# Las sentencias preparadas viven en la sesión del servidor; detrás de un PgBouncer en modo
+# 'transaction' (p. ej. el pooler de Supabase/Neon) deben desactivarse con DB_USAR_PREPARADAS=0.
+DB_USAR_PREPARADAS = os.environ.get('DB_USAR_PREPARADAS', '1') == '1'
+# Timeout de conexión (segundos) y circuito: fallos consecutivos para abrirlo y segundos entre sondas
+DB_CONNECT_TIMEOUT = int(os.environ.get('DB_CONNECT_TIMEOUT', '5'))
+DB_CIRCUITO_FALLOS = int(os.environ.get('DB_CIRCUITO_FALLOS', '3'))
+DB_CIRCUITO_ENFRIAMIENTO = int(os.environ.get('DB_CIRCUITO_ENFRIAMIENTO', '30'))
+# Tiempo máximo por sentencia (ms, 0 = sin límite) según la clase de la ruta. Las rutas de reporte lo
+# declaran con @clase_consulta('reporte'); fuera de una petición (CLI, inicialización) no se aplica.
+TIMEOUTS_CONSULTA_MS = {
+    'interactivo': int(os.environ.get('DB_TIMEOUT_INTERACTIVO_MS', '8000')),
+    'reporte': int(os.environ.get('DB_TIMEOUT_REPORTE_MS', '120000')),
+}
+# Clases de ruta en las que se vigila si el cliente cerró la conexión para cancelar la consulta en curso
+CLASES_VIGILAR_DESCONEXION = {'reporte'}
+INTERVALO_VIGILANCIA_SEGUNDOS = 0.5
+# Búsqueda de texto completo en las notas: configuración de PostgreSQL y máximo de resultados
+CONFIG_TEXTO_NOTAS = 'spanish'
+BUSQUEDA_NOTAS_LIMITE = int(os.environ.get('BUSQUEDA_NOTAS_LIMITE', '200'))
+# Búsqueda por similitud de nombres (pg_trgm): umbral de word_similarity (0-1, más alto = más estricto),
+# máximo de resultados y tiempo máximo de la consulta para acotar la latencia en tablas grandes.
+BUSQUEDA_SIMILITUD_UMBRAL = float(os.environ.get('BUSQUEDA_SIMILITUD_UMBRAL', '0.5'))
+BUSQUEDA_SIMILITUD_LIMITE = int(os.environ.get('BUSQUEDA_SIMILITUD_LIMITE', '200'))
+BUSQUEDA_SIMILITUD_TIMEOUT_MS = int(os.environ.get('BUSQUEDA_SIMILITUD_TIMEOUT_MS', '3000'))
+# Números romanos que se reescriben como dígitos al normalizar nombres ("Gaviota II" = "GAVIOTA 2").
+# I, V y X sueltas solo se convierten al final del nombre, donde casi siempre son numerales.
+ROMANOS_NOMBRE = (('viii', '8'), ('vii', '7'), ('iii', '3'), ('ii', '2'), ('iv', '4'), ('vi', '6'), ('ix', '9'))
+ROMANOS_FINALES_NOMBRE = (('i', '1'), ('v', '5'), ('x', '10'))
+# Valores de 'nombre_patron' que no identifican a nadie (ya normalizados) y no entran al índice de patrones
+PATRONES_SIN_NOMBRE = {'n a', 'na', 'sin patron', 'desconocido', 'no identificado', 'sin dato'}
+# Exportación incremental (/api/delta_csv): filas por lote del cursor de servidor y días que se
+# conservan las marcas de borrado (un cursor más antiguo obliga a sincronizar de nuevo desde cero)
+DELTA_LOTE_FILAS = int(os.environ.get('DELTA_LOTE_FILAS', '2000'))
+DELTA_RETENCION_LAPIDAS_DIAS = int(os.environ.get('DELTA_RETENCION_LAPIDAS_DIAS', '90'))
+# Exportaciones GeoJSON/KML: filas por lote del cursor de servidor
+EXPORTACION_LOTE_FILAS = int(os.environ.get('EXPORTACION_LOTE_FILAS', '2000'))
+# Mapa interactivo (/api/mapa_observaciones): desde este zoom se envían observaciones individuales (hasta
+# MAPA_MAX_PUNTOS por vista); por debajo, o si hay más puntos, se agregan en una rejilla de
+# MAPA_CELDAS_POR_TESELA celdas por lado de cada tesela. Las geometrías del ANP se simplifican con
+# ANP_TOLERANCIA_SIMPLIFICACION grados (~50 m) y se sirven una sola vez con caché del navegador.
+MAPA_ZOOM_DETALLE = int(os.environ.get('MAPA_ZOOM_DETALLE', '11'))
+MAPA_MAX_PUNTOS = int(os.environ.get('MAPA_MAX_PUNTOS', '5000'))
+MAPA_CELDAS_POR_TESELA = int(os.environ.get('MAPA_CELDAS_POR_TESELA', '8'))
+ANP_TOLERANCIA_SIMPLIFICACION = float(os.environ.get('ANP_TOLERANCIA_SIMPLIFICACION', '0.0005'))
+# Reportes por zona personalizada: máximo de vértices de un polígono dibujado o subido como GeoJSON
+ZONA_MAX_VERTICES = int(os.environ.get('ZONA_MAX_VERTICES', '20000'))
+# Zonas registradas (otras áreas protegidas, zonas núcleo, de amortiguamiento, turísticas): archivos GeoJSON
+# en ZONAS_DIR que se cargan al iniciar; el polígono marítimo del ANP siempre se registra como zona 'anp'
+ZONAS_DIR = os.environ.get('ZONAS_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'zonas'))
+# Reclasificación masiva ('flask reclasificar'): filas por lote (cada lote es una transacción corta) y
+# espera máxima por el candado de una fila que la aplicación esté editando antes de reintentar el lote
+RECLASIFICACION_LOTE_FILAS = int(os.environ.get('RECLASIFICACION_LOTE_FILAS', '5000'))
+RECLASIFICACION_LOCK_TIMEOUT_MS = int(os.environ.get('RECLASIFICACION_LOCK_TIMEOUT_MS', '2000'))
+# 'observaciones_embarcaciones' está particionada por año de 'timestamp'. Las particiones de los próximos
+# años se crean de antemano (al iniciar y con 'flask mantener-particiones'); lo demás cae en la de por defecto.
+PARTICIONES_ANIOS_FUTUROS = int(os.environ.get('PARTICIONES_ANIOS_FUTUROS', '2'))
+
+class ConsultaCancelada(Exception):
+    """
+    Una consulta se canceló por 'statement_timeout' (motivo 'timeout') o porque el cliente cerró
+    la conexión (motivo 'desconexion'). No es un psycopg2.Error: atraviesa los 'except psycopg2.Error'
+    de las funciones auxiliares y llega al manejador de errores de Flask.
+    """
+    def __init__(self, motivo, detalle=''):
+        super().__init__(detalle or motivo)
+        self.motivo = motivo
+
+def _timeout_consulta_ms():
+    if not has_request_context():
+        return None
+    return TIMEOUTS_CONSULTA_MS.get(g.get('clase_consulta', 'interactivo'))
+
+def _socket_cliente():
+    if not has_request_context():
+        return None
+    return request.environ.get('gunicorn.socket') or request.environ.get('werkzeug.socket')
+
+def cliente_desconectado(sock=None):
+    """
+    True si el cliente HTTP ya cerró su conexión (el socket es legible pero no hay datos).
+    Con sockets TLS no se puede mirar sin consumir datos y se asume conectado.
+    """
+    sock = sock or _socket_cliente()
+    if sock is None or isinstance(sock, ssl.SSLSocket):
+        return False
+    try:
+        legibles, _, _ = select.select([sock], [], [], 0)
+        return bool(legibles) and sock.recv(1, socket.MSG_PEEK) == b''
+    except OSError:
+        return True
+    except ValueError:
+        return False
+
+def comprobar_cliente_conectado():
+    """Evita seguir trabajando (mapas, documentos) para un cliente que ya se fue."""
+    if cliente_desconectado():
+        raise ConsultaCancelada('desconexion', 'El cliente cerró la conexión.')
+
+class _VigilanciaDesconexion:
+    """
+    Hilo único por petición vigilada: mientras la ruta se ejecuta, comprueba si el cliente se desconectó
+    y, si es así, cancela la sentencia en curso. CursorConLimites.execute solo registra la conexión activa.
+    """
+    def __init__(self, sock):
+        self.cancelada = False
+        self._detener = threading.Event()
+        self._lock = threading.Lock()
+        self._conn_activa = None
+        threading.Thread(target=self._vigilar, args=(sock,), name='vigilancia-cliente', daemon=True).start()
+
+    def _vigilar(self, sock):
+        while not self._detener.wait(INTERVALO_VIGILANCIA_SEGUNDOS):
+            if cliente_desconectado(sock):
+                with self._lock:
+                    self.cancelada = True
+                    if self._conn_activa is not None:
+                        try:
+                            self._conn_activa.cancel()
+                        except psycopg2.Error:
+                            pass
+                return
+
+    def registrar(self, conn):
+        """Marca 'conn' como la conexión con una sentencia en curso (None al terminar)."""
+        with self._lock:
+            self._conn_activa = conn
+
+    def detener(self):
+        self._detener.set()
+
+class CursorConLimites(psycopg2.extensions.cursor):
+    """
+    Cursor de las conexiones del pool: al iniciar cada transacción dentro de una petición fija
+    'SET LOCAL statement_timeout' según la clase de la ruta; en las rutas vigiladas registra la sentencia
+    en curso en la vigilancia de la petición, que la cancela si el cliente se desconecta. Las
+    cancelaciones se convierten en ConsultaCancelada.
+    """
+    def execute(self, query, vars=None):
+        conn = self.connection
+        if not conn.autocommit and conn.get_transaction_status() == psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+            timeout_ms = _timeout_consulta_ms()
+            if timeout_ms is not None:
+                # Cursor base (sin esta lógica); también sirve para los cursores con nombre
+                with psycopg2.extensions.cursor(conn) as cursor_config:
+                    cursor_config.execute("SET LOCAL statement_timeout = %s", (timeout_ms,))
+        vigilancia = g.get('vigilancia_desconexion') if has_request_context() else None
+        if vigilancia is not None:
+            if vigilancia.cancelada:
+                raise ConsultaCancelada('desconexion', 'El cliente cerró la conexión.')
+            vigilancia.registrar(conn)
+        try:
+            return super().execute(query, vars)
+        except psycopg2.errors.QueryCanceled as e:
+            if vigilancia is not None and vigilancia.cancelada:
+                raise ConsultaCancelada('desconexion', str(e)) from e
+            raise ConsultaCancelada('timeout', str(e)) from e
+        finally:
+            if vigilancia is not None:
+                vigilancia.registrar(None)
+
+def clase_consulta(clase):
+    """
+    Decorador de ruta: clase de tiempo máximo de sus consultas ('interactivo' por defecto, 'reporte').
+    En las clases vigiladas arranca una sola vigilancia de desconexión para toda la petición.
+    """
+    def decorador(f):
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            g.clase_consulta = clase
+            sock = _socket_cliente() if clase in CLASES_VIGILAR_DESCONEXION else None
+            if sock is None:
+                return f(*args, **kwargs)
+            vigilancia = g.vigilancia_desconexion = _VigilanciaDesconexion(sock)
+            try:
+                respuesta = f(*args, **kwargs)
+            except BaseException:
+                vigilancia.detener()
+                raise
+            if isinstance(respuesta, Response) and respuesta.is_streamed:
+                # Las consultas de una respuesta en flujo se ejecutan al enviarla: se vigila hasta que termina
+                respuesta.call_on_close(vigilancia.detener)
+            else:
+                vigilancia.detener()
+            return respuesta
+        return decorated_function
+    return decorador
+
+class ConexionAgrupada(psycopg2.extensions.connection):
+    """
+    Conexión de psycopg2 que pertenece a un pool: close() la devuelve al pool en lugar de cerrarla,
+    de modo que las funciones existentes (que siempre llaman conn.close()) la reutilizan sin cambios.
+    Recuerda qué sentencias preparadas ya existen en su sesión del servidor.
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.pool_origen = None
+        self.sentencias_preparadas = set()
+        self.interruptor = None
+        self.cursor_factory = CursorConLimites
+
+    def close(self):
+        pool, self.pool_origen = self.pool_origen, None
+        if pool is None or self.closed:
+            return super().close()
+        try:
+            if self.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                self.rollback()
+            pool.putconn(self)
+            if self.interruptor is not None:
+                self.interruptor.registrar_exito()
+        except Exception as e:
+            # Conexión rota: el pool la descarta (putconn vuelve a llamar close(), que ya la cierra de verdad)
+            # y cuenta como fallo para el interruptor de circuito de su base de datos
+            pool.putconn(self, close=True)
+            if self.interruptor is not None:
+                self.interruptor.registrar_fallo(e)
+
+class InterruptorCircuitoDB:
+    """
+    Interruptor de circuito para el acceso a PostgreSQL. Tras 'umbral_fallos' fallos consecutivos se abre:
+    conectar_db() devuelve None al instante (sin esperar el timeout de conexión) y un hilo en segundo
+    plano prueba la base de datos cada 'enfriamiento' segundos hasta que responde y lo vuelve a cerrar.
+    Mientras está abierto, las lecturas con caché sirven el último resultado aunque haya vencido.
+    """
+    def __init__(self, umbral_fallos, enfriamiento_segundos, nombre='base de datos', url=None):
+        self.nombre = nombre
+        self.url = url
+        self.umbral_fallos = umbral_fallos
+        self.enfriamiento_segundos = enfriamiento_segundos
+        self._lock = threading.Lock()
+        self.fallos_consecutivos = 0
+        self.abierto_desde = None
+        self.ultimo_error = None
+        self.aperturas = 0
+        self.rechazadas = 0
+        self._sonda = None
+
+    @property
+    def abierto(self):
+        return self.abierto_desde is not None
+
+    def permitir(self):
+        if self.abierto_desde is None:
+            return True
+        with self._lock:
+            self.rechazadas += 1
+        return False
+
+    def registrar_exito(self):
+        if self.fallos_consecutivos:
+            with self._lock:
+                self.fallos_consecutivos = 0
+
+    def registrar_fallo(self, error):
+        with self._lock:
+            self.fallos_consecutivos += 1
+            self.ultimo_error = str(error).strip()
+            if self.abierto_desde is not None or self.fallos_consecutivos < self.umbral_fallos:
+                return
+            self.abierto_desde = time.time()
+            self.aperturas += 1
+            print(f"ADVERTENCIA: Circuito de {self.nombre} ABIERTO tras {self.fallos_consecutivos} fallos: {self.ultimo_error}")
+            if self._sonda is None or not self._sonda.is_alive():
+                self._sonda = threading.Thread(target=self._probar_hasta_recuperar, name='sonda-db', daemon=True)
+                self._sonda.start()
+
+    def _probar_hasta_recuperar(self):
+        while True:
+            time.sleep(self.enfriamiento_segundos)
+            try:
+                # Conexión directa (fuera del pool) con el mismo timeout corto
+                conn = psycopg2.connect(self.url, connect_timeout=DB_CONNECT_TIMEOUT, sslmode=DB_SSLMODE)
+                try:
+                    with conn.cursor() as cursor:
+                        cursor.execute("SELECT 1;")
+                finally:
+                    conn.close()
+            except Exception as e:
+                with self._lock:
+                    self.ultimo_error = str(e).strip()
+                print(f"Sonda de {self.nombre}: sigue sin responder ({self.ultimo_error}).")
+                continue
+            with self._lock:
+                segundos = time.time() - self.abierto_desde
+                self.abierto_desde = None
+                self.fallos_consecutivos = 0
+            print(f"Circuito de {self.nombre} CERRADO: responde de nuevo (tras {segundos:.0f} s).")
+            return
+
+    def estado(self):
+        with self._lock:
+            return {
+                'abierto': self.abierto_desde is not None,
+                'abierto_desde': datetime.datetime.fromtimestamp(self.abierto_desde).isoformat() if self.abierto_desde else None,
+                'fallos_consecutivos': self.fallos_consecutivos,
+                'aperturas': self.aperturas,
+                'rechazadas': self.rechazadas,
+                'ultimo_error': self.ultimo_error,
+            }
+
+interruptor_db = InterruptorCircuitoDB(DB_CIRCUITO_FALLOS, DB_CIRCUITO_ENFRIAMIENTO, 'base de datos', DATABASE_URL)
+# Ante el primer fallo de la réplica se pasa a leer de la primaria hasta que la sonda la vea de nuevo
+interruptor_replica = InterruptorCircuitoDB(1, DB_CIRCUITO_ENFRIAMIENTO, 'réplica de lectura', DATABASE_REPLICA_URL)
+
+_pools_db = {}
+_pools_db_pid = None
+_pool_db_lock = threading.Lock()
+
+def _obtener_pool(destino='primaria'):
+    """
+    Crea el pool de conexiones ('primaria' o 'replica') de forma perezosa y una vez por proceso
+    (los workers de gunicorn no deben compartir los sockets heredados del proceso maestro).
+    """
+    global _pools_db_pid
+    with _pool_db_lock:
+        if _pools_db_pid != os.getpid():
+            _pools_db.clear()
+            _pools_db_pid = os.getpid()
+        pool = _pools_db.get(destino)
+        if pool is None:
+            url = urlparse(DATABASE_URL if destino == 'primaria' else DATABASE_REPLICA_URL)
+            opciones = {}
+            if destino == 'replica':
+                # Las sesiones de la réplica nunca escriben (también al probar con dos instancias independientes)
+                opciones['options'] = '-c default_transaction_read_only=on'
+            pool = _pools_db[destino] = psycopg2.pool.ThreadedConnectionPool(
+                DB_POOL_MIN, DB_POOL_MAX,
+                connection_factory=ConexionAgrupada,
+                database=url.path[1:],
+                user=url.username,
+                password=url.password,
+                host=url.hostname,
+                port=url.port,
+                sslmode=DB_SSLMODE, # Supabase/Neon requieren SSL. Esto es importante.
+                connect_timeout=DB_CONNECT_TIMEOUT,
+                **opciones
+            )
+        return pool
+
+def _conectar_pool(destino, interruptor):
+    if not interruptor.permitir():
+        return None # Circuito abierto: falla de inmediato
+    try:
+        pool = _obtener_pool(destino)
+        conn = pool.getconn()
+        if conn.closed:
+            pool.putconn(conn, close=True)
+            conn = pool.getconn()
+        conn.pool_origen = pool
+        conn.interruptor = interruptor
+        return conn
+    except Exception as e:
+        print(f"ERROR: No se pudo conectar a la {interruptor.nombre} PostgreSQL: {e}")
+        interruptor.registrar_fallo(e)
+        return None
 
 def conectar_db():
     """
-    Establece una conexión a la base de datos PostgreSQL usando la URL de entorno.
+    Obtiene una conexión a la base de datos PostgreSQL (primaria) desde el pool del proceso.
+    La conexión se devuelve al pool al llamar conn.close().
     """
     if not DATABASE_URL:
         print("ERROR: DATABASE_URL no está configurada en el entorno.")
         return None
-    
+    return _conectar_pool('primaria', interruptor_db)
+
+# Momento de la última escritura confirmada en este proceso (ver _registrar_momento_escritura)
+_ultima_escritura_proceso = 0.0
+_estado_replica = {'verificado': 0.0, 'retraso': None}
+_estado_replica_lock = threading.Lock()
+
+def _leer_de_primaria():
+    """
+    Lectura de lo propio: durante REPLICA_MAX_RETRASO_SEGUNDOS tras una escritura de esta sesión o de este
+    proceso se lee de la primaria. Pasado ese margen la réplica (con retraso dentro del límite) ya la tiene,
+    y la caché de este proceso no se llena con resultados anteriores a la escritura.
+    """
+    margen = REPLICA_MAX_RETRASO_SEGUNDOS
+    ahora = time.time()
+    if ahora - _ultima_escritura_proceso < margen:
+        return True
+    return has_request_context() and ahora - session.get('ultima_escritura_db', 0) < margen
+
+def _consultar_retraso_replica(conn):
+    """Segundos de retraso de la réplica (0 si está al día o si no es un servidor en recuperación)."""
+    with psycopg2.extensions.cursor(conn) as cursor:
+        cursor.execute("""
+            SELECT CASE
+                WHEN NOT pg_is_in_recovery() THEN 0::float8
+                WHEN pg_last_wal_receive_lsn() IS NOT DISTINCT FROM pg_last_wal_replay_lsn() THEN 0::float8
+                ELSE coalesce(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp())::float8, 'Infinity'::float8)
+            END;
+        """)
+        retraso = cursor.fetchone()[0]
+    conn.rollback() # La consulta siguiente empieza su propia transacción (y su statement_timeout)
+    return retraso
+
+def _retraso_replica_aceptable(conn):
+    with _estado_replica_lock:
+        vigente = time.monotonic() - _estado_replica['verificado'] < REPLICA_INTERVALO_VERIFICACION
+        retraso = _estado_replica['retraso']
+    if not vigente:
+        try:
+            retraso = _consultar_retraso_replica(conn)
+        except psycopg2.Error as e:
+            interruptor_replica.registrar_fallo(e)
+            return False
+        with _estado_replica_lock:
+            _estado_replica['verificado'] = time.monotonic()
+            _estado_replica['retraso'] = retraso
+        if retraso > REPLICA_MAX_RETRASO_SEGUNDOS:
+            print(f"ADVERTENCIA: La réplica lleva {retraso:.1f} s de retraso; se lee de la primaria.")
+    return retraso is not None and retraso <= REPLICA_MAX_RETRASO_SEGUNDOS
+
+def conectar_db_lectura():
+    """
+    Conexión para lecturas de reportes, exportaciones y tablero: la réplica (DATABASE_REPLICA_URL) si está
+    configurada, responde y su retraso está dentro del límite; en cualquier otro caso, la primaria.
+    """
+    if DATABASE_REPLICA_URL and not _leer_de_primaria():
+        conn = _conectar_pool('replica', interruptor_replica)
+        if conn is not None:
+            if _retraso_replica_aceptable(conn):
+                return conn
+            conn.close()
+    return conectar_db()
+
+def estado_replica():
+    with _estado_replica_lock:
+        retraso = _estado_replica['retraso']
+    return {
+        'configurada': bool(DATABASE_REPLICA_URL),
+        'retraso_segundos': retraso,
+        'max_retraso_segundos': REPLICA_MAX_RETRASO_SEGUNDOS,
+        'circuito': interruptor_replica.estado(),
+    }
+
+def _a_parametros_posicionales(sql):
+    """Convierte los marcadores %s de psycopg2 en $1, $2, ... para PREPARE."""
+    partes = sql.split('%s')
+    return ''.join(parte + (f"${i + 1}" if i < len(partes) - 1 else '') for i, parte in enumerate(partes))
+
+def _ejecutar_preparada(cursor, nombre, sql, params):
+    """
+    Ejecuta 'sql' (con marcadores %s) como sentencia preparada del servidor.
+    Se prepara una sola vez por conexión del pool; después solo se envía EXECUTE con los parámetros.
+    Solo perdura en las DB_POOL_MIN conexiones que el pool mantiene abiertas; las que cierra al
+    devolverlas la vuelven a preparar la próxima vez.
+    """
+    conn = cursor.connection
+    if not DB_USAR_PREPARADAS or not isinstance(conn, ConexionAgrupada):
+        cursor.execute(sql, params)
+        return
+    marcadores = ', '.join(['%s'] * len(params))
+    for intento in range(2):
+        if nombre not in conn.sentencias_preparadas:
+            cursor.execute(f"PREPARE {nombre} AS {_a_parametros_posicionales(sql)}")
+            conn.sentencias_preparadas.add(nombre)
+        try:
+            cursor.execute(f"EXECUTE {nombre} ({marcadores})", params)
+            return
+        except psycopg2.errors.InvalidSqlStatementName:
+            # La sesión del servidor ya no tiene la sentencia (p. ej. tras un DISCARD ALL): se vuelve a preparar
+            conn.rollback()
+            conn.sentencias_preparadas.discard(nombre)
+            if intento:
+                raise
+
+def _sql_normalizar_nombre():
+    """
+    Cuerpo SQL de f_normalizar_nombre, equivalente a _normalizar_nombre en Python: sin acentos, en
+    minúsculas, solo letras y dígitos separados por un espacio, y números romanos como dígitos.
+    """
+    expr = "lower(unaccent('unaccent'::regdictionary, coalesce($1, '')))"
+    expr = f"btrim(regexp_replace({expr}, '[^a-z0-9]+', ' ', 'g'))"
+    for romano, digito in ROMANOS_NOMBRE:
+        expr = f"regexp_replace({expr}, '\\m{romano}\\M', '{digito}', 'g')"
+    for romano, digito in ROMANOS_FINALES_NOMBRE:
+        expr = f"regexp_replace({expr}, '\\m{romano}$', '{digito}')"
+    return f"SELECT {expr}"
+
+def _inicializar_busqueda_difusa(conn, cursor):
+    """
+    Extensiones, función de normalización e índices de trigramas para buscar_por_nombre_o_patron.
+    Si el rol no puede crear las extensiones, la búsqueda sigue funcionando con LIKE.
+    """
     try:
-        url = urlparse(DATABASE_URL)
-        conn = psycopg2.connect(
-            database=url.path[1:],
-            user=url.username,
-            password=url.password,
-            host=url.hostname,
-            port=url.port,
-            sslmode='require' # Supabase/Neon requieren SSL. Esto es importante.
+        cursor.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm;")
+        cursor.execute("CREATE EXTENSION IF NOT EXISTS unaccent;")
+        # La función debe ser IMMUTABLE para poder indexarse; se fija el search_path con el esquema
+        # donde quedó unaccent (public en PostgreSQL, 'extensions' en algunos proveedores).
+        cursor.execute("SELECT extnamespace::regnamespace::text FROM pg_extension WHERE extname = 'unaccent';")
+        esquema_unaccent = cursor.fetchone()[0]
+        cursor.execute(f"""
+        CREATE OR REPLACE FUNCTION f_normalizar_nombre(text) RETURNS text
+        LANGUAGE sql IMMUTABLE PARALLEL SAFE
+        SET search_path = {esquema_unaccent}, pg_catalog
+        AS $fn$ {_sql_normalizar_nombre()} $fn$;
+        """)
+        cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_observaciones_nombre_trgm
+        ON observaciones_embarcaciones USING GIN (f_normalizar_nombre(nombre_embarcacion) gin_trgm_ops);
+        """)
+        cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_observaciones_patron_trgm
+        ON observaciones_embarcaciones USING GIN (f_normalizar_nombre(nombre_patron) gin_trgm_ops);
+        """)
+        conn.commit()
+        print("Índices de trigramas para nombres de embarcación y patrón verificados/creados en PostgreSQL.")
+    except psycopg2.Error as e:
+        conn.rollback()
+        print(f"Advertencia: no se pudo habilitar la búsqueda por similitud (pg_trgm/unaccent): {e}")
+
+def _inicializar_registro_embarcaciones(conn, cursor):
+    """
+    Registro normalizado de embarcaciones: una fila por matrícula con sus datos vigentes, el historial
+    de nombres/tipos con los que se ha observado y 'embarcacion_id' en cada observación.
+    Las columnas de texto de las observaciones se conservan (CSV, búsquedas y reportes las siguen usando).
+    La primera ejecución migra y deduplica las observaciones existentes.
+    """
+    try:
+        cursor.execute("""
+        CREATE TABLE IF NOT EXISTS embarcaciones (
+            id SERIAL PRIMARY KEY,
+            matricula TEXT UNIQUE NOT NULL,
+            nombre_embarcacion TEXT,
+            tipo_embarcacion_id TEXT,
+            nombre_patron TEXT,
+            ultima_observacion TIMESTAMP
+        );
+        """)
+        cursor.execute("""
+        CREATE TABLE IF NOT EXISTS embarcaciones_historial (
+            id SERIAL PRIMARY KEY,
+            embarcacion_id INTEGER NOT NULL REFERENCES embarcaciones(id) ON DELETE CASCADE,
+            nombre_embarcacion TEXT NOT NULL DEFAULT '',
+            tipo_embarcacion_id TEXT NOT NULL DEFAULT '',
+            primera_observacion TIMESTAMP,
+            ultima_observacion TIMESTAMP,
+            UNIQUE (embarcacion_id, nombre_embarcacion, tipo_embarcacion_id)
+        );
+        """)
+        cursor.execute("""
+        SELECT column_name FROM information_schema.columns 
+        WHERE table_name='observaciones_embarcaciones' AND column_name='embarcacion_id';
+        """)
+        if cursor.fetchone() is None:
+            cursor.execute("ALTER TABLE observaciones_embarcaciones ADD COLUMN embarcacion_id INTEGER REFERENCES embarcaciones(id);")
+            print("Columna 'embarcacion_id' añadida a la base de datos PostgreSQL.")
+        cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_observaciones_embarcacion_ts
+        ON observaciones_embarcaciones (embarcacion_id, timestamp DESC);
+        """)
+        # Solo contiene las filas pendientes de enlazar, así la sincronización no recorre la tabla
+        cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_observaciones_sin_embarcacion
+        ON observaciones_embarcaciones (matricula) WHERE embarcacion_id IS NULL;
+        """)
+        pendientes = _sincronizar_embarcaciones(cursor)
+        conn.commit()
+        print(f"Registro de embarcaciones verificado en PostgreSQL ({pendientes} observaciones enlazadas).")
+    except psycopg2.Error as e:
+        conn.rollback()
+        print(f"Error al inicializar el registro de embarcaciones en PostgreSQL: {e}")
+
+def _sincronizar_embarcaciones(cursor, matriculas=None):
+    """
+    Da de alta/actualiza en 'embarcaciones' las matrículas de las observaciones sin 'embarcacion_id',
+    amplía su historial de nombres/tipos y las enlaza. Se ejecuta dentro de la transacción de cada
+    escritura (sin commit); 'matriculas' limita el trabajo a las afectadas.
+    Devuelve el número de observaciones enlazadas.
+    """
+    filtro = "embarcacion_id IS NULL"
+    params = ()
+    if matriculas is not None:
+        filtro += " AND matricula = ANY(%s)"
+        params = (list(matriculas),)
+    # Datos vigentes: los de la observación más reciente de cada matrícula
+    cursor.execute(f"""
+        INSERT INTO embarcaciones (matricula, nombre_embarcacion, tipo_embarcacion_id, nombre_patron, ultima_observacion)
+        SELECT DISTINCT ON (matricula) matricula, nombre_embarcacion, tipo_embarcacion_id, nombre_patron, timestamp
+        FROM observaciones_embarcaciones
+        WHERE {filtro}
+        ORDER BY matricula, timestamp DESC
+        ON CONFLICT (matricula) DO UPDATE
+        SET nombre_embarcacion = EXCLUDED.nombre_embarcacion,
+            tipo_embarcacion_id = EXCLUDED.tipo_embarcacion_id,
+            nombre_patron = EXCLUDED.nombre_patron,
+            ultima_observacion = EXCLUDED.ultima_observacion
+        WHERE embarcaciones.ultima_observacion IS NULL
+           OR EXCLUDED.ultima_observacion >= embarcaciones.ultima_observacion;
+    """, params)
+    cursor.execute(f"""
+        INSERT INTO embarcaciones_historial (embarcacion_id, nombre_embarcacion, tipo_embarcacion_id,
+                                             primera_observacion, ultima_observacion)
+        SELECT e.id, coalesce(o.nombre_embarcacion, ''), coalesce(o.tipo_embarcacion_id, ''),
+               MIN(o.timestamp), MAX(o.timestamp)
+        FROM observaciones_embarcaciones o
+        JOIN embarcaciones e ON e.matricula = o.matricula
+        WHERE o.{filtro}
+        GROUP BY e.id, coalesce(o.nombre_embarcacion, ''), coalesce(o.tipo_embarcacion_id, '')
+        ON CONFLICT (embarcacion_id, nombre_embarcacion, tipo_embarcacion_id) DO UPDATE
+        SET primera_observacion = LEAST(embarcaciones_historial.primera_observacion, EXCLUDED.primera_observacion),
+            ultima_observacion = GREATEST(embarcaciones_historial.ultima_observacion, EXCLUDED.ultima_observacion);
+    """, params)
+    cursor.execute(f"""
+        UPDATE observaciones_embarcaciones o
+        SET embarcacion_id = e.id
+        FROM embarcaciones e
+        WHERE e.matricula = o.matricula AND o.{filtro};
+    """, params)
+    return cursor.rowcount
+
+def _inicializar_resumen_embarcaciones(conn, cursor):
+    """
+    Tabla de resumen por embarcación (primera/última observación, última posición, totales y conteos
+    por estatus), mantenida en la misma transacción de cada escritura. Si está vacía se reconstruye.
+    """
+    try:
+        cursor.execute("""
+        CREATE TABLE IF NOT EXISTS resumen_embarcaciones (
+            embarcacion_id INTEGER PRIMARY KEY REFERENCES embarcaciones(id) ON DELETE CASCADE,
+            matricula TEXT NOT NULL,
+            primera_observacion TIMESTAMP,
+            ultima_observacion TIMESTAMP,
+            ultima_observacion_id INTEGER,
+            ultima_latitud DOUBLE PRECISION,
+            ultima_longitud DOUBLE PRECISION,
+            ultimo_estatus_id TEXT,
+            total_observaciones INTEGER NOT NULL DEFAULT 0,
+            total_infracciones INTEGER NOT NULL DEFAULT 0,
+            ultima_infraccion TIMESTAMP,
+            conteos_estatus JSONB NOT NULL DEFAULT '{}'::jsonb
+        );
+        """)
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_resumen_total ON resumen_embarcaciones (total_observaciones DESC);")
+        cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_resumen_infracciones
+        ON resumen_embarcaciones (total_infracciones DESC) WHERE total_infracciones > 0;
+        """)
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_resumen_ultima ON resumen_embarcaciones (ultima_observacion DESC);")
+        cursor.execute("SELECT EXISTS (SELECT 1 FROM resumen_embarcaciones);")
+        if not cursor.fetchone()[0]:
+            _recalcular_resumen_embarcaciones(cursor)
+            print("Tabla 'resumen_embarcaciones' reconstruida desde las observaciones.")
+        conn.commit()
+        print("Tabla 'resumen_embarcaciones' inicializada/verificada en PostgreSQL.")
+    except psycopg2.Error as e:
+        conn.rollback()
+        print(f"Error al inicializar el resumen de embarcaciones en PostgreSQL: {e}")
+
+def _ids_embarcaciones(cursor, matriculas):
+    cursor.execute("SELECT id FROM embarcaciones WHERE matricula = ANY(%s);", (list(matriculas),))
+    return {row[0] for row in cursor.fetchall()}
+
+def _recalcular_resumen_embarcaciones(cursor, embarcacion_ids=None):
+    """
+    Recalcula el resumen de las embarcaciones indicadas (todas si es None) desde sus observaciones,
+    usando el índice (embarcacion_id, timestamp). Para ediciones, borrados e importaciones.
+    """
+    filtro = "embarcacion_id IS NOT NULL"
+    params = []
+    if embarcacion_ids is not None:
+        embarcacion_ids = [i for i in embarcacion_ids if i is not None]
+        if not embarcacion_ids:
+            return
+        filtro = "embarcacion_id = ANY(%s)"
+        params = [embarcacion_ids]
+        cursor.execute("DELETE FROM resumen_embarcaciones WHERE embarcacion_id = ANY(%s);", (embarcacion_ids,))
+    else:
+        cursor.execute("DELETE FROM resumen_embarcaciones;")
+    cursor.execute(f"""
+        WITH por_estatus AS (
+            SELECT embarcacion_id, coalesce(estatus_categoria_id, 'unknown_status') AS estatus,
+                   COUNT(*) AS n, MIN(timestamp) AS primera, MAX(timestamp) AS ultima
+            FROM observaciones_embarcaciones
+            WHERE {filtro}
+            GROUP BY 1, 2
+        ), totales AS (
+            SELECT embarcacion_id, jsonb_object_agg(estatus, n) AS conteos, SUM(n) AS total,
+                   coalesce(SUM(n) FILTER (WHERE estatus = ANY(%s)), 0) AS infracciones,
+                   MAX(ultima) FILTER (WHERE estatus = ANY(%s)) AS ultima_infraccion,
+                   MIN(primera) AS primera
+            FROM por_estatus
+            GROUP BY embarcacion_id
+        ), ultimas AS (
+            SELECT DISTINCT ON (embarcacion_id) embarcacion_id, id, timestamp, latitud_wgs84, longitud_wgs84,
+                   estatus_categoria_id
+            FROM observaciones_embarcaciones
+            WHERE {filtro}
+            ORDER BY embarcacion_id, timestamp DESC, id DESC
         )
-        return conn
-    except Exception as e:
-        print(f"ERROR: No se pudo conectar a la base de datos PostgreSQL: {e}")
+        INSERT INTO resumen_embarcaciones (embarcacion_id, matricula, primera_observacion, ultima_observacion,
+                                           ultima_observacion_id, ultima_latitud, ultima_longitud, ultimo_estatus_id,
+                                           total_observaciones, total_infracciones, ultima_infraccion, conteos_estatus)
+        SELECT t.embarcacion_id, e.matricula, t.primera, u.timestamp, u.id, u.latitud_wgs84, u.longitud_wgs84,
+               u.estatus_categoria_id, t.total, t.infracciones, t.ultima_infraccion, t.conteos
+        FROM totales t
+        JOIN ultimas u ON u.embarcacion_id = t.embarcacion_id
+        JOIN embarcaciones e ON e.id = t.embarcacion_id;
+    """, params + [ESTATUS_INFRACCION, ESTATUS_INFRACCION] + params)
+
+def _sumar_observacion_a_resumen(cursor, fila):
+    """Suma una observación recién insertada al resumen de su embarcación (sin releer su historial)."""
+    cursor.execute("""
+        INSERT INTO resumen_embarcaciones AS r (embarcacion_id, matricula, primera_observacion, ultima_observacion,
+                                                ultima_observacion_id, ultima_latitud, ultima_longitud, ultimo_estatus_id,
+                                                total_observaciones, total_infracciones, ultima_infraccion, conteos_estatus)
+        SELECT e.id, e.matricula, %(ts)s, %(ts)s, %(id)s, %(lat)s, %(lon)s, %(estatus)s,
+               1, %(infraccion)s::int, CASE WHEN %(infraccion)s THEN %(ts)s::timestamp END,
+               jsonb_build_object(%(clave)s, 1)
+        FROM embarcaciones e
+        WHERE e.matricula = %(matricula)s
+        ON CONFLICT (embarcacion_id) DO UPDATE
+        SET primera_observacion = LEAST(r.primera_observacion, EXCLUDED.primera_observacion),
+            ultima_observacion = GREATEST(r.ultima_observacion, EXCLUDED.ultima_observacion),
+            ultima_observacion_id = CASE WHEN EXCLUDED.ultima_observacion >= r.ultima_observacion
+                                         THEN EXCLUDED.ultima_observacion_id ELSE r.ultima_observacion_id END,
+            ultima_latitud = CASE WHEN EXCLUDED.ultima_observacion >= r.ultima_observacion
+                                  THEN EXCLUDED.ultima_latitud ELSE r.ultima_latitud END,
+            ultima_longitud = CASE WHEN EXCLUDED.ultima_observacion >= r.ultima_observacion
+                                   THEN EXCLUDED.ultima_longitud ELSE r.ultima_longitud END,
+            ultimo_estatus_id = CASE WHEN EXCLUDED.ultima_observacion >= r.ultima_observacion
+                                     THEN EXCLUDED.ultimo_estatus_id ELSE r.ultimo_estatus_id END,
+            total_observaciones = r.total_observaciones + 1,
+            total_infracciones = r.total_infracciones + EXCLUDED.total_infracciones,
+            ultima_infraccion = GREATEST(r.ultima_infraccion, EXCLUDED.ultima_infraccion),
+            conteos_estatus = r.conteos_estatus
+                || jsonb_build_object(%(clave)s, coalesce((r.conteos_estatus ->> %(clave)s)::int, 0) + 1);
+    """, {
+        'id': fila['id'], 'matricula': fila['matricula'], 'ts': fila['timestamp'],
+        'lat': fila['latitud_wgs84'], 'lon': fila['longitud_wgs84'], 'estatus': fila['estatus_categoria_id'],
+        'clave': fila['estatus_categoria_id'] or 'unknown_status',
+        'infraccion': fila['estatus_categoria_id'] in ESTATUS_INFRACCION,
+    })
+
+def _inicializar_riesgo_embarcaciones(conn, cursor):
+    """
+    Tablas del puntaje de riesgo (vigente e historial). Si están vacías se calculan desde las
+    observaciones; si se calcularon con otros pesos solo se avisa (recalcular-riesgo los actualiza).
+    """
+    try:
+        cursor.execute("""
+        CREATE TABLE IF NOT EXISTS riesgo_embarcaciones (
+            embarcacion_id INTEGER PRIMARY KEY REFERENCES embarcaciones(id) ON DELETE CASCADE,
+            matricula TEXT NOT NULL,
+            puntaje_log DOUBLE PRECISION NOT NULL,
+            actualizado TIMESTAMP NOT NULL DEFAULT NOW(),
+            version_pesos TEXT
+        );
+        """)
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_riesgo_puntaje ON riesgo_embarcaciones (puntaje_log DESC);")
+        cursor.execute("""
+        CREATE TABLE IF NOT EXISTS riesgo_historial (
+            id BIGSERIAL PRIMARY KEY,
+            embarcacion_id INTEGER NOT NULL REFERENCES embarcaciones(id) ON DELETE CASCADE,
+            registrado TIMESTAMP NOT NULL DEFAULT NOW(),
+            puntaje_log DOUBLE PRECISION,
+            observacion_id INTEGER,
+            motivo TEXT
+        );
+        """)
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_riesgo_historial_emb ON riesgo_historial (embarcacion_id, registrado DESC);")
+        cursor.execute("SELECT COUNT(*), COUNT(*) FILTER (WHERE version_pesos IS DISTINCT FROM %s) FROM riesgo_embarcaciones;",
+                       (RIESGO_VERSION,))
+        total, desactualizados = cursor.fetchone()
+        if total == 0:
+            _recalcular_riesgo_embarcaciones(cursor, motivo='inicial')
+            print("Tabla 'riesgo_embarcaciones' calculada desde las observaciones.")
+        elif desactualizados:
+            print(f"ADVERTENCIA: {desactualizados} puntajes de riesgo usan otros pesos; ejecute 'flask --app app recalcular-riesgo'.")
+        conn.commit()
+        print("Tablas de riesgo por embarcación inicializadas/verificadas en PostgreSQL.")
+    except psycopg2.Error as e:
+        conn.rollback()
+        print(f"Error al inicializar el puntaje de riesgo en PostgreSQL: {e}")
+
+def _termino_riesgo(timestamp, estatus_id):
+    """ln(peso · e^(λ·(t - RIESGO_EPOCA))) de una observación, o None si su estatus no suma riesgo."""
+    peso = PESOS_RIESGO.get(estatus_id, 0)
+    if peso <= 0 or timestamp is None:
         return None
+    dias = (timestamp - RIESGO_EPOCA).total_seconds() / 86400.0
+    return math.log(peso) + RIESGO_LAMBDA * dias
+
+def puntaje_riesgo_actual(puntaje_log, momento=None):
+    """Convierte 'puntaje_log' en el puntaje decaído a 'momento' (ahora por defecto)."""
+    if puntaje_log is None:
+        return 0.0
+    momento = momento or datetime.datetime.now()
+    dias = (momento - RIESGO_EPOCA).total_seconds() / 86400.0
+    return math.exp(puntaje_log - RIESGO_LAMBDA * dias)
+
+def _recalcular_riesgo_embarcaciones(cursor, embarcacion_ids=None, motivo='recalculo'):
+    """
+    Recalcula desde sus observaciones el puntaje de las embarcaciones indicadas (todas si es None)
+    y deja constancia en el historial. Para ediciones, borrados, importaciones y cambios de pesos.
+    """
+    filtro = "o.embarcacion_id IS NOT NULL"
+    params = []
+    if embarcacion_ids is not None:
+        embarcacion_ids = [i for i in embarcacion_ids if i is not None]
+        if not embarcacion_ids:
+            return
+        filtro = "o.embarcacion_id = ANY(%s)"
+        params = [embarcacion_ids]
+        cursor.execute("DELETE FROM riesgo_embarcaciones WHERE embarcacion_id = ANY(%s);", (embarcacion_ids,))
+    else:
+        cursor.execute("DELETE FROM riesgo_embarcaciones;")
+    # ln Σ e^t calculado como m + ln Σ e^(t - m) para no desbordar
+    cursor.execute(f"""
+        WITH pesos AS (
+            SELECT * FROM unnest(%s::text[], %s::float8[]) AS p(estatus, peso)
+        ), terminos AS (
+            SELECT o.embarcacion_id,
+                   ln(p.peso) + %s * (extract(epoch FROM o.timestamp - %s::timestamp) / 86400.0) AS t
+            FROM observaciones_embarcaciones o
+            JOIN pesos p ON p.estatus = o.estatus_categoria_id
+            WHERE {filtro} AND p.peso > 0 AND o.timestamp IS NOT NULL
+        ), maximos AS (
+            SELECT embarcacion_id, MAX(t) AS m FROM terminos GROUP BY embarcacion_id
+        )
+        INSERT INTO riesgo_embarcaciones (embarcacion_id, matricula, puntaje_log, actualizado, version_pesos)
+        SELECT t.embarcacion_id, e.matricula, m.m + ln(SUM(exp(t.t - m.m))), NOW(), %s
+        FROM terminos t
+        JOIN maximos m ON m.embarcacion_id = t.embarcacion_id
+        JOIN embarcaciones e ON e.id = t.embarcacion_id
+        GROUP BY t.embarcacion_id, e.matricula, m.m
+        RETURNING embarcacion_id, puntaje_log;
+    """, [list(PESOS_RIESGO.keys()), list(PESOS_RIESGO.values()), RIESGO_LAMBDA, RIESGO_EPOCA] + params + [RIESGO_VERSION])
+    recalculados = cursor.fetchall()
+    # Las embarcaciones que se quedaron sin observaciones con riesgo también quedan registradas (puntaje nulo)
+    if embarcacion_ids is not None:
+        con_puntaje = {emb_id for emb_id, _ in recalculados}
+        recalculados += [(emb_id, None) for emb_id in set(embarcacion_ids) - con_puntaje]
+    if recalculados:
+        psycopg2.extras.execute_values(cursor, """
+            INSERT INTO riesgo_historial (embarcacion_id, puntaje_log, motivo) VALUES %s
+        """, [(emb_id, puntaje, motivo) for emb_id, puntaje in recalculados])
+
+def _sumar_observacion_a_riesgo(cursor, fila):
+    """Suma al puntaje de su embarcación el término de una observación recién insertada."""
+    termino = _termino_riesgo(fila['timestamp'], fila['estatus_categoria_id'])
+    if termino is None:
+        return
+    cursor.execute("""
+        INSERT INTO riesgo_embarcaciones AS r (embarcacion_id, matricula, puntaje_log, actualizado, version_pesos)
+        SELECT e.id, e.matricula, %s, NOW(), %s
+        FROM embarcaciones e
+        WHERE e.matricula = %s
+        ON CONFLICT (embarcacion_id) DO UPDATE
+        SET puntaje_log = GREATEST(r.puntaje_log, EXCLUDED.puntaje_log)
+                          + ln(1 + exp(-abs(r.puntaje_log - EXCLUDED.puntaje_log))),
+            actualizado = NOW()
+        RETURNING embarcacion_id, puntaje_log;
+    """, (termino, RIESGO_VERSION, fila['matricula']))
+    for emb_id, puntaje in cursor.fetchall():
+        cursor.execute("""
+            INSERT INTO riesgo_historial (embarcacion_id, puntaje_log, observacion_id, motivo)
+            VALUES (%s, %s, %s, 'observacion');
+        """, (emb_id, puntaje, fila['id']))
+
+def _inicializar_indice_patrones(conn, cursor):
+    """
+    Índice de patrones: un registro por nombre normalizado (sin acentos ni mayúsculas, ver
+    _normalizar_nombre) con sus totales y última posición, la relación patrón→embarcación y
+    'patron_id' en cada observación. La primera ejecución enlaza las observaciones existentes.
+    """
+    try:
+        cursor.execute("""
+        CREATE TABLE IF NOT EXISTS patrones (
+            id SERIAL PRIMARY KEY,
+            nombre_normalizado TEXT UNIQUE NOT NULL,
+            nombre TEXT NOT NULL,
+            total_observaciones INTEGER NOT NULL DEFAULT 0,
+            total_infracciones INTEGER NOT NULL DEFAULT 0,
+            primera_observacion TIMESTAMP,
+            ultima_observacion TIMESTAMP,
+            ultima_observacion_id INTEGER,
+            ultima_matricula TEXT,
+            ultima_latitud DOUBLE PRECISION,
+            ultima_longitud DOUBLE PRECISION
+        );
+        """)
+        # Búsqueda por prefijo del nombre normalizado
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_patrones_nombre_prefijo ON patrones (nombre_normalizado text_pattern_ops);")
+        cursor.execute("""
+        CREATE TABLE IF NOT EXISTS patron_embarcacion (
+            patron_id INTEGER NOT NULL REFERENCES patrones(id) ON DELETE CASCADE,
+            embarcacion_id INTEGER NOT NULL REFERENCES embarcaciones(id) ON DELETE CASCADE,
+            observaciones INTEGER NOT NULL,
+            infracciones INTEGER NOT NULL,
+            primera_observacion TIMESTAMP,
+            ultima_observacion TIMESTAMP,
+            PRIMARY KEY (patron_id, embarcacion_id)
+        );
+        """)
+        cursor.execute("""
+        SELECT column_name FROM information_schema.columns 
+        WHERE table_name='observaciones_embarcaciones' AND column_name='patron_id';
+        """)
+        if cursor.fetchone() is None:
+            cursor.execute("ALTER TABLE observaciones_embarcaciones ADD COLUMN patron_id INTEGER REFERENCES patrones(id);")
+            print("Columna 'patron_id' añadida a la base de datos PostgreSQL.")
+        cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_observaciones_patron_ts
+        ON observaciones_embarcaciones (patron_id, timestamp DESC);
+        """)
+        cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_observaciones_sin_patron
+        ON observaciones_embarcaciones (nombre_patron)
+        WHERE patron_id IS NULL AND nombre_patron IS NOT NULL AND btrim(nombre_patron) <> '';
+        """)
+        afectados = _sincronizar_patrones(cursor)
+        _recalcular_patrones(cursor, afectados)
+        conn.commit()
+        print(f"Índice de patrones verificado en PostgreSQL ({len(afectados)} patrones actualizados).")
+    except psycopg2.Error as e:
+        conn.rollback()
+        print(f"Error al inicializar el índice de patrones en PostgreSQL: {e}")
+
+def _inicializar_indice_espacial(conn, cursor):
+    """
+    Índice GiST sobre la posición como 'point' nativo de PostgreSQL (longitud, latitud), para que el mapa
+    interactivo lea solo las observaciones dentro de la vista con 'point(...) <@ box(...)'.
+    No requiere PostGIS; en la tabla particionada se crea en cada partición.
+    """
+    try:
+        cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_observaciones_posicion
+        ON observaciones_embarcaciones USING GIST (point(longitud_wgs84, latitud_wgs84));
+        """)
+        conn.commit()
+        print("Índice espacial 'idx_observaciones_posicion' verificado/creado en PostgreSQL.")
+    except psycopg2.Error as e:
+        conn.rollback()
+        print(f"Error al crear el índice espacial de observaciones en PostgreSQL: {e}")
+
+def _inicializar_zonas_reporte(conn, cursor):
+    """
+    Zonas personalizadas (caladeros, arrecifes, sectores de patrullaje) dibujadas o subidas como GeoJSON
+    para los reportes por zona. Se guardan con su rectángulo envolvente para prefiltrar en SQL.
+    """
+    try:
+        cursor.execute("""
+        CREATE TABLE IF NOT EXISTS zonas_reporte (
+            id SERIAL PRIMARY KEY,
+            nombre TEXT NOT NULL,
+            geojson TEXT NOT NULL,
+            lon_min DOUBLE PRECISION NOT NULL,
+            lat_min DOUBLE PRECISION NOT NULL,
+            lon_max DOUBLE PRECISION NOT NULL,
+            lat_max DOUBLE PRECISION NOT NULL,
+            creado_por INTEGER REFERENCES users(id) ON DELETE SET NULL,
+            creado TIMESTAMP NOT NULL DEFAULT now()
+        );
+        """)
+        conn.commit()
+        print("Tabla 'zonas_reporte' inicializada/verificada en PostgreSQL.")
+    except psycopg2.Error as e:
+        conn.rollback()
+        print(f"Error al inicializar la tabla de zonas de reporte en PostgreSQL: {e}")
+
+def _inicializar_zonas_observaciones(conn, cursor):
+    """
+    Zonas registradas en las que cae cada observación (claves de RegistroZonas), calculadas al guardarla.
+    El índice GIN permite filtrar por zona con 'zonas @> ARRAY[clave]' sin volver a probar polígonos.
+    """
+    try:
+        cursor.execute("ALTER TABLE observaciones_embarcaciones ADD COLUMN IF NOT EXISTS zonas TEXT[] NOT NULL DEFAULT '{}';")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_observaciones_zonas ON observaciones_embarcaciones USING GIN (zonas);")
+        conn.commit()
+        print("Columna 'zonas' de observaciones verificada/creada en PostgreSQL.")
+    except psycopg2.Error as e:
+        conn.rollback()
+        print(f"Error al inicializar la columna de zonas de observaciones en PostgreSQL: {e}")
+
+def _inicializar_reclasificaciones(conn, cursor):
+    """
+    Trabajos de 'flask reclasificar': avance (último id revisado) para poder reanudarlos y el estatus y
+    las zonas anteriores y nuevos de cada observación que cambió, para el resumen y para auditarlos.
+    """
+    try:
+        cursor.execute("""
+        CREATE TABLE IF NOT EXISTS reclasificaciones (
+            id SERIAL PRIMARY KEY,
+            firma_zonas TEXT NOT NULL,
+            solo_zonas BOOLEAN NOT NULL DEFAULT FALSE,
+            iniciada TIMESTAMP NOT NULL DEFAULT now(),
+            terminada TIMESTAMP,
+            abandonada BOOLEAN NOT NULL DEFAULT FALSE,
+            ultimo_id INTEGER NOT NULL DEFAULT 0,
+            revisadas BIGINT NOT NULL DEFAULT 0,
+            omitidas BIGINT NOT NULL DEFAULT 0,
+            por_revisar BIGINT NOT NULL DEFAULT 0
+        );
+        """)
+        cursor.execute("""
+        CREATE TABLE IF NOT EXISTS reclasificacion_cambios (
+            reclasificacion_id INTEGER NOT NULL REFERENCES reclasificaciones(id) ON DELETE CASCADE,
+            observacion_id INTEGER NOT NULL,
+            estatus_anterior TEXT,
+            estatus_nuevo TEXT,
+            zonas_anteriores TEXT[],
+            zonas_nuevas TEXT[]
+        );
+        """)
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_reclasificacion_cambios ON reclasificacion_cambios (reclasificacion_id);")
+        conn.commit()
+        print("Tablas de reclasificación inicializadas/verificadas en PostgreSQL.")
+    except psycopg2.Error as e:
+        conn.rollback()
+        print(f"Error al inicializar las tablas de reclasificación en PostgreSQL: {e}")
+
+def _inicializar_encuentros(conn, cursor):
+    """
+    Encuentros entre embarcaciones (ver actualizar_encuentros): un registro por par de observaciones, con
+    la observación de id menor como 'a'. 'encuentros_estado' guarda hasta qué transacción se procesaron
+    los cambios y con qué umbrales.
+    """
+    try:
+        cursor.execute("""
+        CREATE TABLE IF NOT EXISTS encuentros (
+            observacion_a INTEGER NOT NULL,
+            observacion_b INTEGER NOT NULL,
+            matricula_a TEXT NOT NULL,
+            matricula_b TEXT NOT NULL,
+            timestamp_a TIMESTAMP NOT NULL,
+            timestamp_b TIMESTAMP NOT NULL,
+            longitud_a REAL NOT NULL,
+            latitud_a REAL NOT NULL,
+            longitud_b REAL NOT NULL,
+            latitud_b REAL NOT NULL,
+            distancia_m REAL NOT NULL,
+            minutos REAL NOT NULL,
+            PRIMARY KEY (observacion_a, observacion_b)
+        );
+        """)
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_encuentros_b ON encuentros (observacion_b);")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_encuentros_matricula_a ON encuentros (matricula_a, timestamp_a DESC);")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_encuentros_matricula_b ON encuentros (matricula_b, timestamp_b DESC);")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_encuentros_timestamp ON encuentros (timestamp_a);")
+        cursor.execute("""
+        CREATE TABLE IF NOT EXISTS encuentros_estado (
+            unica BOOLEAN PRIMARY KEY DEFAULT TRUE CHECK (unica),
+            xact_procesado BIGINT,
+            umbrales TEXT,
+            actualizado TIMESTAMP
+        );
+        """)
+        cursor.execute("INSERT INTO encuentros_estado DEFAULT VALUES ON CONFLICT DO NOTHING;")
+        conn.commit()
+        print("Tablas de encuentros entre embarcaciones inicializadas/verificadas en PostgreSQL.")
+    except psycopg2.Error as e:
+        conn.rollback()
+        print(f"Error al inicializar las tablas de encuentros en PostgreSQL: {e}")
+
+def _inicializar_saltos_trayecto(conn, cursor):
+    """
+    Saltos implausibles entre observaciones consecutivas de una embarcación (ver _recalcular_saltos_trayecto),
+    mantenidos en la misma transacción de cada escritura. 'saltos_trayecto_estado' guarda con qué umbrales se
+    calcularon; si no coinciden con los actuales (o nunca se calcularon) se reconstruye la tabla.
+    """
+    try:
+        cursor.execute("""
+        CREATE TABLE IF NOT EXISTS saltos_trayecto (
+            observacion_origen INTEGER NOT NULL,
+            observacion_destino INTEGER NOT NULL,
+            embarcacion_id INTEGER NOT NULL REFERENCES embarcaciones(id) ON DELETE CASCADE,
+            matricula TEXT NOT NULL,
+            timestamp_origen TIMESTAMP NOT NULL,
+            timestamp_destino TIMESTAMP NOT NULL,
+            longitud_origen REAL NOT NULL,
+            latitud_origen REAL NOT NULL,
+            longitud_destino REAL NOT NULL,
+            latitud_destino REAL NOT NULL,
+            distancia_km REAL NOT NULL,
+            horas REAL NOT NULL,
+            velocidad_nudos REAL,
+            observacion_sospechosa INTEGER,
+            PRIMARY KEY (observacion_origen, observacion_destino)
+        );
+        """)
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_saltos_embarcacion ON saltos_trayecto (embarcacion_id);")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_saltos_timestamp ON saltos_trayecto (timestamp_destino DESC);")
+        cursor.execute("""
+        CREATE TABLE IF NOT EXISTS saltos_trayecto_estado (
+            unica BOOLEAN PRIMARY KEY DEFAULT TRUE CHECK (unica),
+            umbrales TEXT,
+            actualizado TIMESTAMP
+        );
+        """)
+        cursor.execute("INSERT INTO saltos_trayecto_estado DEFAULT VALUES ON CONFLICT DO NOTHING;")
+        cursor.execute("SELECT umbrales FROM saltos_trayecto_estado;")
+        if cursor.fetchone()[0] != _umbrales_trayectos():
+            saltos = _recalcular_saltos_trayecto(cursor)
+            print(f"Tabla 'saltos_trayecto' reconstruida desde las observaciones ({saltos} saltos implausibles).")
+        conn.commit()
+        print("Tabla 'saltos_trayecto' inicializada/verificada en PostgreSQL.")
+    except psycopg2.Error as e:
+        conn.rollback()
+        print(f"Error al inicializar los saltos de trayecto en PostgreSQL: {e}")
+
+def _inicializar_cambios_observaciones(conn, cursor):
+    """
+    Seguimiento de cambios para la exportación incremental. Cada inserción o modificación visible de una
+    observación recibe una 'version' (orden de los cambios) y el id de su transacción ('xact', xid8 como
+    BIGINT); cada borrado deja una marca en 'observaciones_eliminadas'. Lo mantienen triggers, así que
+    cubre también la importación CSV y los comandos de mantenimiento.
+    """
+    try:
+        cursor.execute("CREATE SEQUENCE IF NOT EXISTS observaciones_cambio_seq;")
+        cursor.execute("ALTER TABLE observaciones_embarcaciones ADD COLUMN IF NOT EXISTS version BIGINT;")
+        cursor.execute("ALTER TABLE observaciones_embarcaciones ADD COLUMN IF NOT EXISTS xact BIGINT;")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_observaciones_xact ON observaciones_embarcaciones (xact);")
+        cursor.execute("""
+        CREATE TABLE IF NOT EXISTS observaciones_eliminadas (
+            id INTEGER NOT NULL,
+            matricula TEXT,
+            timestamp TIMESTAMP,
+            version BIGINT NOT NULL DEFAULT nextval('observaciones_cambio_seq'),
+            xact BIGINT NOT NULL DEFAULT pg_current_xact_id()::text::bigint,
+            eliminado TIMESTAMP NOT NULL DEFAULT now()
+        );
+        """)
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_observaciones_eliminadas_xact ON observaciones_eliminadas (xact);")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_observaciones_eliminadas_fecha ON observaciones_eliminadas (eliminado);")
+        # Transacción más reciente cuyas marcas de borrado ya se depuraron (ver 'flask depurar-lapidas')
+        cursor.execute("""
+        CREATE TABLE IF NOT EXISTS delta_estado (
+            unica BOOLEAN PRIMARY KEY DEFAULT TRUE CHECK (unica),
+            xact_depurado BIGINT
+        );
+        """)
+        cursor.execute("INSERT INTO delta_estado DEFAULT VALUES ON CONFLICT DO NOTHING;")
+        cursor.execute("""
+        CREATE OR REPLACE FUNCTION f_observaciones_version() RETURNS trigger LANGUAGE plpgsql AS $fn$
+        BEGIN
+            -- Si solo cambiaron columnas internas (embarcacion_id, patron_id) no hay nada nuevo que exportar
+            IF TG_OP = 'UPDATE' AND (NEW.matricula, NEW.nombre_embarcacion, NEW.timestamp, NEW.latitud_wgs84,
+                                     NEW.longitud_wgs84, NEW.tipo_embarcacion_id, NEW.estatus_categoria_id,
+                                     NEW.notas_adicionales, NEW.nombre_patron)
+                                    IS NOT DISTINCT FROM
+                                    (OLD.matricula, OLD.nombre_embarcacion, OLD.timestamp, OLD.latitud_wgs84,
+                                     OLD.longitud_wgs84, OLD.tipo_embarcacion_id, OLD.estatus_categoria_id,
+                                     OLD.notas_adicionales, OLD.nombre_patron) THEN
+                RETURN NEW;
+            END IF;
+            NEW.version := nextval('observaciones_cambio_seq');
+            NEW.xact := pg_current_xact_id()::text::bigint;
+            RETURN NEW;
+        END $fn$;
+        """)
+        cursor.execute("""
+        CREATE OR REPLACE FUNCTION f_observaciones_lapida() RETURNS trigger LANGUAGE plpgsql AS $fn$
+        BEGIN
+            -- Un UPDATE que cambia el año mueve la fila de partición (DELETE + INSERT): no es un borrado
+            IF NOT EXISTS (SELECT 1 FROM observaciones_embarcaciones WHERE id = OLD.id) THEN
+                INSERT INTO observaciones_eliminadas (id, matricula, timestamp)
+                VALUES (OLD.id, OLD.matricula, OLD.timestamp);
+            END IF;
+            RETURN NULL;
+        END $fn$;
+        """)
+        cursor.execute("DROP TRIGGER IF EXISTS trg_observaciones_version ON observaciones_embarcaciones;")
+        cursor.execute("""
+        CREATE TRIGGER trg_observaciones_version BEFORE INSERT OR UPDATE ON observaciones_embarcaciones
+        FOR EACH ROW EXECUTE FUNCTION f_observaciones_version();
+        """)
+        cursor.execute("DROP TRIGGER IF EXISTS trg_observaciones_lapida ON observaciones_embarcaciones;")
+        cursor.execute("""
+        CREATE TRIGGER trg_observaciones_lapida AFTER DELETE ON observaciones_embarcaciones
+        FOR EACH ROW EXECUTE FUNCTION f_observaciones_lapida();
+        """)
+        conn.commit()
+        print("Seguimiento de cambios de observaciones verificado en PostgreSQL.")
+    except psycopg2.Error as e:
+        conn.rollback()
+        print(f"Error al inicializar el seguimiento de cambios en PostgreSQL: {e}")
+
+def _sincronizar_patrones(cursor, nombres=None):
+    """
+    Da de alta los patrones de las observaciones sin 'patron_id' y las enlaza, dentro de la transacción
+    de la escritura. La normalización se hace en Python (_normalizar_nombre), así no depende de que
+    la extensión unaccent esté disponible. Devuelve los IDs de patrón enlazados.
+    """
+    filtro = "patron_id IS NULL AND nombre_patron IS NOT NULL AND btrim(nombre_patron) <> ''"
+    params = ()
+    if nombres is not None:
+        nombres = [n for n in nombres if n]
+        if not nombres:
+            return set()
+        filtro += " AND nombre_patron = ANY(%s)"
+        params = (nombres,)
+    cursor.execute(f"SELECT DISTINCT nombre_patron FROM observaciones_embarcaciones WHERE {filtro};", params)
+    por_normalizado = {}
+    for (nombre,) in cursor.fetchall():
+        normalizado = _normalizar_nombre(nombre)
+        if normalizado and normalizado not in PATRONES_SIN_NOMBRE:
+            por_normalizado.setdefault(normalizado, []).append(nombre)
+    if not por_normalizado:
+        return set()
+    filas_patron = psycopg2.extras.execute_values(cursor, """
+        INSERT INTO patrones (nombre_normalizado, nombre) VALUES %s
+        ON CONFLICT (nombre_normalizado) DO UPDATE SET nombre_normalizado = EXCLUDED.nombre_normalizado
+        RETURNING nombre_normalizado, id
+    """, [(normalizado, nombres_originales[0]) for normalizado, nombres_originales in por_normalizado.items()],
+        fetch=True)
+    id_por_normalizado = dict(filas_patron)
+    psycopg2.extras.execute_values(cursor, """
+        UPDATE observaciones_embarcaciones o
+        SET patron_id = m.patron_id
+        FROM (VALUES %s) AS m(nombre_patron, patron_id)
+        WHERE o.nombre_patron = m.nombre_patron AND o.patron_id IS NULL
+    """, [(nombre, id_por_normalizado[normalizado])
+          for normalizado, nombres_originales in por_normalizado.items() for nombre in nombres_originales],
+        template="(%s, %s::integer)")
+    return set(id_por_normalizado.values())
+
+def _recalcular_patrones(cursor, patron_ids):
+    """
+    Recalcula totales, última posición y la relación patrón→embarcación de los patrones indicados
+    desde sus observaciones (índice patron_id, timestamp).
+    """
+    patron_ids = [i for i in patron_ids if i is not None]
+    if not patron_ids:
+        return
+    cursor.execute("DELETE FROM patron_embarcacion WHERE patron_id = ANY(%s);", (patron_ids,))
+    cursor.execute("""
+        INSERT INTO patron_embarcacion (patron_id, embarcacion_id, observaciones, infracciones,
+                                        primera_observacion, ultima_observacion)
+        SELECT patron_id, embarcacion_id, COUNT(*), COUNT(*) FILTER (WHERE estatus_categoria_id = ANY(%s)),
+               MIN(timestamp), MAX(timestamp)
+        FROM observaciones_embarcaciones
+        WHERE patron_id = ANY(%s) AND embarcacion_id IS NOT NULL
+        GROUP BY patron_id, embarcacion_id;
+    """, (ESTATUS_INFRACCION, patron_ids))
+    cursor.execute("""
+        UPDATE patrones p
+        SET total_observaciones = coalesce(t.total, 0),
+            total_infracciones = coalesce(t.infracciones, 0),
+            primera_observacion = t.primera,
+            ultima_observacion = u.timestamp,
+            ultima_observacion_id = u.id,
+            ultima_matricula = u.matricula,
+            ultima_latitud = u.latitud_wgs84,
+            ultima_longitud = u.longitud_wgs84,
+            nombre = coalesce(u.nombre_patron, p.nombre)
+        FROM unnest(%s::integer[]) AS ids(patron_id)
+        LEFT JOIN (
+            SELECT patron_id, COUNT(*) AS total, COUNT(*) FILTER (WHERE estatus_categoria_id = ANY(%s)) AS infracciones,
+                   MIN(timestamp) AS primera
+            FROM observaciones_embarcaciones
+            WHERE patron_id = ANY(%s)
+            GROUP BY patron_id
+        ) t ON t.patron_id = ids.patron_id
+        LEFT JOIN (
+            SELECT DISTINCT ON (patron_id) patron_id, id, timestamp, matricula, latitud_wgs84, longitud_wgs84, nombre_patron
+            FROM observaciones_embarcaciones
+            WHERE patron_id = ANY(%s)
+            ORDER BY patron_id, timestamp DESC, id DESC
+        ) u ON u.patron_id = ids.patron_id
+        WHERE p.id = ids.patron_id;
+    """, (patron_ids, ESTATUS_INFRACCION, patron_ids, patron_ids))
+
+def _columnas_copiables(cursor, tabla):
+    """Columnas de 'tabla' que admiten INSERT (todas menos las generadas, como notas_tsv), en orden."""
+    cursor.execute("""
+        SELECT attname FROM pg_attribute
+        WHERE attrelid = %s::regclass AND attnum > 0 AND NOT attisdropped AND attgenerated = ''
+        ORDER BY attnum;
+    """, (tabla,))
+    return [row[0] for row in cursor.fetchall()]
+
+def _tabla_particionada(cursor, tabla='observaciones_embarcaciones'):
+    """True si 'tabla' ya es una tabla particionada (relkind 'p')."""
+    cursor.execute("SELECT relkind FROM pg_class WHERE oid = %s::regclass;", (tabla,))
+    return cursor.fetchone()[0] == 'p'
+
+def _asegurar_particiones_observaciones(cursor, desde_anio=None, hasta_anio=None, tabla='observaciones_embarcaciones'):
+    """
+    Crea la partición por defecto y las anuales que falten entre desde_anio (el año actual si es None)
+    y hasta_anio (como mínimo PARTICIONES_ANIOS_FUTUROS años por delante). Las filas de esos años que
+    hubieran caído en la partición por defecto se mueven a la nueva. Devuelve los nombres creados.
+    """
+    if not _tabla_particionada(cursor, tabla):
+        return [] # Instalación anterior aún sin migrar ('flask particionar-observaciones')
+    anio_actual = datetime.datetime.now().year
+    desde = min(desde_anio or anio_actual, anio_actual)
+    hasta = max(hasta_anio or anio_actual, anio_actual + PARTICIONES_ANIOS_FUTUROS)
+    cursor.execute(f"CREATE TABLE IF NOT EXISTS {tabla}_default PARTITION OF {tabla} DEFAULT;")
+    cursor.execute("""
+        SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = %s::regclass;
+    """, (tabla,))
+    existentes = {row[0] for row in cursor.fetchall()}
+    creadas = []
+    for anio in range(desde, hasta + 1):
+        particion = f"{tabla}_{anio}"
+        if particion in existentes:
+            continue
+        rango = (datetime.datetime(anio, 1, 1), datetime.datetime(anio + 1, 1, 1))
+        cursor.execute(f"SELECT EXISTS (SELECT 1 FROM {tabla}_default WHERE timestamp >= %s AND timestamp < %s);", rango)
+        if cursor.fetchone()[0]:
+            # PostgreSQL no deja crear una partición cuyas filas ya están en la de por defecto:
+            # se apartan, se crea la partición y se vuelven a insertar por la tabla padre.
+            columnas = ', '.join(_columnas_copiables(cursor, tabla))
+            cursor.execute(f"""
+                CREATE TEMP TABLE _filas_particion AS
+                SELECT {columnas} FROM {tabla}_default WHERE timestamp >= %s AND timestamp < %s;
+            """, rango)
+            cursor.execute(f"DELETE FROM {tabla}_default WHERE timestamp >= %s AND timestamp < %s;", rango)
+            cursor.execute(f"CREATE TABLE {particion} PARTITION OF {tabla} FOR VALUES FROM (%s) TO (%s);", rango)
+            cursor.execute(f"INSERT INTO {tabla} ({columnas}) SELECT {columnas} FROM _filas_particion;")
+            cursor.execute("DROP TABLE _filas_particion;")
+        else:
+            cursor.execute(f"CREATE TABLE {particion} PARTITION OF {tabla} FOR VALUES FROM (%s) TO (%s);", rango)
+        creadas.append(particion)
+    return creadas
+
+def _migrar_observaciones_a_particiones(conn, cursor):
+    """
+    Convierte una 'observaciones_embarcaciones' sin particionar (instalaciones anteriores) en una tabla
+    particionada por año, en una sola transacción: misma secuencia de ids, mismas columnas (incluida la
+    generada notas_tsv) y mismas claves foráneas. Los índices los vuelve a crear inicializar_db.
+    El bloqueo se toma antes de comprobar el tipo de tabla, de modo que dos ejecuciones simultáneas
+    no migran las dos. Devuelve las filas copiadas, o None si la tabla ya estaba particionada.
+    """
+    cursor.execute("LOCK TABLE observaciones_embarcaciones IN ACCESS EXCLUSIVE MODE;")
+    if _tabla_particionada(cursor):
+        conn.rollback()
+        return None
+    print("Convirtiendo 'observaciones_embarcaciones' en tabla particionada por año...")
+    inicio = time.perf_counter()
+    cursor.execute("""
+        SELECT pg_get_serial_sequence('observaciones_embarcaciones', 'id'),
+               EXTRACT(YEAR FROM MIN(timestamp))::int, EXTRACT(YEAR FROM MAX(timestamp))::int
+        FROM observaciones_embarcaciones;
+    """)
+    secuencia, primer_anio, ultimo_anio = cursor.fetchone()
+    # La clave primaria de una tabla particionada debe incluir la columna de partición
+    cursor.execute("""
+        CREATE TABLE observaciones_embarcaciones_particionada (
+            LIKE observaciones_embarcaciones INCLUDING DEFAULTS INCLUDING GENERATED INCLUDING STORAGE,
+            PRIMARY KEY (id, timestamp)
+        ) PARTITION BY RANGE (timestamp);
+    """)
+    cursor.execute("""
+        SELECT conname, pg_get_constraintdef(oid) FROM pg_constraint
+        WHERE conrelid = 'observaciones_embarcaciones'::regclass AND contype = 'f';
+    """)
+    for nombre, definicion in cursor.fetchall():
+        cursor.execute(f'ALTER TABLE observaciones_embarcaciones_particionada ADD CONSTRAINT "{nombre}" {definicion};')
+    # La secuencia del SERIAL pasa a la tabla nueva para que no se borre con la anterior
+    cursor.execute(f"ALTER SEQUENCE {secuencia} OWNED BY observaciones_embarcaciones_particionada.id;")
+    _asegurar_particiones_observaciones(cursor, primer_anio, ultimo_anio, tabla='observaciones_embarcaciones_particionada')
+    columnas = ', '.join(_columnas_copiables(cursor, 'observaciones_embarcaciones'))
+    cursor.execute(f"""
+        INSERT INTO observaciones_embarcaciones_particionada ({columnas})
+        SELECT {columnas} FROM observaciones_embarcaciones;
+    """)
+    copiadas = cursor.rowcount
+    cursor.execute("DROP TABLE observaciones_embarcaciones;")
+    cursor.execute("ALTER TABLE observaciones_embarcaciones_particionada RENAME TO observaciones_embarcaciones;")
+    cursor.execute("ALTER INDEX observaciones_embarcaciones_particionada_pkey RENAME TO observaciones_embarcaciones_pkey;")
+    cursor.execute("""
+        SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = 'observaciones_embarcaciones'::regclass;
+    """)
+    for (particion,) in cursor.fetchall():
+        cursor.execute(f"""ALTER TABLE {particion}
+                           RENAME TO {particion.replace('_particionada', '', 1)};""")
+    conn.commit()
+    print(f"Tabla 'observaciones_embarcaciones' particionada: {copiadas} filas copiadas "
+          f"en {time.perf_counter() - inicio:.1f} s.")
+    return copiadas
 
 def inicializar_db():
     """
@@ -69,7 +1461,7 @@ def inicializar_db():
         # --- Creación de tabla 'observaciones_embarcaciones' ---
         cursor.execute("""
         CREATE TABLE IF NOT EXISTS observaciones_embarcaciones (
-            id SERIAL PRIMARY KEY,
+            id SERIAL,
             matricula TEXT NOT NULL,
             nombre_embarcacion TEXT,
             timestamp TIMESTAMP NOT NULL,
@@ -78,12 +1470,26 @@ def inicializar_db():
             tipo_embarcacion_id TEXT,
             estatus_categoria_id TEXT,
             notas_adicionales TEXT,
-            nombre_patron TEXT
-        )
+            nombre_patron TEXT,
+            PRIMARY KEY (id, timestamp)
+        ) PARTITION BY RANGE (timestamp)
         """)
         conn.commit()
         print("Tabla 'observaciones_embarcaciones' inicializada/verificada en PostgreSQL con TIMESTAMP.")
 
+        # Particionado por año: los reportes por semana/mes/año solo leen las particiones de su rango
+        # y los años antiguos se pueden separar con 'flask archivar-particion'. La conversión de una
+        # tabla anterior sin particionar no se hace aquí (se importa en cada worker y cada comando),
+        # sino una sola vez con 'flask particionar-observaciones'.
+        if _tabla_particionada(cursor):
+            creadas = _asegurar_particiones_observaciones(cursor)
+            conn.commit()
+            if creadas:
+                print(f"Particiones creadas: {', '.join(creadas)}.")
+        else:
+            print("ADVERTENCIA: 'observaciones_embarcaciones' no está particionada. "
+                  "Ejecute 'flask particionar-observaciones' para convertirla.")
+
         # --- Creación y actualización de tabla 'users' ---
         cursor.execute("""
         CREATE TABLE IF NOT EXISTS users (
@@ -144,6 +1550,42 @@ def inicializar_db():
         conn.commit()
         print("Índice único 'unique_matricula_timestamp' verificado/creado en PostgreSQL.")
 
+        # Búsqueda de texto completo en las notas: tsvector almacenado (lo mantiene PostgreSQL en cada
+        # INSERT/UPDATE) con índice GIN, para no recorrer secuencialmente la columna de texto más grande.
+        cursor.execute("""
+        SELECT column_name FROM information_schema.columns 
+        WHERE table_name='observaciones_embarcaciones' AND column_name='notas_tsv';
+        """)
+        if cursor.fetchone() is None:
+            cursor.execute(f"""
+            ALTER TABLE observaciones_embarcaciones
+            ADD COLUMN notas_tsv tsvector
+            GENERATED ALWAYS AS (to_tsvector('{CONFIG_TEXTO_NOTAS}', coalesce(notas_adicionales, ''))) STORED;
+            """)
+            conn.commit()
+            print("Columna 'notas_tsv' añadida a la base de datos PostgreSQL.")
+        else:
+            print("La columna 'notas_tsv' ya existe en PostgreSQL.")
+        cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_observaciones_notas_tsv
+        ON observaciones_embarcaciones USING GIN (notas_tsv);
+        """)
+        conn.commit()
+        print("Índice GIN 'idx_observaciones_notas_tsv' verificado/creado en PostgreSQL.")
+
+        _inicializar_busqueda_difusa(conn, cursor)
+        _inicializar_registro_embarcaciones(conn, cursor)
+        _inicializar_resumen_embarcaciones(conn, cursor)
+        _inicializar_riesgo_embarcaciones(conn, cursor)
+        _inicializar_indice_patrones(conn, cursor)
+        _inicializar_cambios_observaciones(conn, cursor)
+        _inicializar_indice_espacial(conn, cursor)
+        _inicializar_zonas_reporte(conn, cursor)
+        _inicializar_zonas_observaciones(conn, cursor)
+        _inicializar_reclasificaciones(conn, cursor)
+        _inicializar_encuentros(conn, cursor)
+        _inicializar_saltos_trayecto(conn, cursor)
+
         # --- Creación de usuario administrador por defecto si no existe ninguno ---
         cursor.execute("SELECT COUNT(*) FROM users WHERE role = 'admin';")
         admin_count = cursor.fetchone()[0]
@@ -217,18 +1659,26 @@ class User(UserMixin):
         return user_role_level >= required_role_level
 
 # Función para buscar un usuario por su ID
+# Última versión leída de cada usuario en este proceso. Solo se usa mientras la base de datos no
+# responde, para que las sesiones abiertas sigan viendo las lecturas en caché (modo degradado).
+_usuarios_recientes = {}
+
 def get_user_by_id(user_id):
     conn = None
     cur = None
     try:
         conn = conectar_db()
-        if not conn: return None
+        if not conn: return _usuarios_recientes.get(str(user_id))
         cur = conn.cursor()
         # Seleccionar también 'is_approved' y 'role'
-        cur.execute("SELECT id, username, password_hash, is_approved, role FROM users WHERE id = %s", (user_id,))
+        # Se ejecuta en cada petición autenticada (user_loader): sentencia preparada
+        _ejecutar_preparada(cur, 'usuario_por_id', "SELECT id, username, password_hash, is_approved, role FROM users WHERE id = %s", (user_id,))
         user_data = cur.fetchone()
         if user_data:
-            return User(user_data[0], user_data[1], user_data[2], user_data[3], user_data[4])
+            usuario = User(user_data[0], user_data[1], user_data[2], user_data[3], user_data[4])
+            _usuarios_recientes[str(user_id)] = usuario
+            return usuario
+        _usuarios_recientes.pop(str(user_id), None)
         return None
     except Exception as e:
         print(f"Error al buscar usuario por ID: {e}")
@@ -252,7 +1702,7 @@ def get_user_by_username(username):
         
         cur = conn.cursor()
         # Seleccionar también 'is_approved' y 'role'
-        cur.execute("SELECT id, username, password_hash, is_approved, role FROM users WHERE username = %s", (username,))
+        _ejecutar_preparada(cur, 'usuario_por_nombre', "SELECT id, username, password_hash, is_approved, role FROM users WHERE username = %s", (username,))
         user_data = cur.fetchone()
 
         if user_data:
@@ -409,6 +1859,13 @@ login_manager.login_view = 'login'
 def load_user(user_id):
     return get_user_by_id(user_id)
 
+# Filtro de plantilla para mostrar timestamps sin tener que copiar y modificar las filas en las rutas
+@app.template_filter('fecha_hora')
+def formatear_fecha_hora(valor):
+    if isinstance(valor, datetime.datetime):
+        return valor.strftime('%Y-%m-%d %H:%M:%S')
+    return valor or ''
+
 # Decorador para requerir rol de administrador
 def admin_required(f):
     @wraps(f)
@@ -440,11 +1897,6 @@ def viewer_required(f):
     return decorated_function
 
 
-# Asegurarse de que DB se inicializa y la columna 'nombre_patron' existe al inicio
-with app.app_context():
-    inicializar_db()
-
-
 # 5. --- TRANSFORMADORES DE COORDENADAS y DEFINICIONES GLOBALES ---
 crs_utm_anp = CRS("EPSG:32613") 
 crs_geo = CRS("EPSG:4326")     
@@ -523,6 +1975,28 @@ VESSEL_TYPES = {
     "otra": {"id": "otra", "desc": "Otra / No especificada", "marker_char": "o", "size_factor": 80}
 }
 DEFAULT_VESSEL_TYPE_INFO = {"id": "default", "desc": "Desconocido", "marker_char": "o", "size_factor": 80}
+# Estatus que cuentan como infracción o delito (alertas de reincidencia y resumen por embarcación)
+ESTATUS_INFRACCION = [
+    STATUS_CATEGORIES_INSIDE_ANP[5]['id'], # pesca_lgpas_issue
+    STATUS_CATEGORIES_INSIDE_ANP[6]['id'], # delito
+]
+
+# PUNTAJE DE RIESGO POR EMBARCACIÓN
+# Cada observación aporta peso(estatus) * 2^(-antigüedad / vida media). Para poder sumar observaciones
+# sin recalcular, se guarda ln(Σ peso_i · e^(λ·(t_i - RIESGO_EPOCA))): el decaimiento hasta "ahora" es un
+# factor común a todas las embarcaciones, así que el orden por 'puntaje_log' es el orden por riesgo actual.
+# Tras cambiar pesos o vida media: flask --app app recalcular-riesgo
+PESOS_RIESGO = {
+    STATUS_CATEGORIES_INSIDE_ANP[6]['id']: 5.0,   # delito
+    STATUS_CATEGORIES_INSIDE_ANP[5]['id']: 3.0,   # pesca_lgpas_issue
+    STATUS_CATEGORIES_INSIDE_ANP[4]['id']: 1.5,   # doc_nav_issue
+    STATUS_CATEGORIES_INSIDE_ANP[1]['id']: 0.5,   # paso_inocente: dentro del polígono sin ser turístico ni investigación
+}
+RIESGO_VIDA_MEDIA_DIAS = float(os.environ.get('RIESGO_VIDA_MEDIA_DIAS', '180'))
+RIESGO_LAMBDA = math.log(2) / RIESGO_VIDA_MEDIA_DIAS # por día
+RIESGO_EPOCA = datetime.datetime(2020, 1, 1)
+# Identifica la configuración con la que se calculó cada puntaje
+RIESGO_VERSION = f"{RIESGO_VIDA_MEDIA_DIAS:g}|" + ",".join(f"{k}={v:g}" for k, v in sorted(PESOS_RIESGO.items()))
 
 # COORDENADAS UTM ORIGINALES DEL ANP (Completas)
 anp_maritime_boundary_coords_utm = [
@@ -710,21 +2184,527 @@ def _fetch_as_dict(cursor):
     columns = [col[0] for col in cursor.description]
     return [dict(zip(columns, row)) for row in cursor.fetchall()]
 
-def agregar_observacion_db(matricula, nombre_embarcacion, avistamiento_timestamp, lat_wgs84, lon_wgs84, tipo_emb_id, estatus_cat_id, notas="", nombre_patron=""):
+# TIPOS DE FILA COMPACTOS Y PROYECCIONES DE COLUMNAS
+# Las filas de observaciones son tuplas con nombre (sin diccionario por fila) e inmutables, por lo que
+# las rutas ya no necesitan copiarlas. Admiten fila.campo, fila['campo'] y fila.get('campo') para que
+# el código y las plantillas que esperaban diccionarios sigan funcionando.
+def _definir_tipo_fila(nombre, columnas):
+    base = namedtuple(nombre, columnas)
+
+    class Fila(base):
+        __slots__ = ()
+
+        def __getitem__(self, clave):
+            if isinstance(clave, str):
+                try:
+                    return getattr(self, clave)
+                except AttributeError:
+                    raise KeyError(clave)
+            return base.__getitem__(self, clave)
+
+        def get(self, clave, defecto=None):
+            return getattr(self, clave, defecto)
+
+        def keys(self):
+            return self._fields
+
+    Fila.__name__ = Fila.__qualname__ = nombre
+    return Fila
+
+COLUMNAS_OBSERVACION = ('id', 'matricula', 'nombre_embarcacion', 'timestamp', 'latitud_wgs84', 'longitud_wgs84',
+                        'tipo_embarcacion_id', 'estatus_categoria_id', 'notas_adicionales', 'nombre_patron')
+# Tabla de detalle y CSV: todas las columnas, en el orden del encabezado del CSV
+FilaObservacion = _definir_tipo_fila('FilaObservacion', COLUMNAS_OBSERVACION)
+# Mapa: posición, tipo, estatus, fecha y lo que usan las anotaciones (matrícula y patrón)
+FilaMapa = _definir_tipo_fila('FilaMapa', ('id', 'matricula', 'timestamp', 'latitud_wgs84', 'longitud_wgs84',
+                                           'tipo_embarcacion_id', 'estatus_categoria_id', 'nombre_patron'))
+# Reporte DOCX: lo del mapa incluido en el documento más el texto de cada párrafo
+FilaDocx = _definir_tipo_fila('FilaDocx', ('matricula', 'nombre_embarcacion', 'timestamp', 'latitud_wgs84', 'longitud_wgs84',
+                                           'tipo_embarcacion_id', 'estatus_categoria_id', 'notas_adicionales', 'nombre_patron'))
+# Búsqueda en notas: la observación completa más su relevancia y el fragmento resaltado
+FilaNotas = _definir_tipo_fila('FilaNotas', COLUMNAS_OBSERVACION + ('rango', 'fragmento'))
+PROYECCIONES = {
+    'mapa': FilaMapa,
+    'tabla': FilaObservacion,
+    'docx': FilaDocx,
+    'csv': FilaObservacion,
+}
+
+def _columnas_select(tipo_fila):
+    return ', '.join(tipo_fila._fields)
+
+def _fetch_filas(cursor, tipo_fila):
+    """
+    Ayudante para obtener resultados como filas compactas del tipo indicado.
+    La consulta debe seleccionar exactamente las columnas de 'tipo_fila' y en su orden.
+    """
+    return [tipo_fila._make(row) for row in cursor.fetchall()]
+
+
+# LOTE COLUMNAR DE OBSERVACIONES (MAPA, REPORTE WORD Y CSV)
+# Se construye una vez desde el cursor y lo consumen las tres etapas. Las columnas numéricas son arreglos
+# de NumPy; estatus y tipo se guardan como códigos categóricos. Las columnas derivadas (Web Mercator,
+# colores, descripciones, GMM, partes de la fecha) se calculan de forma vectorizada la primera vez que
+# se piden y se memorizan, de modo que el mapa y el Word de un reporte anual las calculan una sola vez.
+CODIGOS_ESTATUS = [cat['id'] for cat in STATUS_CATEGORIES_INSIDE_ANP.values()] + ['outside_anp', 'unknown_status']
+CODIGO_ESTATUS_DESCONOCIDO = len(CODIGOS_ESTATUS) - 1
+_DESC_POR_CODIGO_ESTATUS = np.array([cat['desc'] for cat in STATUS_CATEGORIES_INSIDE_ANP.values()]
+                                    + ["Fuera del Polígono ANP", "Estatus Desconocido"], dtype=object)
+_COLOR_POR_CODIGO_ESTATUS = np.array([STATUS_COLORS[cat['color_key']] for cat in STATUS_CATEGORIES_INSIDE_ANP.values()]
+                                     + [STATUS_COLORS['outside_anp'], STATUS_COLORS['unknown_status']], dtype=object)
+_DESC_ESTATUS = dict(zip(CODIGOS_ESTATUS, _DESC_POR_CODIGO_ESTATUS.tolist()))
+_COLOR_ESTATUS = dict(zip(CODIGOS_ESTATUS, _COLOR_POR_CODIGO_ESTATUS.tolist()))
+_HEX_ESTATUS = {codigo: mcolors.to_hex(color) for codigo, color in _COLOR_ESTATUS.items()}
+CODIGOS_TIPO = list(VESSEL_TYPES.keys())
+# Igual que en el mapa original: un tipo no reconocido se dibuja como 'otra'
+CODIGO_TIPO_DESCONOCIDO = CODIGOS_TIPO.index('otra')
+
+class LoteObservaciones:
+    """
+    Lote columnar de observaciones. Solo contiene las columnas de la proyección con la que se consultó;
+    pedir otra columna lanza KeyError.
+    """
+    def __init__(self, columnas):
+        self.campos = tuple(columnas.keys())
+        self.n = len(next(iter(columnas.values()))) if columnas else 0
+        self._columnas = {}
+        self._categorias = {}
+        for nombre, valores in columnas.items():
+            if nombre in ('latitud_wgs84', 'longitud_wgs84'):
+                self._columnas[nombre] = np.asarray(valores, dtype=np.float64)
+            elif nombre == 'timestamp':
+                self._columnas[nombre] = np.array(valores, dtype='datetime64[us]')
+            elif nombre in ('estatus_categoria_id', 'tipo_embarcacion_id'):
+                # Categórica: códigos enteros más la tabla de valores distintos del lote (conserva el texto original)
+                categorias = {}
+                self._columnas[nombre] = np.fromiter((categorias.setdefault(v, len(categorias)) for v in valores),
+                                                     dtype=np.int32, count=self.n)
+                self._categorias[nombre] = list(categorias)
+            else:
+                columna = np.empty(self.n, dtype=object)
+                columna[:] = list(valores)
+                self._columnas[nombre] = columna
+
+    @classmethod
+    def desde_cursor(cls, cursor):
+        nombres = [col[0] for col in cursor.description]
+        filas = cursor.fetchall()
+        columnas = list(zip(*filas)) if filas else [()] * len(nombres)
+        return cls(dict(zip(nombres, columnas)))
+
+    @classmethod
+    def desde_filas(cls, filas):
+        """Convierte una lista de filas (tuplas con nombre o diccionarios) al formato columnar."""
+        filas = list(filas)
+        if not filas:
+            return cls({})
+        campos = filas[0]._fields if hasattr(filas[0], '_fields') else tuple(filas[0].keys())
+        return cls({campo: [fila[campo] for fila in filas] for campo in campos})
+
+    def __len__(self):
+        return self.n
+
+    def __getitem__(self, nombre):
+        """Valores de una columna tal como vienen de la base de datos."""
+        if nombre in self._categorias:
+            return np.array(self._categorias[nombre], dtype=object)[self._columnas[nombre]]
+        return self._columnas[nombre]
+
+    def __sizeof__(self):
+        tamano = object.__sizeof__(self)
+        for columna in self._columnas.values():
+            tamano += columna.nbytes
+            if columna.dtype == object:
+                tamano += sum(sys.getsizeof(v) for v in columna)
+        for categorias in self._categorias.values():
+            tamano += sum(sys.getsizeof(v) for v in categorias)
+        return tamano
+
+    # --- Columnas base ---
+    @property
+    def lat(self):
+        return self._columnas['latitud_wgs84']
+
+    @property
+    def lon(self):
+        return self._columnas['longitud_wgs84']
+
+    @cached_property
+    def codigo_estatus(self):
+        """Índice en CODIGOS_ESTATUS de cada fila (los estatus no reconocidos son 'unknown_status')."""
+        indice = {estatus: codigo for codigo, estatus in enumerate(CODIGOS_ESTATUS)}
+        canonicos = np.array([indice.get(v, CODIGO_ESTATUS_DESCONOCIDO) for v in self._categorias['estatus_categoria_id']],
+                             dtype=np.int8)
+        return canonicos[self._columnas['estatus_categoria_id']] if self.n else canonicos
+
+    @cached_property
+    def codigo_tipo(self):
+        """Índice en CODIGOS_TIPO de cada fila (los tipos no reconocidos se tratan como 'otra')."""
+        indice = {tipo: codigo for codigo, tipo in enumerate(CODIGOS_TIPO)}
+        canonicos = np.array([indice.get(str(v), CODIGO_TIPO_DESCONOCIDO) for v in self._categorias['tipo_embarcacion_id']],
+                             dtype=np.int8)
+        return canonicos[self._columnas['tipo_embarcacion_id']] if self.n else canonicos
+
+    @cached_property
+    def timestamp_epoch(self):
+        """Segundos desde 1970-01-01 (int64)."""
+        return self._columnas['timestamp'].astype('datetime64[s]').astype(np.int64)
+
+    # --- Columnas derivadas (perezosas y memorizadas) ---
+    @cached_property
+    def _xy_mercator(self):
+        if not self.n:
+            return np.empty(0), np.empty(0)
+        x, y = transformer_geo_to_mercator.transform(self.lon, self.lat)
+        return np.asarray(x), np.asarray(y)
+
+    @property
+    def x(self):
+        return self._xy_mercator[0]
+
+    @property
+    def y(self):
+        return self._xy_mercator[1]
+
+    @cached_property
+    def colores(self):
+        return _COLOR_POR_CODIGO_ESTATUS[self.codigo_estatus]
+
+    @cached_property
+    def desc_estatus(self):
+        return _DESC_POR_CODIGO_ESTATUS[self.codigo_estatus]
+
+    @cached_property
+    def timestamps(self):
+        """Timestamps como objetos datetime de Python."""
+        return self._columnas['timestamp'].astype(object)
+
+    @cached_property
+    def orden_cronologico(self):
+        return np.argsort(self._columnas['timestamp'], kind='stable')
+
+    @staticmethod
+    def _a_gmm(valores, hemisferio_pos, hemisferio_neg):
+        """Versión vectorizada de dd_to_gmm_str."""
+        absolutos = np.abs(valores)
+        grados = np.floor(absolutos).astype(np.int64)
+        minutos = (absolutos - grados) * 60
+        hemisferios = np.where(valores >= 0, hemisferio_pos, hemisferio_neg)
+        return [f"{g}°{m:.3f}' {h}" for g, m, h in zip(grados.tolist(), minutos.tolist(), hemisferios.tolist())]
+
+    @cached_property
+    def lat_gmm(self):
+        return self._a_gmm(self.lat, 'N', 'S')
+
+    @cached_property
+    def lon_gmm(self):
+        return self._a_gmm(self.lon, 'E', 'W')
+
+    @cached_property
+    def partes_fecha(self):
+        """Año, mes, día, hora y minuto de cada timestamp como arreglos enteros."""
+        ts = self._columnas['timestamp'].astype('datetime64[s]')
+        inicio_mes = ts.astype('datetime64[M]')
+        segundos_dia = (ts - ts.astype('datetime64[D]')).astype(np.int64)
+        return {
+            'anio': ts.astype('datetime64[Y]').astype(np.int64) + 1970,
+            'mes': inicio_mes.astype(np.int64) % 12 + 1,
+            'dia': (ts.astype('datetime64[D]') - inicio_mes.astype('datetime64[D]')).astype(np.int64) + 1,
+            'hora': segundos_dia // 3600,
+            'minuto': segundos_dia % 3600 // 60,
+            'valido': ~np.isnat(ts),
+        }
+
+    @cached_property
+    def timestamp_texto(self):
+        """Timestamps como 'AAAA-MM-DD HH:MM:SS' (cadena vacía si falta)."""
+        textos = np.char.replace(np.datetime_as_string(self._columnas['timestamp'], unit='s'), 'T', ' ')
+        return np.where(np.isnat(self._columnas['timestamp']), '', textos)
+
+    def seleccionar(self, mascara):
+        """Nuevo lote con las filas donde 'mascara' es True (mismas columnas)."""
+        return LoteObservaciones({campo: self[campo][mascara] for campo in self.campos} if self.n else {})
+
+    # --- Salidas ---
+    def filas(self, tipo_fila=None):
+        """Filas con nombre (para plantillas) con los valores originales de cada columna."""
+        tipo_fila = tipo_fila or FilaObservacion
+        columnas = [self.timestamps.tolist() if campo == 'timestamp' else self[campo].tolist()
+                    for campo in tipo_fila._fields]
+        return [tipo_fila._make(valores) for valores in zip(*columnas)] if self.n else []
+
+    def filas_csv(self, campos):
+        """Itera tuplas listas para csv.writer, con el timestamp ya formateado."""
+        columnas = [self.timestamp_texto.tolist() if campo == 'timestamp' else self[campo].tolist()
+                    for campo in campos]
+        return zip(*columnas)
+
+
+# 6.1 --- CACHÉ DE RESULTADOS DE CONSULTAS (INVALIDADA POR ESCRITURAS) ---
+# Ver un resumen y luego descargar su DOCX y su CSV ejecutaba la misma consulta tres veces.
+# Los ayudantes de lectura guardan aquí su resultado junto con un predicado que indica qué filas
+# lo afectan; los ayudantes de escritura notifican las filas que cambiaron (versión anterior y nueva)
+# y solo se descartan las entradas cuyo predicado coincide con alguna de ellas.
+QUERY_CACHE_MAX_BYTES = int(os.environ.get('QUERY_CACHE_MAX_MB', '64')) * 1024 * 1024
+# Cada worker de gunicorn tiene su propia caché y solo ve sus propias escrituras; el TTL acota
+# cuánto tiempo puede servirse un resultado escrito desde otro worker.
+QUERY_CACHE_TTL_SECONDS = int(os.environ.get('QUERY_CACHE_TTL_SECONDS', '300'))
+
+def _estimar_bytes(valor):
+    """
+    Estima la memoria ocupada por un resultado (listas/tuplas/diccionarios y sus valores).
+    Las claves de los diccionarios no se cuentan: son los nombres de columna, compartidos por todas las filas.
+    """
+    if isinstance(valor, dict):
+        return sys.getsizeof(valor) + sum(_estimar_bytes(v) for v in valor.values())
+    if isinstance(valor, (list, tuple)):
+        return sys.getsizeof(valor) + sum(_estimar_bytes(v) for v in valor)
+    return sys.getsizeof(valor)
+
+class CacheConsultas:
+    """
+    Caché LRU con contabilidad de memoria por entrada.
+    Cada entrada guarda (valor, bytes, afecta, creada_en); 'afecta' es una función fila -> bool.
+    """
+    def __init__(self, max_bytes, ttl_segundos):
+        self.max_bytes = max_bytes
+        self.ttl_segundos = ttl_segundos
+        self._entradas = OrderedDict()
+        self._lock = threading.Lock()
+        self.bytes_usados = 0
+        # Se incrementa en cada invalidación; una lectura que empezó antes no guarda su resultado.
+        self.generacion = 0
+        self.aciertos = 0
+        self.fallos = 0
+        self.desalojos = 0
+        self.invalidaciones = 0
+        self.vencidas_servidas = 0
+
+    def obtener(self, clave, contar_fallo=True, aceptar_vencida=False):
+        """
+        Devuelve (encontrado, valor) y marca la entrada como usada recientemente.
+        Las entradas vencidas se conservan (hasta que se reemplazan o se desalojan) para poder servirlas
+        con 'aceptar_vencida' cuando la base de datos no responde.
+        """
+        with self._lock:
+            entrada = self._entradas.get(clave)
+            if entrada is not None and aceptar_vencida:
+                self._entradas.move_to_end(clave)
+                self.vencidas_servidas += 1
+                return True, entrada[0]
+            if entrada is not None and time.monotonic() - entrada[3] > self.ttl_segundos:
+                entrada = None
+            if entrada is None:
+                if contar_fallo:
+                    self.fallos += 1
+                return False, None
+            self._entradas.move_to_end(clave)
+            self.aciertos += 1
+            return True, entrada[0]
+
+    def guardar(self, clave, valor, afecta, generacion):
+        tamano = _estimar_bytes(valor)
+        with self._lock:
+            if generacion != self.generacion or tamano > self.max_bytes:
+                return
+            if clave in self._entradas:
+                self._quitar(clave)
+            self._entradas[clave] = (valor, tamano, afecta, time.monotonic())
+            self.bytes_usados += tamano
+            while self.bytes_usados > self.max_bytes:
+                clave_antigua = next(iter(self._entradas))
+                self._quitar(clave_antigua)
+                self.desalojos += 1
+
+    def invalidar_filas(self, filas):
+        """Descarta las entradas afectadas por alguna de las filas escritas."""
+        with self._lock:
+            self.generacion += 1
+            afectadas = [clave for clave, entrada in self._entradas.items()
+                         if any(entrada[2](fila) for fila in filas)]
+            for clave in afectadas:
+                self._quitar(clave)
+            self.invalidaciones += len(afectadas)
+
+    def limpiar(self):
+        with self._lock:
+            self.generacion += 1
+            self.invalidaciones += len(self._entradas)
+            self._entradas.clear()
+            self.bytes_usados = 0
+
+    def estadisticas(self):
+        with self._lock:
+            total = self.aciertos + self.fallos
+            return {
+                'entradas': len(self._entradas),
+                'bytes_usados': self.bytes_usados,
+                'max_bytes': self.max_bytes,
+                'aciertos': self.aciertos,
+                'fallos': self.fallos,
+                'desalojos': self.desalojos,
+                'invalidaciones': self.invalidaciones,
+                'vencidas_servidas': self.vencidas_servidas,
+                'tasa_aciertos': round(self.aciertos / total, 4) if total else 0.0,
+            }
+
+    def _quitar(self, clave):
+        entrada = self._entradas.pop(clave)
+        self.bytes_usados -= entrada[1]
+
+cache_consultas = CacheConsultas(QUERY_CACHE_MAX_BYTES, QUERY_CACHE_TTL_SECONDS)
+
+def _leer_con_cache(clave, afecta, cargar, claves_alternativas=()):
+    """
+    Devuelve el resultado cacheado para 'clave' o lo obtiene con 'cargar()'.
+    'cargar' devuelve None si la consulta falló; los fallos no se guardan en caché.
+    'claves_alternativas' son claves de la misma consulta con una proyección que contiene a la pedida
+    (p. ej. la tabla completa del resumen sirve también para el DOCX y el CSV).
+    Las filas y los lotes son inmutables; de una lista solo se copia la lista.
+    """
+    for clave_alternativa in claves_alternativas:
+        encontrado, registros = cache_consultas.obtener(clave_alternativa, contar_fallo=False)
+        if encontrado:
+            break
+    else:
+        encontrado, registros = cache_consultas.obtener(clave)
+    if not encontrado:
+        generacion = cache_consultas.generacion
+        registros = cargar()
+        if registros is None:
+            # Base de datos caída o circuito abierto: se sirve el último resultado aunque haya vencido
+            encontrado, registros = cache_consultas.obtener(clave, contar_fallo=False, aceptar_vencida=True)
+            if not encontrado:
+                return None
+        else:
+            cache_consultas.guardar(clave, registros, afecta, generacion)
+    return list(registros) if isinstance(registros, list) else registros
+
+def _afecta_tablero(fila):
+    """Los agregados del tablero y las sugerencias cambian con cualquier escritura."""
+    return True
+
+# Ganchos que se ejecutan después de confirmar una escritura en 'observaciones_embarcaciones'.
+# Reciben la lista de filas afectadas (versión anterior y nueva de cada fila modificada).
+_GANCHOS_POST_ESCRITURA = []
+
+def registrar_gancho_post_escritura(funcion):
+    _GANCHOS_POST_ESCRITURA.append(funcion)
+    return funcion
+
+def _notificar_escritura(filas):
+    filas = [fila for fila in filas if fila]
+    if not filas:
+        return
+    for gancho in _GANCHOS_POST_ESCRITURA:
+        try:
+            gancho(filas)
+        except Exception as e:
+            print(f"ERROR: Falló el gancho post-escritura '{gancho.__name__}': {e}")
+
+@registrar_gancho_post_escritura
+def _invalidar_cache_por_filas(filas):
+    cache_consultas.invalidar_filas(filas)
+
+@registrar_gancho_post_escritura
+def _registrar_momento_escritura(filas):
+    """Lectura de lo propio con réplica: ver _leer_de_primaria."""
+    global _ultima_escritura_proceso
+    _ultima_escritura_proceso = time.time()
+    if has_request_context():
+        session['ultima_escritura_db'] = _ultima_escritura_proceso
+
+# Hilos de mantenimiento en segundo plano (índice espacial, encuentros). No se arrancan al importar el
+# módulo, que también ocurre en cada comando 'flask' y en el proceso maestro de gunicorn antes de crear
+# los workers (los hilos no sobreviven al fork), sino con la primera petición de cada proceso.
+_HILOS_FONDO = []
+_hilos_fondo_pid = None
+_hilos_fondo_lock = threading.Lock()
+
+def registrar_hilo_fondo(nombre):
+    """Decorador: 'funcion' se ejecuta en un hilo daemon 'nombre', una vez por proceso que atiende peticiones."""
+    def decorador(funcion):
+        _HILOS_FONDO.append((nombre, funcion))
+        return funcion
+    return decorador
+
+@app.before_request
+def _iniciar_hilos_fondo():
+    global _hilos_fondo_pid
+    if _hilos_fondo_pid == os.getpid():
+        return
+    with _hilos_fondo_lock:
+        if _hilos_fondo_pid == os.getpid():
+            return
+        _hilos_fondo_pid = os.getpid()
+        for nombre, funcion in _HILOS_FONDO:
+            threading.Thread(target=funcion, name=nombre, daemon=True).start()
+
+def _texto_coincide(termino, valor):
+    """Equivalente en Python de LOWER(valor) LIKE LOWER('%termino%')."""
+    if '%' in termino or '_' in termino:
+        return True # Comodines de LIKE: se invalida de forma conservadora
+    return termino.lower() in (valor or '').lower()
+
+def _normalizar_nombre(texto):
+    """Equivalente en Python de la función SQL f_normalizar_nombre (ver _sql_normalizar_nombre)."""
+    texto = unicodedata.normalize('NFKD', texto or '')
+    texto = ''.join(c for c in texto if not unicodedata.combining(c)).lower()
+    palabras = re.sub(r'[^a-z0-9]+', ' ', texto).split()
+    romanos = dict(ROMANOS_NOMBRE)
+    palabras = [romanos.get(p, p) for p in palabras]
+    if palabras:
+        palabras[-1] = dict(ROMANOS_FINALES_NOMBRE).get(palabras[-1], palabras[-1])
+    return ' '.join(palabras)
+
+def _trigramas(texto):
+    """Trigramas de un nombre normalizado, con el mismo relleno por palabra que pg_trgm."""
+    trigramas = set()
+    for palabra in _normalizar_nombre(texto).split():
+        palabra = f"  {palabra} "
+        trigramas.update(palabra[k:k + 3] for k in range(len(palabra) - 2))
+    return trigramas
+
+def _filtro_estatus_efectivo(status_category_filter):
+    """
+    Devuelve el ID de estatus que realmente se aplica en la consulta, o None si no se filtra por estatus.
+    """
+    if not status_category_filter:
+        return None
+    if status_category_filter == "outside_anp":
+        return status_category_filter
+    for v_dict in STATUS_CATEGORIES_INSIDE_ANP.values():
+        if v_dict['id'] == status_category_filter:
+            return status_category_filter # Usar el ID de texto como se almacena en DB
+    print(f"ADVERTENCIA: Estatus de categoría '{status_category_filter}' no reconocido para el filtro.")
+    return None
+
+def agregar_observacion_db(matricula, nombre_embarcacion, avistamiento_timestamp, lat_wgs84, lon_wgs84, tipo_emb_id, estatus_cat_id, notas="", nombre_patron="", zonas=None):
     """
     Inserta una nueva observación de embarcación en la base de datos.
     'avistamiento_timestamp' ahora debe ser un objeto datetime de Python.
+    'zonas' son las claves de las zonas registradas del punto (se calculan si no se pasan).
     """
+    if zonas is None:
+        zonas = registro_zonas.zonas_en(lon_wgs84, lat_wgs84)
     conn = conectar_db()
     if not conn: return
     cursor = conn.cursor()
     try:
         cursor.execute("""
         INSERT INTO observaciones_embarcaciones
-        (matricula, nombre_embarcacion, timestamp, latitud_wgs84, longitud_wgs84, tipo_embarcacion_id, estatus_categoria_id, notas_adicionales, nombre_patron)
-        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
-        """, (matricula.upper(), nombre_embarcacion, avistamiento_timestamp, lat_wgs84, lon_wgs84, tipo_emb_id, estatus_cat_id, notas, nombre_patron))
+        (matricula, nombre_embarcacion, timestamp, latitud_wgs84, longitud_wgs84, tipo_embarcacion_id, estatus_categoria_id, notas_adicionales, nombre_patron, zonas)
+        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s::text[])
+        RETURNING *
+        """, (matricula.upper(), nombre_embarcacion, avistamiento_timestamp, lat_wgs84, lon_wgs84, tipo_emb_id, estatus_cat_id, notas, nombre_patron, zonas))
+        fila_nueva = _fetch_as_dict(cursor)
+        _sincronizar_embarcaciones(cursor, [matricula.upper()])
+        _sumar_observacion_a_resumen(cursor, fila_nueva[0])
+        _sumar_observacion_a_riesgo(cursor, fila_nueva[0])
+        _recalcular_saltos_trayecto(cursor, _ids_embarcaciones(cursor, [matricula.upper()]))
+        _recalcular_patrones(cursor, _sincronizar_patrones(cursor, [nombre_patron]))
         conn.commit()
+        _notificar_escritura(fila_nueva)
         print(f"Observación para '{matricula}' (Avistamiento: {avistamiento_timestamp}) guardada en PostgreSQL.")
     except psycopg2.Error as e:
         print(f"Error al guardar observación en la base de datos PostgreSQL: {e}")
@@ -734,270 +2714,1372 @@ def agregar_observacion_db(matricula, nombre_embarcacion, avistamiento_timestamp
         conn.close()
 
 # NUEVA FUNCIÓN: Actualizar una observación existente
-def update_observacion_db(obs_id, matricula, nombre_embarcacion, avistamiento_timestamp, lat_wgs84, lon_wgs84, tipo_emb_id, estatus_cat_id, notas="", nombre_patron=""):
+def update_observacion_db(obs_id, matricula, nombre_embarcacion, avistamiento_timestamp, lat_wgs84, lon_wgs84, tipo_emb_id, estatus_cat_id, notas="", nombre_patron="", zonas=None):
     """
     Actualiza una observación de embarcación existente en la base de datos por su ID.
+    'zonas' como en agregar_observacion_db.
     """
+    if zonas is None:
+        zonas = registro_zonas.zonas_en(lon_wgs84, lat_wgs84)
+    conn = conectar_db()
+    if not conn: return False
+    cursor = conn.cursor()
+    try:
+        # Se lee la versión anterior para invalidar también lo que dejaba de coincidir con ella
+        cursor.execute("SELECT * FROM observaciones_embarcaciones WHERE id = %s FOR UPDATE", (obs_id,))
+        fila_anterior = _fetch_as_dict(cursor)
+        cursor.execute("""
+        UPDATE observaciones_embarcaciones
+        SET matricula = %s, nombre_embarcacion = %s, timestamp = %s, 
+            latitud_wgs84 = %s, longitud_wgs84 = %s, tipo_embarcacion_id = %s, 
+            estatus_categoria_id = %s, notas_adicionales = %s, nombre_patron = %s, zonas = %s::text[],
+            embarcacion_id = NULL, patron_id = NULL
+        WHERE id = %s
+        RETURNING *
+        """, (matricula.upper(), nombre_embarcacion, avistamiento_timestamp, lat_wgs84, lon_wgs84, 
+              tipo_emb_id, estatus_cat_id, notas, nombre_patron, zonas, obs_id))
+        fila_nueva = _fetch_as_dict(cursor)
+        # Se vuelve a enlazar (la matrícula, el nombre o el tipo pueden haber cambiado)
+        _sincronizar_embarcaciones(cursor, [matricula.upper()])
+        # Puede cambiar la última observación o los conteos de la embarcación anterior y de la nueva
+        afectadas = {fila['embarcacion_id'] for fila in fila_anterior} | _ids_embarcaciones(cursor, [matricula.upper()])
+        _recalcular_resumen_embarcaciones(cursor, afectadas)
+        _recalcular_riesgo_embarcaciones(cursor, afectadas, motivo='edicion')
+        _recalcular_saltos_trayecto(cursor, afectadas)
+        patrones_afectados = {fila['patron_id'] for fila in fila_anterior} | _sincronizar_patrones(cursor, [nombre_patron])
+        _recalcular_patrones(cursor, patrones_afectados)
+        conn.commit()
+        _notificar_escritura(fila_anterior + fila_nueva)
+        return len(fila_nueva) > 0 # Retorna True si se actualizó una fila
+    except psycopg2.Error as e:
+        print(f"Error al actualizar observación ID {obs_id} en la base de datos PostgreSQL: {e}")
+        conn.rollback()
+        return False
+    finally:
+        cursor.close()
+        conn.close()
+
+# NUEVA FUNCIÓN: Obtener una observación por su ID
+def get_observacion_by_id(obs_id):
+    """
+    Obtiene una observación de embarcación por su ID.
+    """
+    def _cargar():
+        conn = conectar_db()
+        if not conn: return None
+        cursor = conn.cursor()
+        try:
+            _ejecutar_preparada(cursor, 'observacion_por_id',
+                                f"SELECT {_columnas_select(FilaObservacion)} FROM observaciones_embarcaciones WHERE id = %s",
+                                (obs_id,))
+            return _fetch_filas(cursor, FilaObservacion)
+        except psycopg2.Error as e:
+            print(f"Error al obtener observación por ID {obs_id} en PostgreSQL: {e}")
+            return None
+        finally:
+            cursor.close()
+            conn.close()
+
+    registro = _leer_con_cache(('get_observacion_by_id', obs_id),
+                               lambda fila: fila.get('id') == obs_id,
+                               _cargar)
+    return registro[0] if registro else None
+
+
+def buscar_historial_embarcacion(matricula):
+    """
+    Busca todas las observaciones para una matrícula específica.
+    psycopg2 devuelve 'timestamp' como objeto datetime.
+    """
+    matricula = matricula.upper()
+
+    def _cargar():
+        conn = conectar_db()
+        if not conn: return None
+        cursor = conn.cursor()
+        try:
+            # Búsqueda por la clave entera del registro (índice embarcacion_id, timestamp DESC)
+            _ejecutar_preparada(cursor, 'historial_por_embarcacion', f"""
+            SELECT {_columnas_select(FilaObservacion)} FROM observaciones_embarcaciones
+            WHERE embarcacion_id = (SELECT id FROM embarcaciones WHERE matricula = %s)
+            ORDER BY timestamp DESC
+            """, (matricula,))
+            return _fetch_filas(cursor, FilaObservacion)
+        except psycopg2.Error as e:
+            print(f"Error al buscar historial en PostgreSQL: {e}")
+            return None
+        finally:
+            cursor.close()
+            conn.close()
+
+    return _leer_con_cache(('buscar_historial_embarcacion', matricula),
+                           lambda fila: fila.get('matricula') == matricula,
+                           _cargar) or []
+
+def buscar_por_nombre_o_patron(nombre_embarcacion, nombre_patron, umbral=None):
+    """
+    Busca observaciones por nombre de embarcación o nombre de patrón por similitud de trigramas
+    (pg_trgm), ignorando acentos, mayúsculas, puntuación y números romanos. Se ordenan por similitud
+    y se devuelven como máximo BUSQUEDA_SIMILITUD_LIMITE filas.
+    'umbral' (0-1) sustituye a BUSQUEDA_SIMILITUD_UMBRAL; si faltan las extensiones se usa LIKE.
+    psycopg2 devuelve 'timestamp' como objeto datetime.
+    """
+    umbral = BUSQUEDA_SIMILITUD_UMBRAL if umbral is None else umbral
+
+    def _cargar():
+        conn = conectar_db()
+        if not conn: return None
+        cursor = conn.cursor()
+        try:
+            # word_similarity (operador <%) encuentra el término dentro de nombres más largos y usa
+            # los índices GIN sobre f_normalizar_nombre(...); "<%%" es "<%" escapado para psycopg2
+            condiciones = []
+            similitudes = []
+            params = []
+            for columna, termino in (('nombre_embarcacion', nombre_embarcacion), ('nombre_patron', nombre_patron)):
+                if termino:
+                    condiciones.append(f"f_normalizar_nombre(%s) <%% f_normalizar_nombre({columna})")
+                    similitudes.append(f"word_similarity(f_normalizar_nombre(%s), f_normalizar_nombre({columna}))")
+                    params.append(termino)
+            if not condiciones:
+                return []
+            # Parámetros locales a la transacción: se descartan al devolver la conexión al pool
+            cursor.execute("SELECT set_config('pg_trgm.word_similarity_threshold', %s, true), "
+                           "set_config('statement_timeout', %s, true);",
+                           (str(umbral), str(BUSQUEDA_SIMILITUD_TIMEOUT_MS)))
+            cursor.execute(f"""
+                SELECT {_columnas_select(FilaObservacion)}
+                FROM observaciones_embarcaciones
+                WHERE {' AND '.join(condiciones)}
+                ORDER BY {' + '.join(similitudes)} DESC, timestamp DESC
+                LIMIT %s
+            """, tuple(params) + tuple(params) + (BUSQUEDA_SIMILITUD_LIMITE,))
+            return _fetch_filas(cursor, FilaObservacion)
+        except psycopg2.Error as e:
+            print(f"Búsqueda por similitud no disponible, se usa LIKE: {e}")
+            conn.rollback()
+            return _buscar_por_nombre_o_patron_like(cursor, nombre_embarcacion, nombre_patron)
+        finally:
+            cursor.close()
+            conn.close()
+
+    # Invalidación conservadora: toda fila que comparta al menos un trigrama con el término
+    trigramas_nombre = _trigramas(nombre_embarcacion) if nombre_embarcacion else None
+    trigramas_patron = _trigramas(nombre_patron) if nombre_patron else None
+
+    def _afecta(fila):
+        if trigramas_nombre is not None and not (trigramas_nombre & _trigramas(fila.get('nombre_embarcacion'))):
+            return False
+        if trigramas_patron is not None and not (trigramas_patron & _trigramas(fila.get('nombre_patron'))):
+            return False
+        return True
+
+    return _leer_con_cache(('buscar_por_nombre_o_patron', nombre_embarcacion or '', nombre_patron or '', umbral),
+                           _afecta, _cargar) or []
+
+def _buscar_por_nombre_o_patron_like(cursor, nombre_embarcacion, nombre_patron):
+    """Búsqueda anterior por subcadena, para bases de datos sin pg_trgm/unaccent."""
+    try:
+        query = f"SELECT {_columnas_select(FilaObservacion)} FROM observaciones_embarcaciones WHERE 1=1"
+        params = []
+        if nombre_embarcacion:
+            query += " AND LOWER(nombre_embarcacion) LIKE LOWER(%s)"
+            params.append(f'%{nombre_embarcacion}%')
+        if nombre_patron:
+            query += " AND LOWER(nombre_patron) LIKE LOWER(%s)"
+            params.append(f'%{nombre_patron}%')
+        
+        query += " ORDER BY timestamp DESC LIMIT %s"
+        params.append(BUSQUEDA_SIMILITUD_LIMITE)
+        
+        cursor.execute(query, tuple(params))
+        return _fetch_filas(cursor, FilaObservacion)
+    except psycopg2.Error as e:
+        print(f"Error al buscar por nombre/patrón en PostgreSQL: {e}")
+        return None
+
+# Marcadores de control para ts_headline: el fragmento se escapa en Python y solo después se
+# sustituyen por <mark>, así el texto de las notas nunca se inserta como HTML.
+_INICIO_RESALTADO = '\x02'
+_FIN_RESALTADO = '\x03'
+
+def _fragmento_resaltado(fragmento):
+    texto = str(escape(fragmento or ''))
+    return Markup(texto.replace(_INICIO_RESALTADO, '<mark>').replace(_FIN_RESALTADO, '</mark>'))
+
+def buscar_en_notas(texto, limite=BUSQUEDA_NOTAS_LIMITE):
+    """
+    Búsqueda de texto completo (español) en 'notas_adicionales'.
+    Acepta la sintaxis de websearch_to_tsquery: "frase exacta", palabra OR palabra, -excluir.
+    Devuelve las 'limite' observaciones más relevantes con un fragmento resaltado de sus notas.
+    """
+    texto = (texto or '').strip()
+    if not texto:
+        return []
+
+    def _cargar():
+        conn = conectar_db()
+        if not conn: return None
+        cursor = conn.cursor()
+        try:
+            # ts_rank_cd y el índice GIN resuelven el top-N; ts_headline (costoso) solo se calcula para esas filas
+            cursor.execute(f"""
+                SELECT {_columnas_select(FilaObservacion)}, rango,
+                       ts_headline(%s, coalesce(notas_adicionales, ''), consulta,
+                                   'StartSel=' || chr(2) || ', StopSel=' || chr(3) || ', MaxFragments=2, MaxWords=20, MinWords=8')
+                FROM (
+                    SELECT {_columnas_select(FilaObservacion)}, consulta,
+                           ts_rank_cd(notas_tsv, consulta) AS rango
+                    FROM observaciones_embarcaciones, websearch_to_tsquery(%s, %s) AS consulta
+                    WHERE notas_tsv @@ consulta
+                    ORDER BY rango DESC, timestamp DESC
+                    LIMIT %s
+                ) mejores
+                ORDER BY rango DESC, timestamp DESC
+            """, (CONFIG_TEXTO_NOTAS, CONFIG_TEXTO_NOTAS, texto, limite))
+            return [FilaNotas._make(row[:-1] + (_fragmento_resaltado(row[-1]),)) for row in cursor.fetchall()]
+        except psycopg2.Error as e:
+            print(f"Error al buscar en las notas en PostgreSQL: {e}")
+            return None
+        finally:
+            cursor.close()
+            conn.close()
+
+    # No se puede evaluar la consulta de texto en Python: cualquier escritura de una fila con notas
+    # (antes o después del cambio) invalida las búsquedas en caché.
+    def _afecta(fila):
+        return bool(fila.get('notas_adicionales'))
+
+    return _leer_con_cache(('buscar_en_notas', texto, limite), _afecta, _cargar) or []
+
+def _filtro_observaciones_sql(start_date_obj, end_date_obj, estatus_filtro):
+    """
+    Condiciones WHERE y parámetros comunes a los resúmenes y sus descargas.
+    'estatus_filtro' debe venir ya normalizado por _filtro_estatus_efectivo.
+    """
+    condiciones = "1=1"
+    params = []
+    if start_date_obj and end_date_obj:
+        condiciones += " AND timestamp BETWEEN %s AND %s"
+        params.extend([start_date_obj, end_date_obj])
+    if estatus_filtro:
+        condiciones += " AND estatus_categoria_id = %s"
+        params.append(estatus_filtro)
+    return condiciones, params
+
+def _predicado_filtro(start_date_obj, end_date_obj, estatus_filtro):
+    """Predicado de invalidación de caché equivalente a _filtro_observaciones_sql."""
+    filtrar_fechas = bool(start_date_obj and end_date_obj)
+
+    def _afecta(fila):
+        if filtrar_fechas:
+            ts = fila.get('timestamp')
+            if not isinstance(ts, datetime.datetime) or not (start_date_obj <= ts <= end_date_obj):
+                return False
+        return not estatus_filtro or fila.get('estatus_categoria_id') == estatus_filtro
+    return _afecta
+
+def _leer_observaciones_filtradas(start_date_obj, end_date_obj, status_category_filter, proyeccion, como_lote):
+    filtrar_fechas = bool(start_date_obj and end_date_obj)
+    estatus_filtro = _filtro_estatus_efectivo(status_category_filter)
+    tipo_fila = PROYECCIONES[proyeccion]
+
+    def _cargar():
+        if SNAPSHOTS_ACTIVOS:
+            # Meses cerrados desde sus instantáneas; la base de datos solo para el tramo abierto
+            segmentos = _segmentos_periodo(start_date_obj if filtrar_fechas else None,
+                                           end_date_obj if filtrar_fechas else None)
+            if any(segmento[0] == 'mes' for segmento in segmentos):
+                lote = _leer_lote_con_snapshots(segmentos, estatus_filtro, tipo_fila)
+                if lote is None or como_lote:
+                    return lote
+                return lote.filas(tipo_fila)
+        conn = conectar_db_lectura()
+        if not conn: return None
+        cursor = conn.cursor()
+        try:
+            condiciones, params = _filtro_observaciones_sql(start_date_obj, end_date_obj, estatus_filtro)
+            query = (f"SELECT {_columnas_select(tipo_fila)} FROM observaciones_embarcaciones "
+                     f"WHERE {condiciones} ORDER BY timestamp ASC")
+            cursor.execute(query, tuple(params))
+            return LoteObservaciones.desde_cursor(cursor) if como_lote else _fetch_filas(cursor, tipo_fila)
+        except psycopg2.Error as e:
+            print(f"Error al consultar la base de datos para resumen con filtro: {e}")
+            return None
+        finally:
+            cursor.close()
+            conn.close()
+
+    clave_base = ('lote' if como_lote else 'filas',
+                  start_date_obj if filtrar_fechas else None,
+                  end_date_obj if filtrar_fechas else None,
+                  estatus_filtro)
+    alternativas = () if tipo_fila is FilaObservacion else (clave_base + (FilaObservacion.__name__,),)
+    return _leer_con_cache(clave_base + (tipo_fila.__name__,),
+                           _predicado_filtro(start_date_obj, end_date_obj, estatus_filtro),
+                           _cargar, alternativas)
+
+def obtener_observaciones_filtradas(start_date_obj=None, end_date_obj=None, status_category_filter=None, proyeccion='tabla'):
+    """
+    Obtiene observaciones dentro de un rango de fechas y/o por estatus de categoría.
+    'start_date_obj' y 'end_date_obj' deben ser objetos datetime de Python.
+    'status_category_filter' es el ID de estatus por el que se desea filtrar.
+    'proyeccion' ('mapa', 'tabla', 'docx' o 'csv') elige las columnas que se traen de la base de datos.
+    """
+    return _leer_observaciones_filtradas(start_date_obj, end_date_obj, status_category_filter, proyeccion, False) or []
+
+def obtener_lote_observaciones(start_date_obj=None, end_date_obj=None, status_category_filter=None, proyeccion='tabla'):
+    """
+    Igual que obtener_observaciones_filtradas, pero devuelve un LoteObservaciones construido directamente
+    desde el cursor (vacío si la consulta falla).
+    """
+    lote = _leer_observaciones_filtradas(start_date_obj, end_date_obj, status_category_filter, proyeccion, True)
+    return lote if lote is not None else LoteObservaciones({})
+
+
+# ZONAS PERSONALIZADAS PARA REPORTES
+# Los candidatos se prefiltran en SQL por el rectángulo envolvente de la zona (índice GiST de posición) y
+# la pertenencia exacta se decide con shapely.intersects_xy sobre todo el lote a la vez (los puntos del
+# borde cuentan como dentro). Las zonas no se modifican una vez creadas, así que se guardan en memoria.
+_zonas_reporte = {}
+
+def geometria_de_geojson(texto):
+    """
+    Polígono o multipolígono (WGS84) de un GeoJSON: geometría, Feature o FeatureCollection (se unen sus
+    polígonos). Corrige geometrías inválidas (p. ej. bordes que se cruzan). Lanza ValueError si no sirve.
+    """
+    try:
+        datos = json.loads(texto)
+    except (TypeError, ValueError):
+        raise ValueError("El texto no es un GeoJSON válido.")
+    if not isinstance(datos, dict):
+        raise ValueError("El GeoJSON debe ser un objeto.")
+    if datos.get('type') == 'FeatureCollection':
+        geometrias = [f.get('geometry') for f in datos.get('features') or [] if isinstance(f, dict)]
+    elif datos.get('type') == 'Feature':
+        geometrias = [datos.get('geometry')]
+    else:
+        geometrias = [datos]
+    try:
+        geometrias = [shape(g) for g in geometrias if g]
+    except (AttributeError, TypeError, ValueError, shapely.errors.GEOSException) as e:
+        raise ValueError(f"Geometría no válida: {e}")
+    poligonos = [g for g in geometrias if g.geom_type in ('Polygon', 'MultiPolygon') and not g.is_empty]
+    if not poligonos:
+        raise ValueError("El GeoJSON no contiene ningún polígono.")
+    geometria = shapely.unary_union([shapely.make_valid(g) for g in poligonos])
+    # make_valid puede dejar líneas o puntos sueltos: solo interesa la parte poligonal
+    if geometria.geom_type == 'GeometryCollection':
+        geometria = shapely.unary_union([g for g in geometria.geoms if g.geom_type in ('Polygon', 'MultiPolygon')])
+    if geometria.is_empty or geometria.geom_type not in ('Polygon', 'MultiPolygon'):
+        raise ValueError("El polígono está vacío.")
+    if shapely.get_num_coordinates(geometria) > ZONA_MAX_VERTICES:
+        raise ValueError(f"El polígono tiene más de {ZONA_MAX_VERTICES} vértices; simplifíquelo antes de subirlo.")
+    lon_min, lat_min, lon_max, lat_max = geometria.bounds
+    if not (-180 <= lon_min and lon_max <= 180 and -90 <= lat_min and lat_max <= 90):
+        raise ValueError("Las coordenadas deben ser longitud/latitud WGS84 (EPSG:4326).")
+    return geometria
+
+def registrar_zona_reporte(nombre, geometria, usuario_id=None):
+    """Guarda una zona personalizada y devuelve su id (None si falla)."""
     conn = conectar_db()
-    if not conn: return False
+    if not conn: return None
     cursor = conn.cursor()
     try:
         cursor.execute("""
-        UPDATE observaciones_embarcaciones
-        SET matricula = %s, nombre_embarcacion = %s, timestamp = %s, 
-            latitud_wgs84 = %s, longitud_wgs84 = %s, tipo_embarcacion_id = %s, 
-            estatus_categoria_id = %s, notas_adicionales = %s, nombre_patron = %s
-        WHERE id = %s
-        """, (matricula.upper(), nombre_embarcacion, avistamiento_timestamp, lat_wgs84, lon_wgs84, 
-              tipo_emb_id, estatus_cat_id, notas, nombre_patron, obs_id))
+        INSERT INTO zonas_reporte (nombre, geojson, lon_min, lat_min, lon_max, lat_max, creado_por)
+        VALUES (%s, %s, %s, %s, %s, %s, %s) RETURNING id
+        """, (nombre, json.dumps(mapping(geometria)), *geometria.bounds, usuario_id))
+        zona_id = cursor.fetchone()[0]
         conn.commit()
-        return cursor.rowcount > 0 # Retorna True si se actualizó una fila
+        return zona_id
     except psycopg2.Error as e:
-        print(f"Error al actualizar observación ID {obs_id} en la base de datos PostgreSQL: {e}")
         conn.rollback()
-        return False
+        print(f"Error al guardar la zona de reporte en PostgreSQL: {e}")
+        return None
     finally:
         cursor.close()
         conn.close()
 
-# NUEVA FUNCIÓN: Obtener una observación por su ID
-def get_observacion_by_id(obs_id):
-    """
-    Obtiene una observación de embarcación por su ID.
-    """
-    conn = conectar_db()
+def obtener_zona_reporte(zona_id):
+    """Zona personalizada como diccionario (id, nombre, geometria preparada, bbox), o None si no existe."""
+    zona = _zonas_reporte.get(zona_id)
+    if zona is not None:
+        return zona
+    conn = conectar_db_lectura()
     if not conn: return None
     cursor = conn.cursor()
     try:
-        cursor.execute("SELECT * FROM observaciones_embarcaciones WHERE id = %s", (obs_id,))
-        registro = _fetch_as_dict(cursor)
-        return registro[0] if registro else None
+        cursor.execute("SELECT id, nombre, geojson FROM zonas_reporte WHERE id = %s", (zona_id,))
+        fila = cursor.fetchone()
     except psycopg2.Error as e:
-        print(f"Error al obtener observación por ID {obs_id} en PostgreSQL: {e}")
+        print(f"Error al obtener la zona de reporte en PostgreSQL: {e}")
         return None
     finally:
         cursor.close()
         conn.close()
-
-
-def buscar_historial_embarcacion(matricula):
-    """
-    Busca todas las observaciones para una matrícula específica.
-    psycopg2 devuelve 'timestamp' como objeto datetime.
-    """
-    conn = conectar_db()
+    if fila is None:
+        return None
+    geometria = shape(json.loads(fila[2]))
+    shapely.prepare(geometria)
+    zona = {'id': fila[0], 'nombre': fila[1], 'geometria': geometria, 'bbox': geometria.bounds}
+    _zonas_reporte[zona_id] = zona
+    return zona
+
+def listar_zonas_reporte(limite=50):
+    """Zonas personalizadas más recientes (id, nombre, creado) para elegirlas de nuevo en el formulario."""
+    conn = conectar_db_lectura()
     if not conn: return []
     cursor = conn.cursor()
     try:
-        cursor.execute("""
-        SELECT * FROM observaciones_embarcaciones
-        WHERE matricula = %s
-        ORDER BY timestamp DESC
-        """, (matricula.upper(),))
-        registros = _fetch_as_dict(cursor)
-        return registros
+        cursor.execute("SELECT id, nombre, creado FROM zonas_reporte ORDER BY creado DESC LIMIT %s", (limite,))
+        return _fetch_as_dict(cursor)
     except psycopg2.Error as e:
-        print(f"Error al buscar historial en PostgreSQL: {e}")
+        print(f"Error al listar las zonas de reporte en PostgreSQL: {e}")
         return []
     finally:
         cursor.close()
         conn.close()
 
-def buscar_por_nombre_o_patron(nombre_embarcacion, nombre_patron):
+def _filtro_zona_sql(zona):
     """
-    Busca observaciones por nombre de embarcación o nombre de patrón (parcial o completo).
-    psycopg2 devuelve 'timestamp' como objeto datetime.
+    Condición y parámetros del filtro por zona. Las zonas registradas se filtran por la pertenencia ya
+    guardada en cada observación (idx_observaciones_zonas); las personalizadas solo se prefiltran por su
+    rectángulo envolvente (idx_observaciones_posicion) y el polígono exacto se aplica después.
     """
-    conn = conectar_db()
-    if not conn: return []
+    if zona.get('registrada'):
+        return " AND zonas @> ARRAY[%s]::text[]", [zona['clave']]
+    return " AND point(longitud_wgs84, latitud_wgs84) <@ box(point(%s, %s), point(%s, %s))", list(zona['bbox'])
+
+def obtener_lote_zona(zona, start_date_obj=None, end_date_obj=None, status_category_filter=None, proyeccion='tabla'):
+    """
+    Igual que obtener_lote_observaciones, limitado a las observaciones dentro de una zona personalizada
+    (obtener_zona_reporte) o registrada (registro_zonas.zona).
+    """
+    filtrar_fechas = bool(start_date_obj and end_date_obj)
+    estatus_filtro = _filtro_estatus_efectivo(status_category_filter)
+    tipo_fila = PROYECCIONES[proyeccion]
+
+    def _cargar():
+        conn = conectar_db_lectura()
+        if not conn: return None
+        cursor = conn.cursor()
+        try:
+            condiciones, params = _filtro_observaciones_sql(start_date_obj, end_date_obj, estatus_filtro)
+            condicion_zona, params_zona = _filtro_zona_sql(zona)
+            cursor.execute(f"SELECT {_columnas_select(tipo_fila)} FROM observaciones_embarcaciones "
+                           f"WHERE {condiciones}{condicion_zona} ORDER BY timestamp ASC", tuple(params + params_zona))
+            lote = LoteObservaciones.desde_cursor(cursor)
+        except psycopg2.Error as e:
+            print(f"Error al consultar la base de datos para el reporte por zona: {e}")
+            return None
+        finally:
+            cursor.close()
+            conn.close()
+        if zona.get('registrada') or not len(lote):
+            return lote
+        return lote.seleccionar(shapely.intersects_xy(zona['geometria'], lote.lon, lote.lat))
+
+    predicado = _predicado_filtro(start_date_obj, end_date_obj, estatus_filtro)
+    lon_min, lat_min, lon_max, lat_max = zona['bbox']
+
+    def _afecta(fila):
+        if zona.get('registrada'):
+            return predicado(fila) and zona['clave'] in (fila.get('zonas') or ())
+        lon, lat = fila.get('longitud_wgs84'), fila.get('latitud_wgs84')
+        return (predicado(fila) and lon is not None and lat is not None
+                and lon_min <= lon <= lon_max and lat_min <= lat <= lat_max)
+
+    lote = _leer_con_cache(('lote_zona', zona['id'], start_date_obj if filtrar_fechas else None,
+                            end_date_obj if filtrar_fechas else None, estatus_filtro, tipo_fila.__name__),
+                           _afecta, _cargar)
+    return lote if lote is not None else LoteObservaciones({})
+
+
+
+# ZONAS REGISTRADAS Y REGLAS DE ESTATUS
+# Además del polígono marítimo del ANP (zona 'anp'), se registran las zonas de los archivos GeoJSON de
+# ZONAS_DIR (*.geojson o *.json, FeatureCollection). Propiedades de cada Feature:
+#   clave           identificador corto (minúsculas, dígitos y '_'); es lo que se guarda en cada observación
+#   nombre          texto para reportes y mapas (por defecto, la clave)
+#   tipo            'anp', 'nucleo' (no pesca), 'amortiguamiento', 'turistica', ... (por defecto 'zona')
+#   protegida       si cuenta como área protegida (por defecto true): fuera de todas las zonas protegidas el
+#                   estatus es siempre 'outside_anp'; dentro se respeta el capturado
+#   estatus_minimo  opcional: estatus mínimo dentro de la zona según el orden de STATUS_CATEGORIES_INSIDE_ANP
+#                   (p. ej. 'pesca_lgpas_issue' en una zona núcleo de no pesca); uno menor se eleva a este
+# Los shapefiles se convierten antes con 'ogr2ogr -f GeoJSON -t_srs EPSG:4326 zonas/nucleo.geojson nucleo.shp'.
+# Todas las zonas van en un STRtree, así que cada lote de puntos se clasifica contra todas en una sola
+# consulta; las zonas pueden solaparse y una observación puede pertenecer a varias.
+_RANGO_ESTATUS = {cat['id']: rango for rango, cat in STATUS_CATEGORIES_INSIDE_ANP.items()}
+_ESTATUS_POR_RANGO = np.array([None] * (max(_RANGO_ESTATUS.values()) + 1), dtype=object)
+_ESTATUS_POR_RANGO[list(_RANGO_ESTATUS.values())] = list(_RANGO_ESTATUS.keys())
+_PATRON_CLAVE_ZONA = re.compile(r'^[a-z0-9_]{1,40}$')
+
+class RegistroZonas:
+    """Zonas registradas (inmutable: para cambiar las zonas se construye un registro nuevo)."""
+
+    def __init__(self, zonas):
+        self.zonas = zonas
+        self._por_clave = {zona['clave']: zona for zona in zonas}
+        self._claves = [zona['clave'] for zona in zonas]
+        self._arbol = shapely.STRtree([zona['geometria'] for zona in zonas])
+        self._protegida = np.array([zona['protegida'] for zona in zonas], dtype=bool)
+        self._rango_minimo = np.array([_RANGO_ESTATUS.get(zona['estatus_minimo'], 0) for zona in zonas], dtype=np.int8)
+        # Identifica geometrías y reglas: una reclasificación interrumpida solo se reanuda con la misma firma
+        firma = hashlib.sha1()
+        for zona in zonas:
+            firma.update(json.dumps([zona['clave'], zona['protegida'], zona['estatus_minimo']]).encode('utf-8'))
+            firma.update(shapely.to_wkb(zona['geometria']))
+        self.firma = firma.hexdigest()
+
+    @classmethod
+    def cargar(cls, directorio):
+        """Zona 'anp' más las de los archivos de 'directorio'; los archivos o zonas inválidos se omiten con aviso."""
+        zonas = []
+        if not anp_maritime_polygon_geo.is_empty:
+            zonas.append(cls._zona('anp', "Polígono Marítimo ANP", 'anp', anp_maritime_polygon_geo, True, None, None))
+        archivos = sorted(f for f in os.listdir(directorio) if f.endswith(('.geojson', '.json'))) if os.path.isdir(directorio) else []
+        for archivo in archivos:
+            ruta = os.path.join(directorio, archivo)
+            try:
+                with open(ruta, encoding='utf-8') as f:
+                    datos = json.load(f)
+            except (OSError, ValueError) as e:
+                print(f"ADVERTENCIA (zonas): no se pudo leer '{ruta}': {e}")
+                continue
+            rasgos = datos.get('features') if isinstance(datos, dict) and datos.get('type') == 'FeatureCollection' else [datos]
+            for numero, rasgo in enumerate(rasgos or [], start=1):
+                try:
+                    zonas.append(cls._zona_de_rasgo(rasgo, archivo, {zona['clave'] for zona in zonas}))
+                except ValueError as e:
+                    print(f"ADVERTENCIA (zonas): zona {numero} de '{archivo}' omitida: {e}")
+        print(f"Registro de zonas: {', '.join(zona['clave'] for zona in zonas) or 'ninguna'}.")
+        return cls(zonas)
+
+    @staticmethod
+    def _zona(clave, nombre, tipo, geometria, protegida, estatus_minimo, archivo):
+        shapely.prepare(geometria)
+        return {'id': clave, 'clave': clave, 'nombre': nombre, 'tipo': tipo, 'geometria': geometria,
+                'bbox': geometria.bounds, 'protegida': protegida, 'estatus_minimo': estatus_minimo,
+                'archivo': archivo, 'registrada': True}
+
+    @classmethod
+    def _zona_de_rasgo(cls, rasgo, archivo, claves_usadas):
+        if not isinstance(rasgo, dict) or rasgo.get('type') != 'Feature':
+            raise ValueError("no es un Feature de GeoJSON.")
+        propiedades = rasgo.get('properties') or {}
+        clave = str(propiedades.get('clave') or '')
+        if not _PATRON_CLAVE_ZONA.match(clave):
+            raise ValueError(f"clave '{clave}' no válida (minúsculas, dígitos y '_').")
+        if clave in claves_usadas:
+            raise ValueError(f"la clave '{clave}' ya está registrada.")
+        estatus_minimo = propiedades.get('estatus_minimo') or None
+        if estatus_minimo is not None and estatus_minimo not in _RANGO_ESTATUS:
+            raise ValueError(f"estatus_minimo '{estatus_minimo}' no existe.")
+        geometria = geometria_de_geojson(json.dumps(rasgo))
+        return cls._zona(clave, str(propiedades.get('nombre') or clave), str(propiedades.get('tipo') or 'zona'),
+                         geometria, bool(propiedades.get('protegida', True)), estatus_minimo, archivo)
+
+    def zona(self, clave):
+        """Zona registrada con esa clave, o None."""
+        return self._por_clave.get(clave)
+
+    def zonas_de_puntos(self, lon, lat):
+        """
+        Claves de las zonas de cada punto (lista de listas, en el orden del registro). Todos los puntos se
+        consultan a la vez contra el STRtree; los de borde cuentan como dentro y los nulos no caen en ninguna.
+        """
+        return self._zonas_de_pares(len(lon), *self._consultar(lon, lat))
+
+    def _consultar(self, lon, lat):
+        """Pares (índice de punto, índice de zona) de los puntos que caen en cada zona."""
+        lon = np.asarray(lon, dtype=float)
+        lat = np.asarray(lat, dtype=float)
+        if not len(lon) or not self.zonas:
+            return np.empty(0, dtype=np.intp), np.empty(0, dtype=np.intp)
+        return self._arbol.query(shapely.points(lon, lat), predicate='intersects')
+
+    def _zonas_de_pares(self, n, indice_punto, indice_zona):
+        zonas = [[] for _ in range(n)]
+        orden = np.lexsort((indice_zona, indice_punto))
+        for punto, zona in zip(indice_punto[orden].tolist(), indice_zona[orden].tolist()):
+            zonas[punto].append(self._claves[zona])
+        return zonas
+
+    def clasificar_lote(self, lon, lat, estatus):
+        """
+        Versión vectorizada de zonas_de_puntos + aplicar_reglas para un lote: devuelve (zonas de cada
+        punto, estatus final como arreglo, máscara de puntos dentro de alguna zona protegida).
+        """
+        n = len(estatus)
+        indice_punto, indice_zona = self._consultar(lon, lat)
+        protegida = np.zeros(n, dtype=bool)
+        protegida[indice_punto[self._protegida[indice_zona]]] = True
+        rango_minimo = np.zeros(n, dtype=np.int8)
+        np.maximum.at(rango_minimo, indice_punto, self._rango_minimo[indice_zona])
+        estatus = np.asarray(estatus, dtype=object)
+        rango_actual = np.fromiter((_RANGO_ESTATUS.get(e, 0) for e in estatus), dtype=np.int8, count=n)
+        final = np.where(rango_actual < rango_minimo, _ESTATUS_POR_RANGO[rango_minimo], estatus)
+        final = np.where(protegida, final, 'outside_anp')
+        return self._zonas_de_pares(n, indice_punto, indice_zona), final, protegida
+
+    def zonas_en(self, lon, lat):
+        """Claves de las zonas de un solo punto."""
+        return self.zonas_de_puntos([lon], [lat])[0]
+
+    def es_protegida(self, zonas):
+        """True si alguna de las zonas cuenta como área protegida."""
+        return any(self._por_clave[clave]['protegida'] for clave in zonas if clave in self._por_clave)
+
+    def aplicar_reglas(self, estatus, zonas):
+        """
+        Estatus final de una observación a partir del capturado y de sus zonas: 'outside_anp' si no está en
+        ninguna zona protegida; si no, el capturado elevado al mayor 'estatus_minimo' de sus zonas.
+        """
+        if not self.es_protegida(zonas):
+            return 'outside_anp'
+        for clave in zonas:
+            minimo = self._por_clave[clave]['estatus_minimo'] if clave in self._por_clave else None
+            if minimo and _RANGO_ESTATUS.get(estatus, 0) < _RANGO_ESTATUS[minimo]:
+                estatus = minimo
+        return estatus
+
+registro_zonas = RegistroZonas.cargar(ZONAS_DIR)
+
+
+# 6.2 --- INSTANTÁNEAS DE PERIODOS CERRADOS ---
+# Un mes terminado casi no cambia, pero cada reporte anual o total lo volvía a consultar y a dibujar.
+# Cada mes cerrado se congela en SNAPSHOTS_DIR/AAAA-MM/: columnas numéricas y códigos categóricos en .npy
+# (se abren con mmap), texto como UTF-8 concatenado con desplazamientos, y meta.json con sus agregados.
+# Los mapas ya dibujados de meses y años cerrados se guardan en SNAPSHOTS_DIR/mapas/. Una escritura que
+# toca un mes cerrado borra su instantánea y los mapas que lo incluyen; se vuelve a congelar al pedirlo.
+SNAPSHOTS_DIR = os.environ.get('SNAPSHOTS_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'snapshots'))
+SNAPSHOTS_ACTIVOS = os.environ.get('SNAPSHOTS_ACTIVOS', '1') == '1'
+# Días del mes siguiente durante los que un mes todavía se considera abierto (capturas tardías)
+SNAPSHOT_DIAS_GRACIA = int(os.environ.get('SNAPSHOT_DIAS_GRACIA', '5'))
+SNAPSHOT_VERSION = 1
+_COLUMNAS_NUMERICAS_SNAPSHOT = {'id': np.int64, 'timestamp': 'datetime64[us]',
+                                'latitud_wgs84': np.float64, 'longitud_wgs84': np.float64}
+_COLUMNAS_CATEGORICAS_SNAPSHOT = ('tipo_embarcacion_id', 'estatus_categoria_id')
+_COLUMNAS_TEXTO_SNAPSHOT = ('matricula', 'nombre_embarcacion', 'notas_adicionales', 'nombre_patron')
+_snapshots_lock = threading.Lock()
+
+def _inicio_mes(fecha):
+    return datetime.datetime(fecha.year, fecha.month, 1)
+
+def _mes_siguiente(inicio_mes):
+    return datetime.datetime(inicio_mes.year + inicio_mes.month // 12, inicio_mes.month % 12 + 1, 1)
+
+def _inicio_mes_abierto():
+    """Primer instante del periodo abierto: todo lo anterior pertenece a meses cerrados."""
+    return _inicio_mes(datetime.datetime.now() - datetime.timedelta(days=SNAPSHOT_DIAS_GRACIA))
+
+def _clave_mes(inicio_mes):
+    return f"{inicio_mes.year:04d}-{inicio_mes.month:02d}"
+
+def _ruta_snapshot(inicio_mes):
+    return os.path.join(SNAPSHOTS_DIR, _clave_mes(inicio_mes))
+
+def _ruta_invalidacion(inicio_mes):
+    return os.path.join(SNAPSHOTS_DIR, 'invalidaciones', _clave_mes(inicio_mes))
+
+def _invalidado_desde(meses, momento):
+    """True si alguno de los meses se invalidó en o después de 'momento' (time.time())."""
+    for inicio_mes in meses:
+        try:
+            if os.path.getmtime(_ruta_invalidacion(inicio_mes)) >= momento:
+                return True
+        except OSError:
+            pass
+    return False
+
+def _primer_mes_con_datos():
+    """Inicio del mes de la observación más antigua (guardado en SNAPSHOTS_DIR/indice.json)."""
+    ruta = os.path.join(SNAPSHOTS_DIR, 'indice.json')
+    try:
+        with open(ruta, encoding='utf-8') as archivo:
+            return datetime.datetime.fromisoformat(json.load(archivo)['primer_mes'])
+    except (OSError, ValueError, KeyError):
+        pass
+    conn = conectar_db_lectura()
+    if not conn: return None
     cursor = conn.cursor()
     try:
-        query = "SELECT * FROM observaciones_embarcaciones WHERE 1=1"
-        params = []
-        if nombre_embarcacion:
-            query += " AND LOWER(nombre_embarcacion) LIKE LOWER(%s)"
-            params.append(f'%{nombre_embarcacion}%')
-        if nombre_patron:
-            query += " AND LOWER(nombre_patron) LIKE LOWER(%s)"
-            params.append(f'%{nombre_patron}%')
-        
-        query += " ORDER BY timestamp DESC"
-        
-        cursor.execute(query, tuple(params))
-        registros = _fetch_as_dict(cursor)
-        return registros
+        cursor.execute("SELECT MIN(timestamp) FROM observaciones_embarcaciones;")
+        minimo = cursor.fetchone()[0]
     except psycopg2.Error as e:
-        print(f"Error al buscar por nombre/patrón en PostgreSQL: {e}")
-        return []
+        print(f"Error al obtener la primera observación: {e}")
+        return None
     finally:
         cursor.close()
         conn.close()
+    if minimo is None:
+        return None
+    primer_mes = _inicio_mes(minimo)
+    try:
+        os.makedirs(SNAPSHOTS_DIR, exist_ok=True)
+        with open(ruta, 'w', encoding='utf-8') as archivo:
+            json.dump({'primer_mes': primer_mes.isoformat()}, archivo)
+    except OSError as e:
+        print(f"ADVERTENCIA: No se pudo guardar el índice de instantáneas: {e}")
+    return primer_mes
+
+def _segmentos_periodo(start_date_obj, end_date_obj):
+    """
+    Divide el rango de un reporte (None = sin límite) en meses cerrados completos ('mes', inicio) y
+    tramos que se consultan en vivo ('vivo', desde, hasta), con 'hasta' exclusivo y en orden cronológico.
+    El tramo anterior al primer mes con datos se conserva por si llegaron observaciones más antiguas.
+    """
+    desde = start_date_obj
+    hasta = end_date_obj + datetime.timedelta(microseconds=1) if end_date_obj else None
+    if desde is None:
+        mes = _primer_mes_con_datos()
+    else:
+        mes = desde if desde == _inicio_mes(desde) else _mes_siguiente(_inicio_mes(desde))
+    limite = min(hasta, _inicio_mes_abierto()) if hasta else _inicio_mes_abierto()
+    meses = []
+    while mes is not None and _mes_siguiente(mes) <= limite:
+        meses.append(mes)
+        mes = _mes_siguiente(mes)
+    if not meses:
+        return [('vivo', desde, hasta)]
+    segmentos = []
+    if desde is None or desde < meses[0]:
+        segmentos.append(('vivo', desde, meses[0]))
+    segmentos.extend(('mes', inicio_mes) for inicio_mes in meses)
+    if hasta is None or hasta > _mes_siguiente(meses[-1]):
+        segmentos.append(('vivo', _mes_siguiente(meses[-1]), hasta))
+    return segmentos
+
+def _guardar_columna_texto(ruta, nombre, valores):
+    codificados = [(v or '').encode('utf-8') for v in valores]
+    desplazamientos = np.zeros(len(codificados) + 1, dtype=np.int64)
+    desplazamientos[1:] = np.cumsum(np.fromiter(map(len, codificados), dtype=np.int64, count=len(codificados)))
+    np.save(os.path.join(ruta, f'{nombre}.offsets.npy'), desplazamientos)
+    np.save(os.path.join(ruta, f'{nombre}.nulos.npy'), np.array([v is None for v in valores], dtype=bool))
+    with open(os.path.join(ruta, f'{nombre}.utf8'), 'wb') as archivo:
+        archivo.write(b''.join(codificados))
+
+def _leer_columna_texto(ruta, nombre, mascara=None):
+    inicios = np.load(os.path.join(ruta, f'{nombre}.offsets.npy')).tolist()
+    nulos = np.load(os.path.join(ruta, f'{nombre}.nulos.npy')).tolist()
+    indices = np.flatnonzero(mascara).tolist() if mascara is not None else range(len(nulos))
+    with open(os.path.join(ruta, f'{nombre}.utf8'), 'rb') as archivo:
+        # Solo se decodifican las filas seleccionadas; el resto del archivo ni se lee
+        datos = mmap.mmap(archivo.fileno(), 0, access=mmap.ACCESS_READ) if os.fstat(archivo.fileno()).st_size else b''
+        try:
+            columna = np.empty(len(indices), dtype=object)
+            columna[:] = [None if nulos[i] else datos[inicios[i]:inicios[i + 1]].decode('utf-8') for i in indices]
+        finally:
+            if isinstance(datos, mmap.mmap):
+                datos.close()
+    return columna
+
+def _leer_meta_snapshot(ruta):
+    try:
+        with open(os.path.join(ruta, 'meta.json'), encoding='utf-8') as archivo:
+            meta = json.load(archivo)
+    except (OSError, ValueError):
+        return None
+    return meta if meta.get('version') == SNAPSHOT_VERSION else None
 
-def obtener_observaciones_filtradas(start_date_obj=None, end_date_obj=None, status_category_filter=None):
+def _construir_snapshot(inicio_mes):
     """
-    Obtiene observaciones dentro de un rango de fechas y/o por estatus de categoría.
-    'start_date_obj' y 'end_date_obj' deben ser objetos datetime de Python.
-    'status_category_filter' es el ID de estatus por el que se desea filtrar.
+    Congela un mes cerrado leyendo de la primaria (la réplica podría no tener aún una corrección tardía).
+    Devuelve su meta, o None si no se pudo o si el mes se invalidó mientras se construía.
     """
+    clave = _clave_mes(inicio_mes)
+    comienzo = time.time()
     conn = conectar_db()
-    if not conn: return []
+    if not conn: return None
     cursor = conn.cursor()
     try:
-        query = "SELECT * FROM observaciones_embarcaciones WHERE 1=1"
-        params = []
-
-        if start_date_obj and end_date_obj:
-            query += " AND timestamp BETWEEN %s AND %s"
-            params.extend([start_date_obj, end_date_obj])
-        
-        if status_category_filter:
-            # Si el filtro es "outside_anp", se filtra por eso
-            if status_category_filter == "outside_anp":
-                query += " AND estatus_categoria_id = %s"
-                params.append(status_category_filter)
-            else:
-                # Si el filtro es un estatus dentro del ANP, se filtra por su ID
-                # Primero, encontrar el ID numérico si el filtro viene como nombre legible
-                found_status_id_for_query = None
-                for k_int, v_dict in STATUS_CATEGORIES_INSIDE_ANP.items():
-                    if v_dict['id'] == status_category_filter:
-                        found_status_id_for_query = status_category_filter # Usar el ID de texto como se almacena en DB
-                        break
-                
-                if found_status_id_for_query:
-                    query += " AND estatus_categoria_id = %s"
-                    params.append(found_status_id_for_query)
-                elif status_category_filter != "": # Evitar errores si el filtro está vacío (Todos los estatus)
-                    print(f"ADVERTENCIA: Estatus de categoría '{status_category_filter}' no reconocido para el filtro.")
-                    # Si no se encuentra, no se añade el filtro de estatus o se podría añadir un filtro que no devuelva nada
-        
-        query += " ORDER BY timestamp ASC"
-        
-        cursor.execute(query, tuple(params))
-        registros = _fetch_as_dict(cursor)
-        return registros
+        cursor.execute(f"""
+            SELECT {_columnas_select(FilaObservacion)} FROM observaciones_embarcaciones
+            WHERE timestamp >= %s AND timestamp < %s ORDER BY timestamp ASC, id ASC;
+        """, (inicio_mes, _mes_siguiente(inicio_mes)))
+        filas = cursor.fetchall()
     except psycopg2.Error as e:
-        print(f"Error al consultar la base de datos para resumen con filtro: {e}")
-        return []
+        print(f"Error al leer el mes {clave} para su instantánea: {e}")
+        return None
     finally:
         cursor.close()
         conn.close()
 
-# NUEVA FUNCIÓN: Obtener conteo de observaciones por mes/año
-def get_observation_counts_by_month_year():
-    conn = conectar_db()
-    if not conn: return []
-    cursor = conn.cursor()
+    n = len(filas)
+    columnas = dict(zip(COLUMNAS_OBSERVACION, zip(*filas))) if filas else {c: () for c in COLUMNAS_OBSERVACION}
+    estatus = [v or 'unknown_status' for v in columnas['estatus_categoria_id']]
+    meta = {
+        'version': SNAPSHOT_VERSION,
+        'mes': clave,
+        'filas': n,
+        'creado': datetime.datetime.now().isoformat(timespec='seconds'),
+        'categorias': {},
+        'agregados': {
+            'por_estatus': {e: estatus.count(e) for e in sorted(set(estatus))},
+            'por_tipo': {t: columnas['tipo_embarcacion_id'].count(t) for t in sorted(set(columnas['tipo_embarcacion_id']), key=str)},
+            'embarcaciones': len(set(columnas['matricula'])),
+            'infracciones': sum(1 for e in estatus if e in ESTATUS_INFRACCION),
+        },
+    }
+    ruta = _ruta_snapshot(inicio_mes)
+    temporal = f"{ruta}.tmp-{os.getpid()}-{threading.get_ident()}"
     try:
-        cursor.execute("""
-            SELECT 
-                EXTRACT(YEAR FROM timestamp) AS year,
-                EXTRACT(MONTH FROM timestamp) AS month,
-                COUNT(*) AS count
-            FROM observaciones_embarcaciones
-            GROUP BY 1, 2
-            ORDER BY 1 ASC, 2 ASC;
-        """)
-        return _fetch_as_dict(cursor)
-    except Exception as e:
-        print(f"Error al obtener conteos de observaciones por mes/año: {e}")
-        return []
+        os.makedirs(temporal, exist_ok=True)
+        for nombre, tipo in _COLUMNAS_NUMERICAS_SNAPSHOT.items():
+            np.save(os.path.join(temporal, f'{nombre}.npy'), np.array(columnas[nombre], dtype=tipo))
+        for nombre in _COLUMNAS_CATEGORICAS_SNAPSHOT:
+            categorias = {}
+            codigos = np.fromiter((categorias.setdefault(v, len(categorias)) for v in columnas[nombre]),
+                                  dtype=np.int32, count=n)
+            np.save(os.path.join(temporal, f'{nombre}.npy'), codigos)
+            meta['categorias'][nombre] = list(categorias)
+        for nombre in _COLUMNAS_TEXTO_SNAPSHOT:
+            _guardar_columna_texto(temporal, nombre, columnas[nombre])
+        with open(os.path.join(temporal, 'meta.json'), 'w', encoding='utf-8') as archivo:
+            json.dump(meta, archivo, ensure_ascii=False)
+        with _snapshots_lock:
+            if _invalidado_desde([inicio_mes], comienzo):
+                shutil.rmtree(temporal, ignore_errors=True)
+                return None
+            shutil.rmtree(ruta, ignore_errors=True)
+            os.replace(temporal, ruta)
+    except OSError as e:
+        # Sin disco escribible (u otro proceso la reemplazó a la vez) se sigue consultando en vivo
+        print(f"ADVERTENCIA: No se pudo guardar la instantánea de {clave}: {e}")
+        shutil.rmtree(temporal, ignore_errors=True)
+        return _leer_meta_snapshot(ruta)
+    print(f"Instantánea del mes {clave} creada ({n} observaciones).")
+    return meta
+
+def _columnas_snapshot_mes(inicio_mes, campos, estatus_filtro):
+    """
+    Columnas 'campos' del mes (construyendo su instantánea si falta), filtradas por estatus.
+    Devuelve {} si no hay filas y None si hay que consultar el mes en vivo.
+    """
+    ruta = _ruta_snapshot(inicio_mes)
+    meta = _leer_meta_snapshot(ruta) or _construir_snapshot(inicio_mes)
+    if meta is None:
+        return None
+    try:
+        if not meta['filas']:
+            return {}
+        categorias = meta['categorias']
+        mascara = None
+        if estatus_filtro:
+            if estatus_filtro not in categorias['estatus_categoria_id']:
+                return {}
+            codigos = np.load(os.path.join(ruta, 'estatus_categoria_id.npy'), mmap_mode='r')
+            mascara = np.asarray(codigos) == categorias['estatus_categoria_id'].index(estatus_filtro)
+        columnas = {}
+        for campo in campos:
+            if campo in _COLUMNAS_TEXTO_SNAPSHOT:
+                columnas[campo] = _leer_columna_texto(ruta, campo, mascara)
+                continue
+            columna = np.load(os.path.join(ruta, f'{campo}.npy'), mmap_mode='r')
+            if campo in categorias:
+                valores = np.empty(len(categorias[campo]), dtype=object)
+                valores[:] = categorias[campo]
+                columna = valores[columna]
+            columnas[campo] = columna if mascara is None else columna[mascara]
+        return columnas
+    except (OSError, ValueError, KeyError) as e:
+        print(f"ADVERTENCIA: Instantánea de {_clave_mes(inicio_mes)} ilegible ({e}); se consulta en vivo.")
+        return None
+
+def _leer_lote_con_snapshots(segmentos, estatus_filtro, tipo_fila):
+    """Arma el lote de un reporte con las instantáneas de los meses cerrados y consultas de los tramos vivos."""
+    campos = tipo_fila._fields
+    partes = []
+    conn = cursor = None
+    try:
+        for segmento in segmentos:
+            columnas = None
+            if segmento[0] == 'mes':
+                columnas = _columnas_snapshot_mes(segmento[1], campos, estatus_filtro)
+                if columnas is None:
+                    segmento = ('vivo', segmento[1], _mes_siguiente(segmento[1]))
+            if columnas is None:
+                if conn is None:
+                    conn = conectar_db_lectura()
+                    if not conn: return None
+                    cursor = conn.cursor()
+                _, desde, hasta = segmento
+                condiciones, params = ["TRUE"], []
+                if desde:
+                    condiciones.append("timestamp >= %s")
+                    params.append(desde)
+                if hasta:
+                    condiciones.append("timestamp < %s")
+                    params.append(hasta)
+                if estatus_filtro:
+                    condiciones.append("estatus_categoria_id = %s")
+                    params.append(estatus_filtro)
+                cursor.execute(f"SELECT {_columnas_select(tipo_fila)} FROM observaciones_embarcaciones "
+                               f"WHERE {' AND '.join(condiciones)} ORDER BY timestamp ASC", tuple(params))
+                lote = LoteObservaciones.desde_cursor(cursor)
+                columnas = {campo: lote[campo] for campo in campos} if len(lote) else {}
+            if columnas:
+                partes.append(columnas)
+    except psycopg2.Error as e:
+        print(f"Error al consultar la base de datos para resumen con instantáneas: {e}")
+        return None
     finally:
         if cursor: cursor.close()
         if conn: conn.close()
+    return LoteObservaciones({campo: np.concatenate([parte[campo] for parte in partes]) if partes else []
+                              for campo in campos})
+
+def invalidar_snapshots(meses):
+    """Borra las instantáneas de los meses indicados (inicios de mes) y los mapas guardados que los incluyen."""
+    for inicio_mes in meses:
+        clave = _clave_mes(inicio_mes)
+        try:
+            os.makedirs(os.path.dirname(_ruta_invalidacion(inicio_mes)), exist_ok=True)
+            with open(_ruta_invalidacion(inicio_mes), 'w', encoding='utf-8') as archivo:
+                archivo.write(datetime.datetime.now().isoformat())
+        except OSError as e:
+            print(f"ADVERTENCIA: No se pudo marcar la invalidación de {clave}: {e}")
+        with _snapshots_lock:
+            shutil.rmtree(_ruta_snapshot(inicio_mes), ignore_errors=True)
+            for periodo in (clave, str(inicio_mes.year)):
+                shutil.rmtree(os.path.join(SNAPSHOTS_DIR, 'mapas', periodo), ignore_errors=True)
+        print(f"Instantánea del mes {clave} invalidada.")
+
+@registrar_gancho_post_escritura
+def _invalidar_snapshots_por_filas(filas):
+    abierto = _inicio_mes_abierto()
+    meses = {_inicio_mes(fila.get('timestamp')) for fila in filas if isinstance(fila.get('timestamp'), datetime.datetime)}
+    meses = sorted(mes for mes in meses if mes < abierto)
+    if meses:
+        invalidar_snapshots(meses)
+
+def _periodo_cerrado(start_date_obj, end_date_obj):
+    """'AAAA-MM' o 'AAAA' si [start, end] es exactamente un mes o un año ya cerrado; None en otro caso."""
+    if not (start_date_obj and end_date_obj) or start_date_obj != _inicio_mes(start_date_obj):
+        return None
+    fin = end_date_obj + datetime.timedelta(microseconds=1)
+    if fin > _inicio_mes_abierto():
+        return None
+    if fin == _mes_siguiente(start_date_obj):
+        return _clave_mes(start_date_obj)
+    if start_date_obj.month == 1 and fin == datetime.datetime(start_date_obj.year + 1, 1, 1):
+        return str(start_date_obj.year)
+    return None
+
+def png_mapa_periodo(lote, titulo, start_date_obj, end_date_obj, estatus_filtro=None, dpi=None, zona=None):
+    """
+    PNG del mapa de un resumen (None si no se pudo dibujar). Si el periodo es un mes o un año cerrado,
+    el PNG se guarda junto a las instantáneas y las siguientes veces no se vuelve a dibujar.
+    Los mapas de una zona personalizada ('zona', ver obtener_zona_reporte) no se guardan.
+    """
+    periodo = _periodo_cerrado(start_date_obj, end_date_obj) if SNAPSHOTS_ACTIVOS and zona is None else None
+    ruta = None
+    if periodo:
+        huella = hashlib.sha1(f"{SNAPSHOT_VERSION}|{titulo}|{estatus_filtro or ''}|{dpi or ''}".encode('utf-8')).hexdigest()[:16]
+        ruta = os.path.join(SNAPSHOTS_DIR, 'mapas', periodo, f"{huella}.png")
+        try:
+            with open(ruta, 'rb') as archivo:
+                return archivo.read()
+        except OSError:
+            pass
+
+    fig, ax = graficar_mapa_general(lote, titulo, es_historial_individual=False,
+                                    zona_geo=zona['geometria'] if zona else None)
+    if not fig:
+        return None
+    buffer = io.BytesIO()
+    opciones = {'dpi': dpi} if dpi else {}
+    fig.savefig(buffer, format='png', bbox_inches='tight', pad_inches=0.1, **opciones)
+    plt.close(fig)
+    png = buffer.getvalue()
+
+    if ruta:
+        anio = int(periodo[:4])
+        meses = [datetime.datetime(anio, int(periodo[5:]), 1)] if len(periodo) > 4 else \
+                [datetime.datetime(anio, m, 1) for m in range(1, 13)]
+        # El lote pudo salir de la caché de consultas, que en otros workers vive hasta QUERY_CACHE_TTL_SECONDS
+        # después de una escritura: no se guarda el mapa de un periodo invalidado hace menos que eso.
+        if not _invalidado_desde(meses, time.time() - QUERY_CACHE_TTL_SECONDS):
+            try:
+                os.makedirs(os.path.dirname(ruta), exist_ok=True)
+                temporal = f"{ruta}.tmp-{os.getpid()}-{threading.get_ident()}"
+                with open(temporal, 'wb') as archivo:
+                    archivo.write(png)
+                os.replace(temporal, ruta)
+            except OSError as e:
+                print(f"ADVERTENCIA: No se pudo guardar el mapa del periodo {periodo}: {e}")
+    return png
+
+# NUEVA FUNCIÓN: Obtener conteo de observaciones por mes/año
+def get_observation_counts_by_month_year():
+    def _cargar():
+        conn = conectar_db_lectura()
+        if not conn: return None
+        cursor = conn.cursor()
+        try:
+            cursor.execute("""
+                SELECT 
+                    EXTRACT(YEAR FROM timestamp) AS year,
+                    EXTRACT(MONTH FROM timestamp) AS month,
+                    COUNT(*) AS count
+                FROM observaciones_embarcaciones
+                GROUP BY 1, 2
+                ORDER BY 1 ASC, 2 ASC;
+            """)
+            return _fetch_as_dict(cursor)
+        except psycopg2.Error as e:
+            print(f"Error al obtener conteos de observaciones por mes/año: {e}")
+            return None
+        finally:
+            if cursor: cursor.close()
+            if conn: conn.close()
+
+    return _leer_con_cache(('get_observation_counts_by_month_year',), _afecta_tablero, _cargar) or []
 
 # NUEVA FUNCIÓN: Obtener distribución de estatus
 def get_status_distribution():
-    conn = conectar_db()
-    if not conn: return []
-    cursor = conn.cursor()
-    try:
-        cursor.execute("""
-            SELECT estatus_categoria_id, COUNT(*) AS count
-            FROM observaciones_embarcaciones
-            GROUP BY estatus_categoria_id
-            ORDER BY count DESC;
-        """)
-        return _fetch_as_dict(cursor)
-    except Exception as e:
-        print(f"Error al obtener distribución de estatus: {e}")
-        return []
-    finally:
-        if cursor: cursor.close()
-        if conn: conn.close()
+    def _cargar():
+        conn = conectar_db_lectura()
+        if not conn: return None
+        cursor = conn.cursor()
+        try:
+            cursor.execute("""
+                SELECT estatus_categoria_id, COUNT(*) AS count
+                FROM observaciones_embarcaciones
+                GROUP BY estatus_categoria_id
+                ORDER BY count DESC;
+            """)
+            return _fetch_as_dict(cursor)
+        except psycopg2.Error as e:
+            print(f"Error al obtener distribución de estatus: {e}")
+            return None
+        finally:
+            if cursor: cursor.close()
+            if conn: conn.close()
+
+    return _leer_con_cache(('get_status_distribution',), _afecta_tablero, _cargar) or []
 
 # NUEVA FUNCIÓN: Obtener embarcaciones recurrentes (ej. top 10 por matrícula)
 def get_top_recurrent_vessels(limit=10):
-    conn = conectar_db()
-    if not conn: return []
-    cursor = conn.cursor()
-    try:
-        cursor.execute("""
-            SELECT matricula, COUNT(*) AS count
-            FROM observaciones_embarcaciones
-            GROUP BY matricula
-            ORDER BY count DESC
-            LIMIT %s;
-        """, (limit,))
-        return _fetch_as_dict(cursor)
-    except Exception as e:
-        print(f"Error al obtener embarcaciones recurrentes: {e}")
-        return []
-    finally:
-        if cursor: cursor.close()
-        if conn: conn.close()
+    def _cargar():
+        conn = conectar_db_lectura()
+        if not conn: return None
+        cursor = conn.cursor()
+        try:
+            # Lectura directa del resumen por embarcación (índice sobre total_observaciones)
+            cursor.execute("""
+                SELECT matricula, total_observaciones AS count
+                FROM resumen_embarcaciones
+                ORDER BY total_observaciones DESC
+                LIMIT %s;
+            """, (limit,))
+            return _fetch_as_dict(cursor)
+        except psycopg2.Error as e:
+            print(f"Error al obtener embarcaciones recurrentes: {e}")
+            return None
+        finally:
+            if cursor: cursor.close()
+            if conn: conn.close()
+
+    return _leer_con_cache(('get_top_recurrent_vessels', limit), _afecta_tablero, _cargar) or []
 
 # NUEVA FUNCIÓN: Obtener embarcaciones con estatus de infracción/delito repetido
 def get_repeated_infraction_vessels(min_infractions=2):
+    def _cargar():
+        conn = conectar_db_lectura()
+        if not conn: return None
+        cursor = conn.cursor()
+        try:
+            # Conteos mantenidos en el resumen por embarcación (estatus de ESTATUS_INFRACCION)
+            cursor.execute("""
+                SELECT matricula, total_infracciones AS infraction_count, ultima_infraccion, conteos_estatus
+                FROM resumen_embarcaciones
+                WHERE total_infracciones >= %s AND total_infracciones > 0
+                ORDER BY total_infracciones DESC;
+            """, (min_infractions,))
+        
+            results = _fetch_as_dict(cursor)
+        
+            for res in results:
+                if res['ultima_infraccion']:
+                    res['last_infraction_date'] = res['ultima_infraccion'].strftime('%Y-%m-%d %H:%M')
+                else:
+                    res['last_infraction_date'] = 'N/A'
+                # Descripciones legibles de los estatus de infracción detectados, con su conteo
+                res['all_status_descriptions'] = []
+                for cat_info in STATUS_CATEGORIES_INSIDE_ANP.values():
+                    conteo = res['conteos_estatus'].get(cat_info['id'], 0)
+                    if cat_info['id'] in ESTATUS_INFRACCION and conteo:
+                        res['all_status_descriptions'].append(f"{cat_info['desc']} ({conteo})")
+        
+            return results
+
+        except psycopg2.Error as e:
+            print(f"Error al obtener embarcaciones con infracciones repetidas: {e}")
+            return None
+        finally:
+            if cursor: cursor.close()
+            if conn: conn.close()
+
+    return _leer_con_cache(('get_repeated_infraction_vessels', min_infractions), _afecta_tablero, _cargar) or []
+
+def obtener_resumen_embarcacion(matricula):
+    """
+    Resumen de una embarcación (primera/última observación, última posición, totales y conteos
+    por estatus) leído de 'resumen_embarcaciones'. Devuelve un diccionario o None.
+    """
+    matricula = matricula.upper()
+
+    def _cargar():
+        conn = conectar_db()
+        if not conn: return None
+        cursor = conn.cursor()
+        try:
+            _ejecutar_preparada(cursor, 'resumen_por_matricula', """
+            SELECT r.*, e.nombre_embarcacion, e.tipo_embarcacion_id, e.nombre_patron
+            FROM resumen_embarcaciones r
+            JOIN embarcaciones e ON e.id = r.embarcacion_id
+            WHERE r.matricula = %s
+            """, (matricula,))
+            return _fetch_as_dict(cursor)
+        except psycopg2.Error as e:
+            print(f"Error al obtener el resumen de la embarcación en PostgreSQL: {e}")
+            return None
+        finally:
+            cursor.close()
+            conn.close()
+
+    registro = _leer_con_cache(('obtener_resumen_embarcacion', matricula),
+                               lambda fila: fila.get('matricula') == matricula,
+                               _cargar)
+    return registro[0] if registro else None
+
+def obtener_posiciones_flota(dias=None):
+    """
+    Última posición conocida de cada embarcación (una fila FilaMapa por embarcación), desde el resumen.
+    'dias' limita a las embarcaciones vistas en los últimos N días.
+    """
+    def _cargar():
+        conn = conectar_db_lectura()
+        if not conn: return None
+        cursor = conn.cursor()
+        try:
+            query = """
+                SELECT r.ultima_observacion_id, r.matricula, r.ultima_observacion, r.ultima_latitud, r.ultima_longitud,
+                       e.tipo_embarcacion_id, r.ultimo_estatus_id, e.nombre_patron
+                FROM resumen_embarcaciones r
+                JOIN embarcaciones e ON e.id = r.embarcacion_id
+                WHERE r.ultima_latitud IS NOT NULL AND r.ultima_longitud IS NOT NULL
+            """
+            params = []
+            if dias:
+                query += " AND r.ultima_observacion >= %s"
+                params.append(datetime.datetime.now() - datetime.timedelta(days=dias))
+            query += " ORDER BY r.ultima_observacion DESC"
+            cursor.execute(query, tuple(params))
+            return _fetch_filas(cursor, FilaMapa)
+        except psycopg2.Error as e:
+            print(f"Error al obtener las posiciones de la flota en PostgreSQL: {e}")
+            return None
+        finally:
+            cursor.close()
+            conn.close()
+
+    # Cualquier escritura puede cambiar la última posición de una embarcación
+    return _leer_con_cache(('obtener_posiciones_flota', dias), lambda fila: True, _cargar) or []
+
+def _tamano_celda_mapa(zoom):
+    """Lado en grados de la celda de agregación para un nivel de zoom de Leaflet."""
+    return 360.0 / (2 ** zoom * MAPA_CELDAS_POR_TESELA)
+
+def obtener_rasgos_mapa(bbox, zoom, start_date_obj=None, end_date_obj=None, status_category_filter=None, matricula=None):
+    """
+    Observaciones dentro de 'bbox' (lon_min, lat_min, lon_max, lat_max) como FeatureCollection para el
+    mapa interactivo. Desde MAPA_ZOOM_DETALLE devuelve cada observación; por debajo (o si pasan de
+    MAPA_MAX_PUNTOS) devuelve una celda por grupo con su conteo, su centroide y el estatus más frecuente.
+    La vista se amplía a múltiplos de la celda para que los grupos no cambien al desplazar el mapa.
+    Devuelve None si falla la consulta.
+    """
+    estatus_filtro = _filtro_estatus_efectivo(status_category_filter)
+    matricula = matricula.upper() if matricula else None
+    celda = _tamano_celda_mapa(zoom)
+    lon_min, lat_min = math.floor(bbox[0] / celda) * celda, math.floor(bbox[1] / celda) * celda
+    lon_max, lat_max = math.ceil(bbox[2] / celda) * celda, math.ceil(bbox[3] / celda) * celda
+    condiciones, params = _filtro_observaciones_sql(start_date_obj, end_date_obj, estatus_filtro)
+    condiciones += " AND point(longitud_wgs84, latitud_wgs84) <@ box(point(%s, %s), point(%s, %s))"
+    params.extend([lon_min, lat_min, lon_max, lat_max])
+    if matricula:
+        condiciones += " AND matricula = %s"
+        params.append(matricula)
+
+    def _feature(lon, lat, propiedades):
+        return {'type': 'Feature', 'geometry': {'type': 'Point', 'coordinates': [lon, lat]}, 'properties': propiedades}
+
+    def _cargar():
+        conn = conectar_db_lectura()
+        if not conn: return None
+        cursor = conn.cursor()
+        try:
+            if zoom >= MAPA_ZOOM_DETALLE:
+                cursor.execute(f"SELECT {_columnas_select(FilaMapa)} FROM observaciones_embarcaciones "
+                               f"WHERE {condiciones} ORDER BY timestamp DESC LIMIT %s", tuple(params) + (MAPA_MAX_PUNTOS + 1,))
+                filas = _fetch_filas(cursor, FilaMapa)
+                if len(filas) <= MAPA_MAX_PUNTOS:
+                    return {'type': 'FeatureCollection', 'agregado': False, 'features': [
+                        _feature(fila.longitud_wgs84, fila.latitud_wgs84, {
+                            'id': fila.id, 'matricula': fila.matricula, 'nombre_patron': fila.nombre_patron,
+                            'timestamp': fila.timestamp.strftime('%Y-%m-%d %H:%M') if fila.timestamp else None,
+                            'tipo_embarcacion_id': fila.tipo_embarcacion_id,
+                            'estatus_categoria_id': fila.estatus_categoria_id,
+                            'estatus_desc': _DESC_ESTATUS.get(fila.estatus_categoria_id, "Estatus Desconocido"),
+                            'color': _HEX_ESTATUS.get(fila.estatus_categoria_id, _HEX_ESTATUS['unknown_status']),
+                        }) for fila in filas]}
+            cursor.execute(f"""
+                SELECT count(*), avg(longitud_wgs84), avg(latitud_wgs84),
+                       mode() WITHIN GROUP (ORDER BY estatus_categoria_id)
+                FROM observaciones_embarcaciones
+                WHERE {condiciones}
+                GROUP BY floor(longitud_wgs84 / %s), floor(latitud_wgs84 / %s)
+            """, tuple(params) + (celda, celda))
+            return {'type': 'FeatureCollection', 'agregado': True, 'features': [
+                _feature(lon, lat, {
+                    'conteo': conteo, 'estatus_categoria_id': estatus,
+                    'estatus_desc': _DESC_ESTATUS.get(estatus, "Estatus Desconocido"),
+                    'color': _HEX_ESTATUS.get(estatus, _HEX_ESTATUS['unknown_status']),
+                }) for conteo, lon, lat, estatus in cursor.fetchall()]}
+        except psycopg2.Error as e:
+            print(f"Error al obtener las observaciones del mapa en PostgreSQL: {e}")
+            return None
+        finally:
+            cursor.close()
+            conn.close()
+
+    predicado = _predicado_filtro(start_date_obj, end_date_obj, estatus_filtro)
+
+    def _afecta(fila):
+        lon, lat = fila.get('longitud_wgs84'), fila.get('latitud_wgs84')
+        return (predicado(fila) and lon is not None and lat is not None
+                and lon_min <= lon <= lon_max and lat_min <= lat <= lat_max
+                and (not matricula or fila.get('matricula') == matricula))
+
+    return _leer_con_cache(('obtener_rasgos_mapa', (lon_min, lat_min, lon_max, lat_max), zoom,
+                            start_date_obj, end_date_obj, estatus_filtro, matricula), _afecta, _cargar)
+
+def obtener_perfil_patron(nombre_patron, limite_observaciones=50):
+    """
+    Perfil de un patrón a partir del índice de patrones: sus totales y última posición, las embarcaciones
+    en las que se le ha visto y sus observaciones más recientes. La comparación ignora acentos,
+    mayúsculas y puntuación. Si el nombre no coincide exactamente se devuelven las coincidencias parciales
+    en 'coincidencias' (y el perfil si solo hay una). Devuelve None si falla la consulta.
+    """
+    normalizado = _normalizar_nombre(nombre_patron)
+    if not normalizado:
+        return {'patron': None, 'embarcaciones': [], 'observaciones': [], 'coincidencias': []}
+
+    def _cargar():
+        conn = conectar_db()
+        if not conn: return None
+        cursor = conn.cursor()
+        try:
+            perfil = {'patron': None, 'embarcaciones': [], 'observaciones': [], 'coincidencias': []}
+            cursor.execute("SELECT * FROM patrones WHERE nombre_normalizado = %s;", (normalizado,))
+            patrones = _fetch_as_dict(cursor)
+            if not patrones:
+                cursor.execute("""
+                    SELECT * FROM patrones WHERE nombre_normalizado LIKE %s
+                    ORDER BY total_observaciones DESC LIMIT 20;
+                """, (f'%{normalizado}%',))
+                perfil['coincidencias'] = _fetch_as_dict(cursor)
+                if len(perfil['coincidencias']) != 1:
+                    return perfil
+                patrones = perfil['coincidencias']
+            patron = perfil['patron'] = patrones[0]
+            cursor.execute("""
+                SELECT e.matricula, e.nombre_embarcacion, e.tipo_embarcacion_id, pe.observaciones, pe.infracciones,
+                       pe.primera_observacion, pe.ultima_observacion
+                FROM patron_embarcacion pe
+                JOIN embarcaciones e ON e.id = pe.embarcacion_id
+                WHERE pe.patron_id = %s
+                ORDER BY pe.ultima_observacion DESC;
+            """, (patron['id'],))
+            perfil['embarcaciones'] = _fetch_as_dict(cursor)
+            cursor.execute(f"""
+                SELECT {_columnas_select(FilaObservacion)} FROM observaciones_embarcaciones
+                WHERE patron_id = %s
+                ORDER BY timestamp DESC
+                LIMIT %s;
+            """, (patron['id'], limite_observaciones))
+            perfil['observaciones'] = _fetch_filas(cursor, FilaObservacion)
+            return perfil
+        except psycopg2.Error as e:
+            print(f"Error al obtener el perfil del patrón en PostgreSQL: {e}")
+            return None
+        finally:
+            cursor.close()
+            conn.close()
+
+    return _leer_con_cache(('obtener_perfil_patron', normalizado, limite_observaciones),
+                           lambda fila: normalizado in _normalizar_nombre(fila.get('nombre_patron')),
+                           _cargar)
+
+def get_top_risk_vessels(limit=10):
+    """
+    Embarcaciones con mayor puntaje de riesgo (índice sobre puntaje_log), con el puntaje decaído a hoy.
+    """
+    def _cargar():
+        conn = conectar_db_lectura()
+        if not conn: return None
+        cursor = conn.cursor()
+        try:
+            cursor.execute("""
+                SELECT r.matricula, r.puntaje_log, r.actualizado, s.total_infracciones, s.ultima_observacion
+                FROM riesgo_embarcaciones r
+                LEFT JOIN resumen_embarcaciones s ON s.embarcacion_id = r.embarcacion_id
+                ORDER BY r.puntaje_log DESC
+                LIMIT %s;
+            """, (limit,))
+            results = _fetch_as_dict(cursor)
+            ahora = datetime.datetime.now()
+            for res in results:
+                res['score'] = round(puntaje_riesgo_actual(res['puntaje_log'], ahora), 2)
+            return results
+        except psycopg2.Error as e:
+            print(f"Error al obtener embarcaciones de mayor riesgo: {e}")
+            return None
+        finally:
+            if cursor: cursor.close()
+            if conn: conn.close()
+
+    return _leer_con_cache(('get_top_risk_vessels', limit), _afecta_tablero, _cargar) or []
+
+def obtener_historial_riesgo(matricula, limite=50):
+    """
+    Evolución del puntaje de riesgo de una embarcación: cada registro con el puntaje que tenía en ese
+    momento ('puntaje_en_fecha') y el motivo del cambio.
+    """
     conn = conectar_db()
     if not conn: return []
     cursor = conn.cursor()
     try:
-        # IDs de estatus que se consideran "infracción" o "delito"
-        infraction_status_ids = [
-            STATUS_CATEGORIES_INSIDE_ANP[5]['id'], # pesca_lgpas_issue
-            STATUS_CATEGORIES_INSIDE_ANP[6]['id'], # delito
-        ]
-        
-        # Filtramos por los estatus de infracción/delito y contamos las ocurrencias por matrícula
-        cursor.execute(f"""
-            SELECT matricula, COUNT(*) AS infraction_count, 
-                   array_agg(estatus_categoria_id) AS all_status_ids,
-                   array_agg(timestamp ORDER BY timestamp DESC) AS last_timestamps
-            FROM observaciones_embarcaciones
-            WHERE estatus_categoria_id IN %s
-            GROUP BY matricula
-            HAVING COUNT(*) >= %s
-            ORDER BY infraction_count DESC;
-        """, (tuple(infraction_status_ids), min_infractions))
-        
+        cursor.execute("""
+            SELECT h.registrado, h.puntaje_log, h.observacion_id, h.motivo
+            FROM riesgo_historial h
+            JOIN embarcaciones e ON e.id = h.embarcacion_id
+            WHERE e.matricula = %s
+            ORDER BY h.registrado DESC, h.id DESC
+            LIMIT %s;
+        """, (matricula.upper(), limite))
         results = _fetch_as_dict(cursor)
-        
-        # Opcional: para cada infracción, obtener el último timestamp
         for res in results:
-            if res['last_timestamps']:
-                res['last_infraction_date'] = max(res['last_timestamps']).strftime('%Y-%m-%d %H:%M')
-            else:
-                res['last_infraction_date'] = 'N/A'
-            # Convertir la lista de IDs de estatus a descripciones legibles
-            res['all_status_descriptions'] = []
-            for status_id in res['all_status_ids']:
-                if status_id == 'outside_anp':
-                    res['all_status_descriptions'].append("Fuera del Polígono ANP")
-                else:
-                    for cat_info in STATUS_CATEGORIES_INSIDE_ANP.values():
-                        if cat_info['id'] == status_id:
-                            res['all_status_descriptions'].append(cat_info['desc'])
-                            break
-        
+            res['puntaje_en_fecha'] = round(puntaje_riesgo_actual(res['puntaje_log'], res['registrado']), 2)
         return results
-
-    except Exception as e:
-        print(f"Error al obtener embarcaciones con infracciones repetidas: {e}")
+    except psycopg2.Error as e:
+        print(f"Error al obtener el historial de riesgo en PostgreSQL: {e}")
         return []
     finally:
-        if cursor: cursor.close()
-        if conn: conn.close()
+        cursor.close()
+        conn.close()
 
 
 def eliminar_observacion_db(id_observacion):
@@ -1008,9 +4090,16 @@ def eliminar_observacion_db(id_observacion):
     if not conn: return False
     cursor = conn.cursor()
     try:
-        cursor.execute("DELETE FROM observaciones_embarcaciones WHERE id = %s", (id_observacion,))
+        cursor.execute("DELETE FROM observaciones_embarcaciones WHERE id = %s RETURNING *", (id_observacion,))
+        filas_eliminadas = _fetch_as_dict(cursor)
+        afectadas = {fila['embarcacion_id'] for fila in filas_eliminadas}
+        _recalcular_resumen_embarcaciones(cursor, afectadas)
+        _recalcular_riesgo_embarcaciones(cursor, afectadas, motivo='eliminacion')
+        _recalcular_saltos_trayecto(cursor, afectadas)
+        _recalcular_patrones(cursor, {fila['patron_id'] for fila in filas_eliminadas})
         conn.commit()
-        if cursor.rowcount > 0:
+        _notificar_escritura(filas_eliminadas)
+        if filas_eliminadas:
             print(f"Observación con ID {id_observacion} eliminada exitosamente de PostgreSQL.")
             return True
         else:
@@ -1028,9 +4117,11 @@ def eliminar_observacion_db(id_observacion):
 def generar_reporte_word(fig, observations_data, title, filename_or_buffer="reporte_inspeccion.docx"):
     """
     Genera un documento Word (.docx) con el mapa de Matplotlib y un resumen de observaciones.
+    'fig' es la figura o el PNG ya dibujado (bytes, p. ej. de png_mapa_periodo).
     Acepta un buffer en memoria o un nombre de archivo para guardar.
-    Las 'observations_data' deben contener objetos datetime para el timestamp.
+    'observations_data' es un LoteObservaciones (o una lista de filas, que se convierte a lote).
     """
+    lote = observations_data if isinstance(observations_data, LoteObservaciones) else LoteObservaciones.desde_filas(observations_data)
     print(f"DEBUG_WORD: Intentando generar reporte Word '{filename_or_buffer}' desde cero...")
     document = Document() 
     
@@ -1040,8 +4131,11 @@ def generar_reporte_word(fig, observations_data, title, filename_or_buffer="repo
     temp_img_buffer = io.BytesIO() 
     try:
         print(f"DEBUG_WORD: Guardando imagen temporal del mapa en buffer...")
-        fig.savefig(temp_img_buffer, format='png', dpi=300, bbox_inches='tight', pad_inches=0.1)
-        plt.close(fig) 
+        if isinstance(fig, (bytes, bytearray)):
+            temp_img_buffer.write(fig)
+        else:
+            fig.savefig(temp_img_buffer, format='png', dpi=300, bbox_inches='tight', pad_inches=0.1)
+            plt.close(fig) 
         temp_img_buffer.seek(0) 
         print(f"DEBUG_WORD: Imagen temporal guardada en buffer.")
     except Exception as e:
@@ -1072,37 +4166,31 @@ def generar_reporte_word(fig, observations_data, title, filename_or_buffer="repo
         except locale.Error:
             print("ADVERTENCIA: No se pudo configurar el locale español. Los meses se mostrarán en inglés.")
 
-    sorted_observations = sorted(observations_data, key=lambda x: x.get('timestamp'))
-
-    for i, obs in enumerate(sorted_observations):
-        timestamp_dt_obj = obs.get('timestamp')
-        
-        if isinstance(timestamp_dt_obj, datetime.datetime):
-            date_str = timestamp_dt_obj.strftime('%d')
-            month_str = timestamp_dt_obj.strftime('%B')
-            year_str = timestamp_dt_obj.strftime('%Y')
-            time_str = timestamp_dt_obj.strftime('%H:%M')
+    # Todo lo que el párrafo necesita se obtiene del lote en forma vectorizada (y memorizada si el mapa ya lo pidió)
+    nombres_mes = [""] + [datetime.date(2000, m, 1).strftime('%B') for m in range(1, 13)]
+    fechas = lote.partes_fecha
+    lat_gmm, lon_gmm = lote.lat_gmm, lote.lon_gmm
+    desc_estatus = lote.desc_estatus
+    nombres = lote['nombre_embarcacion']
+    matriculas = lote['matricula']
+    patrones = lote['nombre_patron']
+    notas_col = lote['notas_adicionales']
+
+    for i, idx in enumerate(lote.orden_cronologico.tolist()):
+        if fechas['valido'][idx]:
+            date_str = f"{fechas['dia'][idx]:02d}"
+            month_str = nombres_mes[fechas['mes'][idx]]
+            year_str = str(fechas['anio'][idx])
+            time_str = f"{fechas['hora'][idx]:02d}:{fechas['minuto'][idx]:02d}"
         else:
             date_str, month_str, year_str, time_str = "N/A", "N/A", "N/A", "N/A"
-            print(f"ADVERTENCIA: Timestamp no es objeto datetime para reporte Word. Tipo: {type(timestamp_dt_obj)}. Usando N/A.")
-
-        lat_dd = obs.get('lat_dd') or obs.get('latitud_wgs84')
-        lon_dd = obs.get('lon_dd') or obs.get('longitud_wgs84')
-        lat_gmm = dd_to_gmm_str(lat_dd, True) if lat_dd is not None else "N/A"
-        lon_gmm = dd_to_gmm_str(lon_dd, False) if lon_dd is not None else "N/A"
+            print(f"ADVERTENCIA: Timestamp ausente para reporte Word. Usando N/A.")
 
-        vessel_name = obs.get('nombre_embarcacion', obs.get('name', 'N/A'))
-        matricula = obs.get('matricula', 'N/A')
-        nombre_patron = obs.get('nombre_patron', 'N/A')
-
-        status_id = obs.get('estatus_categoria_id') or obs.get('status_category_id')
-        status_desc = "Estatus Desconocido"
-        if status_id == "outside_anp": status_desc = "Fuera del Polígono ANP"
-        else:
-            # Buscar el estatus en STATUS_CATEGORIES_INSIDE_ANP por su 'id' de texto
-            for cat_info in STATUS_CATEGORIES_INSIDE_ANP.values():
-                if cat_info['id'] == status_id: status_desc = cat_info['desc']; break
-        notes = obs.get('notas_adicionales', '')
+        vessel_name = nombres[idx]
+        matricula = matriculas[idx]
+        nombre_patron = patrones[idx]
+        status_desc = desc_estatus[idx]
+        notes = notas_col[idx]
 
         patron_report_text = ""
         if nombre_patron and nombre_patron.strip().lower() != 'n/a':
@@ -1111,7 +4199,7 @@ def generar_reporte_word(fig, observations_data, title, filename_or_buffer="repo
         report_paragraph = document.add_paragraph()
         runner = report_paragraph.add_run(
             f"{i+1}.- El día {date_str} de {month_str} de {year_str} a las {time_str} horas "
-            f"en la situación geográfica {lat_gmm} y {lon_gmm} se detectó a la embarcación "
+            f"en la situación geográfica {lat_gmm[idx]} y {lon_gmm[idx]} se detectó a la embarcación "
             f"de nombre \"{vessel_name}\" matrícula {matricula}{patron_report_text}, fue reportada la situación de "
             f"{status_desc} teniendo como nota: {notes}."
         )
@@ -1127,12 +4215,15 @@ def generar_reporte_word(fig, observations_data, title, filename_or_buffer="repo
 
 
 # FUNCIÓN PARA GRAFICAR HISTORIAL O MAPA DE SESIÓN (SOLO MUESTRA EL MAPA)
-def graficar_mapa_general(registros_data, titulo_mapa, es_historial_individual=False):
+def graficar_mapa_general(registros_data, titulo_mapa, es_historial_individual=False, zona_geo=None):
     """
     Genera un mapa con las observaciones de embarcaciones, límites del ANP y leyendas.
-    'registros_data' debe contener objetos datetime para el timestamp.
+    'registros_data' es un LoteObservaciones (o una lista de filas, que se convierte a lote).
+    'zona_geo' es el polígono (WGS84) de una zona personalizada que se dibuja sobre el ANP.
     """
-    if not registros_data:
+    comprobar_cliente_conectado()
+    lote = registros_data if isinstance(registros_data, LoteObservaciones) else LoteObservaciones.desde_filas(registros_data or [])
+    if not len(lote):
         print(f"No hay registros para graficar para: {titulo_mapa}")
         return None, None
 
@@ -1155,72 +4246,54 @@ def graficar_mapa_general(registros_data, titulo_mapa, es_historial_individual=F
         ax.plot(x_pb_m, y_pb_m, color="saddlebrown", linewidth=0.8, zorder=4, alpha=0.7, label="Puerto Balleto")
         ax.fill(x_pb_m, y_pb_m, color="peru", alpha=0.6, zorder=3)
 
-    for nombre_isla, data_mercator in islas_menores_data_mercator.items():
-        if data_mercator["coords"]:
-            points_collection_m = MultiPoint(data_mercator["coords"])
-            ax.plot([p.x for p in points_collection_m.geoms], [p.y for p in points_collection_m.geoms],
-                    marker=data_mercator["marker"], color=data_mercator["color"], linestyle='None',
-                    markersize=6, label=nombre_isla, zorder=5, alpha=0.8)
-    
-    legend_elements_types_used_on_this_map = {}
-    
-    for i, data_point in enumerate(registros_data):
-        lon_wgs84 = data_point['longitud_wgs84']
-        lat_wgs84 = data_point['latitud_wgs84']
-        
-        x_m, y_m = transformer_geo_to_mercator.transform(lon_wgs84, lat_wgs84)
-        
-        v_type_id = data_point.get('tipo_embarcacion_id')
-        s_cat_id = data_point.get('estatus_categoria_id')
-        
-        if isinstance(v_type_id, int):
-            found_v_type = False
-            for k_str, v_info in VESSEL_TYPES.items():
-                if v_info['id'] == str(v_type_id):
-                    v_type_id = k_str 
-                    found_v_type = True
-                    break
-            if not found_v_type:
-                v_type_id = 'otra' 
-        elif v_type_id not in VESSEL_TYPES: 
-            v_type_id = 'otra'
-
-        marker_details = VESSEL_TYPES.get(v_type_id, DEFAULT_VESSEL_TYPE_INFO)
-        
-        color = STATUS_COLORS.get("unknown_status") 
-        if s_cat_id == "outside_anp":
-            color = STATUS_COLORS["outside_anp"]
-        else:
-            for cat_info in STATUS_CATEGORIES_INSIDE_ANP.values():
-                if cat_info['id'] == s_cat_id:
-                    color = STATUS_COLORS[cat_info['color_key']]
-                    break
-        
-        if marker_details['desc'] not in legend_elements_types_used_on_this_map:
-            legend_elements_types_used_on_this_map[marker_details['desc']] = plt.Line2D([0],[0], marker=marker_details['marker_char'], color='w', label=marker_details['desc'], linestyle='None', markeredgecolor='black', markerfacecolor='dimgray', markersize=7)
+    for nombre_isla, data_mercator in islas_menores_data_mercator.items():
+        if data_mercator["coords"]:
+            points_collection_m = MultiPoint(data_mercator["coords"])
+            ax.plot([p.x for p in points_collection_m.geoms], [p.y for p in points_collection_m.geoms],
+                    marker=data_mercator["marker"], color=data_mercator["color"], linestyle='None',
+                    markersize=6, label=nombre_isla, zorder=5, alpha=0.8)
 
-        ax.scatter(x_m, y_m, 
-                   marker=marker_details['marker_char'], color=color, 
-                   s=marker_details['size_factor'] * (0.7 if es_historial_individual else 0.5), 
+    if zona_geo is not None:
+        poligonos = zona_geo.geoms if zona_geo.geom_type == 'MultiPolygon' else [zona_geo]
+        for i, poligono in enumerate(poligonos):
+            x_zona_m, y_zona_m = transformer_geo_to_mercator.transform(*poligono.exterior.xy)
+            ax.plot(x_zona_m, y_zona_m, color="darkorange", linewidth=1.8, linestyle='--', zorder=6,
+                    label="Zona del Reporte" if i == 0 else None)
+    
+    legend_elements_types_used_on_this_map = {}
+    factor_tamano = 0.7 if es_historial_individual else 0.5
+    x_merc, y_merc = lote.x, lote.y
+    colores = lote.colores
+    codigo_tipo = lote.codigo_tipo
+
+    # Un scatter por tipo de embarcación (un marcador por llamada) con el color de estatus por punto
+    for codigo, v_type_id in enumerate(CODIGOS_TIPO):
+        mascara = codigo_tipo == codigo
+        if not mascara.any():
+            continue
+        marker_details = VESSEL_TYPES[v_type_id]
+        legend_elements_types_used_on_this_map[marker_details['desc']] = plt.Line2D([0],[0], marker=marker_details['marker_char'], color='w', label=marker_details['desc'], linestyle='None', markeredgecolor='black', markerfacecolor='dimgray', markersize=7)
+        ax.scatter(x_merc[mascara], y_merc[mascara], 
+                   marker=marker_details['marker_char'], color=colores[mascara].tolist(), 
+                   s=marker_details['size_factor'] * factor_tamano, 
                    edgecolors='black', linewidths=0.4, zorder=10, alpha=0.75)
-        
-        ts_obj = data_point['timestamp']
-        ts_fmt = ts_obj.strftime('%y-%m-%d %H:%M')
-        
-        status_desc_display = "Estatus Desconocido"
-        found_status_desc = False
-        for cat_info in STATUS_CATEGORIES_INSIDE_ANP.values():
-            if cat_info['id'] == s_cat_id: status_desc_display = cat_info['desc']; found_status_desc = True; break
-        if not found_status_desc and s_cat_id == "outside_anp": status_desc_display = "Fuera del Polígono ANP"
-        
-        if es_historial_individual or len(registros_data) < 15: 
-            patron_map_text = f"C. {data_point.get('nombre_patron', 'N/A')}" if data_point.get('nombre_patron') and data_point['nombre_patron'].strip().lower() != 'n/a' else "N/A"
-            annot_text = (f"{data_point['matricula']}\nPatrón: {patron_map_text}\n{ts_fmt}\n{status_desc_display}")
-            ax.annotate(annot_text, (x_m, y_m),
-                        xytext=(0, marker_details['size_factor'] * (0.7 if es_historial_individual else 0.5) * 0.05 + 7), 
+
+    if es_historial_individual or len(lote) < 15: 
+        timestamps = lote.timestamps
+        desc_estatus = lote.desc_estatus
+        matriculas = lote['matricula']
+        patrones = lote['nombre_patron']
+        for idx in range(len(lote)):
+            marker_details = VESSEL_TYPES[CODIGOS_TIPO[codigo_tipo[idx]]]
+            ts_fmt = timestamps[idx].strftime('%y-%m-%d %H:%M')
+            nombre_patron = patrones[idx]
+            patron_map_text = f"C. {nombre_patron}" if nombre_patron and nombre_patron.strip().lower() != 'n/a' else "N/A"
+            annot_text = (f"{matriculas[idx]}\nPatrón: {patron_map_text}\n{ts_fmt}\n{desc_estatus[idx]}")
+            ax.annotate(annot_text, (x_merc[idx], y_merc[idx]),
+                        xytext=(0, marker_details['size_factor'] * factor_tamano * 0.05 + 7), 
                         textcoords='offset points', fontsize=4 if not es_historial_individual else 5.5, 
                         ha='center', va='bottom',
-                        bbox=dict(boxstyle="round,pad=0.1", fc=color, alpha=0.6, ec='none'))
+                        bbox=dict(boxstyle="round,pad=0.1", fc=colores[idx], alpha=0.6, ec='none'))
     
     ax.set_xlabel("X (Web Mercator)"); ax.set_ylabel("Y (Web Mercator)")
     try: cx.add_basemap(ax, crs=crs_mercator.to_string(), source=cx.providers.Esri.WorldImagery, zorder=0, alpha=0.9)
@@ -1274,6 +4347,908 @@ def graficar_mapa_general(registros_data, titulo_mapa, es_historial_individual=F
     return fig, ax 
 
 
+# 6.3 --- ÍNDICE ESPACIAL EN MEMORIA ("EMBARCACIONES CERCA DE AQUÍ") ---
+# Rejilla de celdas de INDICE_ESPACIAL_CELDA_GRADOS por lado, fragmentada por mes: cada fragmento es un
+# diccionario celda -> {id: punto}. Se construye al arrancar el worker y se pone al día con los cambios
+# registrados por los triggers de la exportación incremental (columna 'xact' y 'observaciones_eliminadas'),
+# de modo que también ve lo escrito por otros workers, por la importación CSV o por los comandos de
+# mantenimiento. Una escritura de este worker fuerza la puesta al día antes de la siguiente consulta.
+INDICE_ESPACIAL_ACTIVO = os.environ.get('INDICE_ESPACIAL_ACTIVO', '1') == '1'
+INDICE_ESPACIAL_CELDA_GRADOS = float(os.environ.get('INDICE_ESPACIAL_CELDA_GRADOS', '0.01')) # ~1.1 km
+INDICE_ESPACIAL_INTERVALO = float(os.environ.get('INDICE_ESPACIAL_INTERVALO', '5'))
+INDICE_ESPACIAL_RADIO_MAX_KM = float(os.environ.get('INDICE_ESPACIAL_RADIO_MAX_KM', '100'))
+INDICE_ESPACIAL_MAX_RESULTADOS = int(os.environ.get('INDICE_ESPACIAL_MAX_RESULTADOS', '1000'))
+RADIO_TIERRA_KM = 6371.0088
+KM_POR_GRADO = math.pi * RADIO_TIERRA_KM / 180
+
+def _distancia_km(lon1, lat1, lon2, lat2):
+    """Distancia de gran círculo (haversine) en kilómetros."""
+    p1, p2 = math.radians(lat1), math.radians(lat2)
+    a = math.sin((p2 - p1) / 2) ** 2 + math.cos(p1) * math.cos(p2) * math.sin(math.radians(lon2 - lon1) / 2) ** 2
+    return 2 * RADIO_TIERRA_KM * math.asin(min(1.0, math.sqrt(a)))
+
+def _distancias_km(lon1, lat1, lon2, lat2):
+    """Igual que _distancia_km, elemento a elemento sobre arreglos de NumPy."""
+    p1, p2 = np.radians(lat1), np.radians(lat2)
+    a = np.sin((p2 - p1) / 2) ** 2 + np.cos(p1) * np.cos(p2) * np.sin(np.radians(np.subtract(lon2, lon1)) / 2) ** 2
+    return 2 * RADIO_TIERRA_KM * np.arcsin(np.minimum(1.0, np.sqrt(a)))
+
+class IndiceEspacialObservaciones:
+    """
+    Índice de posiciones de observaciones para búsquedas por radio y de los k más cercanos con filtro
+    de tiempo. Cada punto es (id, longitud, latitud, timestamp, matricula, estatus_categoria_id).
+    """
+    def __init__(self, celda_grados):
+        self.celda = celda_grados
+        self._fragmentos = {} # inicio de mes -> {(ix, iy): {id: punto}}
+        self._ubicacion = {} # id -> (inicio de mes, (ix, iy))
+        self._lock = threading.Lock() # protege las estructuras
+        self._lock_sincronizacion = threading.Lock() # una sola construcción/puesta al día a la vez
+        self._cursor_xact = None # xmin de la última lectura; None = sin construir
+        self._ultima_sincronizacion = 0.0
+        self._pendiente = False
+        self.construcciones = 0
+        self.puestas_al_dia = 0
+
+    def _celda_de(self, lon, lat):
+        return (math.floor(lon / self.celda), math.floor(lat / self.celda))
+
+    def _insertar(self, fragmentos, ubicacion, punto):
+        mes = _inicio_mes(punto[3])
+        celda = self._celda_de(punto[1], punto[2])
+        fragmentos.setdefault(mes, {}).setdefault(celda, {})[punto[0]] = punto
+        ubicacion[punto[0]] = (mes, celda)
+
+    def _quitar(self, id_observacion):
+        mes, celda = self._ubicacion.pop(id_observacion, (None, None))
+        if mes is None:
+            return
+        celdas = self._fragmentos[mes]
+        del celdas[celda][id_observacion]
+        if not celdas[celda]:
+            del celdas[celda]
+            if not celdas:
+                del self._fragmentos[mes]
+
+    @staticmethod
+    def _punto(fila):
+        id_observacion, lon, lat, ts, matricula, estatus = fila
+        # Las matrículas y estatus se repiten mucho: se comparte una sola copia de cada cadena
+        return (id_observacion, float(lon), float(lat), ts,
+                sys.intern(matricula) if matricula else matricula, sys.intern(estatus) if estatus else estatus)
+
+    def marcar_pendiente(self):
+        self._pendiente = True
+
+    def sincronizar(self):
+        """
+        Construye el índice si no existe o lo pone al día si hubo escrituras en este worker o pasaron más de
+        INDICE_ESPACIAL_INTERVALO segundos. Devuelve False si el índice no está disponible (base de datos caída).
+        """
+        if self._cursor_xact is not None and not self._pendiente \
+                and time.monotonic() - self._ultima_sincronizacion < INDICE_ESPACIAL_INTERVALO:
+            return True
+        with self._lock_sincronizacion:
+            if self._cursor_xact is not None and not self._pendiente \
+                    and time.monotonic() - self._ultima_sincronizacion < INDICE_ESPACIAL_INTERVALO:
+                return True
+            self._pendiente = False
+            conn = conectar_db_lectura()
+            if not conn:
+                self._pendiente = True
+                return self._cursor_xact is not None # Se responde con lo que ya hay
+            try:
+                cursor = conn.cursor()
+                cursor.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ, READ ONLY;")
+                cursor.execute("SELECT pg_snapshot_xmin(pg_current_snapshot())::text::bigint, xact_depurado FROM delta_estado;")
+                nuevo_xact, xact_depurado = cursor.fetchone()
+                columnas = "id, longitud_wgs84, latitud_wgs84, timestamp, matricula, estatus_categoria_id"
+                desde_xact = self._cursor_xact
+                # Si se depuraron borrados que aún no se habían aplicado, no se puede seguir incrementalmente
+                if desde_xact is None or (xact_depurado is not None and desde_xact <= xact_depurado):
+                    cursor_servidor = conn.cursor(name='indice_espacial')
+                    cursor_servidor.itersize = DELTA_LOTE_FILAS
+                    cursor_servidor.execute(f"SELECT {columnas} FROM observaciones_embarcaciones WHERE timestamp IS NOT NULL;")
+                    fragmentos, ubicacion = {}, {}
+                    for fila in cursor_servidor:
+                        self._insertar(fragmentos, ubicacion, self._punto(fila))
+                    cursor_servidor.close()
+                    with self._lock:
+                        self._fragmentos, self._ubicacion = fragmentos, ubicacion
+                    self.construcciones += 1
+                    print(f"Índice espacial construido: {len(ubicacion)} observaciones en {len(fragmentos)} meses.")
+                else:
+                    cursor.execute("SELECT id FROM observaciones_eliminadas WHERE xact >= %s;", (desde_xact,))
+                    eliminadas = [fila[0] for fila in cursor.fetchall()]
+                    cursor.execute(f"SELECT {columnas} FROM observaciones_embarcaciones "
+                                   f"WHERE xact >= %s AND timestamp IS NOT NULL;", (desde_xact,))
+                    cambiadas = [self._punto(fila) for fila in cursor.fetchall()]
+                    with self._lock:
+                        for id_observacion in eliminadas:
+                            self._quitar(id_observacion)
+                        for punto in cambiadas:
+                            self._quitar(punto[0])
+                            self._insertar(self._fragmentos, self._ubicacion, punto)
+                    self.puestas_al_dia += 1
+                conn.commit()
+                self._cursor_xact = nuevo_xact
+                self._ultima_sincronizacion = time.monotonic()
+                return True
+            except psycopg2.Error as e:
+                self._pendiente = True
+                print(f"Error al sincronizar el índice espacial: {e}")
+                return self._cursor_xact is not None
+            finally:
+                conn.close()
+
+    def _candidatos(self, celdas, desde, hasta, estatus):
+        """Puntos de las celdas indicadas dentro del periodo [desde, hasta] (None = sin límite)."""
+        for mes, fragmento in self._fragmentos.items():
+            if (desde and _mes_siguiente(mes) <= desde) or (hasta and mes > hasta):
+                continue
+            mes_completo = (not desde or mes >= desde) and (not hasta or _mes_siguiente(mes) <= hasta)
+            for celda in celdas:
+                puntos = fragmento.get(celda)
+                if not puntos:
+                    continue
+                for punto in puntos.values():
+                    if estatus and punto[5] != estatus:
+                        continue
+                    if not mes_completo and ((desde and punto[3] < desde) or (hasta and punto[3] > hasta)):
+                        continue
+                    yield punto
+
+    def en_radio(self, lon, lat, radio_km, desde=None, hasta=None, estatus=None):
+        """Puntos a no más de 'radio_km' de (lon, lat), del más cercano al más lejano, como (distancia, punto)."""
+        d_lat = radio_km / KM_POR_GRADO
+        d_lon = radio_km / (KM_POR_GRADO * max(math.cos(math.radians(min(abs(lat) + d_lat, 89.0))), 1e-6))
+        ix0, iy0 = self._celda_de(lon - d_lon, lat - d_lat)
+        ix1, iy1 = self._celda_de(lon + d_lon, lat + d_lat)
+        celdas = [(ix, iy) for ix in range(ix0, ix1 + 1) for iy in range(iy0, iy1 + 1)]
+        with self._lock:
+            resultado = [(d, punto) for punto in self._candidatos(celdas, desde, hasta, estatus)
+                         for d in (_distancia_km(lon, lat, punto[1], punto[2]),) if d <= radio_km]
+        resultado.sort(key=lambda par: par[0])
+        return resultado
+
+    def mas_cercanos(self, lon, lat, k, radio_max_km, desde=None, hasta=None, estatus=None):
+        """
+        Los 'k' puntos más cercanos a (lon, lat) dentro de 'radio_max_km', como (distancia, punto).
+        Recorre anillos de celdas alrededor del punto hasta que ningún anillo siguiente puede mejorar el k-ésimo.
+        """
+        cx, cy = self._celda_de(lon, lat)
+        # Lado mínimo de una celda en km (en longitud se encoge con la latitud)
+        lado_km = self.celda * KM_POR_GRADO * max(math.cos(math.radians(min(abs(lat) + radio_max_km / KM_POR_GRADO, 89.0))), 1e-6)
+        anillo_max = int(radio_max_km / lado_km) + 1
+        mejores = [] # montículo de (-distancia, id, punto) con los k mejores
+        with self._lock:
+            for r in range(anillo_max + 1):
+                # Cualquier punto del anillo r está al menos a (r - 1) celdas completas del punto buscado
+                if len(mejores) == k and -mejores[0][0] <= (r - 1) * lado_km:
+                    break
+                if r == 0:
+                    celdas = [(cx, cy)]
+                else:
+                    celdas = [(cx + dx, cy + dy) for dx in range(-r, r + 1) for dy in (-r, r)] + \
+                             [(cx + dx, cy + dy) for dx in (-r, r) for dy in range(-r + 1, r)]
+                for punto in self._candidatos(celdas, desde, hasta, estatus):
+                    d = _distancia_km(lon, lat, punto[1], punto[2])
+                    if d > radio_max_km:
+                        continue
+                    if len(mejores) < k:
+                        heapq.heappush(mejores, (-d, punto[0], punto))
+                    elif d < -mejores[0][0]:
+                        heapq.heapreplace(mejores, (-d, punto[0], punto))
+        return sorted(((-d, punto) for d, _, punto in mejores), key=lambda par: par[0])
+
+    def estadisticas(self):
+        with self._lock:
+            return {
+                'construido': self._cursor_xact is not None,
+                'observaciones': len(self._ubicacion),
+                'meses': len(self._fragmentos),
+                'celdas': sum(len(celdas) for celdas in self._fragmentos.values()),
+                'construcciones': self.construcciones,
+                'puestas_al_dia': self.puestas_al_dia,
+                'segundos_desde_sincronizacion': round(time.monotonic() - self._ultima_sincronizacion, 1)
+                                                 if self._cursor_xact is not None else None,
+            }
+
+indice_espacial = IndiceEspacialObservaciones(INDICE_ESPACIAL_CELDA_GRADOS)
+
+@registrar_gancho_post_escritura
+def _marcar_indice_espacial_pendiente(filas):
+    indice_espacial.marcar_pendiente()
+
+if INDICE_ESPACIAL_ACTIVO and DATABASE_URL:
+    # Se construye en segundo plano con la primera petición del worker; una consulta que llegue antes
+    # espera a que termine (sincronizar comparte el mismo candado).
+    registrar_hilo_fondo('indice-espacial')(indice_espacial.sincronizar)
+
+
+
+# 6.4 --- ENCUENTROS ENTRE EMBARCACIONES ---
+# Dos embarcaciones distintas vistas a menos de ENCUENTROS_DISTANCIA_M metros y ENCUENTROS_MINUTOS minutos
+# (transbordos, nodriza con pangas). Los pares se buscan con una rejilla espacio-temporal: cada observación
+# cae en una celda (t, y, x) del tamaño de los umbrales y solo se compara con las de su celda y las 26
+# vecinas, nunca con todas. La tabla 'encuentros' se pone al día de forma incremental con los cambios que
+# registran los triggers de la exportación incremental ('xact' y 'observaciones_eliminadas'): un hilo en
+# segundo plano procesa lo nuevo tras cada escritura del worker o cada ENCUENTROS_INTERVALO segundos, y un
+# candado consultivo evita que dos workers lo hagan a la vez. Si cambian los umbrales se recalcula todo.
+ENCUENTROS_ACTIVO = os.environ.get('ENCUENTROS_ACTIVO', '1') == '1'
+ENCUENTROS_DISTANCIA_M = float(os.environ.get('ENCUENTROS_DISTANCIA_M', '500'))
+ENCUENTROS_MINUTOS = float(os.environ.get('ENCUENTROS_MINUTOS', '30'))
+ENCUENTROS_INTERVALO = float(os.environ.get('ENCUENTROS_INTERVALO', '60'))
+_CANDADO_ENCUENTROS = 4704701 # pg_advisory_xact_lock: una sola puesta al día a la vez
+
+def _pares_cercanos(segundos, lon, lat, distancia_m, ventana_segundos):
+    """
+    Índices (i, j), con i < j, de los pares de puntos a no más de 'distancia_m' metros y 'ventana_segundos'
+    segundos, y su distancia en metros. 'segundos' son los instantes como número (p. ej. época Unix).
+    """
+    vacio = np.empty(0, dtype=np.intp)
+    n = len(segundos)
+    if n < 2:
+        return vacio, vacio, np.empty(0)
+    # Proyección equirectangular con el coseno de la latitud más alejada del ecuador, para que ninguna
+    # celda mida menos de 'distancia_m' de ancho
+    metros_por_grado = KM_POR_GRADO * 1000
+    coseno = max(math.cos(math.radians(min(float(np.abs(lat).max()), 89.0))), 1e-6)
+    cx = np.floor(lon * (metros_por_grado * coseno / distancia_m)).astype(np.int64)
+    cy = np.floor(lat * (metros_por_grado / distancia_m)).astype(np.int64)
+    ct = np.floor(segundos / ventana_segundos).astype(np.int64)
+    # Celdas numeradas desde 1 para que las vecinas (±1) sigan dentro del rango de la clave
+    cx -= cx.min() - 1
+    cy -= cy.min() - 1
+    ct -= ct.min() - 1
+    nx, ny = int(cx.max()) + 2, int(cy.max()) + 2
+    claves = (ct * ny + cy) * nx + cx
+    orden = np.argsort(claves, kind='stable')
+    ordenadas = claves[orden]
+    todos = np.arange(n)
+    pares_i, pares_j = [], []
+    for dt in (-1, 0, 1):
+        for dy in (-1, 0, 1):
+            for dx in (-1, 0, 1):
+                vecinas = claves + (dt * ny + dy) * nx + dx
+                inicio = np.searchsorted(ordenadas, vecinas, 'left')
+                cuantos = np.searchsorted(ordenadas, vecinas, 'right') - inicio
+                total = int(cuantos.sum())
+                if not total:
+                    continue
+                # Cada punto contra todos los de la celda vecina: i repetido y j recorriendo el tramo ordenado
+                i = np.repeat(todos, cuantos)
+                desplazamiento = np.arange(total) - np.repeat(np.cumsum(cuantos) - cuantos, cuantos)
+                j = orden[np.repeat(inicio, cuantos) + desplazamiento]
+                mantener = i < j
+                pares_i.append(i[mantener])
+                pares_j.append(j[mantener])
+    if not pares_i:
+        return vacio, vacio, np.empty(0)
+    i, j = np.concatenate(pares_i), np.concatenate(pares_j)
+    cerca_en_tiempo = np.abs(segundos[i] - segundos[j]) <= ventana_segundos
+    i, j = i[cerca_en_tiempo], j[cerca_en_tiempo]
+    metros = _distancias_km(lon[i], lat[i], lon[j], lat[j]) * 1000
+    cerca = metros <= distancia_m
+    return i[cerca], j[cerca], metros[cerca]
+
+def _insertar_encuentros(cursor, filas, ids_nuevos=None):
+    """
+    Busca los encuentros entre las filas (id, matricula, timestamp, longitud, latitud) y los inserta.
+    Con 'ids_nuevos' solo se guardan los pares en los que participa alguna de esas observaciones.
+    Devuelve cuántos encuentros se insertaron.
+    """
+    if len(filas) < 2:
+        return 0
+    ids, matriculas, marcas, lon, lat = (np.array(columna, dtype=object) for columna in zip(*filas))
+    ids, lon, lat = ids.astype(np.int64), lon.astype(float), lat.astype(float)
+    segundos = marcas.astype('datetime64[s]').astype(np.int64).astype(float)
+    i, j, metros = _pares_cercanos(segundos, lon, lat, ENCUENTROS_DISTANCIA_M, ENCUENTROS_MINUTOS * 60)
+    mantener = matriculas[i] != matriculas[j]
+    if ids_nuevos is not None:
+        nuevo = np.isin(ids, list(ids_nuevos))
+        mantener &= nuevo[i] | nuevo[j]
+    i, j, metros = i[mantener], j[mantener], metros[mantener]
+    # La observación 'a' es siempre la de id menor, para que cada par tenga una sola fila
+    a, b = np.where(ids[i] < ids[j], i, j), np.where(ids[i] < ids[j], j, i)
+    if not len(a):
+        return 0
+    psycopg2.extras.execute_values(cursor, """
+        INSERT INTO encuentros (observacion_a, observacion_b, matricula_a, matricula_b, timestamp_a, timestamp_b,
+                                longitud_a, latitud_a, longitud_b, latitud_b, distancia_m, minutos)
+        VALUES %s ON CONFLICT DO NOTHING
+    """, [(int(ids[x]), int(ids[y]), matriculas[x], matriculas[y], marcas[x], marcas[y],
+           float(lon[x]), float(lat[x]), float(lon[y]), float(lat[y]), round(float(m), 1),
+           round(abs(float(segundos[x] - segundos[y])) / 60, 1))
+          for x, y, m in zip(a.tolist(), b.tolist(), metros.tolist())], page_size=1000)
+    return len(a)
+
+def _observaciones_en_ventanas(cursor, filas, columnas, minutos=None):
+    """
+    Observaciones a no más de 'minutos' (ENCUENTROS_MINUTOS por defecto) de alguna de las filas, cuyo
+    timestamp es el tercer valor (ventanas de tiempo unidas).
+    """
+    margen = datetime.timedelta(minutes=ENCUENTROS_MINUTOS if minutos is None else minutos)
+    ventanas = []
+    for ts in sorted(fila[2] for fila in filas):
+        if ventanas and ts - margen <= ventanas[-1][1]:
+            ventanas[-1][1] = ts + margen
+        else:
+            ventanas.append([ts - margen, ts + margen])
+    cursor.execute(f"""
+        SELECT {', '.join('o.' + c for c in columnas.split(', '))}
+        FROM observaciones_embarcaciones o
+        JOIN unnest(%s::timestamp[], %s::timestamp[]) AS v(desde, hasta) ON o.timestamp BETWEEN v.desde AND v.hasta;
+    """, ([v[0] for v in ventanas], [v[1] for v in ventanas]))
+    return cursor.fetchall()
+
+def _bloques_por_tiempo(cursor_servidor, minutos):
+    """
+    Recorre un cursor de servidor ordenado por timestamp (tercer valor de cada fila) en bloques de
+    DELTA_LOTE_FILAS filas, sin cargar la tabla entera. Cada bloque va precedido de las filas ya recorridas a
+    no más de 'minutos' del final del bloque anterior, para que también se encuentren los pares que cruzan el corte.
+    Produce (filas, n_contexto): las primeras n_contexto filas ya se recorrieron en el bloque anterior.
+    """
+    margen = datetime.timedelta(minutes=minutos)
+    contexto = []
+    while True:
+        bloque = cursor_servidor.fetchmany(DELTA_LOTE_FILAS)
+        if not bloque:
+            return
+        filas = contexto + bloque
+        yield filas, len(contexto)
+        limite = bloque[-1][2] - margen
+        inicio = len(filas)
+        while inicio and filas[inicio - 1][2] >= limite:
+            inicio -= 1
+        contexto = filas[inicio:]
+
+def actualizar_encuentros(completo=False):
+    """
+    Pone al día la tabla 'encuentros' con las observaciones nuevas, editadas o borradas desde la última
+    vez (o la recalcula entera). Devuelve (observaciones comparadas, encuentros insertados), o None si otro
+    proceso la está actualizando o la base de datos no responde.
+    """
+    conn = conectar_db()
+    if not conn: return None
+    cursor = conn.cursor()
+    try:
+        cursor.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ;")
+        cursor.execute("SELECT pg_try_advisory_xact_lock(%s);", (_CANDADO_ENCUENTROS,))
+        if not cursor.fetchone()[0]:
+            conn.rollback()
+            return None
+        cursor.execute("""
+            SELECT pg_snapshot_xmin(pg_current_snapshot())::text::bigint, d.xact_depurado, e.xact_procesado, e.umbrales
+            FROM delta_estado d, encuentros_estado e;
+        """)
+        nuevo_xact, xact_depurado, desde_xact, umbrales_guardados = cursor.fetchone()
+        umbrales = f"{ENCUENTROS_DISTANCIA_M:g} m / {ENCUENTROS_MINUTOS:g} min"
+        # Si se depuraron borrados que aún no se habían aplicado, no se puede seguir incrementalmente
+        completo = (completo or desde_xact is None or umbrales_guardados != umbrales
+                    or (xact_depurado is not None and desde_xact <= xact_depurado))
+        columnas = "id, matricula, timestamp, longitud_wgs84, latitud_wgs84"
+        if completo:
+            cursor.execute("DELETE FROM encuentros;")
+            cursor_servidor = conn.cursor(name='encuentros_completo')
+            cursor_servidor.itersize = DELTA_LOTE_FILAS
+            cursor_servidor.execute(f"SELECT {columnas} FROM observaciones_embarcaciones "
+                                    f"WHERE timestamp IS NOT NULL ORDER BY timestamp;")
+            comparadas = insertados = 0
+            for filas, n_contexto in _bloques_por_tiempo(cursor_servidor, ENCUENTROS_MINUTOS):
+                # Los pares entre filas de contexto ya se guardaron con el bloque anterior
+                nuevas = {fila[0] for fila in filas[n_contexto:]} if n_contexto else None
+                insertados += _insertar_encuentros(cursor, filas, nuevas)
+                comparadas += len(filas) - n_contexto
+            cursor_servidor.close()
+        else:
+            cursor.execute("SELECT id FROM observaciones_eliminadas WHERE xact >= %s;", (desde_xact,))
+            eliminadas = [fila[0] for fila in cursor.fetchall()]
+            cursor.execute(f"SELECT {columnas} FROM observaciones_embarcaciones WHERE xact >= %s AND timestamp IS NOT NULL;",
+                           (desde_xact,))
+            cambiadas = cursor.fetchall()
+            ids_cambiados = [fila[0] for fila in cambiadas] + eliminadas
+            if ids_cambiados:
+                # Las editadas pierden sus encuentros anteriores y se vuelven a comparar con su posición nueva
+                cursor.execute("DELETE FROM encuentros WHERE observacion_a = ANY(%s) OR observacion_b = ANY(%s);",
+                               (ids_cambiados, ids_cambiados))
+            filas = _observaciones_en_ventanas(cursor, cambiadas, columnas) if cambiadas else []
+            insertados = _insertar_encuentros(cursor, filas, {fila[0] for fila in cambiadas})
+            comparadas = len(filas)
+        cursor.execute("UPDATE encuentros_estado SET xact_procesado = %s, umbrales = %s, actualizado = now();",
+                       (nuevo_xact, umbrales))
+        conn.commit()
+        if completo:
+            print(f"Encuentros recalculados: {insertados} entre {comparadas} observaciones ({umbrales}).")
+        return comparadas, insertados
+    except psycopg2.Error as e:
+        conn.rollback()
+        print(f"Error al actualizar los encuentros entre embarcaciones: {e}")
+        return None
+    finally:
+        cursor.close()
+        conn.close()
+
+_aviso_encuentros = threading.Event()
+
+@registrar_gancho_post_escritura
+def _avisar_detector_encuentros(filas):
+    _aviso_encuentros.set()
+
+def _hilo_encuentros():
+    """Bucle del hilo de fondo 'encuentros' (ver registrar_hilo_fondo)."""
+    while True:
+        _aviso_encuentros.clear()
+        try:
+            actualizar_encuentros()
+        except Exception as e:
+            print(f"Error inesperado en la detección de encuentros: {e}")
+        _aviso_encuentros.wait(ENCUENTROS_INTERVALO)
+
+if ENCUENTROS_ACTIVO and DATABASE_URL:
+    registrar_hilo_fondo('encuentros')(_hilo_encuentros)
+
+def obtener_encuentros_embarcacion(matricula, limite=100):
+    """Encuentros más recientes de una embarcación, con la otra matrícula, el momento y el punto medio."""
+    conn = conectar_db_lectura()
+    if not conn: return []
+    cursor = conn.cursor()
+    try:
+        cursor.execute("""
+            SELECT CASE WHEN matricula_a = %s THEN matricula_b ELSE matricula_a END AS otra_matricula,
+                   LEAST(timestamp_a, timestamp_b) AS timestamp, distancia_m, minutos,
+                   (latitud_a + latitud_b) / 2 AS latitud, (longitud_a + longitud_b) / 2 AS longitud,
+                   observacion_a, observacion_b
+            FROM encuentros
+            WHERE matricula_a = %s OR matricula_b = %s
+            ORDER BY timestamp DESC LIMIT %s;
+        """, (matricula, matricula, matricula, limite))
+        return _fetch_as_dict(cursor)
+    except psycopg2.Error as e:
+        print(f"Error al obtener los encuentros de '{matricula}': {e}")
+        return []
+    finally:
+        cursor.close()
+        conn.close()
+
+def obtener_encuentros_mapa(bbox, start_date_obj=None, end_date_obj=None, matricula=None):
+    """
+    FeatureCollection de los encuentros con algún extremo dentro de 'bbox' (línea entre las dos
+    observaciones), hasta MAPA_MAX_PUNTOS. None si la consulta falla.
+    """
+    conn = conectar_db_lectura()
+    if not conn: return None
+    cursor = conn.cursor()
+    condiciones = "(point(longitud_a, latitud_a) <@ box(point(%s, %s), point(%s, %s)) " \
+                  "OR point(longitud_b, latitud_b) <@ box(point(%s, %s), point(%s, %s)))"
+    params = list(bbox) * 2
+    if start_date_obj and end_date_obj:
+        condiciones += " AND timestamp_a BETWEEN %s AND %s"
+        params += [start_date_obj, end_date_obj]
+    if matricula:
+        condiciones += " AND (matricula_a = %s OR matricula_b = %s)"
+        params += [matricula, matricula]
+    try:
+        cursor.execute(f"""
+            SELECT matricula_a, matricula_b, timestamp_a, longitud_a, latitud_a, longitud_b, latitud_b, distancia_m, minutos
+            FROM encuentros WHERE {condiciones} ORDER BY timestamp_a DESC LIMIT %s;
+        """, params + [MAPA_MAX_PUNTOS])
+        filas = cursor.fetchall()
+    except psycopg2.Error as e:
+        print(f"Error al consultar los encuentros para el mapa: {e}")
+        return None
+    finally:
+        cursor.close()
+        conn.close()
+    return {'type': 'FeatureCollection', 'features': [
+        {'type': 'Feature',
+         'geometry': {'type': 'LineString', 'coordinates': [[lon_a, lat_a], [lon_b, lat_b]]},
+         'properties': {'matricula_a': mat_a, 'matricula_b': mat_b, 'timestamp': ts.strftime('%Y-%m-%d %H:%M'),
+                        'distancia_m': distancia, 'minutos': minutos}}
+        for mat_a, mat_b, ts, lon_a, lat_a, lon_b, lat_b, distancia, minutos in filas]}
+
+
+# 6.5 --- TRAYECTOS Y SALTOS IMPLAUSIBLES ---
+# El trayecto de una embarcación une sus observaciones en orden de tiempo; con la distancia ortodrómica y el
+# tiempo de cada tramo se obtiene la velocidad implícita. Un tramo de más de TRAYECTOS_DISTANCIA_MINIMA_M que
+# exigiría navegar a más de TRAYECTOS_VELOCIDAD_MAXIMA_NUDOS (con TRAYECTOS_TOLERANCIA_MINUTOS de margen por el
+# redondeo de las horas capturadas) es un salto implausible: casi siempre una matrícula mal leída o una
+# coordenada mal capturada. Si una observación tiene saltos de entrada y de salida pero sus vecinas se unen sin
+# salto, ella es la sospechosa. Se calcula con NumPy para todas las embarcaciones a la vez (un solo
+# ordenamiento y diferencias entre filas vecinas), y la tabla 'saltos_trayecto' se mantiene en la misma
+# transacción de cada escritura, como el resumen y el riesgo.
+TRAYECTOS_VELOCIDAD_MAXIMA_NUDOS = float(os.environ.get('TRAYECTOS_VELOCIDAD_MAXIMA_NUDOS', '40'))
+TRAYECTOS_TOLERANCIA_MINUTOS = float(os.environ.get('TRAYECTOS_TOLERANCIA_MINUTOS', '1'))
+TRAYECTOS_DISTANCIA_MINIMA_M = float(os.environ.get('TRAYECTOS_DISTANCIA_MINIMA_M', '1000'))
+KM_POR_MILLA_NAUTICA = 1.852
+
+def _umbrales_trayectos():
+    return (f"{TRAYECTOS_VELOCIDAD_MAXIMA_NUDOS:g} kn / {TRAYECTOS_TOLERANCIA_MINUTOS:g} min / "
+            f"{TRAYECTOS_DISTANCIA_MINIMA_M:g} m")
+
+def _saltos_implausibles(km, horas):
+    limite_km = TRAYECTOS_VELOCIDAD_MAXIMA_NUDOS * KM_POR_MILLA_NAUTICA * (horas + TRAYECTOS_TOLERANCIA_MINUTOS / 60)
+    return (km > limite_km) & (km * 1000 > TRAYECTOS_DISTANCIA_MINIMA_M)
+
+def _tramos_trayectos(grupos, segundos, ids, lon, lat):
+    """
+    Tramos entre observaciones consecutivas de cada grupo (embarcación), de todos los grupos a la vez.
+    Devuelve (origen, destino, km, horas, nudos, implausible, sospechosa): los índices de las filas de cada
+    tramo, en orden de grupo y tiempo; sus medidas (nudos NaN si las dos observaciones son del mismo instante);
+    la máscara de tramos implausibles y la máscara, por fila, de observaciones sospechosas.
+    """
+    orden = np.lexsort((ids, segundos, grupos)) # A igual instante, por id
+    mismo_grupo = grupos[orden[1:]] == grupos[orden[:-1]]
+    origen, destino = orden[:-1][mismo_grupo], orden[1:][mismo_grupo]
+    km = _distancias_km(lon[origen], lat[origen], lon[destino], lat[destino])
+    horas = (segundos[destino] - segundos[origen]) / 3600
+    with np.errstate(divide='ignore', invalid='ignore'):
+        nudos = np.where(horas > 0, km / KM_POR_MILLA_NAUTICA / horas, np.nan)
+    implausible = _saltos_implausibles(km, horas)
+    sospechosa = np.zeros(len(grupos), dtype=bool)
+    # Los tramos t y t + 1 comparten la observación del medio si son de la misma embarcación
+    picos = np.flatnonzero((destino[:-1] == origen[1:]) & implausible[:-1] & implausible[1:])
+    if len(picos):
+        a, c = origen[picos], destino[picos + 1]
+        directo = _saltos_implausibles(_distancias_km(lon[a], lat[a], lon[c], lat[c]), (segundos[c] - segundos[a]) / 3600)
+        sospechosa[destino[picos[~directo]]] = True
+    return origen, destino, km, horas, nudos, implausible, sospechosa
+
+def _columnas_trayecto(filas):
+    """(ids, segundos, longitudes, latitudes) como arreglos a partir de filas (id, timestamp, longitud, latitud)."""
+    ids, marcas, lon, lat = zip(*filas)
+    segundos = np.array(marcas, dtype='datetime64[us]').astype(np.int64) / 1e6
+    return np.array(ids, dtype=np.int64), segundos, np.array(lon, dtype=float), np.array(lat, dtype=float)
+
+def _recalcular_saltos_trayecto(cursor, embarcacion_ids=None):
+    """
+    Recalcula los saltos implausibles de las embarcaciones indicadas (todas si es None) desde sus
+    observaciones, usando el índice (embarcacion_id, timestamp). Devuelve cuántos saltos quedaron.
+    """
+    filtro = "embarcacion_id IS NOT NULL"
+    params = []
+    if embarcacion_ids is not None:
+        embarcacion_ids = [i for i in embarcacion_ids if i is not None]
+        if not embarcacion_ids:
+            return 0
+        filtro = "embarcacion_id = ANY(%s)"
+        params = [embarcacion_ids]
+        cursor.execute("DELETE FROM saltos_trayecto WHERE embarcacion_id = ANY(%s);", (embarcacion_ids,))
+    else:
+        cursor.execute("DELETE FROM saltos_trayecto;")
+    cursor.execute(f"""
+        SELECT id, timestamp, longitud_wgs84, latitud_wgs84, embarcacion_id, matricula
+        FROM observaciones_embarcaciones
+        WHERE {filtro} AND timestamp IS NOT NULL AND longitud_wgs84 IS NOT NULL AND latitud_wgs84 IS NOT NULL;
+    """, params)
+    filas = cursor.fetchall()
+    saltos = []
+    if filas:
+        ids, segundos, lon, lat = _columnas_trayecto([fila[:4] for fila in filas])
+        embarcaciones = np.array([fila[4] for fila in filas], dtype=np.int64)
+        origen, destino, km, horas, nudos, implausible, sospechosa = _tramos_trayectos(embarcaciones, segundos, ids, lon, lat)
+        for o, d, k, h, v in zip(origen[implausible].tolist(), destino[implausible].tolist(), km[implausible].tolist(),
+                                 horas[implausible].tolist(), nudos[implausible].tolist()):
+            o_fila, d_fila = filas[o], filas[d]
+            sospechosa_id = o_fila[0] if sospechosa[o] else d_fila[0] if sospechosa[d] else None
+            saltos.append((o_fila[0], d_fila[0], o_fila[4], o_fila[5], o_fila[1], d_fila[1], o_fila[2], o_fila[3],
+                           d_fila[2], d_fila[3], round(k, 3), round(h, 4), None if math.isnan(v) else round(v, 1),
+                           sospechosa_id))
+    if saltos:
+        psycopg2.extras.execute_values(cursor, """
+            INSERT INTO saltos_trayecto (observacion_origen, observacion_destino, embarcacion_id, matricula,
+                                         timestamp_origen, timestamp_destino, longitud_origen, latitud_origen,
+                                         longitud_destino, latitud_destino, distancia_km, horas, velocidad_nudos,
+                                         observacion_sospechosa)
+            VALUES %s
+        """, saltos, page_size=1000)
+    if embarcacion_ids is None:
+        cursor.execute("UPDATE saltos_trayecto_estado SET umbrales = %s, actualizado = now();", (_umbrales_trayectos(),))
+    return len(saltos)
+
+def trayecto_embarcacion(observaciones):
+    """
+    Trayecto de una embarcación a partir de sus observaciones (FilaObservacion, en cualquier orden).
+    Devuelve (FeatureCollection con la línea del trayecto y una línea por salto implausible, lista de saltos
+    del más reciente al más antiguo).
+    """
+    filas = [(obs.id, obs.timestamp, obs.longitud_wgs84, obs.latitud_wgs84) for obs in observaciones
+             if obs.timestamp and obs.longitud_wgs84 is not None and obs.latitud_wgs84 is not None]
+    if not filas:
+        return {'type': 'FeatureCollection', 'features': []}, []
+    ids, segundos, lon, lat = _columnas_trayecto(filas)
+    origen, destino, km, horas, nudos, implausible, sospechosa = _tramos_trayectos(
+        np.zeros(len(filas), dtype=np.int64), segundos, ids, lon, lat)
+    orden = np.lexsort((ids, segundos))
+    rasgos = [{'type': 'Feature',
+               'geometry': {'type': 'LineString', 'coordinates': np.column_stack((lon[orden], lat[orden])).tolist()},
+               'properties': {'tipo': 'trayecto', 'observaciones': len(filas)}}] if len(filas) > 1 else []
+    saltos = []
+    for t in np.flatnonzero(implausible)[::-1].tolist():
+        o, d = int(origen[t]), int(destino[t])
+        salto = {'observacion_origen': filas[o][0], 'observacion_destino': filas[d][0],
+                 'timestamp_origen': filas[o][1], 'timestamp_destino': filas[d][1],
+                 'distancia_km': round(float(km[t]), 2), 'horas': round(float(horas[t]), 2),
+                 'velocidad_nudos': None if np.isnan(nudos[t]) else round(float(nudos[t]), 1),
+                 'observacion_sospechosa': filas[o][0] if sospechosa[o] else filas[d][0] if sospechosa[d] else None}
+        saltos.append(salto)
+        rasgos.append({'type': 'Feature',
+                       'geometry': {'type': 'LineString', 'coordinates': [[filas[o][2], filas[o][3]], [filas[d][2], filas[d][3]]]},
+                       'properties': {'tipo': 'salto', **salto,
+                                      'timestamp_origen': salto['timestamp_origen'].strftime('%Y-%m-%d %H:%M'),
+                                      'timestamp_destino': salto['timestamp_destino'].strftime('%Y-%m-%d %H:%M')}})
+    return {'type': 'FeatureCollection', 'features': rasgos}, saltos
+
+def obtener_saltos_recientes(limite=10):
+    """Saltos implausibles más recientes de toda la flota, para el tablero."""
+    def _cargar():
+        conn = conectar_db_lectura()
+        if not conn: return None
+        cursor = conn.cursor()
+        try:
+            cursor.execute("""
+                SELECT matricula, timestamp_origen, timestamp_destino, distancia_km, horas, velocidad_nudos,
+                       observacion_origen, observacion_destino, observacion_sospechosa
+                FROM saltos_trayecto
+                ORDER BY timestamp_destino DESC
+                LIMIT %s;
+            """, (limite,))
+            return _fetch_as_dict(cursor)
+        except psycopg2.Error as e:
+            print(f"Error al obtener los saltos de trayecto recientes: {e}")
+            return None
+        finally:
+            cursor.close()
+            conn.close()
+
+    return _leer_con_cache(('obtener_saltos_recientes', limite), _afecta_tablero, _cargar) or []
+
+
+# 6.6 --- POSIBLES DUPLICADOS ---
+# La restricción única (matricula, timestamp) solo evita el duplicado exacto. El mismo avistamiento capturado
+# por dos oficiales con un minuto de diferencia, o con la matrícula mal escrita, son dos observaciones a menos
+# de DUPLICADOS_DISTANCIA_M metros y DUPLICADOS_MINUTOS minutos cuyas matrículas normalizadas (sin espacios ni
+# guiones, O = 0, I = 1) son iguales o difieren en una sola edición (cambio, falta, sobra o transposición de
+# un carácter). Los bloques son los de la rejilla espacio-temporal de los encuentros (_pares_cercanos): solo se
+# comparan observaciones de celdas (t, y, x) vecinas, y dentro de ellas se compara la matrícula. La matrícula
+# no forma parte de la clave del bloque porque justo las mal escritas caerían en bloques distintos.
+DUPLICADOS_MINUTOS = float(os.environ.get('DUPLICADOS_MINUTOS', '10'))
+DUPLICADOS_DISTANCIA_M = float(os.environ.get('DUPLICADOS_DISTANCIA_M', '300'))
+DUPLICADOS_LONGITUD_MINIMA = 4 # Con matrículas más cortas solo cuenta la coincidencia exacta
+_TRADUCCION_MATRICULA = str.maketrans('OI', '01')
+
+def _normalizar_matricula(matricula):
+    return re.sub(r'[^A-Z0-9]', '', (matricula or '').upper()).translate(_TRADUCCION_MATRICULA)
+
+def _matriculas_similares(a, b):
+    """Matrículas normalizadas iguales o, si no son muy cortas, a una sola edición de distancia."""
+    if a == b:
+        return True
+    if min(len(a), len(b)) < DUPLICADOS_LONGITUD_MINIMA or abs(len(a) - len(b)) > 1:
+        return False
+    if len(a) == len(b):
+        diferentes = [k for k in range(len(a)) if a[k] != b[k]]
+        return len(diferentes) == 1 or (len(diferentes) == 2 and diferentes[1] == diferentes[0] + 1
+                                        and a[diferentes[0]] == b[diferentes[1]] and a[diferentes[1]] == b[diferentes[0]])
+    corta, larga = (a, b) if len(a) < len(b) else (b, a)
+    return any(larga[:k] + larga[k + 1:] == corta for k in range(len(larga)))
+
+def _pares_duplicados(filas):
+    """
+    Pares (i, j, metros, minutos), con i < j, de posibles duplicados entre las filas
+    (id, matricula, timestamp, longitud, latitud).
+    """
+    if len(filas) < 2:
+        return []
+    _, matriculas, marcas, lon, lat = zip(*filas)
+    segundos = np.array(marcas, dtype='datetime64[us]').astype(np.int64) / 1e6
+    i, j, metros = _pares_cercanos(segundos, np.array(lon, dtype=float), np.array(lat, dtype=float),
+                                   DUPLICADOS_DISTANCIA_M, DUPLICADOS_MINUTOS * 60)
+    normalizadas = [_normalizar_matricula(m) for m in matriculas]
+    return [(a, b, round(m, 1), round(abs(float(segundos[a] - segundos[b])) / 60, 1))
+            for a, b, m in zip(i.tolist(), j.tolist(), metros.tolist())
+            if _matriculas_similares(normalizadas[a], normalizadas[b])]
+
+def _duplicados_de_lote(cursor, nuevas):
+    """
+    Posibles duplicados de las filas nuevas (None, matricula, timestamp, longitud, latitud), aún sin guardar,
+    contra la base de datos y contra las filas nuevas anteriores del mismo lote. Devuelve
+    {índice de la fila nueva: [(fila existente o índice de la fila nueva anterior, metros, minutos)]}.
+    """
+    nuevas = list(nuevas)
+    if not nuevas:
+        return {}
+    existentes = _observaciones_en_ventanas(cursor, nuevas, "id, matricula, timestamp, longitud_wgs84, latitud_wgs84",
+                                            minutos=DUPLICADOS_MINUTOS)
+    n = len(existentes)
+    duplicados = {}
+    for a, b, metros, minutos in _pares_duplicados(existentes + nuevas):
+        if b < n:
+            continue # Dos observaciones ya guardadas: es cosa de la auditoría
+        otra = existentes[a] if a < n else a - n
+        duplicados.setdefault(b - n, []).append((otra, metros, minutos))
+    return duplicados
+
+def buscar_posibles_duplicados(matricula, timestamp, lat, lon):
+    """
+    Observaciones guardadas que podrían ser el mismo avistamiento que el indicado, de la más cercana a la más
+    lejana, como diccionarios con id, matricula, timestamp, distancia_m y minutos. Se consulta la primaria
+    para ver también lo que otro oficial acaba de capturar.
+    """
+    if timestamp is None or lat is None or lon is None:
+        return []
+    conn = conectar_db()
+    if not conn: return []
+    cursor = conn.cursor()
+    try:
+        coincidencias = _duplicados_de_lote(cursor, [(None, matricula, timestamp, lon, lat)]).get(0, [])
+        return sorted(({'id': fila[0], 'matricula': fila[1], 'timestamp': fila[2], 'distancia_m': metros, 'minutos': minutos}
+                       for fila, metros, minutos in coincidencias), key=lambda d: d['distancia_m'])
+    except psycopg2.Error as e:
+        print(f"Error al buscar posibles duplicados de '{matricula}': {e}")
+        return []
+    finally:
+        cursor.close()
+        conn.close()
+
+
+# 6.7 --- VALIDACIÓN Y CLASIFICACIÓN DE ARCHIVOS CSV ---
+# El CSV se lee en bloques de CSV_LOTE_FILAS filas que se pasan a columnas: fechas y coordenadas se convierten
+# con NumPy para todo el bloque (solo si el bloque trae algún valor irreconocible se revisa valor por valor) y
+# todos los puntos se clasifican a la vez contra las zonas registradas (RegistroZonas.clasificar_lote). Se
+# rechazan las filas cuyo estatus contradice su posición: estatus de dentro del ANP con el punto fuera,
+# 'outside_anp' con el punto dentro, o estatus por debajo del mínimo de su zona. Con 'corregir' se guarda el
+# estatus que corresponde a la posición cuando se puede saber (no en el caso de 'outside_anp' dentro). Todo
+# ocurre en el proceso de la petición: el trabajo ya está vectorizado y un grupo de procesos creado con fork
+# desde un worker con hilos (índice espacial, encuentros, vigilancia) podría heredar un candado tomado.
+CSV_LOTE_FILAS = int(os.environ.get('CSV_LOTE_FILAS', '20000'))
+CSV_PROBLEMAS_MOSTRADOS = 200
+
+def _timestamp_csv(texto):
+    """Un timestamp del CSV en los formatos que acepta la importación (con zona horaria: se pasa a UTC), o None."""
+    for formato in ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M'):
+        try:
+            return datetime.datetime.strptime(texto, formato)
+        except ValueError:
+            pass
+    try:
+        marca = datetime.datetime.fromisoformat(texto.replace('Z', '+00:00'))
+    except ValueError:
+        return None
+    return marca.astimezone(datetime.timezone.utc).replace(tzinfo=None) if marca.tzinfo else marca
+
+def _convertir_timestamps_csv(textos):
+    # Si algún texto no se reconoce se parte el tramo en dos: los pocos valores raros se revisan uno a uno
+    # y el resto sigue convirtiéndose por tramos
+    try:
+        return textos.astype('datetime64[us]')
+    except ValueError:
+        if len(textos) == 1:
+            return np.array([_timestamp_csv(textos[0])], dtype='datetime64[us]')
+        mitad = len(textos) // 2
+        return np.concatenate((_convertir_timestamps_csv(textos[:mitad]), _convertir_timestamps_csv(textos[mitad:])))
+
+def _timestamps_csv(textos):
+    """Arreglo datetime64[us] de los textos (NaT si no se reconocen o no traen al menos la fecha completa)."""
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore') # NumPy avisa al convertir textos con zona horaria
+        marcas = _convertir_timestamps_csv(textos)
+    marcas[np.char.str_len(textos) < 10] = np.datetime64('NaT')
+    return marcas
+
+def _numeros_csv(textos):
+    """(valores como float con NaN en los vacíos, máscara de vacíos, máscara de textos que no son un número finito)."""
+    vacios = textos == ''
+    try:
+        numeros = np.where(vacios, 'nan', textos).astype(float)
+    except ValueError:
+        numeros = np.array([_numero_csv(texto) for texto in textos.tolist()])
+    return numeros, vacios, ~vacios & ~np.isfinite(numeros)
+
+def _numero_csv(texto):
+    try:
+        return float(texto)
+    except ValueError:
+        return math.nan
+
+def _validar_lote_csv(encabezado, filas, primera_fila, corregir):
+    """
+    Valida y clasifica un bloque de filas del CSV (listas de texto del largo del encabezado) cuya primera fila
+    tiene el número 'primera_fila'. Devuelve (filas válidas como (número de fila, valores a insertar), problemas
+    como (número de fila, matrícula, motivo), estatus corregidos).
+    """
+    n = len(filas)
+    columnas = dict(zip(encabezado, zip(*filas))) if n else {}
+    def texto(nombre):
+        return np.char.strip(np.asarray(columnas.get(nombre, ('',) * n), dtype=str).reshape(n))
+
+    matriculas = np.char.upper(texto('matricula'))
+    textos_timestamp = texto('timestamp')
+    marcas = _timestamps_csv(textos_timestamp)
+    lat, lat_vacia, lat_invalida = _numeros_csv(texto('latitud_wgs84'))
+    lon, lon_vacia, lon_invalida = _numeros_csv(texto('longitud_wgs84'))
+    estatus = texto('estatus_categoria_id').astype(object)
+
+    motivos = np.full(n, '', dtype=object)
+    def marcar(mascara, motivo, valores=None):
+        for k in np.flatnonzero((motivos == '') & mascara).tolist():
+            motivos[k] = f"{motivo} ('{valores[k]}')" if valores is not None else motivo
+    marcar(matriculas == '', "matrícula vacía")
+    marcar(np.isnat(marcas), "timestamp no reconocido", textos_timestamp)
+    marcar(lat_invalida, "latitud no numérica", texto('latitud_wgs84'))
+    marcar(lon_invalida, "longitud no numérica", texto('longitud_wgs84'))
+    marcar(lat_vacia & lon_vacia, "faltan las coordenadas") # latitud y longitud son NOT NULL
+    marcar(lat_vacia != lon_vacia, "falta la latitud o la longitud")
+    marcar((np.abs(lat) > 90) | (np.abs(lon) > 180), "coordenada fuera de rango")
+    marcar((estatus != '') & ~np.isin(estatus, CODIGOS_ESTATUS), "estatus desconocido", estatus)
+
+    # Clasificación de todos los puntos válidos del bloque a la vez
+    zonas = [[] for _ in range(n)]
+    corregidas = 0
+    k = np.flatnonzero(motivos == '')
+    if len(k):
+        zonas_k, final, protegida = registro_zonas.clasificar_lote(lon[k], lat[k], estatus[k])
+        for indice, zonas_punto in zip(k.tolist(), zonas_k):
+            zonas[indice] = zonas_punto
+        declarado = estatus[k]
+        dentro = np.isin(declarado, list(_RANGO_ESTATUS))
+        fuera_de_anp = dentro & ~protegida
+        bajo_minimo = dentro & protegida & (final != declarado)
+        fuera_en_anp = protegida & (declarado == 'outside_anp')
+        for j in np.flatnonzero(fuera_en_anp).tolist():
+            nombres = ', '.join(registro_zonas.zona(clave)['nombre'] for clave in zonas_k[j])
+            motivos[k[j]] = f"estatus '{_DESC_ESTATUS['outside_anp']}' pero el punto está dentro de {nombres}"
+        contradictorias = np.flatnonzero(fuera_de_anp | bajo_minimo).tolist()
+        if corregir:
+            estatus[k[contradictorias]] = final[contradictorias]
+            corregidas = len(contradictorias)
+        else:
+            for j in contradictorias:
+                motivos[k[j]] = (f"estatus '{_DESC_ESTATUS[declarado[j]]}' de dentro del ANP pero el punto está fuera"
+                                 if fuera_de_anp[j] else
+                                 f"estatus '{_DESC_ESTATUS[declarado[j]]}' por debajo del mínimo de su zona "
+                                 f"('{_DESC_ESTATUS[final[j]]}')")
+
+    validas = np.flatnonzero(motivos == '')
+    def valores(nombre):
+        return columnas.get(nombre, (None,) * n)
+    nombres_embarcacion, tipos, notas, patrones = (valores(c) for c in ('nombre_embarcacion', 'tipo_embarcacion_id',
+                                                                          'notas_adicionales', 'nombre_patron'))
+    marcas_validas = marcas[validas].tolist()
+    matriculas = matriculas.tolist()
+    filas_validas = [
+        (primera_fila + i, (matriculas[i], nombres_embarcacion[i], marca,
+                            float(lat[i]), float(lon[i]),
+                            tipos[i], estatus[i] or None, notas[i], patrones[i], zonas[i]))
+        for i, marca in zip(validas.tolist(), marcas_validas)]
+    problemas = [(primera_fila + i, matriculas[i], motivos[i]) for i in np.flatnonzero(motivos != '').tolist()]
+    return filas_validas, problemas, corregidas
+
+def validar_csv_observaciones(texto, corregir=False):
+    """
+    Lee un CSV de observaciones por bloques de CSV_LOTE_FILAS filas y los valida y clasifica (ver
+    _validar_lote_csv) a medida que los lee. Las filas se numeran desde 1 sin contar el encabezado.
+    Devuelve (filas válidas, problemas, estatus corregidos).
+    """
+    lector = csv.reader(io.StringIO(texto))
+    encabezado = [columna.strip() for columna in next(lector, [])]
+    largo = len(encabezado)
+    no_vacias = (fila for fila in lector if fila)
+    filas_validas, problemas, corregidas = [], [], 0
+    primera_fila = 1
+    while True:
+        filas = [fila if len(fila) == largo else fila[:largo] + [''] * (largo - len(fila))
+                 for fila in itertools.islice(no_vacias, CSV_LOTE_FILAS)]
+        if not filas:
+            break
+        validas_bloque, problemas_bloque, corregidas_bloque = _validar_lote_csv(encabezado, filas, primera_fila, corregir)
+        filas_validas.extend(validas_bloque)
+        problemas.extend(problemas_bloque)
+        corregidas += corregidas_bloque
+        primera_fila += len(filas)
+    return filas_validas, problemas, corregidas
+
+
 # 7. --- RUTAS DE AUTENTICACIÓN Y APLICACIÓN ---
 @app.route('/login', methods=['GET', 'POST'])
 def login():
@@ -1354,6 +5329,14 @@ def index():
     status_categories_for_template['outside_anp'] = {"id": "outside_anp", "desc": "Fuera del Polígono ANP"}
     return render_template('index.html', vessel_types=vessel_types_for_template, status_categories=status_categories_for_template)
 
+def _estatus_con_reglas_de_zona(estatus, zonas):
+    """Aplica las reglas de estatus de las zonas y avisa al usuario si el estatus capturado se elevó."""
+    final = registro_zonas.aplicar_reglas(estatus, zonas)
+    if final != estatus and final != 'outside_anp':
+        nombres = ', '.join(registro_zonas.zona(clave)['nombre'] for clave in zonas)
+        flash(f"El estatus se ajustó a '{_DESC_ESTATUS.get(final, final)}' por las reglas de la zona ({nombres}).", 'warning')
+    return final
+
 @app.route('/add_observation', methods=['POST'])
 @editor_required # Solo editores y administradores pueden añadir observaciones
 def add_observation():
@@ -1400,8 +5383,9 @@ def add_observation():
         flash(f"Error en el formato de coordenadas: {e}", 'error')
         return redirect(url_for('index'))
 
-    curr_pt_geo = Point(lon_dd, lat_dd)
-    is_in_anp = anp_maritime_polygon_geo.intersects(curr_pt_geo) if not anp_maritime_polygon_geo.is_empty else False
+    # Una sola consulta contra todas las zonas registradas; fuera de las protegidas el estatus es 'outside_anp'
+    zonas = registro_zonas.zonas_en(lon_dd, lat_dd)
+    is_in_anp = registro_zonas.es_protegida(zonas)
 
     status_category_id = "outside_anp"
     if is_in_anp:
@@ -1427,7 +5411,15 @@ def add_observation():
     notas = request.form.get('notas_adicionales', '')
     vessel_type_id = request.form['vessel_type'] 
 
-    agregar_observacion_db(matricula, nombre_embarcacion, avist_dt_obj, lat_dd, lon_dd, vessel_type_id, status_category_id, notas, nombre_patron)
+    # Si parece el mismo avistamiento que uno ya guardado, se pide confirmación antes de guardarlo
+    if not request.form.get('confirmar_duplicado'):
+        duplicados = buscar_posibles_duplicados(matricula, avist_dt_obj, lat_dd, lon_dd)
+        if duplicados:
+            return render_template('confirmar_duplicado.html', duplicados=duplicados, formulario=request.form,
+                                   matricula=matricula, timestamp=avist_dt_obj)
+
+    status_category_id = _estatus_con_reglas_de_zona(status_category_id, zonas)
+    agregar_observacion_db(matricula, nombre_embarcacion, avist_dt_obj, lat_dd, lon_dd, vessel_type_id, status_category_id, notas, nombre_patron, zonas)
     flash(f"Observación para matrícula '{matricula}' guardada exitosamente.", 'success') 
     return redirect(url_for('history', matricula=matricula))
 
@@ -1438,38 +5430,52 @@ def history():
     matricula = request.args.get('matricula', '')
     nombre_embarcacion = request.args.get('nombre_embarcacion', '')
     nombre_patron = request.args.get('nombre_patron', '')
+    notas = request.args.get('notas', '').strip()
     
     observations_raw = [] 
     message = None 
+    resumen = None
+    historial_riesgo = []
+    encuentros = []
+    saltos = []
     
     if matricula:
         observations_raw = buscar_historial_embarcacion(matricula)
+        resumen = obtener_resumen_embarcacion(matricula)
+        historial_riesgo = obtener_historial_riesgo(matricula, limite=20)
+        encuentros = obtener_encuentros_embarcacion(matricula.upper(), limite=50)
+        _, saltos = trayecto_embarcacion(observations_raw)
         if not observations_raw:
             message = f"No se encontraron observaciones para la matrícula '{matricula}'."
     elif nombre_embarcacion or nombre_patron:
         observations_raw = buscar_por_nombre_o_patron(nombre_embarcacion, nombre_patron)
         if not observations_raw:
             message = "No se encontraron observaciones para el nombre de embarcación o patrón proporcionado."
+    elif notas:
+        # Resultados ordenados por relevancia, con el fragmento de las notas resaltado
+        observations_raw = buscar_en_notas(notas)
+        if not observations_raw:
+            message = f"No se encontraron observaciones cuyas notas coincidan con '{notas}'."
     
-    if not (matricula or nombre_embarcacion or nombre_patron) and not observations_raw:
-        message = "Ingrese un criterio de búsqueda (matrícula, nombre de embarcación o patrón)."
-
-    fig, ax = graficar_mapa_general(observations_raw, f"Historial para {matricula or nombre_embarcacion or nombre_patron}", es_historial_individual=True)
-    
-    img_buffer = io.BytesIO()
-    if fig:
-        fig.savefig(img_buffer, format='png', bbox_inches='tight', pad_inches=0.1)
-        plt.close(fig) 
-    img_buffer.seek(0)
-    img_base64 = base64.b64encode(img_buffer.getvalue()).decode('utf-8')
-    del fig 
-
-    observations_for_template = []
-    for obs in observations_raw:
-        temp_obs = obs.copy() 
-        if isinstance(temp_obs['timestamp'], datetime.datetime):
-            temp_obs['timestamp'] = temp_obs['timestamp'].strftime('%Y-%m-%d %H:%M:%S')
-        observations_for_template.append(temp_obs)
+    if not (matricula or nombre_embarcacion or nombre_patron or notas) and not observations_raw:
+        message = "Ingrese un criterio de búsqueda (matrícula, nombre de embarcación, patrón o texto de las notas)."
+
+    img_base64 = None
+    # Con matrícula el navegador dibuja el mapa interactivo desde /api/mapa_observaciones; las búsquedas por
+    # nombre, patrón o notas no se pueden expresar como filtro del mapa y conservan la imagen estática.
+    if not matricula:
+        fig, ax = graficar_mapa_general(observations_raw, f"Historial para {nombre_embarcacion or nombre_patron or notas}", es_historial_individual=True)
+
+        img_buffer = io.BytesIO()
+        if fig:
+            fig.savefig(img_buffer, format='png', bbox_inches='tight', pad_inches=0.1)
+            plt.close(fig)
+        img_buffer.seek(0)
+        img_base64 = base64.b64encode(img_buffer.getvalue()).decode('utf-8')
+        del fig
+
+    # Las filas son inmutables; la plantilla formatea el timestamp con el filtro 'fecha_hora'
+    observations_for_template = observations_raw
 
     vessel_types_for_template = {k: v for k, v in VESSEL_TYPES.items()}
     status_categories_for_template = {}
@@ -1483,11 +5489,262 @@ def history():
                            matricula=matricula, 
                            nombre_embarcacion=nombre_embarcacion, 
                            nombre_patron=nombre_patron, 
+                           notas=notas, 
+                           resumen=resumen, 
+                           historial_riesgo=historial_riesgo, 
+                           encuentros=encuentros, 
+                           saltos=saltos, 
                            message=message, 
                            vessel_types=vessel_types_for_template, 
                            status_categories=status_categories_for_template)
 
 
+# Perfil de un patrón: embarcaciones, observaciones, infracciones y última posición
+@app.route('/captain_profile')
+@viewer_required
+def captain_profile():
+    nombre_patron = request.args.get('nombre', '').strip()
+    perfil = obtener_perfil_patron(nombre_patron) if nombre_patron else None
+    message = None
+    img_base64 = None
+    if not nombre_patron:
+        message = "Ingrese el nombre del patrón."
+    elif perfil is None:
+        message = "No se pudo consultar el índice de patrones."
+    elif not perfil['patron'] and not perfil['coincidencias']:
+        message = f"No se encontró ningún patrón que coincida con '{nombre_patron}'."
+
+    if perfil and perfil['observaciones']:
+        fig, ax = graficar_mapa_general(perfil['observaciones'], f"Observaciones del patrón {perfil['patron']['nombre']}",
+                                        es_historial_individual=True)
+        if fig:
+            img_buffer = io.BytesIO()
+            fig.savefig(img_buffer, format='png', bbox_inches='tight', pad_inches=0.1)
+            plt.close(fig)
+            img_base64 = base64.b64encode(img_buffer.getvalue()).decode('utf-8')
+        del fig
+
+    status_categories_for_template = {v['id']: v for v in STATUS_CATEGORIES_INSIDE_ANP.values()}
+    status_categories_for_template['outside_anp'] = {"id": "outside_anp", "desc": "Fuera del Polígono ANP"}
+
+    return render_template('captain_profile.html',
+                           nombre_patron=nombre_patron,
+                           perfil=perfil,
+                           map_image=img_base64,
+                           message=message,
+                           vessel_types={k: v for k, v in VESSEL_TYPES.items()},
+                           status_categories=status_categories_for_template)
+
+@app.route('/api/captain_profile')
+@viewer_required
+def api_captain_profile():
+    nombre_patron = request.args.get('nombre', '').strip()
+    perfil = obtener_perfil_patron(nombre_patron)
+    if perfil is None:
+        return jsonify({'error': 'No se pudo consultar el índice de patrones.'}), 503
+    return jsonify({
+        'patron': perfil['patron'],
+        'embarcaciones': perfil['embarcaciones'],
+        'observaciones': [fila._asdict() for fila in perfil['observaciones']],
+        'coincidencias': [{'nombre': c['nombre'], 'total_observaciones': c['total_observaciones']}
+                          for c in perfil['coincidencias']],
+    })
+
+
+# Mapa de la flota: última posición conocida de cada embarcación (desde el resumen por embarcación)
+@app.route('/fleet_map')
+@viewer_required
+def fleet_map():
+    dias = request.args.get('dias', type=int)
+    posiciones = obtener_posiciones_flota(dias)
+    message = None
+    if not posiciones:
+        message = "No hay posiciones registradas para el período seleccionado."
+
+    titulo = "Últimas Posiciones Conocidas de la Flota"
+    if dias:
+        titulo += f" (vistas en los últimos {dias} días)"
+    fig, ax = graficar_mapa_general(posiciones, titulo)
+
+    img_buffer = io.BytesIO()
+    if fig:
+        fig.savefig(img_buffer, format='png', bbox_inches='tight', pad_inches=0.1)
+        plt.close(fig)
+    img_buffer.seek(0)
+    img_base64 = base64.b64encode(img_buffer.getvalue()).decode('utf-8') if fig else None
+    del fig
+
+    status_categories_for_template = {v['id']: v for v in STATUS_CATEGORIES_INSIDE_ANP.values()}
+    status_categories_for_template['outside_anp'] = {"id": "outside_anp", "desc": "Fuera del Polígono ANP"}
+
+    return render_template('fleet_map.html',
+                           posiciones=posiciones,
+                           map_image=img_base64,
+                           map_title=titulo,
+                           dias=dias,
+                           message=message,
+                           status_categories=status_categories_for_template)
+
+
+# Mapa interactivo: observaciones de la vista actual (agregadas a poco zoom) y geometrías del ANP
+def _bbox_de_peticion():
+    """bbox=lon_min,lat_min,lon_max,lat_max de la petición, o None si falta o no es válido."""
+    try:
+        lon_min, lat_min, lon_max, lat_max = (float(v) for v in request.args.get('bbox', '').split(','))
+    except ValueError:
+        return None
+    if not (-180 <= lon_min < lon_max <= 180 and -90 <= lat_min < lat_max <= 90):
+        return None
+    return lon_min, lat_min, lon_max, lat_max
+
+def _periodo_de_peticion_mapa():
+    """
+    (inicio, fin) de los argumentos del resumen (report_type, year, month, week_num_option) o de
+    desde/hasta (AAAA-MM-DD); (None, None) sin periodo. Lanza ValueError si no son válidos.
+    """
+    if request.args.get('report_type'):
+        start_date_obj, end_date_obj, _, _ = _rango_periodo_resumen(request.args)
+        return start_date_obj, end_date_obj
+    desde, hasta = request.args.get('desde'), request.args.get('hasta')
+    start_date_obj = datetime.datetime.strptime(desde, '%Y-%m-%d') if desde else None
+    end_date_obj = (datetime.datetime.combine(datetime.datetime.strptime(hasta, '%Y-%m-%d'), datetime.time.max)
+                    if hasta else None)
+    if bool(start_date_obj) != bool(end_date_obj):
+        raise ValueError("Indique 'desde' y 'hasta' juntos.")
+    return start_date_obj, end_date_obj
+
+@app.route('/api/mapa_observaciones')
+@viewer_required
+def api_mapa_observaciones():
+    """
+    GeoJSON de las observaciones dentro de 'bbox' para el nivel 'zoom'. El periodo se indica con los
+    argumentos del resumen (report_type, year, month, week_num_option) o con desde/hasta (AAAA-MM-DD);
+    también admite status_category y matricula.
+    """
+    bbox = _bbox_de_peticion()
+    if bbox is None:
+        return jsonify({'error': "Parámetro 'bbox' inválido (lon_min,lat_min,lon_max,lat_max)."}), 400
+    zoom = min(max(request.args.get('zoom', default=MAPA_ZOOM_DETALLE, type=int), 0), 22)
+    try:
+        start_date_obj, end_date_obj = _periodo_de_peticion_mapa()
+    except ValueError as e:
+        return jsonify({'error': f"Periodo inválido: {e}"}), 400
+
+    rasgos = obtener_rasgos_mapa(bbox, zoom, start_date_obj, end_date_obj,
+                                 request.args.get('status_category', '').strip(),
+                                 request.args.get('matricula', '').strip())
+    if rasgos is None:
+        return jsonify({'error': 'No se pudieron consultar las observaciones.'}), 503
+    return jsonify(rasgos)
+
+@app.route('/api/mapa_encuentros')
+@viewer_required
+def api_mapa_encuentros():
+    """
+    GeoJSON de los encuentros entre embarcaciones dentro de 'bbox' (una línea por par de observaciones).
+    Admite el mismo periodo que /api/mapa_observaciones y matricula; el estatus no aplica.
+    """
+    bbox = _bbox_de_peticion()
+    if bbox is None:
+        return jsonify({'error': "Parámetro 'bbox' inválido (lon_min,lat_min,lon_max,lat_max)."}), 400
+    try:
+        start_date_obj, end_date_obj = _periodo_de_peticion_mapa()
+    except ValueError as e:
+        return jsonify({'error': f"Periodo inválido: {e}"}), 400
+    rasgos = obtener_encuentros_mapa(bbox, start_date_obj, end_date_obj, request.args.get('matricula', '').strip().upper())
+    if rasgos is None:
+        return jsonify({'error': 'No se pudieron consultar los encuentros.'}), 503
+    return jsonify(rasgos)
+
+@app.route('/api/encuentros_embarcacion')
+@viewer_required
+def api_encuentros_embarcacion():
+    """Encuentros más recientes de la embarcación 'matricula' (hasta 'limite', 100 por defecto)."""
+    matricula = request.args.get('matricula', '').strip().upper()
+    if not matricula:
+        return jsonify({'error': "Parámetro 'matricula' obligatorio."}), 400
+    limite = min(max(request.args.get('limite', default=100, type=int), 1), 1000)
+    encuentros = obtener_encuentros_embarcacion(matricula, limite)
+    for encuentro in encuentros:
+        encuentro['timestamp'] = encuentro['timestamp'].strftime('%Y-%m-%d %H:%M:%S')
+    return jsonify({'matricula': matricula, 'encuentros': encuentros})
+
+@app.route('/api/trayecto_embarcacion')
+@viewer_required
+def api_trayecto_embarcacion():
+    """Trayecto de la embarcación 'matricula' como GeoJSON: la línea completa y una línea por salto implausible."""
+    matricula = request.args.get('matricula', '').strip().upper()
+    if not matricula:
+        return jsonify({'error': "Parámetro 'matricula' obligatorio."}), 400
+    trayecto, _ = trayecto_embarcacion(buscar_historial_embarcacion(matricula))
+    return jsonify(trayecto)
+
+@app.route('/api/embarcaciones_cercanas')
+@viewer_required
+def api_embarcaciones_cercanas():
+    """
+    Observaciones cerca de un punto (lat, lon) desde el índice espacial en memoria. Con 'k' devuelve las
+    k más cercanas (dentro de radio_km, si se indica); si no, todas las que están a menos de radio_km.
+    Admite desde/hasta (AAAA-MM-DD o AAAA-MM-DDTHH:MM) y status_category. 'embarcaciones' resume los
+    resultados por matrícula con su observación más cercana.
+    """
+    lat = request.args.get('lat', type=float)
+    lon = request.args.get('lon', type=float)
+    radio_km = request.args.get('radio_km', type=float)
+    k = request.args.get('k', type=int)
+    if lat is None or lon is None or not (-90 <= lat <= 90 and -180 <= lon <= 180):
+        return jsonify({'error': "Parámetros 'lat' y 'lon' obligatorios y válidos."}), 400
+    if k is None and radio_km is None:
+        return jsonify({'error': "Indique 'radio_km', 'k' o ambos."}), 400
+    if (radio_km is not None and not 0 < radio_km <= INDICE_ESPACIAL_RADIO_MAX_KM) or \
+            (k is not None and not 0 < k <= INDICE_ESPACIAL_MAX_RESULTADOS):
+        return jsonify({'error': f"'radio_km' debe estar entre 0 y {INDICE_ESPACIAL_RADIO_MAX_KM:g} "
+                                 f"y 'k' entre 1 y {INDICE_ESPACIAL_MAX_RESULTADOS}."}), 400
+    try:
+        desde, hasta = (datetime.datetime.fromisoformat(request.args[nombre]) if request.args.get(nombre) else None
+                        for nombre in ('desde', 'hasta'))
+    except ValueError:
+        return jsonify({'error': "Fechas 'desde'/'hasta' inválidas (AAAA-MM-DD)."}), 400
+    if hasta and len(request.args['hasta']) == 10:
+        hasta = datetime.datetime.combine(hasta.date(), datetime.time.max) # Día completo
+    estatus = _filtro_estatus_efectivo(request.args.get('status_category', '').strip())
+
+    inicio = time.perf_counter()
+    if not indice_espacial.sincronizar():
+        return jsonify({'error': 'El índice espacial no está disponible.'}), 503
+    if k is not None:
+        resultados = indice_espacial.mas_cercanos(lon, lat, k, radio_km or INDICE_ESPACIAL_RADIO_MAX_KM, desde, hasta, estatus)
+    else:
+        resultados = indice_espacial.en_radio(lon, lat, radio_km, desde, hasta, estatus)
+    truncado = len(resultados) > INDICE_ESPACIAL_MAX_RESULTADOS
+    resultados = resultados[:INDICE_ESPACIAL_MAX_RESULTADOS]
+    milisegundos = round((time.perf_counter() - inicio) * 1000, 2)
+
+    observaciones = [{'id': id_observacion, 'matricula': matricula, 'latitud_wgs84': p_lat, 'longitud_wgs84': p_lon,
+                      'timestamp': ts.strftime('%Y-%m-%d %H:%M:%S'), 'estatus_categoria_id': estatus_punto,
+                      'distancia_km': round(distancia, 3)}
+                     for distancia, (id_observacion, p_lon, p_lat, ts, matricula, estatus_punto) in resultados]
+    embarcaciones = {}
+    for obs in observaciones: # Ya vienen de la más cercana a la más lejana
+        resumen = embarcaciones.setdefault(obs['matricula'], {'matricula': obs['matricula'], 'observaciones': 0,
+                                                              'distancia_km': obs['distancia_km'],
+                                                              'observacion_mas_cercana': obs['id']})
+        resumen['observaciones'] += 1
+    return jsonify({'observaciones': observaciones, 'embarcaciones': list(embarcaciones.values()),
+                    'truncado': truncado, 'milisegundos': milisegundos})
+
+@app.route('/api/mapa_anp')
+@viewer_required
+def api_mapa_anp():
+    """Geometrías simplificadas del ANP; el navegador las guarda en caché y las revalida con el ETag."""
+    cuerpo, etag = geojson_anp()
+    respuesta = Response(cuerpo, mimetype='application/geo+json')
+    respuesta.set_etag(etag)
+    respuesta.cache_control.private = True
+    respuesta.cache_control.max_age = 86400
+    return respuesta.make_conditional(request)
+
+
 # NUEVA RUTA: Editar observación (GET para mostrar formulario)
 @app.route('/edit_observation/<int:obs_id>', methods=['GET'])
 @editor_required # Solo editores y administradores pueden editar observaciones
@@ -1497,6 +5754,7 @@ def edit_observation(obs_id):
         flash("Observación no encontrada.", 'error')
         return redirect(url_for('history'))
     
+    observation = observation._asdict() # Copia editable para añadir campos de presentación
     # Formatear el timestamp para el input datetime-local
     if isinstance(observation['timestamp'], datetime.datetime):
         observation['timestamp_formatted'] = observation['timestamp'].strftime('%Y-%m-%dT%H:%M')
@@ -1557,8 +5815,9 @@ def update_observation(obs_id):
         flash(f"Error en el formato de coordenadas: {e}", 'error')
         return redirect(url_for('edit_observation', obs_id=obs_id))
 
-    curr_pt_geo = Point(lon_dd, lat_dd)
-    is_in_anp = anp_maritime_polygon_geo.intersects(curr_pt_geo) if not anp_maritime_polygon_geo.is_empty else False
+    # Una sola consulta contra todas las zonas registradas; fuera de las protegidas el estatus es 'outside_anp'
+    zonas = registro_zonas.zonas_en(lon_dd, lat_dd)
+    is_in_anp = registro_zonas.es_protegida(zonas)
 
     status_category_id = "outside_anp"
     if is_in_anp:
@@ -1583,7 +5842,8 @@ def update_observation(obs_id):
     notas = request.form.get('notas_adicionales', '')
     vessel_type_id = request.form['vessel_type'] 
 
-    if update_observacion_db(obs_id, matricula, nombre_embarcacion, avist_dt_obj, lat_dd, lon_dd, vessel_type_id, status_category_id, notas, nombre_patron):
+    status_category_id = _estatus_con_reglas_de_zona(status_category_id, zonas)
+    if update_observacion_db(obs_id, matricula, nombre_embarcacion, avist_dt_obj, lat_dd, lon_dd, vessel_type_id, status_category_id, notas, nombre_patron, zonas):
         flash(f"Observación ID {obs_id} actualizada exitosamente.", 'success') 
         return redirect(url_for('history', matricula=matricula))
     else:
@@ -1593,16 +5853,15 @@ def update_observation(obs_id):
 
 @app.route('/download_report/<matricula>')
 @viewer_required # Cualquier usuario aprobado puede descargar reportes de historial individual
+@clase_consulta('reporte')
 def download_report(matricula):
     observations_raw = buscar_historial_embarcacion(matricula) 
     if not observations_raw:
         flash("No hay datos para generar el reporte.", 'error')
         return redirect(url_for('history', matricula=matricula))
     
-    observations_for_report = []
-    for obs in observations_raw:
-        temp_obs = obs.copy()
-        observations_for_report.append(temp_obs)
+    # Un solo lote columnar para el mapa y el texto del Word
+    observations_for_report = LoteObservaciones.desde_filas(observations_raw)
 
     fig, ax = graficar_mapa_general(observations_for_report, f"Historial para {matricula}", es_historial_individual=True)
     
@@ -1624,8 +5883,9 @@ def download_report(matricula):
 
 @app.route('/download_all_csv')
 @viewer_required # Cualquier usuario aprobado puede descargar todos los CSVs
+@clase_consulta('reporte')
 def download_all_csv():
-    conn = conectar_db()
+    conn = conectar_db_lectura()
     if not conn:
         flash("Error: No se pudo conectar a la base de datos para exportar CSV.", 'error')
         return redirect(url_for('index'))
@@ -1672,6 +5932,96 @@ def download_all_csv():
         conn.close()
 
 
+def _serializador_cursor_delta():
+    return URLSafeSerializer(app.config['SECRET_KEY'], salt='delta-observaciones')
+
+@app.route('/api/delta_csv')
+@viewer_required
+@clase_consulta('reporte')
+def api_delta_csv():
+    """
+    Exportación incremental para sistemas externos. Con ?cursor= devuelve las filas insertadas o
+    modificadas ('upsert') y borradas ('delete') desde ese cursor, en el orden en que cambiaron; sin cursor,
+    la tabla completa (sincronización inicial). El cursor siguiente va en la cabecera X-Delta-Cursor.
+
+    El cursor es el xmin de la instantánea de la lectura: toda transacción anterior ya terminó y fue
+    entregada, así que no se pierde ningún cambio aunque las transacciones confirmen en otro orden.
+    Un cambio puede repetirse en la entrega siguiente (aplicarlo dos veces no altera el resultado).
+    Si la transmisión se corta, la respuesta queda incompleta y el cursor no debe guardarse.
+    """
+    desde_xact = None
+    if request.args.get('cursor'):
+        try:
+            desde_xact = int(_serializador_cursor_delta().loads(request.args['cursor'])['x'])
+        except (BadSignature, KeyError, TypeError, ValueError):
+            return jsonify({'error': 'Cursor no válido.'}), 400
+
+    conn = conectar_db_lectura()
+    if not conn:
+        return jsonify({'error': 'No se pudo conectar a la base de datos.'}), 503
+    try:
+        cursor = conn.cursor()
+        # Una sola instantánea para el cursor nuevo y para las filas que se entregan
+        cursor.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ, READ ONLY;")
+        cursor.execute("SELECT pg_snapshot_xmin(pg_current_snapshot())::text::bigint, xact_depurado FROM delta_estado;")
+        nuevo_xact, xact_depurado = cursor.fetchone()
+        cursor.close()
+        if desde_xact is not None and xact_depurado is not None and desde_xact <= xact_depurado:
+            conn.close()
+            return jsonify({'error': 'El cursor es anterior a la última depuración de borrados; '
+                                     'sincroniza de nuevo sin cursor.'}), 410
+        columnas = _columnas_select(FilaObservacion)
+        cursor_servidor = conn.cursor(name='delta_observaciones')
+        cursor_servidor.itersize = DELTA_LOTE_FILAS
+        if desde_xact is None:
+            cursor_servidor.execute(f"SELECT 'upsert', {columnas} FROM observaciones_embarcaciones;")
+        else:
+            cursor_servidor.execute(f"""
+                SELECT operacion, {columnas} FROM (
+                    SELECT 'upsert' AS operacion, {columnas}, version
+                    FROM observaciones_embarcaciones WHERE xact >= %s
+                    UNION ALL
+                    SELECT 'delete', id, matricula, NULL, timestamp, NULL::real, NULL::real, NULL, NULL, NULL, NULL, version
+                    FROM observaciones_eliminadas WHERE xact >= %s
+                ) cambios
+                ORDER BY version;
+            """, (desde_xact, desde_xact))
+    except psycopg2.Error as e:
+        conn.close()
+        print(f"Error al preparar la exportación incremental: {e}")
+        return jsonify({'error': 'Error al consultar los cambios.'}), 500
+
+    indice_timestamp = COLUMNAS_OBSERVACION.index('timestamp') + 1
+
+    def _generar():
+        buffer = io.StringIO()
+        escritor = csv.writer(buffer)
+        escritor.writerow(('operacion',) + COLUMNAS_OBSERVACION)
+        try:
+            while True:
+                filas = cursor_servidor.fetchmany(DELTA_LOTE_FILAS)
+                for fila in filas:
+                    fila = list(fila)
+                    if isinstance(fila[indice_timestamp], datetime.datetime):
+                        fila[indice_timestamp] = fila[indice_timestamp].strftime('%Y-%m-%d %H:%M:%S')
+                    escritor.writerow(fila)
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+                if not filas:
+                    break
+        except psycopg2.Error as e:
+            # Se propaga para que el servidor corte la respuesta sin cerrarla bien (el cliente lo detecta)
+            print(f"Error durante la exportación incremental: {e}")
+            raise
+
+    respuesta = Response(stream_with_context(_generar()), mimetype='text/csv')
+    # La conexión vuelve al pool al cerrarse la respuesta, aunque el generador no llegue a iniciarse
+    respuesta.call_on_close(conn.close)
+    respuesta.headers['X-Delta-Cursor'] = _serializador_cursor_delta().dumps({'x': nuevo_xact})
+    respuesta.headers['Content-Disposition'] = 'attachment; filename=observaciones_delta.csv'
+    return respuesta
+
 @app.route('/summary_options')
 @viewer_required # Cualquier usuario aprobado puede ver opciones de resumen
 def summary_options():
@@ -1692,29 +6042,43 @@ def summary_options():
                            current_year=current_year, 
                            calendar=calendar, 
                            datetime=datetime,
-                           all_status_categories=all_status_categories)
+                           all_status_categories=all_status_categories,
+                           zonas_reporte=listar_zonas_reporte(),
+                           zonas_registradas=registro_zonas.zonas)
+
+
+# Reporte por zona personalizada: la zona se dibuja en el mapa o se sube como GeoJSON y se guarda, de modo
+# que el resumen, el DOCX y las descargas la reciben como ?zona_id=
+@app.route('/zona_reporte', methods=['POST'])
+@viewer_required
+def crear_zona_reporte():
+    nombre = request.form.get('nombre_zona', '').strip() or "Zona sin nombre"
+    texto = request.form.get('geojson', '').strip()
+    archivo = request.files.get('archivo_geojson')
+    if archivo and archivo.filename:
+        texto = archivo.read().decode('utf-8-sig', errors='replace')
+    if not texto:
+        flash("Dibuje la zona en el mapa o suba un archivo GeoJSON.", 'error')
+        return redirect(url_for('summary_options'))
+    try:
+        geometria = geometria_de_geojson(texto)
+    except ValueError as e:
+        flash(f"Error en la zona: {e}", 'error')
+        return redirect(url_for('summary_options'))
+    zona_id = registrar_zona_reporte(nombre, geometria, current_user.id)
+    if zona_id is None:
+        flash("Error: No se pudo guardar la zona en la base de datos.", 'error')
+        return redirect(url_for('summary_options'))
+    argumentos = {campo: request.form[campo] for campo in ('report_type', 'year', 'month', 'week_num_option', 'status_category')
+                  if request.form.get(campo)}
+    return redirect(url_for('summary_report', zona_id=zona_id, **argumentos))
 
 
 @app.route('/summary_report', methods=['GET'])
 @viewer_required # Cualquier usuario aprobado puede ver reportes de resumen
+@clase_consulta('reporte')
 def summary_report():
-    report_type = request.args.get('report_type')
-    requested_year = request.args.get('year', type=int)
-    requested_month = request.args.get('month', type=int)
-    week_num_option = request.args.get('week_num_option', type=int)
     status_category_filter = request.args.get('status_category', '').strip() # NUEVO: Obtener el filtro de estatus
-
-    current_server_year = datetime.datetime.now().year
-    current_server_month = datetime.datetime.now().month
-
-    year = requested_year if requested_year is not None and requested_year != 0 else current_server_year
-    month = requested_month if requested_month is not None and requested_month != 0 else current_server_month
-
-    print(f"DEBUG_REQUEST (Summary Report): requested_year={requested_year}, requested_month={requested_month}, status_category_filter='{status_category_filter}'")
-    print(f"DEBUG_USED (Summary Report): year={year}, month={month}")
-
-
-    start_date_obj, end_date_obj, map_title_suffix = None, None, ""
     message = None
     
     try:
@@ -1726,68 +6090,24 @@ def summary_report():
             print("ADVERTENCIA: No se pudo configurar el locale español en summary_report.")
 
     try:
-        if report_type == "weekly":
-            if not week_num_option: 
-                flash("Error: El número de semana es obligatorio para el resumen semanal.", 'error')
-                return redirect(url_for('summary_options'))
-
-            first_day_of_month = datetime.date(year, month, 1)
-            
-            # Calcular el primer domingo de la semana del mes
-            # weekday() devuelve 0 para lunes, 6 para domingo. (first_day_of_month.weekday() + 1) % 7 da 1 para lunes, 0 para domingo.
-            # Esto calcula los días a restar para llegar al domingo anterior o el mismo domingo si first_day_of_month es domingo.
-            first_sunday_of_relevant_period_date = first_day_of_month - datetime.timedelta(days=(first_day_of_month.weekday() + 1) % 7)
-
-            start_week_date = first_sunday_of_relevant_period_date + datetime.timedelta(weeks=week_num_option - 1)
-            end_week_date = start_week_date + datetime.timedelta(days=6)
-
-            start_date_obj = datetime.datetime.combine(start_week_date, datetime.time.min).replace(microsecond=0)
-            end_date_obj = datetime.datetime.combine(end_week_date, datetime.time.max).replace(microsecond=999999)
-            
-            print(f"DEBUG_FINAL_RANGE (Weekly Report): start_date_obj={start_date_obj}, end_date_obj={end_date_obj}")
-            
-            display_start_date_title = max(start_week_date, first_day_of_month)
-            display_end_date_title = min(end_week_date, datetime.date(year, month, calendar.monthrange(year, month)[1]))
-            map_title_suffix = (f"Semana del {display_start_date_title.strftime('%d de %B')} "
-                                f"al {display_end_date_title.strftime('%d de %B de %Y')}")
-
-        elif report_type == "monthly":
-            _, num_days = calendar.monthrange(year, month)
-            
-            start_date_obj = datetime.datetime(year, month, 1, 0, 0, 0, 0)
-            end_date_obj = datetime.datetime(year, month, num_days, 23, 59, 59, 999999)
-            
-            print(f"DEBUG_FINAL_RANGE (Monthly Report): start_date_obj={start_date_obj}, end_date_obj={end_date_obj}")
-
-            map_title_suffix = f"{datetime.date(year, month, 1).strftime('%B').capitalize()} {year}"
-        
-        elif report_type == "annual":
-            start_date_obj = datetime.datetime(year, 1, 1, 0, 0, 0, 0)
-            end_date_obj = datetime.datetime(year, 12, 31, 23, 59, 59, 999999)
-            
-            print(f"DEBUG_FINAL_RANGE (Annual Report): start_date_obj={start_date_obj}, end_date_obj={end_date_obj}")
-
-            map_title_suffix = f"Año {year}"
-
-        elif report_type == "total":
-            start_date_obj, end_date_obj = None, None 
-            map_title_suffix = "Todas las Inspecciones (Neto)"
-            print(f"DEBUG_FINAL_RANGE (Total Report): No hay filtro de fechas.")
-        else:
-            flash("Error: Tipo de reporte no válido.", 'error')
-            return redirect(url_for('summary_options'))
-
+        start_date_obj, end_date_obj, _, map_title_suffix = _rango_periodo_resumen(request.args)
     except ValueError as ve: 
         flash(f"Error en la entrada de fecha para resumen: {ve}", 'error')
         print(f"ERROR: ValueError en summary_report: {ve}")
         return redirect(url_for('summary_options'))
-    except Exception as e_date: 
-        flash(f"Error al procesar fechas para resumen: {e_date}", 'error')
-        print(f"ERROR: Excepción inesperada en summary_report: {e_date}")
+
+    try:
+        zona = _zona_de_peticion()
+    except ValueError as e:
+        flash(f"Error: {e}", 'error')
         return redirect(url_for('summary_options'))
 
     # Pasar el filtro de estatus a la función de obtención de observaciones
-    observations_raw = obtener_observaciones_filtradas(start_date_obj, end_date_obj, status_category_filter if status_category_filter != "" else None)
+    if zona:
+        lote_observaciones = obtener_lote_zona(zona, start_date_obj, end_date_obj, status_category_filter if status_category_filter != "" else None)
+        map_title_suffix += f" - Zona: {zona['nombre']}"
+    else:
+        lote_observaciones = obtener_lote_observaciones(start_date_obj, end_date_obj, status_category_filter if status_category_filter != "" else None)
 
     # Si se aplicó un filtro de estatus, añadirlo al título
     if status_category_filter:
@@ -1802,25 +6122,16 @@ def summary_report():
         map_title_suffix += f" (Estatus: {status_desc})"
 
 
-    if not observations_raw:
+    if not len(lote_observaciones):
         message = f"No se encontraron observaciones para el periodo: {map_title_suffix}."
 
-    fig, ax = graficar_mapa_general(observations_raw, f"Resumen Inspecciones: {map_title_suffix}", es_historial_individual=False)
-    
-    img_buffer = io.BytesIO()
-    if fig:
-        fig.savefig(img_buffer, format='png', bbox_inches='tight', pad_inches=0.1)
-        plt.close(fig)
-    img_buffer.seek(0)
-    img_base64 = base64.b64encode(img_buffer.getvalue()).decode('utf-8')
-    del fig 
+    # Meses y años cerrados reutilizan el mapa ya dibujado (ver png_mapa_periodo)
+    png_mapa = png_mapa_periodo(lote_observaciones, f"Resumen Inspecciones: {map_title_suffix}",
+                                start_date_obj, end_date_obj, _filtro_estatus_efectivo(status_category_filter), zona=zona)
+    img_base64 = base64.b64encode(png_mapa or b'').decode('utf-8')
 
-    observations_for_template = []
-    for obs in observations_raw:
-        temp_obs = obs.copy() 
-        if isinstance(temp_obs['timestamp'], datetime.datetime):
-            temp_obs['timestamp'] = temp_obs['timestamp'].strftime('%Y-%m-%d %H:%M:%S')
-        observations_for_template.append(temp_obs)
+    # Las filas son inmutables; la plantilla formatea el timestamp con el filtro 'fecha_hora'
+    observations_for_template = lote_observaciones.filas()
 
     vessel_types_for_template = {k: v for k, v in VESSEL_TYPES.items()}
     status_categories_for_template = {}
@@ -1833,28 +6144,16 @@ def summary_report():
                            map_image=img_base64, 
                            map_title=f"Resumen Inspecciones: {map_title_suffix}", 
                            message=message,
+                           zona=zona,
                            vessel_types=vessel_types_for_template, 
                            status_categories=status_categories_for_template)
 
 
 @app.route('/download_summary_report/<report_type>')
-@viewer_required # Cualquier usuario aprobado puede descargar reportes de resumen DOCX
-def download_summary_report(report_type):
-    requested_year = request.args.get('year', type=int)
-    requested_month = request.args.get('month', type=int)
-    week_num_option = request.args.get('week_num_option', type=int)
-    status_category_filter = request.args.get('status_category', '').strip() # NUEVO: Obtener el filtro de estatus
-
-    current_server_year = datetime.datetime.now().year
-    current_server_month = datetime.datetime.now().month
-
-    year = requested_year if requested_year is not None and requested_year != 0 else current_server_year
-    month = requested_month if requested_month is not None and requested_month != 0 else current_server_month
-
-    print(f"DEBUG_REQUEST (Download Summary): requested_year={requested_year}, requested_month={requested_month}, status_category_filter='{status_category_filter}'")
-    print(f"DEBUG_USED (Download Summary): year={year}, month={month}")
-
-    start_date_obj, end_date_obj, map_title_suffix = None, None, ""
+@viewer_required # Cualquier usuario aprobado puede descargar reportes de resumen DOCX
+@clase_consulta('reporte')
+def download_summary_report(report_type):
+    status_category_filter = request.args.get('status_category', '').strip() # NUEVO: Obtener el filtro de estatus
     
     try:
         locale.setlocale(locale.LC_TIME, 'es_ES.UTF-8')
@@ -1865,63 +6164,24 @@ def download_summary_report(report_type):
             print("ADVERTENCIA: No se pudo configurar el locale español para descarga de reporte.")
 
     try:
-        if report_type == "weekly":
-            if not week_num_option: 
-                flash("Error: El número de semana es obligatorio para reporte semanal.", 'error')
-                return redirect(url_for('summary_options'))
-            
-            first_day_of_month = datetime.date(year, month, 1)
-            first_sunday_of_relevant_period_date = first_day_of_month - datetime.timedelta(days=(first_day_of_month.weekday() + 1) % 7)
-
-            start_week_date = first_sunday_of_relevant_period_date + datetime.timedelta(weeks=week_num_option - 1)
-            end_week_date = start_week_date + datetime.timedelta(days=6)
-
-            start_date_obj = datetime.datetime.combine(start_week_date, datetime.time.min).replace(microsecond=0)
-            end_date_obj = datetime.datetime.combine(end_week_date, datetime.time.max).replace(microsecond=999999)
-            
-            print(f"DEBUG_FINAL_RANGE (Weekly Download): start_date_obj={start_date_obj}, end_date_obj={end_date_obj}")
-
-            display_start_date_title = max(start_week_date, first_day_of_month)
-            display_end_date_title = min(end_week_date, datetime.date(year, month, calendar.monthrange(year, month)[1]))
-            map_title_suffix = (f"Semana del {display_start_date_title.strftime('%d de %B')} "
-                                f"al {display_end_date_title.strftime('%d de %B de %Y')}")
-
-        elif report_type == "monthly":
-            _, num_days = calendar.monthrange(year, month)
-            start_date_obj = datetime.datetime(year, month, 1, 0, 0, 0, 0)
-            end_date_obj = datetime.datetime(year, month, num_days, 23, 59, 59, 999999)
-            
-            print(f"DEBUG_FINAL_RANGE (Monthly Download): start_date_obj={start_date_obj}, end_date_obj={end_date_obj}")
-
-            map_title_suffix = f"{datetime.date(year, month, 1).strftime('%B').capitalize()} {year}"
-        
-        elif report_type == "annual":
-            start_date_obj = datetime.datetime(year, 1, 1, 0, 0, 0, 0)
-            end_date_obj = datetime.datetime(year, 12, 31, 23, 59, 59, 999999)
-            
-            print(f"DEBUG_FINAL_RANGE (Annual Download): start_date_obj={start_date_obj}, end_date_obj={end_date_obj}")
-
-            map_title_suffix = f"Año {year}"
-
-        elif report_type == "total":
-            start_date_obj, end_date_obj = None, None 
-            map_title_suffix = "Todas las Inspecciones (Neto)"
-            print(f"DEBUG_FINAL_RANGE (Total Download): No hay filtro de fechas.")
-        else:
-            flash("Error: Tipo de reporte no válido.", 'error')
-            return redirect(url_for('summary_options'))
-
+        start_date_obj, end_date_obj, filename_suffix, map_title_suffix = _rango_periodo_resumen(request.args, report_type)
     except ValueError as ve: 
         flash(f"Error en la entrada de fecha para reporte Word: {ve}", 'error')
         print(f"ERROR: ValueError en download_summary_report: {ve}")
         return redirect(url_for('summary_options'))
-    except Exception as e_date: 
-        flash(f"Error al procesar fechas para reporte Word: {e_date}", 'error')
-        print(f"ERROR: Excepción inesperada en download_summary_report: {e_date}")
+
+    try:
+        zona = _zona_de_peticion()
+    except ValueError as e:
+        flash(f"Error: {e}", 'error')
         return redirect(url_for('summary_options'))
 
     # Pasar el filtro de estatus a la función de obtención de observaciones
-    observations_raw = obtener_observaciones_filtradas(start_date_obj, end_date_obj, status_category_filter if status_category_filter != "" else None)
+    if zona:
+        lote_observaciones = obtener_lote_zona(zona, start_date_obj, end_date_obj, status_category_filter if status_category_filter != "" else None, proyeccion='docx')
+        map_title_suffix += f" - Zona: {zona['nombre']}"
+    else:
+        lote_observaciones = obtener_lote_observaciones(start_date_obj, end_date_obj, status_category_filter if status_category_filter != "" else None, proyeccion='docx')
 
     # Si se aplicó un filtro de estatus, añadirlo al título del documento
     if status_category_filter:
@@ -1935,22 +6195,21 @@ def download_summary_report(report_type):
                     break
         map_title_suffix += f" (Estatus: {status_desc})"
 
-    if not observations_raw:
+    if not len(lote_observaciones):
         flash(f"No hay datos para generar el reporte DOCX para el periodo: {map_title_suffix}.", 'error')
         return redirect(url_for('summary_options'))
 
-    observations_for_report = []
-    for obs in observations_raw:
-        temp_obs = obs.copy()
-        observations_for_report.append(temp_obs)
+    # El mapa y el texto del Word consumen el mismo lote (coordenadas, colores y GMM se calculan una vez)
+    observations_for_report = lote_observaciones
 
-    fig, ax = graficar_mapa_general(observations_for_report, f"Resumen Inspecciones: {map_title_suffix}", es_historial_individual=False)
+    png_mapa = png_mapa_periodo(observations_for_report, f"Resumen Inspecciones: {map_title_suffix}",
+                                start_date_obj, end_date_obj, _filtro_estatus_efectivo(status_category_filter), dpi=300, zona=zona)
     
     doc_buffer = io.BytesIO()
     
-    if fig:
+    if png_mapa:
         try:
-            generar_reporte_word(fig, observations_for_report, f"Resumen de Inspección: {map_title_suffix}", filename_or_buffer=doc_buffer)
+            generar_reporte_word(png_mapa, observations_for_report, f"Resumen de Inspección: {map_title_suffix}", filename_or_buffer=doc_buffer)
         except Exception as e:
             print(f"Error generating Word report for download: {e}")
             flash("Error al generar el reporte de Word.", 'error')
@@ -1960,24 +6219,23 @@ def download_summary_report(report_type):
         return redirect(url_for('summary_options'))
 
     doc_buffer.seek(0)
-    filename = f"resumen_{report_type}"
-    if year: filename += f"_{year}"
-    if month: filename += f"_{month}"
-    if week_num_option: filename += f"_{week_num_option}"
+    filename = f"resumen{filename_suffix}"
     if status_category_filter: filename += f"_{status_category_filter}" # Añadir estatus al nombre del archivo
+    if zona: filename += f"_zona{zona['id']}"
     filename += ".docx"
 
     return send_file(doc_buffer, download_name=filename, as_attachment=True, mimetype='application/vnd.openxmlformats-officedocument.wordprocessingml.document')
 
-# NUEVA RUTA: Descargar CSV de resumen filtrado
-@app.route('/download_summary_csv')
-@viewer_required # Cualquier usuario aprobado puede descargar CSVs de resumen
-def download_summary_csv():
-    report_type = request.args.get('report_type')
-    requested_year = request.args.get('year', type=int)
-    requested_month = request.args.get('month', type=int)
-    week_num_option = request.args.get('week_num_option', type=int)
-    status_category_filter = request.args.get('status_category', '').strip()
+def _rango_periodo_resumen(args, report_type=None):
+    """
+    (start_date_obj, end_date_obj, sufijo de archivo, título) del periodo pedido en los argumentos de un
+    resumen (report_type, year, month, week_num_option); report_type se puede pasar aparte cuando viene
+    en la URL. El título usa el locale de fechas vigente. Lanza ValueError si faltan datos o no son válidos.
+    """
+    report_type = report_type or args.get('report_type')
+    requested_year = args.get('year', type=int)
+    requested_month = args.get('month', type=int)
+    week_num_option = args.get('week_num_option', type=int)
 
     current_server_year = datetime.datetime.now().year
     current_server_month = datetime.datetime.now().month
@@ -1985,32 +6243,57 @@ def download_summary_csv():
     year = requested_year if requested_year is not None and requested_year != 0 else current_server_year
     month = requested_month if requested_month is not None and requested_month != 0 else current_server_month
 
-    start_date_obj, end_date_obj = None, None
-    filename_suffix = ""
-
-    try:
-        if report_type == "weekly":
-            if not week_num_option: raise ValueError("El número de semana es obligatorio para el resumen semanal.")
-            first_day_of_month = datetime.date(year, month, 1)
-            first_sunday_of_relevant_period_date = first_day_of_month - datetime.timedelta(days=(first_day_of_month.weekday() + 1) % 7)
-            start_week_date = first_sunday_of_relevant_period_date + datetime.timedelta(weeks=week_num_option - 1)
-            end_week_date = start_week_date + datetime.timedelta(days=6)
-            start_date_obj = datetime.datetime.combine(start_week_date, datetime.time.min).replace(microsecond=0)
-            end_date_obj = datetime.datetime.combine(end_week_date, datetime.time.max).replace(microsecond=999999)
-            filename_suffix = f"_semanal_{year}_{month}_{week_num_option}"
-        elif report_type == "monthly":
-            _, num_days = calendar.monthrange(year, month)
-            start_date_obj = datetime.datetime(year, month, 1, 0, 0, 0, 0)
-            end_date_obj = datetime.datetime(year, month, num_days, 23, 59, 59, 999999)
-            filename_suffix = f"_mensual_{year}_{month}"
-        elif report_type == "annual":
-            start_date_obj = datetime.datetime(year, 1, 1, 0, 0, 0, 0)
-            end_date_obj = datetime.datetime(year, 12, 31, 23, 59, 59, 999999)
-            filename_suffix = f"_anual_{year}"
-        elif report_type == "total":
-            filename_suffix = "_total"
-        else:
-            raise ValueError("Tipo de reporte no válido.")
+    if report_type == "weekly":
+        if not week_num_option: raise ValueError("El número de semana es obligatorio para el resumen semanal.")
+        first_day_of_month = datetime.date(year, month, 1)
+        # Semanas de domingo a sábado: la primera es la que contiene el día 1 del mes
+        first_sunday_of_relevant_period_date = first_day_of_month - datetime.timedelta(days=(first_day_of_month.weekday() + 1) % 7)
+        start_week_date = first_sunday_of_relevant_period_date + datetime.timedelta(weeks=week_num_option - 1)
+        end_week_date = start_week_date + datetime.timedelta(days=6)
+        start_date_obj = datetime.datetime.combine(start_week_date, datetime.time.min).replace(microsecond=0)
+        end_date_obj = datetime.datetime.combine(end_week_date, datetime.time.max).replace(microsecond=999999)
+        # El título se recorta a los días del mes pedido
+        display_start_date_title = max(start_week_date, first_day_of_month)
+        display_end_date_title = min(end_week_date, datetime.date(year, month, calendar.monthrange(year, month)[1]))
+        titulo = (f"Semana del {display_start_date_title.strftime('%d de %B')} "
+                  f"al {display_end_date_title.strftime('%d de %B de %Y')}")
+        return start_date_obj, end_date_obj, f"_semanal_{year}_{month}_{week_num_option}", titulo
+    elif report_type == "monthly":
+        _, num_days = calendar.monthrange(year, month)
+        start_date_obj = datetime.datetime(year, month, 1, 0, 0, 0, 0)
+        end_date_obj = datetime.datetime(year, month, num_days, 23, 59, 59, 999999)
+        titulo = f"{datetime.date(year, month, 1).strftime('%B').capitalize()} {year}"
+        return start_date_obj, end_date_obj, f"_mensual_{year}_{month}", titulo
+    elif report_type == "annual":
+        start_date_obj = datetime.datetime(year, 1, 1, 0, 0, 0, 0)
+        end_date_obj = datetime.datetime(year, 12, 31, 23, 59, 59, 999999)
+        return start_date_obj, end_date_obj, f"_anual_{year}", f"Año {year}"
+    elif report_type == "total":
+        return None, None, "_total", "Todas las Inspecciones (Neto)"
+    raise ValueError("Tipo de reporte no válido.")
+
+def _zona_de_peticion():
+    """
+    Zona pedida con ?zona_id=: un número es una zona personalizada y un texto la clave de una zona
+    registrada (None si no se pidió). Lanza ValueError si no existe.
+    """
+    zona_id = request.args.get('zona_id', '').strip()
+    if not zona_id:
+        return None
+    zona = obtener_zona_reporte(int(zona_id)) if zona_id.isdigit() else registro_zonas.zona(zona_id)
+    if zona is None:
+        raise ValueError(f"La zona {zona_id} no existe o no se pudo consultar.")
+    return zona
+
+# NUEVA RUTA: Descargar CSV de resumen filtrado
+@app.route('/download_summary_csv')
+@viewer_required # Cualquier usuario aprobado puede descargar CSVs de resumen
+@clase_consulta('reporte')
+def download_summary_csv():
+    status_category_filter = request.args.get('status_category', '').strip()
+
+    try:
+        start_date_obj, end_date_obj, filename_suffix, _ = _rango_periodo_resumen(request.args)
     except ValueError as e:
         flash(f"Error en la entrada de fecha para CSV de resumen: {e}", 'error')
         return redirect(url_for('summary_options'))
@@ -2018,9 +6301,19 @@ def download_summary_csv():
         flash(f"Error al procesar fechas para CSV de resumen: {e}", 'error')
         return redirect(url_for('summary_options'))
 
-    observations_raw = obtener_observaciones_filtradas(start_date_obj, end_date_obj, status_category_filter if status_category_filter != "" else None)
+    try:
+        zona = _zona_de_peticion()
+    except ValueError as e:
+        flash(f"Error: {e}", 'error')
+        return redirect(url_for('summary_options'))
 
-    if not observations_raw:
+    if zona:
+        lote_observaciones = obtener_lote_zona(zona, start_date_obj, end_date_obj, status_category_filter if status_category_filter != "" else None, proyeccion='csv')
+        filename_suffix += f"_zona{zona['id']}"
+    else:
+        lote_observaciones = obtener_lote_observaciones(start_date_obj, end_date_obj, status_category_filter if status_category_filter != "" else None, proyeccion='csv')
+
+    if not len(lote_observaciones):
         flash("No hay datos para generar el CSV de resumen filtrado.", 'error')
         return redirect(url_for('summary_options'))
 
@@ -2032,25 +6325,11 @@ def download_summary_csv():
     csv_writer = csv.writer(csv_buffer)
     
     # Escribir encabezados
-    column_names = ['id', 'matricula', 'nombre_embarcacion', 'timestamp', 'latitud_wgs84', 
-                    'longitud_wgs84', 'tipo_embarcacion_id', 'estatus_categoria_id', 'notas_adicionales', 'nombre_patron']
+    column_names = list(COLUMNAS_OBSERVACION)
     csv_writer.writerow(column_names)
     
-    # Escribir datos
-    for obs in observations_raw:
-        row = [
-            obs.get('id'),
-            obs.get('matricula'),
-            obs.get('nombre_embarcacion'),
-            obs.get('timestamp').strftime('%Y-%m-%d %H:%M:%S') if isinstance(obs.get('timestamp'), datetime.datetime) else '',
-            obs.get('latitud_wgs84'),
-            obs.get('longitud_wgs84'),
-            obs.get('tipo_embarcacion_id'),
-            obs.get('estatus_categoria_id'),
-            obs.get('notas_adicionales'),
-            obs.get('nombre_patron')
-        ]
-        csv_writer.writerow(row)
+    # Escribir datos (el timestamp se formatea de forma vectorizada en el lote)
+    csv_writer.writerows(lote_observaciones.filas_csv(column_names))
     
     csv_buffer.seek(0)
     
@@ -2060,6 +6339,204 @@ def download_summary_csv():
                      as_attachment=True)
 
 
+# EXPORTACIÓN GEOJSON / KML EN FLUJO
+# Los analistas SIG convertían a mano el CSV del resumen. Estas exportaciones leen desde un cursor de
+# servidor por lotes y van enviando cada lote ya serializado, así que la memoria no crece con el periodo.
+FORMATOS_GEO = {
+    # formato: (tipo MIME, extensión)
+    'geojson': ('application/geo+json', 'geojson'),
+    'ndjson': ('application/x-ndjson', 'geojsonl'), # un Feature por línea
+    'kml': ('application/vnd.google-earth.kml+xml', 'kml'),
+}
+
+def _rasgos_anp():
+    """Geometrías base del ANP y zonas registradas en WGS84 como (nombre, categoría, geometría de shapely)."""
+    rasgos = [("Polígono Marítimo ANP", 'anp', anp_maritime_polygon_geo),
+              ("Isla María Madre", 'isla', isla_maria_madre_polygon_geo),
+              ("Puerto Balleto", 'puerto', puerto_balleto_polygon_geo)]
+    rasgos += [(nombre, 'islote', MultiPoint(datos['coords'])) for nombre, datos in islas_menores_data_geo.items()]
+    rasgos += [(zona['nombre'], zona['tipo'], zona['geometria']) for zona in registro_zonas.zonas if zona['clave'] != 'anp']
+    return [rasgo for rasgo in rasgos if not rasgo[2].is_empty]
+
+_GEOJSON_ANP = None
+
+def geojson_anp():
+    """
+    FeatureCollection de las geometrías del ANP simplificadas para el mapa interactivo, con su ETag.
+    Se calcula una vez por proceso: las geometrías no cambian mientras la aplicación está en marcha.
+    """
+    global _GEOJSON_ANP
+    if _GEOJSON_ANP is None:
+        features = [{'type': 'Feature',
+                     'geometry': mapping(geometria.simplify(ANP_TOLERANCIA_SIMPLIFICACION, preserve_topology=True)),
+                     'properties': {'nombre': nombre, 'categoria': categoria}}
+                    for nombre, categoria, geometria in _rasgos_anp()]
+        cuerpo = json.dumps({'type': 'FeatureCollection', 'features': features}, ensure_ascii=False)
+        _GEOJSON_ANP = (cuerpo, hashlib.sha1(cuerpo.encode('utf-8')).hexdigest())
+    return _GEOJSON_ANP
+
+def _propiedades_observacion(fila):
+    propiedades = {campo: fila[campo] for campo in COLUMNAS_OBSERVACION
+                   if campo not in ('latitud_wgs84', 'longitud_wgs84')}
+    propiedades['timestamp'] = fila.timestamp.strftime('%Y-%m-%dT%H:%M:%S') if fila.timestamp else None
+    propiedades['estatus_desc'] = _DESC_ESTATUS.get(fila.estatus_categoria_id, "Estatus Desconocido")
+    return propiedades
+
+def _flujo_geojson(lotes, rasgos, por_lineas):
+    """FeatureCollection (o un Feature por línea si 'por_lineas') a partir de lotes de FilaObservacion."""
+    def _feature(geometria, propiedades):
+        return json.dumps({'type': 'Feature', 'geometry': geometria, 'properties': propiedades}, ensure_ascii=False)
+
+    separador = '\n' if por_lineas else ',\n'
+    if not por_lineas:
+        yield '{"type": "FeatureCollection", "features": [\n'
+    hay_features = False
+    lotes_texto = itertools.chain(
+        [[_feature(mapping(geometria), {'nombre': nombre, 'categoria': categoria}) for nombre, categoria, geometria in rasgos]],
+        ([_feature({'type': 'Point', 'coordinates': [fila.longitud_wgs84, fila.latitud_wgs84]}, _propiedades_observacion(fila))
+          for fila in lote] for lote in lotes))
+    for features in lotes_texto:
+        if features:
+            yield (separador if hay_features else '') + separador.join(features)
+            hay_features = True
+    if por_lineas:
+        yield '\n' if hay_features else ''
+    else:
+        yield '\n]}\n'
+
+def _color_kml(color):
+    """Color de Matplotlib en el formato aabbggrr de KML."""
+    r, g, b = (round(c * 255) for c in mcolors.to_rgb(color))
+    return f"ff{b:02x}{g:02x}{r:02x}"
+
+def _coordenadas_kml(coordenadas):
+    return ' '.join(f"{lon},{lat}" for lon, lat in coordenadas)
+
+def _flujo_kml(lotes, rasgos, titulo):
+    """Documento KML (un estilo por estatus, TimeStamp en cada Placemark) a partir de lotes de FilaObservacion."""
+    partes = ['<?xml version="1.0" encoding="UTF-8"?>\n<kml xmlns="http://www.opengis.net/kml/2.2">\n<Document>\n',
+              f"<name>{escape(titulo)}</name>\n"]
+    for codigo, color in _COLOR_ESTATUS.items():
+        partes.append(f'<Style id="estatus_{codigo}"><IconStyle><color>{_color_kml(color)}</color>'
+                      '<Icon><href>http://maps.google.com/mapfiles/kml/shapes/shaded_dot.png</href></Icon>'
+                      '</IconStyle></Style>\n')
+    partes.append('<Style id="anp"><LineStyle><color>ff0000ff</color><width>2</width></LineStyle>'
+                  '<PolyStyle><color>1a0000ff</color></PolyStyle></Style>\n')
+    if rasgos:
+        partes.append("<Folder><name>Geometrías del ANP</name>\n")
+        for nombre, categoria, geometria in rasgos:
+            if geometria.geom_type in ('Polygon', 'MultiPolygon'):
+                poligonos = geometria.geoms if geometria.geom_type == 'MultiPolygon' else [geometria]
+                cuerpo = "<MultiGeometry>" + ''.join(
+                    f"<Polygon><outerBoundaryIs><LinearRing><coordinates>{_coordenadas_kml(poligono.exterior.coords)}"
+                    "</coordinates></LinearRing></outerBoundaryIs>"
+                    + ''.join(f"<innerBoundaryIs><LinearRing><coordinates>{_coordenadas_kml(anillo.coords)}"
+                              "</coordinates></LinearRing></innerBoundaryIs>" for anillo in poligono.interiors)
+                    + "</Polygon>" for poligono in poligonos) + "</MultiGeometry>"
+            else:
+                cuerpo = "<MultiGeometry>" + ''.join(f"<Point><coordinates>{p.x},{p.y}</coordinates></Point>"
+                                                     for p in geometria.geoms) + "</MultiGeometry>"
+            partes.append(f"<Placemark><name>{escape(nombre)}</name><styleUrl>#anp</styleUrl>"
+                          f"<ExtendedData><Data name=\"categoria\"><value>{categoria}</value></Data></ExtendedData>"
+                          f"{cuerpo}</Placemark>\n")
+        partes.append("</Folder>\n")
+    partes.append("<Folder><name>Observaciones</name>\n")
+    yield ''.join(partes)
+    for lote in lotes:
+        partes = []
+        for fila in lote:
+            propiedades = _propiedades_observacion(fila)
+            estilo = fila.estatus_categoria_id if fila.estatus_categoria_id in _COLOR_ESTATUS else 'unknown_status'
+            datos = ''.join(f'<Data name="{campo}"><value>{escape(valor)}</value></Data>'
+                            for campo, valor in propiedades.items() if valor is not None)
+            cuando = f"<TimeStamp><when>{propiedades['timestamp']}</when></TimeStamp>" if propiedades['timestamp'] else ''
+            partes.append(f"<Placemark><name>{escape(fila.matricula)}</name>{cuando}<styleUrl>#estatus_{estilo}</styleUrl>"
+                          f"<ExtendedData>{datos}</ExtendedData>"
+                          f"<Point><coordinates>{fila.longitud_wgs84},{fila.latitud_wgs84}</coordinates></Point></Placemark>\n")
+        yield ''.join(partes)
+    yield "</Folder>\n</Document>\n</kml>\n"
+
+@app.route('/download_summary_geo')
+@viewer_required # Cualquier usuario aprobado puede descargar las exportaciones del resumen
+@clase_consulta('reporte')
+def download_summary_geo():
+    """
+    Observaciones del resumen (mismos filtros de periodo y estatus que el CSV) como GeoJSON ('geojson'),
+    GeoJSON por líneas ('ndjson') o KML ('kml'). Con incluir_anp=1 se añaden las geometrías del ANP.
+    """
+    formato = request.args.get('formato', 'geojson')
+    status_category_filter = request.args.get('status_category', '').strip()
+    if formato not in FORMATOS_GEO:
+        flash("Formato de exportación no válido.", 'error')
+        return redirect(url_for('summary_options'))
+    try:
+        start_date_obj, end_date_obj, filename_suffix, _ = _rango_periodo_resumen(request.args)
+    except ValueError as e:
+        flash(f"Error en la entrada de fecha para la exportación: {e}", 'error')
+        return redirect(url_for('summary_options'))
+    try:
+        zona = _zona_de_peticion()
+    except ValueError as e:
+        flash(f"Error: {e}", 'error')
+        return redirect(url_for('summary_options'))
+    if zona:
+        filename_suffix += f"_zona{zona['id']}"
+    if status_category_filter:
+        filename_suffix += f"_{status_category_filter}"
+
+    conn = conectar_db_lectura()
+    if not conn:
+        flash("Error: No se pudo conectar a la base de datos para exportar.", 'error')
+        return redirect(url_for('summary_options'))
+    condiciones, params = _filtro_observaciones_sql(start_date_obj, end_date_obj, _filtro_estatus_efectivo(status_category_filter))
+    if zona:
+        condicion_zona, params_zona = _filtro_zona_sql(zona)
+        condiciones += condicion_zona
+        params += params_zona
+    try:
+        # Cursor con nombre: PostgreSQL entrega las filas por lotes en lugar de todo el resultado de una vez
+        cursor = conn.cursor(name='exportacion_geo')
+        cursor.itersize = EXPORTACION_LOTE_FILAS
+        cursor.execute(f"SELECT {_columnas_select(FilaObservacion)} FROM observaciones_embarcaciones "
+                       f"WHERE {condiciones} ORDER BY timestamp ASC", tuple(params))
+    except psycopg2.Error as e:
+        conn.close()
+        print(f"Error al preparar la exportación {formato}: {e}")
+        flash("Error al exportar las observaciones.", 'error')
+        return redirect(url_for('summary_options'))
+
+    def _lotes():
+        try:
+            while True:
+                filas = cursor.fetchmany(EXPORTACION_LOTE_FILAS)
+                if not filas:
+                    break
+                lote = [FilaObservacion._make(fila) for fila in filas]
+                if zona and not zona.get('registrada'):
+                    # El SQL solo prefiltra por el rectángulo envolvente; aquí se aplica el polígono exacto
+                    dentro = shapely.intersects_xy(zona['geometria'], [fila.longitud_wgs84 for fila in lote],
+                                                   [fila.latitud_wgs84 for fila in lote])
+                    lote = [fila for fila, incluida in zip(lote, dentro) if incluida]
+                yield lote
+        except psycopg2.Error as e:
+            # Se propaga para que la descarga quede incompleta en lugar de parecer terminada
+            print(f"Error durante la exportación {formato}: {e}")
+            raise
+
+    rasgos = _rasgos_anp() if request.args.get('incluir_anp') == '1' else []
+    if zona:
+        rasgos.append((zona['nombre'], 'zona', zona['geometria']))
+    if formato == 'kml':
+        flujo = _flujo_kml(_lotes(), rasgos, f"Observaciones{filename_suffix}")
+    else:
+        flujo = _flujo_geojson(_lotes(), rasgos, por_lineas=(formato == 'ndjson'))
+    mimetype, extension = FORMATOS_GEO[formato]
+    respuesta = Response(stream_with_context(flujo), mimetype=mimetype)
+    respuesta.call_on_close(conn.close)
+    respuesta.headers['Content-Disposition'] = f'attachment; filename=resumen_observaciones{filename_suffix}.{extension}'
+    return respuesta
+
+
 @app.route('/delete_observation/<int:obs_id>', methods=['POST'])
 @editor_required # Solo editores y administradores pueden eliminar observaciones
 def delete_observation(obs_id):
@@ -2076,6 +6553,7 @@ def delete_observation(obs_id):
 
 @app.route('/upload_csv_to_db', methods=['GET', 'POST'])
 @editor_required # Solo editores y administradores pueden subir CSVs
+@clase_consulta('reporte')
 def upload_csv_to_db():
     if request.method == 'POST':
         if 'csv_file' not in request.files:
@@ -2089,103 +6567,93 @@ def upload_csv_to_db():
         
         if file and file.filename.endswith('.csv'):
             try:
-                stream = io.StringIO(file.stream.read().decode("UTF8"))
-                reader = csv.DictReader(stream)
-                
+                # Validación y clasificación por bloques, sin tocar la base de datos
+                filas_validas, problemas, corregidas = validar_csv_observaciones(
+                    file.stream.read().decode("utf-8-sig"), corregir=bool(request.form.get('corregir_estatus')))
+                total_invalidas = len(problemas)
+
                 conn = conectar_db()
                 if not conn:
                     flash('Error: No se pudo conectar a la base de datos.', 'error')
                     return render_template('upload_csv.html')
 
                 cursor = conn.cursor()
-                total_inserted = 0
-                total_skipped = 0
-
-                for row_num, row_data_from_csv in enumerate(reader):
-                    try:
-                        insert_sql = """
-                        INSERT INTO observaciones_embarcaciones (
-                            matricula, nombre_embarcacion, timestamp, latitud_wgs84, longitud_wgs84,
-                            tipo_embarcacion_id, estatus_categoria_id, notas_adicionales, nombre_patron
-                        ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
-                        ON CONFLICT (matricula, timestamp) DO NOTHING; 
-                        """
-                        
-                        matricula_val = row_data_from_csv.get('matricula')
-                        nombre_embarcacion_val = row_data_from_csv.get('nombre_embarcacion')
-                        timestamp_val_raw = row_data_from_csv.get('timestamp')
-
-                        timestamp_dt_obj = None
-                        if timestamp_val_raw:
-                            try:
-                                timestamp_dt_obj = datetime.datetime.strptime(timestamp_val_raw, '%Y-%m-%d %H:%M:%S')
-                            except ValueError:
-                                try:
-                                    timestamp_dt_obj = datetime.datetime.strptime(timestamp_val_raw, '%Y-%m-%d %H:%M')
-                                except ValueError:
-                                    try:
-                                        timestamp_dt_obj = datetime.datetime.fromisoformat(timestamp_val_raw.replace('Z', '+00:00'))
-                                    except ValueError:
-                                        print(f"ADVERTENCIA (CSV Import): Timestamp no reconocido en fila {row_num + 1}: '{timestamp_val_raw}'. Esta fila podría fallar la inserción.")
-                                        timestamp_dt_obj = None 
-                        
-                        if timestamp_dt_obj is None:
-                            raise ValueError(f"No se pudo parsear el timestamp '{timestamp_val_raw}' a un formato de fecha/hora válido.")
-
-                        latitud_val = None
-                        if row_data_from_csv.get('latitud_wgs84'):
-                            try:
-                                latitud_val = float(row_data_from_csv['latitud_wgs84'])
-                            except ValueError:
-                                print(f"ADVERTENCIA (CSV Import): Latitud no válida en fila {row_num + 1}: '{row_data_from_csv['latitud_wgs84']}'")
-                        
-                        longitud_val = None
-                        if row_data_from_csv.get('longitud_wgs84'):
-                            try:
-                                longitud_val = float(row_data_from_csv['longitud_wgs84'])
-                            except ValueError:
-                                print(f"ADVERTENCIA (CSV Import): Longitud no válida en fila {row_num + 1}: '{row_data_from_csv['longitud_wgs84']}'")
-
-                        tipo_embarcacion_id_val = row_data_from_csv.get('tipo_embarcacion_id')
-                        estatus_categoria_id_val = row_data_from_csv.get('estatus_categoria_id')
-                        notas_adicionales_val = row_data_from_csv.get('notas_adicionales')
-                        nombre_patron_val = row_data_from_csv.get('nombre_patron')
-
-                        cursor.execute(insert_sql, (
-                            matricula_val,
-                            nombre_embarcacion_val,
-                            timestamp_dt_obj, 
-                            latitud_val,
-                            longitud_val,
-                            tipo_embarcacion_id_val,
-                            estatus_categoria_id_val,
-                            notas_adicionales_val,
-                            nombre_patron_val
-                        ))
-                        if cursor.rowcount > 0: 
-                            total_inserted += 1
-                        else: 
-                            total_skipped += 1
-
-                    except KeyError as e:
-                        print(f"ADVERTENCIA (CSV Import): Columna '{e}' no encontrada en CSV para la fila {row_num + 1}. Fila omitida.")
-                        total_skipped += 1
-                    except (ValueError, TypeError) as e:
-                        print(f"ADVERTENCIA (CSV Import): Error de conversión de tipo en fila {row_num + 1} (Matrícula: {row_data_from_csv.get('matricula', 'N/A')}): {e}. Fila omitida.")
-                        total_skipped += 1
-                    except psycopg2.Error as e: 
-                        print(f"ERROR DB (CSV Import) al procesar fila {row_num + 1} (Matrícula: {row_data_from_csv.get('matricula', 'N/A')}): {e}. Fila omitida.")
-                        conn.rollback() 
-                        total_skipped += 1
-                    except Exception as e:
-                        print(f"ERROR inesperado (CSV Import) al procesar fila {row_num + 1} (Matrícula: {row_data_from_csv.get('matricula', 'N/A')}): {e}. Fila omitida.")
-                        total_skipped += 1
-
-                conn.commit()
-                cursor.close()
-                conn.close()
+                filas_insertadas = []
+                total_duplicados = 0
+                try:
+                    # Mismo avistamiento ya guardado o repetido en el archivo, a pocos metros y minutos. La misma
+                    # matrícula con el mismo timestamp no es un posible duplicado: la omite ON CONFLICT (ya existente).
+                    if not request.form.get('permitir_duplicados'):
+                        duplicados = _duplicados_de_lote(cursor, [
+                            (None, valores[0], valores[2], valores[4], valores[3]) for _, valores in filas_validas])
+                        claves = [(valores[0], valores[2]) for _, valores in filas_validas]
+                        clave_de = lambda otra: (otra[1], otra[2]) if isinstance(otra, tuple) else claves[otra]
+                        descartadas = set()
+                        for k, coincidencias in sorted(duplicados.items()):
+                            row_num, valores = filas_validas[k]
+                            exacta = next((c for c in coincidencias if clave_de(c[0]) == claves[k]), None)
+                            # Repetida exacta: ya existente, salvo que repita una fila del archivo ya descartada
+                            if exacta and (isinstance(exacta[0], tuple) or exacta[0] not in descartadas):
+                                continue
+                            otra, metros, minutos = exacta or coincidencias[0]
+                            otra = f"la observación {otra[0]}" if isinstance(otra, tuple) else f"la fila {filas_validas[otra][0]}"
+                            problemas.append((row_num, valores[0], f"parece duplicado de {otra} ({metros} m, {minutos} min)"))
+                            descartadas.add(k)
+                        total_duplicados = len(descartadas)
+                        filas_validas = [fila for k, fila in enumerate(filas_validas) if k not in descartadas]
+
+                    if filas_validas:
+                        insertadas = psycopg2.extras.execute_values(cursor, """
+                            INSERT INTO observaciones_embarcaciones (
+                                matricula, nombre_embarcacion, timestamp, latitud_wgs84, longitud_wgs84,
+                                tipo_embarcacion_id, estatus_categoria_id, notas_adicionales, nombre_patron, zonas
+                            ) VALUES %s
+                            ON CONFLICT (matricula, timestamp) DO NOTHING
+                            RETURNING *;
+                        """, [valores for _, valores in filas_validas],
+                            template="(%s, %s, %s, %s, %s, %s, %s, %s, %s, %s::text[])", page_size=1000, fetch=True)
+                        columnas = [col[0] for col in cursor.description]
+                        filas_insertadas = [dict(zip(columnas, fila)) for fila in insertadas]
+                    if filas_insertadas:
+                        # Años históricos sin partición: sus filas cayeron en la de por defecto y se mueven a una propia
+                        anios = [fila['timestamp'].year for fila in filas_insertadas]
+                        _asegurar_particiones_observaciones(cursor, min(anios), max(anios))
+                        matriculas_insertadas = {fila['matricula'] for fila in filas_insertadas}
+                        _sincronizar_embarcaciones(cursor, matriculas_insertadas)
+                        afectadas = _ids_embarcaciones(cursor, matriculas_insertadas)
+                        _recalcular_resumen_embarcaciones(cursor, afectadas)
+                        _recalcular_riesgo_embarcaciones(cursor, afectadas, motivo='importacion_csv')
+                        _recalcular_saltos_trayecto(cursor, afectadas)
+                        _recalcular_patrones(cursor, _sincronizar_patrones(
+                            cursor, {fila['nombre_patron'] for fila in filas_insertadas}))
+                    conn.commit()
+                except psycopg2.Error as e:
+                    conn.rollback()
+                    print(f"ERROR DB (CSV Import): {e}")
+                    flash(f'Error de la base de datos al importar el CSV; no se guardó ninguna fila: {e}', 'error')
+                    return render_template('upload_csv.html')
+                finally:
+                    cursor.close()
+                    conn.close()
+                _notificar_escritura(filas_insertadas)
+
+                total_inserted = len(filas_insertadas)
+                total_skipped = total_invalidas + total_duplicados + len(filas_validas) - total_inserted # Inválidas, posibles duplicados y ya existentes
+                print(f"Importación CSV: {total_inserted} insertadas, {total_invalidas} inválidas o contradictorias, "
+                      f"{total_duplicados} posibles duplicados, {len(filas_validas) - total_inserted} ya existentes.")
                 flash(f'CSV importado exitosamente. Se insertaron {total_inserted} registros y se omitieron {total_skipped}.', 'success')
+                if corregidas:
+                    flash(f'Se corrigió según la posición el estatus de {corregidas} filas que contradecían su ubicación.', 'info')
+                if total_duplicados:
+                    flash(f'Se omitieron {total_duplicados} filas que parecen duplicados de observaciones ya guardadas o de otras '
+                          f'filas del archivo (a menos de {DUPLICADOS_DISTANCIA_M:g} m y {DUPLICADOS_MINUTOS:g} min).', 'warning')
+                if problemas:
+                    problemas.sort()
+                    return render_template('upload_csv.html', problemas=problemas[:CSV_PROBLEMAS_MOSTRADOS],
+                                           total_problemas=len(problemas))
                 return redirect(url_for('index')) 
+            except ConsultaCancelada:
+                raise
             except Exception as e:
                 flash(f'Error al procesar el archivo CSV: {e}', 'error')
                 return render_template('upload_csv.html')
@@ -2251,12 +6719,15 @@ def delete_user(user_id):
 # NUEVA RUTA: Panel de Estadísticas y KPIs / Patrones de Anomalías
 @app.route('/dashboard_stats')
 @viewer_required # Cualquier usuario aprobado puede ver las estadísticas
+@clase_consulta('reporte')
 def dashboard_stats():
     # Obtener datos para gráficos/estadísticas
     observations_by_month_year = get_observation_counts_by_month_year()
     status_distribution = get_status_distribution()
     top_recurrent_vessels = get_top_recurrent_vessels(limit=5) # Top 5 embarcaciones más recurrentes
+    top_risk_vessels = get_top_risk_vessels(limit=10) # Top 10 por puntaje de riesgo
     repeated_infraction_vessels = get_repeated_infraction_vessels(min_infractions=2) # Embarcaciones con 2 o más infracciones
+    saltos_recientes = obtener_saltos_recientes(limite=10) # Posibles matrículas o coordenadas mal capturadas
 
     # Preprocesar datos para facilitar la visualización en la plantilla
     # Para observaciones por mes/año (ej. para un gráfico de barras/líneas)
@@ -2309,7 +6780,16 @@ def dashboard_stats():
                            status_labels=status_labels,
                            status_data=status_data,
                            top_recurrent_vessels=top_recurrent_vessels,
-                           repeated_infraction_vessels=repeated_infraction_vessels)
+                           top_risk_vessels=top_risk_vessels,
+                           repeated_infraction_vessels=repeated_infraction_vessels,
+                           saltos_recientes=saltos_recientes)
+
+# NUEVA RUTA API: Contadores de la caché de consultas (aciertos, fallos, desalojos, memoria)
+@app.route('/api/cache_stats')
+@admin_required # Solo administradores pueden consultar el estado interno de la caché
+def cache_stats():
+    return jsonify({**cache_consultas.estadisticas(), 'circuito_db': interruptor_db.estado(), 'replica': estado_replica(),
+                    'indice_espacial': indice_espacial.estadisticas()})
 
 # NUEVA RUTA: Perfil de usuario y cambio de contraseña
 @app.route('/user_profile', methods=['GET'])
@@ -2359,39 +6839,663 @@ def search_suggestions():
     query = request.args.get('q', '').strip().lower()
     if not query:
         return jsonify([])
+    return jsonify(obtener_sugerencias_busqueda(query))
 
+def obtener_sugerencias_busqueda(query):
+    """Sugerencias de matrícula, nombre de embarcación y patrón para el autocompletado (con caché)."""
+    def _cargar():
+        conn = conectar_db()
+        if not conn:
+            return None
+        cursor = conn.cursor()
+        
+        suggestions = set()
+        try:
+            # Las sugerencias salen del registro de embarcaciones (una fila por matrícula), no de las observaciones
+            # Buscar matrículas
+            cursor.execute("SELECT matricula FROM embarcaciones WHERE LOWER(matricula) LIKE %s LIMIT 10", (f'%{query}%',))
+            for row in cursor.fetchall():
+                suggestions.add(row[0])
+        
+            # Buscar nombres de embarcación (incluye nombres anteriores del historial)
+            cursor.execute("SELECT DISTINCT nombre_embarcacion FROM embarcaciones_historial WHERE LOWER(nombre_embarcacion) LIKE %s LIMIT 10", (f'%{query}%',))
+            for row in cursor.fetchall():
+                if row[0]: # Asegurarse de que no sea None
+                    suggestions.add(row[0])
+
+            # Buscar nombres de patrón en el índice de patrones (sin acentos: se compara el nombre normalizado)
+            cursor.execute("SELECT nombre AS nombre_patron FROM patrones WHERE nombre_normalizado LIKE %s ORDER BY total_observaciones DESC LIMIT 10",
+                           (f'%{_normalizar_nombre(query)}%',))
+            for row in cursor.fetchall():
+                if row[0] and row[0].lower() != 'n/a': # Asegurarse de que no sea None o 'N/A'
+                    suggestions.add(row[0])
+
+        except psycopg2.Error as e:
+            print(f"Error al obtener sugerencias de búsqueda: {e}")
+            return None
+        finally:
+            if cursor: cursor.close()
+            if conn: conn.close()
+        
+        return sorted(list(suggestions))
+
+    return _leer_con_cache(('obtener_sugerencias_busqueda', query), _afecta_tablero, _cargar) or []
+
+
+# Consultas canceladas: por tiempo se informa al usuario; si el cliente se fue no hay a quién responder
+@app.errorhandler(ConsultaCancelada)
+def manejar_consulta_cancelada(error):
+    if error.motivo == 'desconexion':
+        print(f"Consulta cancelada en {request.path}: el cliente cerró la conexión.")
+        return '', 499 # Convención de nginx: el cliente cerró la petición
+    print(f"Consulta cancelada por tiempo en {request.path}: {error}")
+    mensaje = ("La consulta tardó demasiado y fue cancelada. "
+               "Reduzca el período o los filtros de búsqueda e intente de nuevo.")
+    if request.path.startswith('/api/'):
+        return jsonify({'error': mensaje}), 504
+    flash(mensaje, 'error')
+    destino = request.referrer if request.referrer and request.referrer != request.url else url_for('index')
+    return redirect(destino)
+
+# Modo degradado: base.html muestra un aviso mientras el circuito de la base de datos está abierto
+@app.context_processor
+def inyectar_estado_db():
+    return {'db_degradada': interruptor_db.abierto}
+
+
+# 8. --- COMANDOS DE MANTENIMIENTO (flask --app app <comando>) ---
+
+def _medir_construccion(construir):
+    """Devuelve (pico de memoria en bytes, segundos) de construir()."""
+    tracemalloc.start()
+    inicio = time.perf_counter()
+    resultado = construir()
+    segundos = time.perf_counter() - inicio
+    _, pico = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del resultado
+    return pico, segundos
+
+@app.cli.command('benchmark-filas')
+def benchmark_filas():
+    """
+    Compara, para 10k filas sintéticas, el camino anterior (SELECT * + _fetch_as_dict + .copy() en la ruta)
+    con las filas compactas y las proyecciones de columnas.
+    """
+    n_filas = 10000
+    base_ts = datetime.datetime(2024, 1, 1)
+    filas_completas = [
+        (i, f"MAT-{i % 700:05d}", f"Embarcación {i % 700}", base_ts + datetime.timedelta(minutes=37 * i),
+         21.5 + (i % 100) / 1000.0, -106.5 + (i % 100) / 1000.0, 'panga', 'paso_inocente',
+         f"Nota {i}: " + "artes de pesca observadas, tripulación a bordo. " * 3, f"Patrón {i % 300}")
+        for i in range(n_filas)
+    ]
+    indices_mapa = [COLUMNAS_OBSERVACION.index(c) for c in FilaMapa._fields]
+    # Lo que la base de datos devolvería con la proyección del mapa (solo esas columnas)
+    filas_mapa = [tuple(fila[i] for i in indices_mapa) for fila in filas_completas]
+
+    def _antes():
+        registros = [dict(zip(COLUMNAS_OBSERVACION, fila)) for fila in list(filas_completas)]
+        return registros, [obs.copy() for obs in registros]
+
+    casos = [
+        ("dict por fila + copia (antes)", _antes),
+        ("FilaObservacion (tabla/CSV)", lambda: [FilaObservacion._make(fila) for fila in list(filas_completas)]),
+        ("FilaMapa (proyección mapa)", lambda: [FilaMapa._make(fila) for fila in list(filas_mapa)]),
+    ]
+    # Tamaño de lo que viaja desde el servidor (valores de cada proyección)
+    bytes_completos = _estimar_bytes(filas_completas)
+    bytes_mapa = _estimar_bytes(filas_mapa)
+    print(f"Filas: {n_filas}")
+    print(f"Datos transferidos: SELECT * ~{bytes_completos / 1024:.0f} KiB, proyección mapa ~{bytes_mapa / 1024:.0f} KiB")
+    for nombre, construir in casos:
+        pico, segundos = _medir_construccion(construir)
+        print(f"{nombre:<32} memoria pico {pico / 1024:8.0f} KiB   tiempo {segundos * 1000:7.1f} ms")
+
+@app.cli.command('recalcular-riesgo')
+def recalcular_riesgo():
+    """Recalcula el puntaje de riesgo de todas las embarcaciones con los pesos y la vida media actuales."""
     conn = conectar_db()
     if not conn:
-        return jsonify([])
+        print("No se pudo conectar a la base de datos.")
+        return
     cursor = conn.cursor()
-    
-    suggestions = set()
     try:
-        # Buscar matrículas
-        cursor.execute("SELECT DISTINCT matricula FROM observaciones_embarcaciones WHERE LOWER(matricula) LIKE %s LIMIT 10", (f'%{query}%',))
-        for row in cursor.fetchall():
-            suggestions.add(row[0])
-        
-        # Buscar nombres de embarcación
-        cursor.execute("SELECT DISTINCT nombre_embarcacion FROM observaciones_embarcaciones WHERE LOWER(nombre_embarcacion) LIKE %s LIMIT 10", (f'%{query}%',))
-        for row in cursor.fetchall():
-            if row[0]: # Asegurarse de que no sea None
-                suggestions.add(row[0])
+        inicio = time.perf_counter()
+        _recalcular_riesgo_embarcaciones(cursor, motivo='recalculo')
+        cursor.execute("SELECT COUNT(*) FROM riesgo_embarcaciones;")
+        total = cursor.fetchone()[0]
+        conn.commit()
+        print(f"Puntaje de riesgo recalculado para {total} embarcaciones en {time.perf_counter() - inicio:.1f} s "
+              f"(configuración {RIESGO_VERSION}).")
+    except psycopg2.Error as e:
+        conn.rollback()
+        print(f"Error al recalcular el puntaje de riesgo: {e}")
+    finally:
+        cursor.close()
+        conn.close()
 
-        # Buscar nombres de patrón
-        cursor.execute("SELECT DISTINCT nombre_patron FROM observaciones_embarcaciones WHERE LOWER(nombre_patron) LIKE %s LIMIT 10", (f'%{query}%',))
-        for row in cursor.fetchall():
-            if row[0] and row[0].lower() != 'n/a': # Asegurarse de que no sea None o 'N/A'
-                suggestions.add(row[0])
+@app.cli.command('mantener-particiones')
+def mantener_particiones():
+    """
+    Crea las particiones anuales de los próximos PARTICIONES_ANIOS_FUTUROS años y mueve a su propia
+    partición las filas que hayan caído en la de por defecto. Pensado para ejecutarse desde cron.
+    """
+    conn = conectar_db()
+    if not conn:
+        print("No se pudo conectar a la base de datos.")
+        return
+    cursor = conn.cursor()
+    try:
+        cursor.execute("""
+            SELECT EXTRACT(YEAR FROM MIN(timestamp))::int, EXTRACT(YEAR FROM MAX(timestamp))::int
+            FROM observaciones_embarcaciones_default;
+        """)
+        desde, hasta = cursor.fetchone()
+        creadas = _asegurar_particiones_observaciones(cursor, desde, hasta)
+        conn.commit()
+        print(f"Particiones creadas: {', '.join(creadas)}." if creadas else "No faltaba ninguna partición.")
+        cursor.execute("""
+            SELECT c.relname, c.reltuples::bigint FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+            WHERE i.inhparent = 'observaciones_embarcaciones'::regclass ORDER BY c.relname;
+        """)
+        for particion, filas_estimadas in cursor.fetchall():
+            print(f"  {particion}: ~{max(filas_estimadas, 0)} filas")
+    except psycopg2.Error as e:
+        conn.rollback()
+        print(f"Error al mantener las particiones: {e}")
+    finally:
+        cursor.close()
+        conn.close()
 
-    except Exception as e:
-        print(f"Error al obtener sugerencias de búsqueda: {e}")
+@app.cli.command('particionar-observaciones')
+def particionar_observaciones():
+    """
+    Convierte una 'observaciones_embarcaciones' sin particionar (instalaciones anteriores) en la tabla
+    particionada por año y vuelve a crear sus índices. Se ejecuta una vez, con la aplicación detenida
+    o aceptando que la tabla quede bloqueada mientras se copian las filas.
+    """
+    conn = conectar_db()
+    if not conn:
+        print("No se pudo conectar a la base de datos.")
+        return
+    cursor = conn.cursor()
+    try:
+        copiadas = _migrar_observaciones_a_particiones(conn, cursor)
+    except psycopg2.Error as e:
+        conn.rollback()
+        print(f"Error al particionar 'observaciones_embarcaciones': {e}")
+        return
     finally:
-        if cursor: cursor.close()
-        if conn: conn.close()
-    
-    return jsonify(sorted(list(suggestions)))
+        cursor.close()
+        conn.close()
+    if copiadas is None:
+        print("'observaciones_embarcaciones' ya estaba particionada.")
+        return
+    inicializar_db() # Índices, restricciones y particiones de los próximos años sobre la tabla nueva
+
+@app.cli.command('archivar-particion')
+@click.argument('anio', type=int)
+@click.option('--csv', 'ruta_csv', default=None, help='Exporta antes las filas del año a este archivo CSV.')
+@click.option('--eliminar', is_flag=True, help='Borra la tabla separada (usar junto con --csv).')
+def archivar_particion(anio, ruta_csv, eliminar):
+    """
+    Separa de 'observaciones_embarcaciones' la partición de un año: es solo un cambio de catálogo, sin
+    reescribir filas. La tabla separada queda como tabla normal (o se borra con --eliminar) y se
+    recalculan resumen, riesgo y patrones de las embarcaciones que tenían observaciones ese año.
+    """
+    particion = f"observaciones_embarcaciones_{anio}"
+    if eliminar and not ruta_csv:
+        print("--eliminar borraría las observaciones sin copia: úsalo junto con --csv.")
+        return
+    conn = conectar_db()
+    if not conn:
+        print("No se pudo conectar a la base de datos.")
+        return
+    cursor = conn.cursor()
+    try:
+        cursor.execute("""
+            SELECT EXISTS (SELECT 1 FROM pg_inherits
+                           WHERE inhrelid = to_regclass(%s) AND inhparent = 'observaciones_embarcaciones'::regclass);
+        """, (particion,))
+        if not cursor.fetchone()[0]:
+            print(f"No existe la partición '{particion}'.")
+            return
+        if ruta_csv:
+            with open(ruta_csv, 'w', newline='', encoding='utf-8') as archivo:
+                cursor.copy_expert(f"""
+                    COPY (SELECT id, matricula, nombre_embarcacion, timestamp, latitud_wgs84, longitud_wgs84,
+                                 tipo_embarcacion_id, estatus_categoria_id, notas_adicionales, nombre_patron
+                          FROM {particion} ORDER BY timestamp) TO STDOUT WITH CSV HEADER
+                """, archivo)
+            print(f"Observaciones de {anio} exportadas a '{ruta_csv}'.")
+        cursor.execute(f"SELECT array_agg(DISTINCT embarcacion_id), array_agg(DISTINCT patron_id) FROM {particion};")
+        embarcacion_ids, patron_ids = cursor.fetchone()
+        embarcacion_ids = [i for i in embarcacion_ids or [] if i is not None]
+        patron_ids = {i for i in patron_ids or [] if i is not None}
+        cursor.execute(f"ALTER TABLE observaciones_embarcaciones DETACH PARTITION {particion};")
+        _recalcular_resumen_embarcaciones(cursor, embarcacion_ids)
+        _recalcular_riesgo_embarcaciones(cursor, embarcacion_ids, motivo='archivo')
+        _recalcular_saltos_trayecto(cursor, embarcacion_ids)
+        _recalcular_patrones(cursor, patron_ids)
+        if eliminar:
+            cursor.execute(f"DROP TABLE {particion};")
+        conn.commit()
+        invalidar_snapshots([datetime.datetime(anio, mes, 1) for mes in range(1, 13)])
+        destino = "borrada" if eliminar else f"conservada como tabla independiente '{particion}'"
+        print(f"Partición de {anio} separada ({destino}); {len(embarcacion_ids)} embarcaciones recalculadas.")
+    except (psycopg2.Error, OSError) as e:
+        conn.rollback()
+        print(f"Error al archivar la partición de {anio}: {e}")
+    finally:
+        cursor.close()
+        conn.close()
+
+@app.cli.command('congelar-periodos')
+@click.option('--desde', default=None, help='Primer mes a congelar (AAAA-MM); por defecto el primero con datos.')
+@click.option('--reconstruir', is_flag=True, help='Vuelve a congelar también los meses que ya tienen instantánea.')
+@click.option('--verificar', is_flag=True, help='Compara cada instantánea con la base de datos y rehace las que difieran.')
+def congelar_periodos(desde, reconstruir, verificar):
+    """
+    Crea las instantáneas de los meses cerrados que falten (pensado para cron, a principios de mes).
+    --verificar detecta cambios hechos fuera de la aplicación, que no pasan por los ganchos de escritura.
+    """
+    try:
+        mes = datetime.datetime.strptime(desde, '%Y-%m') if desde else _primer_mes_con_datos()
+    except ValueError:
+        print("--desde debe tener el formato AAAA-MM.")
+        return
+    if mes is None:
+        print("No hay observaciones que congelar.")
+        return
+    abierto = _inicio_mes_abierto()
+    while mes < abierto:
+        clave = _clave_mes(mes)
+        meta = _leer_meta_snapshot(_ruta_snapshot(mes))
+        if meta and verificar:
+            columnas = _columnas_snapshot_mes(mes, COLUMNAS_OBSERVACION, None)
+            congeladas = sorted(LoteObservaciones(columnas).filas() if columnas else [])
+            conn = conectar_db()
+            if not conn:
+                print("No se pudo conectar a la base de datos.")
+                return
+            cursor = conn.cursor()
+            try:
+                cursor.execute(f"""
+                    SELECT {_columnas_select(FilaObservacion)} FROM observaciones_embarcaciones
+                    WHERE timestamp >= %s AND timestamp < %s ORDER BY id;
+                """, (mes, _mes_siguiente(mes)))
+                vivas = _fetch_filas(cursor, FilaObservacion)
+            finally:
+                cursor.close()
+                conn.close()
+            if vivas != congeladas:
+                print(f"{clave}: la instantánea difiere de la base de datos.")
+                invalidar_snapshots([mes])
+                meta = None
+        if meta is None or reconstruir:
+            meta = _construir_snapshot(mes)
+            estado = "congelado" if meta else "no se pudo congelar"
+        else:
+            estado = "ya congelado"
+        if meta:
+            agregados = meta['agregados']
+            print(f"{clave}: {estado}; {meta['filas']} observaciones, {agregados['embarcaciones']} embarcaciones, "
+                  f"{agregados['infracciones']} infracciones.")
+        else:
+            print(f"{clave}: {estado}.")
+        mes = _mes_siguiente(mes)
+
+@app.cli.command('depurar-lapidas')
+def depurar_lapidas():
+    """
+    Borra las marcas de borrado con más de DELTA_RETENCION_LAPIDAS_DIAS días. Los cursores de la
+    exportación incremental anteriores a ellas dejan de valer (responden 410).
+    """
+    conn = conectar_db()
+    if not conn:
+        print("No se pudo conectar a la base de datos.")
+        return
+    cursor = conn.cursor()
+    try:
+        cursor.execute("""
+            WITH depuradas AS (
+                DELETE FROM observaciones_eliminadas WHERE eliminado < now() - %s * interval '1 day'
+                RETURNING xact
+            )
+            UPDATE delta_estado SET xact_depurado = GREATEST(xact_depurado, (SELECT MAX(xact) FROM depuradas))
+            RETURNING (SELECT COUNT(*) FROM depuradas);
+        """, (DELTA_RETENCION_LAPIDAS_DIAS,))
+        depuradas = cursor.fetchone()[0]
+        conn.commit()
+        print(f"{depuradas} marcas de borrado con más de {DELTA_RETENCION_LAPIDAS_DIAS} días depuradas.")
+    except psycopg2.Error as e:
+        conn.rollback()
+        print(f"Error al depurar las marcas de borrado: {e}")
+    finally:
+        cursor.close()
+        conn.close()
 
+# RECLASIFICACIÓN MASIVA
+# El estatus 'outside_anp' y las zonas se deciden al guardar cada observación; si se corrigen los límites o
+# cambian las reglas de las zonas, 'flask reclasificar' recorre la tabla por id en lotes, clasifica cada lote
+# de forma vectorizada (RegistroZonas.clasificar_lote) y escribe solo las filas que cambian con un UPDATE por
+# lote. Cada lote es una transacción corta que también guarda el avance, así que el trabajo se puede
+# interrumpir y reanudar, y convive con la aplicación en marcha: una fila editada mientras tanto (su
+# 'version' cambió) no se sobrescribe. Una observación dentro de una zona protegida con estatus 'outside_anp'
+# no se puede reclasificar sola (no se sabe qué estatus le corresponde) y solo se informa para revisarla.
+_CANDADO_RECLASIFICACION = 4504601 # pg_advisory_lock: un solo trabajo a la vez
+
+def _clasificar_lote_reclasificacion(filas, solo_zonas):
+    """(cambios, ids por revisar) de un lote; cada cambio es (fila, estatus nuevo, zonas nuevas)."""
+    estatus_actual = [fila['estatus_categoria_id'] for fila in filas]
+    zonas, estatus, protegida = registro_zonas.clasificar_lote([fila['longitud_wgs84'] for fila in filas],
+                                                               [fila['latitud_wgs84'] for fila in filas], estatus_actual)
+    if solo_zonas:
+        estatus = np.asarray(estatus_actual, dtype=object)
+    revisar = protegida & (estatus == 'outside_anp')
+    cambios = [(fila, nuevo, zonas_nuevas)
+               for fila, nuevo, zonas_nuevas in zip(filas, estatus.tolist(), zonas)
+               if nuevo != fila['estatus_categoria_id'] or zonas_nuevas != list(fila['zonas'] or [])]
+    return cambios, [fila['id'] for fila, marcar in zip(filas, revisar.tolist()) if marcar]
+
+def _escribir_lote_reclasificacion(cursor, trabajo_id, cambios):
+    """UPDATE de las filas que cambian (salvo las editadas desde que se leyeron) y su registro. Devuelve las escritas."""
+    if not cambios:
+        return []
+    por_id = {fila['id']: (fila, estatus, zonas) for fila, estatus, zonas in cambios}
+    escritas = psycopg2.extras.execute_values(cursor, """
+        UPDATE observaciones_embarcaciones o SET estatus_categoria_id = d.estatus, zonas = d.zonas
+        FROM (VALUES %s) AS d(id, version, estatus, zonas)
+        WHERE o.id = d.id AND o.version IS NOT DISTINCT FROM d.version
+        RETURNING o.id
+    """, [(fila['id'], fila.get('version'), estatus, zonas) for fila, estatus, zonas in cambios],
+        template="(%s, %s::bigint, %s, %s::text[])", page_size=len(cambios), fetch=True)
+    escritas = [por_id[id_obs] for (id_obs,) in escritas]
+    if escritas:
+        psycopg2.extras.execute_values(cursor, """
+            INSERT INTO reclasificacion_cambios (reclasificacion_id, observacion_id, estatus_anterior, estatus_nuevo,
+                                                 zonas_anteriores, zonas_nuevas) VALUES %s
+        """, [(trabajo_id, fila['id'], fila['estatus_categoria_id'], estatus, list(fila['zonas'] or []), zonas)
+              for fila, estatus, zonas in escritas], template="(%s, %s, %s, %s, %s::text[], %s::text[])")
+        # El resumen, el riesgo y los totales por patrón dependen del estatus
+        con_estatus_nuevo = [fila for fila, estatus, _ in escritas if estatus != fila['estatus_categoria_id']]
+        embarcaciones = {fila.get('embarcacion_id') for fila in con_estatus_nuevo}
+        _recalcular_resumen_embarcaciones(cursor, embarcaciones)
+        _recalcular_riesgo_embarcaciones(cursor, embarcaciones, motivo='reclasificacion')
+        patrones = {fila.get('patron_id') for fila in con_estatus_nuevo} - {None}
+        if patrones:
+            _recalcular_patrones(cursor, patrones)
+    return escritas
+
+def _resumen_reclasificacion(cursor, trabajo_id):
+    """Transiciones de estatus y entradas/salidas por zona acumuladas de un trabajo (todas sus ejecuciones)."""
+    cursor.execute("""
+        SELECT estatus_anterior, estatus_nuevo, COUNT(*) FROM reclasificacion_cambios
+        WHERE reclasificacion_id = %s AND estatus_anterior IS DISTINCT FROM estatus_nuevo
+        GROUP BY 1, 2 ORDER BY 3 DESC;
+    """, (trabajo_id,))
+    transiciones = Counter({(anterior, nuevo): n for anterior, nuevo, n in cursor.fetchall()})
+    cursor.execute("""
+        SELECT z.clave,
+               COUNT(*) FILTER (WHERE z.clave = ANY(c.zonas_nuevas) AND NOT z.clave = ANY(c.zonas_anteriores)),
+               COUNT(*) FILTER (WHERE z.clave = ANY(c.zonas_anteriores) AND NOT z.clave = ANY(c.zonas_nuevas))
+        FROM reclasificacion_cambios c CROSS JOIN LATERAL unnest(c.zonas_anteriores || c.zonas_nuevas) AS z(clave)
+        WHERE c.reclasificacion_id = %s
+        GROUP BY z.clave;
+    """, (trabajo_id,))
+    entradas, salidas = Counter(), Counter()
+    for clave, entran, salen in cursor.fetchall():
+        entradas[clave], salidas[clave] = entran, salen
+    return transiciones, entradas, salidas
+
+def _imprimir_resumen_reclasificacion(revisadas, omitidas, por_revisar, transiciones, entradas, salidas, ids_por_revisar):
+    print(f"Observaciones revisadas: {revisadas}. Cambios de estatus: {sum(transiciones.values())}.")
+    for (anterior, nuevo), n in transiciones.most_common():
+        print(f"  {_DESC_ESTATUS.get(anterior, anterior)} -> {_DESC_ESTATUS.get(nuevo, nuevo)}: {n}")
+    for clave in sorted(set(entradas) | set(salidas)):
+        if entradas[clave] or salidas[clave]:
+            print(f"  Zona '{clave}': {entradas[clave]} entran, {salidas[clave]} salen")
+    if omitidas:
+        print(f"{omitidas} observaciones se editaron durante el trabajo y no se tocaron (la edición ya las clasificó).")
+    if por_revisar:
+        muestra = ', '.join(str(id_obs) for id_obs in ids_por_revisar[:20])
+        print(f"{por_revisar} observaciones dentro de una zona protegida siguen como 'outside_anp' y deben revisarse"
+              f"{f' (ids: {muestra}...)' if muestra else ''}.")
+
+@app.cli.command('reclasificar')
+@click.option('--simular', is_flag=True, help='Solo calcula y muestra los cambios, sin escribir nada.')
+@click.option('--solo-zonas', is_flag=True, help='Recalcula la pertenencia a zonas sin cambiar estatus.')
+@click.option('--desde-cero', is_flag=True, help='Abandona el trabajo pendiente y empieza uno nuevo.')
+@click.option('--lote', default=RECLASIFICACION_LOTE_FILAS, show_default=True, help='Observaciones por lote.')
+@click.option('--pausa', default=0.0, show_default=True, help='Segundos de espera entre lotes para no cargar la base.')
+def reclasificar(simular, solo_zonas, desde_cero, lote, pausa):
+    """
+    Reclasifica todas las observaciones (estatus y zonas) con las geometrías y reglas actuales. Un trabajo
+    interrumpido se reanuda desde su último lote si las zonas no cambiaron. Reinicie la aplicación después
+    de cambiar ZONAS_DIR para que las observaciones nuevas se clasifiquen igual.
+    """
+    conn = conectar_db()
+    if not conn:
+        print("No se pudo conectar a la base de datos.")
+        return
+    cursor = conn.cursor()
+    inicio = time.perf_counter()
+    trabajo_id, ultimo_id, revisadas, omitidas, por_revisar = None, 0, 0, 0, 0
+    ids_por_revisar = []
+    transiciones, entradas, salidas = Counter(), Counter(), Counter()
+    candado = False
+    try:
+        if not simular:
+            cursor.execute("SELECT pg_try_advisory_lock(%s);", (_CANDADO_RECLASIFICACION,))
+            candado = cursor.fetchone()[0]
+            if not candado:
+                print("Otra reclasificación está en curso.")
+                return
+            cursor.execute("""
+                SELECT id, firma_zonas, solo_zonas, ultimo_id, revisadas, omitidas, por_revisar FROM reclasificaciones
+                WHERE terminada IS NULL AND NOT abandonada ORDER BY id DESC LIMIT 1;
+            """)
+            pendiente = cursor.fetchone()
+            if pendiente and not desde_cero and pendiente[1] == registro_zonas.firma and pendiente[2] == solo_zonas:
+                trabajo_id, _, _, ultimo_id, revisadas, omitidas, por_revisar = pendiente
+                print(f"Reanudando la reclasificación {trabajo_id} desde el id {ultimo_id} ({revisadas} ya revisadas).")
+            else:
+                if pendiente:
+                    cursor.execute("UPDATE reclasificaciones SET abandonada = TRUE WHERE id = %s;", (pendiente[0],))
+                    print(f"La reclasificación {pendiente[0]} quedó abandonada (se pidió empezar de cero o cambiaron las zonas).")
+                cursor.execute("INSERT INTO reclasificaciones (firma_zonas, solo_zonas) VALUES (%s, %s) RETURNING id;",
+                               (registro_zonas.firma, solo_zonas))
+                trabajo_id = cursor.fetchone()[0]
+            conn.commit()
+
+        intentos = 0
+        while True:
+            try:
+                cursor.execute("SET LOCAL lock_timeout = %s;", (f"{RECLASIFICACION_LOCK_TIMEOUT_MS}ms",))
+                cursor.execute("SELECT * FROM observaciones_embarcaciones WHERE id > %s ORDER BY id LIMIT %s;", (ultimo_id, lote))
+                filas = _fetch_as_dict(cursor)
+                if not filas:
+                    conn.rollback()
+                    break
+                cambios, revisar = _clasificar_lote_reclasificacion(filas, solo_zonas)
+                if simular:
+                    escritas = cambios
+                    conn.rollback()
+                else:
+                    escritas = _escribir_lote_reclasificacion(cursor, trabajo_id, cambios)
+                    cursor.execute("""
+                        UPDATE reclasificaciones SET ultimo_id = %s, revisadas = revisadas + %s,
+                               omitidas = omitidas + %s, por_revisar = por_revisar + %s
+                        WHERE id = %s;
+                    """, (filas[-1]['id'], len(filas), len(cambios) - len(escritas), len(revisar), trabajo_id))
+                    conn.commit()
+            except psycopg2.errors.LockNotAvailable:
+                # Filas bloqueadas por una edición en curso: se reintenta el lote completo
+                conn.rollback()
+                intentos += 1
+                if intentos > 5:
+                    print(f"Lote desde el id {ultimo_id} bloqueado repetidamente; vuelva a ejecutar el comando para reanudar.")
+                    return
+                time.sleep(intentos)
+                continue
+            intentos = 0
+            if escritas and not simular:
+                _notificar_escritura([fila for fila, _, _ in escritas]
+                                     + [dict(fila, estatus_categoria_id=estatus, zonas=zonas) for fila, estatus, zonas in escritas])
+            if simular:
+                for fila, estatus, zonas in escritas:
+                    if estatus != fila['estatus_categoria_id']:
+                        transiciones[(fila['estatus_categoria_id'], estatus)] += 1
+                    anteriores = set(fila['zonas'] or [])
+                    entradas.update(set(zonas) - anteriores)
+                    salidas.update(anteriores - set(zonas))
+            ultimo_id = filas[-1]['id']
+            revisadas += len(filas)
+            omitidas += len(cambios) - len(escritas)
+            por_revisar += len(revisar)
+            ids_por_revisar.extend(revisar[:20 - len(ids_por_revisar)])
+            if pausa:
+                time.sleep(pausa)
+
+        if not simular:
+            cursor.execute("UPDATE reclasificaciones SET terminada = now() WHERE id = %s;", (trabajo_id,))
+            transiciones, entradas, salidas = _resumen_reclasificacion(cursor, trabajo_id)
+            conn.commit()
+        print(f"Reclasificación {'simulada' if simular else trabajo_id} terminada en {time.perf_counter() - inicio:.1f} s.")
+        _imprimir_resumen_reclasificacion(revisadas, omitidas, por_revisar, transiciones, entradas, salidas, ids_por_revisar)
+    except psycopg2.Error as e:
+        conn.rollback()
+        print(f"Error al reclasificar (revisadas hasta el id {ultimo_id}; vuelva a ejecutar para reanudar): {e}")
+    finally:
+        if candado:
+            cursor.execute("SELECT pg_advisory_unlock(%s);", (_CANDADO_RECLASIFICACION,))
+            conn.commit()
+        cursor.close()
+        conn.close()
+
+@app.cli.command('detectar-encuentros')
+@click.option('--desde-cero', is_flag=True, help='Recalcula todos los encuentros en lugar de solo los cambios.')
+def detectar_encuentros(desde_cero):
+    """
+    Pone al día la tabla de encuentros entre embarcaciones (lo hace también la aplicación en segundo
+    plano); con --desde-cero la recalcula entera, p. ej. tras cambiar ENCUENTROS_DISTANCIA_M o ENCUENTROS_MINUTOS.
+    """
+    inicio = time.perf_counter()
+    resultado = actualizar_encuentros(completo=desde_cero)
+    if resultado is None:
+        print("No se pudieron actualizar los encuentros (base de datos no disponible u otro proceso actualizándolos).")
+        return
+    comparadas, insertados = resultado
+    print(f"{insertados} encuentros nuevos entre {comparadas} observaciones comparadas en {time.perf_counter() - inicio:.1f} s.")
+
+@app.cli.command('auditar-duplicados')
+@click.option('--csv', 'ruta_csv', default=None, help='Escribe los pares encontrados en este archivo CSV.')
+@click.option('--mostrar', default=20, show_default=True, help='Cuántos pares se muestran en pantalla.')
+def auditar_duplicados(ruta_csv, mostrar):
+    """
+    Busca en toda la tabla pares de observaciones que parecen el mismo avistamiento (matrícula igual o a una
+    edición, a menos de DUPLICADOS_DISTANCIA_M metros y DUPLICADOS_MINUTOS minutos). Solo informa; no borra nada.
+    """
+    conn = conectar_db_lectura()
+    if not conn:
+        print("No se pudo conectar a la base de datos.")
+        return
+    try:
+        inicio = time.perf_counter()
+        cursor_servidor = conn.cursor(name='auditoria_duplicados')
+        cursor_servidor.itersize = DELTA_LOTE_FILAS
+        cursor_servidor.execute("""
+            SELECT id, matricula, timestamp, longitud_wgs84, latitud_wgs84 FROM observaciones_embarcaciones
+            WHERE timestamp IS NOT NULL AND longitud_wgs84 IS NOT NULL AND latitud_wgs84 IS NOT NULL
+            ORDER BY timestamp;
+        """)
+        # Por bloques de tiempo (ver _bloques_por_tiempo): en memoria solo quedan los pares encontrados
+        pares, total = [], 0
+        for filas, n_contexto in _bloques_por_tiempo(cursor_servidor, DUPLICADOS_MINUTOS):
+            pares.extend((filas[a], filas[b], metros, minutos) for a, b, metros, minutos in _pares_duplicados(filas)
+                         if b >= n_contexto) # Los pares entre filas de contexto ya salieron en el bloque anterior
+            total += len(filas) - n_contexto
+        cursor_servidor.close()
+        conn.commit()
+    except psycopg2.Error as e:
+        print(f"Error al leer las observaciones: {e}")
+        return
+    finally:
+        conn.close()
+    pares.sort(key=lambda par: par[0][2], reverse=True)
+    exactos = sum(1 for a, b, _, _ in pares if _normalizar_matricula(a[1]) == _normalizar_matricula(b[1]))
+    print(f"{len(pares)} posibles duplicados entre {total} observaciones ({exactos} con la misma matrícula, "
+          f"{len(pares) - exactos} con matrícula parecida) en {time.perf_counter() - inicio:.1f} s "
+          f"(umbral {DUPLICADOS_DISTANCIA_M:g} m / {DUPLICADOS_MINUTOS:g} min).")
+    for a, b, metros, minutos in pares[:mostrar]:
+        print(f"  {a[0]} ({a[1]}, {a[2]:%Y-%m-%d %H:%M}) ~ {b[0]} ({b[1]}, "
+              f"{b[2]:%Y-%m-%d %H:%M}): {metros} m, {minutos} min")
+    if ruta_csv:
+        with open(ruta_csv, 'w', newline='', encoding='utf-8') as archivo:
+            escritor = csv.writer(archivo)
+            escritor.writerow(['id_a', 'matricula_a', 'timestamp_a', 'id_b', 'matricula_b', 'timestamp_b', 'distancia_m', 'minutos'])
+            for a, b, metros, minutos in pares:
+                escritor.writerow([*a[:3], *b[:3], metros, minutos])
+        print(f"Pares escritos en '{ruta_csv}'.")
+
+@app.cli.command('reconstruir-trayectos')
+def reconstruir_trayectos():
+    """
+    Recalcula los saltos implausibles de los trayectos de todas las embarcaciones (la aplicación los mantiene
+    al escribir), p. ej. tras cambiar TRAYECTOS_VELOCIDAD_MAXIMA_NUDOS.
+    """
+    conn = conectar_db()
+    if not conn:
+        print("No se pudo conectar a la base de datos.")
+        return
+    cursor = conn.cursor()
+    try:
+        inicio = time.perf_counter()
+        saltos = _recalcular_saltos_trayecto(cursor)
+        conn.commit()
+        print(f"{saltos} saltos implausibles en los trayectos, calculados en {time.perf_counter() - inicio:.1f} s "
+              f"({_umbrales_trayectos()}).")
+    except psycopg2.Error as e:
+        conn.rollback()
+        print(f"Error al reconstruir los trayectos: {e}")
+    finally:
+        cursor.close()
+        conn.close()
+
+@app.cli.command('estado-replica')
+def estado_replica_cli():
+    """Muestra a dónde se dirigen las lecturas de reportes y el retraso actual de la réplica."""
+    if not DATABASE_REPLICA_URL:
+        print("DATABASE_REPLICA_URL no está configurada: todas las lecturas van a la primaria.")
+        return
+    conn = _conectar_pool('replica', interruptor_replica)
+    if not conn:
+        print("La réplica no responde: las lecturas de reportes irán a la primaria.")
+        return
+    try:
+        retraso = _consultar_retraso_replica(conn)
+        with psycopg2.extensions.cursor(conn) as cursor:
+            cursor.execute("SELECT pg_is_in_recovery();")
+            en_recuperacion = cursor.fetchone()[0]
+        conn.rollback()
+    except psycopg2.Error as e:
+        print(f"Error al consultar la réplica: {e}")
+        return
+    finally:
+        conn.close()
+    if not en_recuperacion:
+        print("ADVERTENCIA: La réplica no está en recuperación (¿instancia independiente?); su retraso se toma como 0.")
+    destino = 'réplica' if retraso <= REPLICA_MAX_RETRASO_SEGUNDOS else 'primaria'
+    print(f"Retraso de la réplica: {retraso:.1f} s (máximo {REPLICA_MAX_RETRASO_SEGUNDOS:.0f} s). "
+          f"Las lecturas de reportes van a la {destino}.")
+
+
+# Asegurarse de que DB se inicializa y la columna 'nombre_patron' existe al inicio. Va al final del módulo:
+# la inicialización recalcula tablas derivadas (resumen, riesgo, patrones, trayectos) y necesita todas las
+# constantes y funciones definidas arriba.
+with app.app_context():
+    inicializar_db()
 
 if __name__ == '__main__':
     try:
@@ -0,0 +1,118 @@
+// Mapa interactivo (Leaflet) para el historial y los resúmenes.
+// Pide a /api/mapa_observaciones solo lo que está en la vista, con el zoom actual: a poco zoom el servidor
+// devuelve celdas agregadas (círculo proporcional al conteo) y al acercarse, las observaciones individuales.
+// Las geometrías del ANP se piden una sola vez (el navegador las guarda en caché). Si se indica
+// urlEncuentros, los encuentros entre embarcaciones de la vista se dibujan como líneas entre ambas observaciones.
+// Si se indica urlTrayecto, se dibuja una sola vez el trayecto de la embarcación, con los saltos implausibles en rojo.
+window.iniciarMapaInteractivo = function(idContenedor, urlObservaciones, urlAnp, filtros, urlEncuentros, urlTrayecto) {
+    const contenedor = document.getElementById(idContenedor);
+    if (!contenedor || typeof L === 'undefined') return null;
+
+    const mapa = L.map(contenedor).setView([21.6, -106.55], 10);
+    L.tileLayer('https://server.arcgisonline.com/ArcGIS/rest/services/World_Imagery/MapServer/tile/{z}/{y}/{x}', {
+        maxZoom: 18,
+        attribution: 'Tiles &copy; Esri'
+    }).addTo(mapa);
+
+    fetch(urlAnp, { credentials: 'same-origin' })
+        .then(respuesta => respuesta.ok ? respuesta.json() : null)
+        .then(datos => {
+            if (!datos) return;
+            L.geoJSON(datos, {
+                style: { color: '#ff0000', weight: 2, fillOpacity: 0.05 },
+                pointToLayer: (feature, latlng) => L.circleMarker(latlng, { radius: 3, color: '#ffffff', weight: 1 })
+            }).bindTooltip(capa => capa.feature.properties.nombre).addTo(mapa);
+        });
+
+    // El trayecto va debajo de los marcadores para no tapar sus ventanas emergentes
+    const capaTrayecto = L.layerGroup().addTo(mapa);
+    const capaObservaciones = L.layerGroup().addTo(mapa);
+    const capaEncuentros = L.layerGroup().addTo(mapa);
+    let peticionActual = null;
+
+    function escapar(texto) {
+        const div = document.createElement('div');
+        div.textContent = texto == null ? '' : String(texto);
+        return div.innerHTML;
+    }
+
+    function marcador(feature, latlng) {
+        const p = feature.properties;
+        if (p.conteo !== undefined) {
+            // Celda agregada: radio proporcional al logaritmo del conteo
+            return L.circleMarker(latlng, {
+                radius: 6 + 4 * Math.log10(p.conteo), color: p.color, fillColor: p.color, fillOpacity: 0.6, weight: 1
+            }).bindPopup(`<strong>${p.conteo}</strong> observaciones<br>Estatus más frecuente: ${escapar(p.estatus_desc)}`);
+        }
+        return L.circleMarker(latlng, { radius: 5, color: '#000000', fillColor: p.color, fillOpacity: 0.9, weight: 1 })
+            .bindPopup(`<strong>${escapar(p.matricula)}</strong><br>${escapar(p.timestamp)}<br>` +
+                       `Patrón: ${escapar(p.nombre_patron || 'N/A')}<br>${escapar(p.estatus_desc)}`);
+    }
+
+    function lineaEncuentro(feature, capa) {
+        const p = feature.properties;
+        capa.bindPopup(`<strong>Encuentro</strong><br>${escapar(p.matricula_a)} &ndash; ${escapar(p.matricula_b)}<br>` +
+                       `${escapar(p.timestamp)}<br>${Math.round(p.distancia_m)} m, ${p.minutos} min`);
+    }
+
+    function tramoTrayecto(feature) {
+        return feature.properties.tipo === 'salto'
+            ? { color: '#ff3030', weight: 3, dashArray: '2 6' }
+            : { color: '#ffffff', weight: 2, opacity: 0.7 };
+    }
+
+    function saltoTrayecto(feature, capa) {
+        const p = feature.properties;
+        if (p.tipo !== 'salto') return;
+        const velocidad = p.velocidad_nudos === null ? 'mismo instante' : `${p.velocidad_nudos} nudos`;
+        capa.bindPopup(`<strong>Salto implausible</strong><br>${escapar(p.timestamp_origen)} &rarr; ${escapar(p.timestamp_destino)}<br>` +
+                       `${p.distancia_km} km en ${p.horas} h (${velocidad})` +
+                       (p.observacion_sospechosa ? `<br>Observación sospechosa: ${p.observacion_sospechosa}` : ''));
+    }
+
+    if (urlTrayecto) {
+        fetch(urlTrayecto, { credentials: 'same-origin' })
+            .then(respuesta => respuesta.ok ? respuesta.json() : null)
+            .then(datos => {
+                if (!datos) return;
+                L.geoJSON(datos, { style: tramoTrayecto, onEachFeature: saltoTrayecto }).addTo(capaTrayecto);
+            })
+            .catch(error => console.error('Error al cargar el trayecto:', error));
+    }
+
+    function actualizar() {
+        const limites = mapa.getBounds();
+        const parametros = new URLSearchParams(filtros || {});
+        parametros.set('bbox', [limites.getWest(), limites.getSouth(), limites.getEast(), limites.getNorth()]
+            .map(v => Math.min(Math.max(v, -180), 180).toFixed(5)).join(','));
+        parametros.set('zoom', mapa.getZoom());
+        // Si el usuario sigue moviendo el mapa, se cancela la petición anterior
+        if (peticionActual) peticionActual.abort();
+        peticionActual = new AbortController();
+        fetch(`${urlObservaciones}?${parametros}`, { credentials: 'same-origin', signal: peticionActual.signal })
+            .then(respuesta => respuesta.ok ? respuesta.json() : null)
+            .then(datos => {
+                if (!datos) return;
+                capaObservaciones.clearLayers();
+                L.geoJSON(datos, { pointToLayer: marcador }).addTo(capaObservaciones);
+            })
+            .catch(error => { if (error.name !== 'AbortError') console.error('Error al cargar el mapa:', error); });
+        if (urlEncuentros) {
+            fetch(`${urlEncuentros}?${parametros}`, { credentials: 'same-origin', signal: peticionActual.signal })
+                .then(respuesta => respuesta.ok ? respuesta.json() : null)
+                .then(datos => {
+                    if (!datos) return;
+                    capaEncuentros.clearLayers();
+                    L.geoJSON(datos, {
+                        style: { color: '#ff00ff', weight: 3, dashArray: '6 4' },
+                        onEachFeature: lineaEncuentro
+                    }).addTo(capaEncuentros);
+                })
+                .catch(error => { if (error.name !== 'AbortError') console.error('Error al cargar los encuentros:', error); });
+        }
+    }
+
+    mapa.on('moveend', actualizar);
+    actualizar();
+    return mapa;
+};
@@ -0,0 +1,315 @@
+"""Comprobaciones deterministas de los núcleos vectorizados de app.py, llamados directamente."""
+import datetime
+import math
+
+import numpy as np
+
+def _pares_fuerza_bruta(app, segundos, lon, lat, distancia_m, ventana_segundos):
+    pares = set()
+    for i in range(len(segundos)):
+        for j in range(i + 1, len(segundos)):
+            if abs(segundos[i] - segundos[j]) <= ventana_segundos and \
+                    app._distancia_km(lon[i], lat[i], lon[j], lat[j]) * 1000 <= distancia_m:
+                pares.add((i, j))
+    return pares
+
+def _pares(app, segundos, lon, lat, distancia_m, ventana_segundos):
+    i, j, metros = app._pares_cercanos(np.asarray(segundos, dtype=float), np.asarray(lon, dtype=float),
+                                       np.asarray(lat, dtype=float), distancia_m, ventana_segundos)
+    assert np.all(metros <= distancia_m)
+    return set(zip(i.tolist(), j.tolist()))
+
+# --- _pares_cercanos (encuentros y duplicados) ---
+
+def test_pares_cercanos_sin_puntos_suficientes(app_modulo):
+    i, j, metros = app_modulo._pares_cercanos(np.array([0.0]), np.array([-106.5]), np.array([21.5]), 500, 1800)
+    assert len(i) == len(j) == len(metros) == 0
+
+def test_pares_cercanos_igual_a_fuerza_bruta(app_modulo):
+    rng = np.random.default_rng(7)
+    n = 400
+    # Dos grupos muy separados en longitud para que la rejilla tenga muchas columnas vacías entre ellos
+    lon = np.where(rng.random(n) < 0.5, -110.0, -100.0) + rng.uniform(0, 0.03, n)
+    lat = 21.5 + rng.uniform(0, 0.03, n)
+    segundos = rng.uniform(0, 6 * 3600, n)
+    assert _pares(app_modulo, segundos, lon, lat, 500, 1800) == \
+        _pares_fuerza_bruta(app_modulo, segundos, lon, lat, 500, 1800)
+
+def test_pares_cercanos_cruzan_bordes_de_celda(app_modulo):
+    # Pares a ambos lados de un borde de celda en cada eje (t, y, x) y en diagonal
+    distancia_m, ventana = 500, 1800
+    paso_lat = distancia_m / (app_modulo.KM_POR_GRADO * 1000)
+    lat0 = math.floor(21.5 / paso_lat) * paso_lat # borde exacto de una fila de celdas
+    t0 = 100 * ventana # borde exacto de una celda de tiempo
+    segundos = [t0 - 5, t0 + 5, t0 - 5, t0 + 5]
+    lat = [lat0 - paso_lat * 0.1, lat0 + paso_lat * 0.1, lat0 + 0.5, lat0 + 0.5 + paso_lat * 0.2]
+    lon = [-106.5, -106.5, -106.4, -106.4]
+    assert _pares(app_modulo, segundos, lon, lat, distancia_m, ventana) == {(0, 1), (2, 3)}
+
+def test_pares_cercanos_respeta_umbrales(app_modulo):
+    metros_por_grado = app_modulo.KM_POR_GRADO * 1000
+    # Mismo lugar pero fuera de la ventana de tiempo; y a tiempo pero a 600 m
+    segundos = [0, 1801, 5000, 5000]
+    lat = [21.5, 21.5, 22.0, 22.0 + 600 / metros_por_grado]
+    lon = [-106.5, -106.5, -106.5, -106.5]
+    assert _pares(app_modulo, segundos, lon, lat, 500, 1800) == set()
+
+# --- _bloques_por_tiempo (recálculo completo de encuentros y auditoría de duplicados) ---
+
+class _CursorServidor:
+    def __init__(self, filas):
+        self.filas, self.posicion = filas, 0
+
+    def fetchmany(self, tamano):
+        bloque = self.filas[self.posicion:self.posicion + tamano]
+        self.posicion += tamano
+        return bloque
+
+def _filas_ordenadas(n, semilla):
+    rng = np.random.default_rng(semilla)
+    inicio = datetime.datetime(2024, 1, 1)
+    minutos = np.sort(rng.uniform(0, 60 * 24 * 3, n))
+    return [(k + 1, f"M{k % 50}", inicio + datetime.timedelta(minutes=float(m)),
+             -106.5 + float(rng.uniform(0, 0.02)), 21.5 + float(rng.uniform(0, 0.02))) for k, m in enumerate(minutos)]
+
+def test_bloques_por_tiempo_recorre_cada_fila_una_vez(app_modulo, monkeypatch):
+    monkeypatch.setattr(app_modulo, 'DELTA_LOTE_FILAS', 37)
+    filas = _filas_ordenadas(500, 1)
+    propias = []
+    for bloque, n_contexto in app_modulo._bloques_por_tiempo(_CursorServidor(filas), 30):
+        # El contexto son exactamente las filas ya vistas a no más de 30 minutos de la última
+        limite = propias[-1][2] - datetime.timedelta(minutes=30) if propias else None
+        assert bloque[:n_contexto] == [f for f in propias if limite is not None and f[2] >= limite]
+        propias.extend(bloque[n_contexto:])
+    assert propias == filas
+
+def test_bloques_por_tiempo_encuentran_pares_que_cruzan_el_corte(app_modulo, monkeypatch):
+    monkeypatch.setattr(app_modulo, 'DELTA_LOTE_FILAS', 25)
+    filas = _filas_ordenadas(600, 2)
+
+    def pares(lista):
+        segundos = np.array([f[2].timestamp() for f in lista])
+        i, j, _ = app_modulo._pares_cercanos(segundos, np.array([f[3] for f in lista]),
+                                             np.array([f[4] for f in lista]), 500, 30 * 60)
+        return [(lista[a][0], lista[b][0], b) for a, b in zip(i.tolist(), j.tolist())]
+
+    esperados = {(a, b) for a, b, _ in pares(filas)}
+    encontrados = []
+    for bloque, n_contexto in app_modulo._bloques_por_tiempo(_CursorServidor(filas), 30):
+        # Igual que los llamadores: se omiten los pares entre filas de contexto
+        encontrados.extend((a, b) for a, b, indice_b in pares(bloque) if indice_b >= n_contexto)
+    assert len(encontrados) == len(set(encontrados))
+    assert set(encontrados) == esperados
+    assert any(a <= 25 * k < b for k in range(1, 24) for a, b in esperados) # hay pares que cruzan un corte
+
+# --- _tramos_trayectos (saltos de posición implausibles) ---
+
+def _tramos(app, puntos):
+    """puntos: (grupo, id, minutos, lat) con longitud fija; devuelve los tramos como pares de ids."""
+    grupos = np.array([p[0] for p in puntos], dtype=np.int64)
+    ids = np.array([p[1] for p in puntos], dtype=np.int64)
+    segundos = np.array([p[2] * 60.0 for p in puntos])
+    lat = np.array([p[3] for p in puntos], dtype=float)
+    lon = np.full(len(puntos), -106.5)
+    origen, destino, km, horas, nudos, implausible, sospechosa = app._tramos_trayectos(grupos, segundos, ids, lon, lat)
+    tramos = list(zip(ids[origen].tolist(), ids[destino].tolist()))
+    return tramos, nudos, {t for t, m in zip(tramos, implausible) if m}, set(ids[sospechosa].tolist())
+
+def test_tramos_por_embarcacion_y_en_orden_de_tiempo(app_modulo):
+    # Filas desordenadas e intercaladas; a igual instante se ordena por id
+    puntos = [(2, 21, 30, 21.50), (1, 12, 60, 21.51), (2, 20, 0, 21.50), (1, 11, 0, 21.50), (1, 10, 0, 21.50)]
+    tramos, nudos, implausibles, sospechosas = _tramos(app_modulo, puntos)
+    assert tramos == [(10, 11), (11, 12), (20, 21)]
+    assert math.isnan(nudos[0]) and not math.isnan(nudos[1])
+    assert implausibles == set() and sospechosas == set()
+
+def test_pico_de_ida_y_vuelta_marca_la_observacion_del_medio(app_modulo):
+    # 1° de latitud (~111 km) en 5 minutos y de vuelta: la observación 2 está mal capturada
+    tramos, _, implausibles, sospechosas = _tramos(app_modulo, [(1, 1, 0, 21.5), (1, 2, 5, 22.5), (1, 3, 10, 21.5)])
+    assert implausibles == {(1, 2), (2, 3)}
+    assert sospechosas == {2}
+
+def test_salto_sin_regreso_no_tiene_sospechosa(app_modulo):
+    # Un solo salto imposible: no se sabe cuál de las dos observaciones está mal
+    _, _, implausibles, sospechosas = _tramos(app_modulo, [(1, 1, 0, 21.5), (1, 2, 5, 22.5), (1, 3, 65, 22.55)])
+    assert implausibles == {(1, 2)}
+    assert sospechosas == set()
+
+def test_dos_saltos_en_la_misma_direccion_no_tienen_sospechosa(app_modulo):
+    # El tramo directo 1→3 también es imposible: no es un pico de ida y vuelta
+    _, _, implausibles, sospechosas = _tramos(app_modulo, [(1, 1, 0, 21.5), (1, 2, 5, 22.5), (1, 3, 10, 23.5)])
+    assert implausibles == {(1, 2), (2, 3)}
+    assert sospechosas == set()
+
+def test_picos_no_cruzan_embarcaciones(app_modulo):
+    # Cada embarcación tiene un solo salto; juntas formarían un falso pico en la observación 2
+    puntos = [(1, 1, 0, 21.5), (1, 2, 5, 22.5), (2, 3, 10, 22.5), (2, 4, 15, 21.5)]
+    _, _, implausibles, sospechosas = _tramos(app_modulo, puntos)
+    assert implausibles == {(1, 2), (3, 4)}
+    assert sospechosas == set()
+
+def test_umbrales_de_velocidad_y_distancia_minima(app_modulo):
+    limite_km = app_modulo.TRAYECTOS_VELOCIDAD_MAXIMA_NUDOS * app_modulo.KM_POR_MILLA_NAUTICA * (1 + app_modulo.TRAYECTOS_TOLERANCIA_MINUTOS / 60)
+    grados = limite_km / app_modulo.KM_POR_GRADO
+    puntos = [
+        (1, 1, 0, 21.5), (1, 2, 60, 21.5 + grados * 0.99), # justo por debajo del límite en una hora
+        (2, 3, 0, 21.5), (2, 4, 60, 21.5 + grados * 1.01), # justo por encima
+        (3, 5, 0, 21.5), (3, 6, 0, 21.5 + 0.5 / app_modulo.KM_POR_GRADO), # 500 m en el mismo instante
+    ]
+    _, _, implausibles, _ = _tramos(app_modulo, puntos)
+    assert implausibles == {(3, 4)}
+
+# --- Posibles duplicados ---
+
+def test_normalizar_matricula(app_modulo):
+    assert app_modulo._normalizar_matricula(' pna-1234 ') == 'PNA1234'
+    # O/0 e I/1 se confunden al leer y capturar
+    assert app_modulo._normalizar_matricula('BCO-IO') == app_modulo._normalizar_matricula('BC0 10')
+    assert app_modulo._normalizar_matricula(None) == ''
+
+def test_matriculas_similares_ediciones(app_modulo):
+    similares = app_modulo._matriculas_similares
+    assert similares('PNA1234', 'PNA1234')
+    assert similares('PNA1234', 'PNA1284') # sustitución
+    assert similares('PNA1234', 'PNA1243') # transposición de vecinas
+    assert similares('PNA1234', 'PAN1234')
+    assert similares('PNA1234', 'PNA12345') and similares('PNA12345', 'PNA1234') # inserción al final
+    assert similares('PNA1234', 'XPNA1234') # al inicio
+    assert similares('PNA1234', 'PNA11234') # en medio
+
+def test_matriculas_similares_rechaza_mas_de_una_edicion(app_modulo):
+    similares = app_modulo._matriculas_similares
+    assert not similares('PNA1234', 'PNA1432') # intercambio de no vecinas
+    assert not similares('PNA1234', 'PNB1284') # dos sustituciones
+    assert not similares('PNA1234', 'PNA123456') # dos inserciones
+    assert not similares('PNA1234', 'NA12345') # borrado más inserción
+    assert not similares('PNA1234', 'PNA1243X')
+
+def test_matriculas_cortas_solo_coinciden_exactas(app_modulo):
+    similares = app_modulo._matriculas_similares
+    corta = 'A' * (app_modulo.DUPLICADOS_LONGITUD_MINIMA - 1)
+    assert similares(corta, corta)
+    assert not similares(corta, corta[:-1] + 'B')
+    assert not similares(corta, corta + 'B')
+
+def test_pares_duplicados(app_modulo):
+    t = datetime.datetime(2024, 3, 1, 10, 0)
+    metros = 1 / (app_modulo.KM_POR_GRADO * 1000) # grados de latitud por metro
+    filas = [
+        (1, 'PNA-1234', t, -106.5, 21.5),
+        (2, 'pna1243', t + datetime.timedelta(minutes=4), -106.5, 21.5 + 100 * metros), # transpuesta, 100 m
+        (3, 'PNA1234', t + datetime.timedelta(minutes=30), -106.5, 21.5), # fuera de la ventana
+        (4, 'ZZZ9999', t, -106.5, 21.5), # otra embarcación en el mismo lugar
+        (5, 'PNA1234', t, -106.5, 21.5 + 400 * metros), # demasiado lejos
+    ]
+    pares = app_modulo._pares_duplicados(filas)
+    assert [(a, b) for a, b, _, _ in pares] == [(0, 1)]
+    assert pares[0][2] == 100.0 and pares[0][3] == 4.0
+
+def test_duplicados_de_lote_contra_base_y_archivo(app_modulo):
+    t = datetime.datetime(2024, 3, 1, 10, 0)
+    existentes = [(77, 'PNA1234', t, -106.5, 21.5), (78, 'PNA1234', t + datetime.timedelta(minutes=1), -106.5, 21.5)]
+
+    class Cursor:
+        def execute(self, sql, params=None):
+            pass
+
+        def fetchall(self):
+            return list(existentes)
+
+    nuevas = [
+        (None, 'QRS5678', t + datetime.timedelta(hours=2), -106.5, 21.5),
+        (None, 'PNA1234', t + datetime.timedelta(minutes=3), -106.5, 21.5),
+        (None, 'QRS5687', t + datetime.timedelta(hours=2, minutes=2), -106.5, 21.5),
+    ]
+    duplicados = app_modulo._duplicados_de_lote(Cursor(), nuevas)
+    # El par entre las dos ya guardadas (77, 78) no se informa: es cosa de la auditoría
+    assert sorted(duplicados) == [1, 2]
+    assert sorted(otra[0] for otra, _, _ in duplicados[1]) == [77, 78]
+    assert [otra for otra, _, _ in duplicados[2]] == [0] # índice de la fila nueva anterior
+
+# --- Validación del CSV de observaciones ---
+
+ENCABEZADO_CSV = "matricula,timestamp,latitud_wgs84,longitud_wgs84,estatus_categoria_id,nombre_patron\n"
+DENTRO_ANP = "21.6,-106.55"
+FUERA_ANP = "21.5,-105.0"
+
+def _motivos(problemas):
+    return {fila: motivo for fila, _, motivo in problemas}
+
+def test_csv_vacio(app_modulo):
+    assert app_modulo.validar_csv_observaciones("") == ([], [], 0)
+    assert app_modulo.validar_csv_observaciones(ENCABEZADO_CSV) == ([], [], 0)
+
+def test_csv_sin_coordenadas_se_rechaza(app_modulo):
+    validas, problemas, _ = app_modulo.validar_csv_observaciones(
+        "matricula,timestamp,latitud_wgs84,longitud_wgs84,estatus_categoria_id\nABC123,2024-05-01 10:00,,,\n")
+    assert validas == []
+    assert problemas == [(1, 'ABC123', "faltan las coordenadas")]
+
+def test_csv_motivos_de_rechazo_y_numeracion(app_modulo):
+    texto = ENCABEZADO_CSV + (
+        f",2024-05-01 10:00,{FUERA_ANP},outside_anp,\n"      # 1
+        f"B1,ayer,{FUERA_ANP},outside_anp,\n"                # 2
+        "\n"                                                 # las líneas en blanco no cuentan
+        "B2,2024-05-01 10:00,norte,-105.0,outside_anp,\n"    # 3
+        "B3,2024-05-01 10:00,21.5,,outside_anp,\n"           # 4
+        "B4,2024-05-01 10:00,95,-105.0,outside_anp,\n"       # 5
+        f"B5,2024-05-01 10:00,{FUERA_ANP},inventado,\n"      # 6
+        f"b6,2024-05-01 10:00,{FUERA_ANP}\n"                 # 7: fila corta, se completa
+    )
+    validas, problemas, _ = app_modulo.validar_csv_observaciones(texto)
+    motivos = _motivos(problemas)
+    assert motivos[1] == "matrícula vacía"
+    assert motivos[2] == "timestamp no reconocido ('ayer')"
+    assert motivos[3] == "latitud no numérica ('norte')"
+    assert motivos[4] == "falta la latitud o la longitud"
+    assert motivos[5] == "coordenada fuera de rango"
+    assert motivos[6] == "estatus desconocido ('inventado')"
+    assert [(fila, valores[0]) for fila, valores in validas] == [(7, 'B6')]
+
+def test_csv_valores_de_filas_validas(app_modulo):
+    texto = ENCABEZADO_CSV + f" abc-1 ,2024-05-01T10:00:00-06:00,{FUERA_ANP},outside_anp,Juan\n"
+    (fila, valores), = app_modulo.validar_csv_observaciones(texto)[0]
+    matricula, _, marca, lat, lon, _, estatus, _, patron, zonas = valores
+    assert (fila, matricula, lat, lon, estatus, patron) == (1, 'ABC-1', 21.5, -105.0, 'outside_anp', 'Juan')
+    assert marca == datetime.datetime(2024, 5, 1, 16, 0) # con zona horaria se guarda en UTC
+    assert zonas == []
+
+def test_csv_un_timestamp_malo_no_afecta_al_resto_del_bloque(app_modulo):
+    # La conversión por bloque cae a la bisección cuando hay un valor irreconocible
+    lineas = [f"M{k},2024-05-01 10:{k:02d},{FUERA_ANP},outside_anp," for k in range(40)]
+    lineas[17] = f"M17,2024-13-45 10:00,{FUERA_ANP},outside_anp,"
+    validas, problemas, _ = app_modulo.validar_csv_observaciones(ENCABEZADO_CSV + "\n".join(lineas) + "\n")
+    assert [fila for fila, _, _ in problemas] == [18]
+    assert [valores[2].minute for _, valores in validas] == [k for k in range(40) if k != 17]
+
+def test_csv_estatus_contradictorios(app_modulo):
+    texto = ENCABEZADO_CSV + (
+        f"C1,2024-05-01 10:00,{FUERA_ANP},paso_inocente,\n"  # estatus de dentro, punto fuera
+        f"C2,2024-05-01 10:00,{DENTRO_ANP},outside_anp,\n"   # 'outside_anp' dentro del polígono
+        f"C3,2024-05-01 10:00,{DENTRO_ANP},paso_inocente,\n" # coherente
+    )
+    validas, problemas, corregidas = app_modulo.validar_csv_observaciones(texto)
+    motivos = _motivos(problemas)
+    assert "de dentro del ANP pero el punto está fuera" in motivos[1]
+    assert "pero el punto está dentro de" in motivos[2]
+    assert corregidas == 0
+    (fila, valores), = validas
+    assert fila == 3 and 'anp' in valores[9]
+
+    # Con 'corregir' el primero toma el estatus de su posición; el segundo se rechaza siempre
+    validas, problemas, corregidas = app_modulo.validar_csv_observaciones(texto, corregir=True)
+    assert corregidas == 1
+    assert [fila for fila, _, _ in problemas] == [2]
+    assert {fila: valores[6] for fila, valores in validas}[1] == 'outside_anp'
+
+def test_csv_por_bloques_igual_que_en_uno(app_modulo, monkeypatch):
+    lineas = [f"D{k},2024-05-01 10:{k:02d},{DENTRO_ANP if k % 3 else FUERA_ANP},paso_inocente,"
+              for k in range(25)]
+    lineas[4] = "D4,2024-05-01 10:04,,,paso_inocente,"
+    texto = ENCABEZADO_CSV + "\n".join(lineas) + "\n"
+    en_uno = app_modulo.validar_csv_observaciones(texto, corregir=True)
+    monkeypatch.setattr(app_modulo, 'CSV_LOTE_FILAS', 4)
+    assert app_modulo.validar_csv_observaciones(texto, corregir=True) == en_uno
+    assert _motivos(en_uno[1]) == {5: "faltan las coordenadas"}
@@ -0,0 +1,17 @@
+"""La importación de app.py inicializa la base de datos con todas las constantes y funciones ya definidas."""
+
+def test_importacion_sin_errores_de_inicializacion(salida_inicio):
+    assert "Error al inicializar" not in salida_inicio
+
+def test_riesgo_calculado_en_base_vacia(salida_inicio):
+    # RIESGO_VERSION y PESOS_RIESGO se definen después de inicializar_db en el módulo
+    assert "Tabla 'riesgo_embarcaciones' calculada desde las observaciones." in salida_inicio
+    assert "Tablas de riesgo por embarcación inicializadas/verificadas" in salida_inicio
+
+def test_indice_patrones_sincronizado(salida_inicio):
+    # _sincronizar_patrones usa _normalizar_nombre y ESTATUS_INFRACCION, definidos más abajo en el módulo
+    assert "Índice de patrones verificado en PostgreSQL (0 patrones actualizados)." in salida_inicio
+
+def test_saltos_trayecto_reconstruidos(salida_inicio):
+    # _umbrales_trayectos y _recalcular_saltos_trayecto (con RADIO_TIERRA_KM) se definen más abajo
+    assert "Tabla 'saltos_trayecto' reconstruida desde las observaciones (0 saltos implausibles)." in salida_inicio